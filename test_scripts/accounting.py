@@ -0,0 +1,312 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Accounts for the resources used by the process tree of a test: its peak memory, CPU time, context switches, and the
+bytes it read and wrote.
+
+A test's command is run by this module as a script (see :func:`wrap_command`), which starts the command, waits for
+it with ``wait4`` to get the resource usage of the command and of the descendants it waited for, and writes that to a
+JSON file. Before reaping the command it reads ``/proc/<pid>/io``, which then includes the I/O of those descendants
+too. When the cgroup v2 memory controller is available, the command is run in a cgroup of its own, whose peak memory
+and CPU time include every process in the tree. Children forked from the zygote are accounted for by the zygote in the
+same way (see :func:`reap_child`). When none of these are available, the test runner falls back to sampling the
+memory of the test's processes (see :meth:`PypeItTest.sample_memory`).
+
+This only uses the standard library, as it's run as a script.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import resource
+import subprocess
+
+SCRIPT = os.path.abspath(__file__)
+""" str: This module's file, which is run to account for the resources used by a command."""
+
+
+class ResourceUsage(object):
+    """The resources used by the process tree of a test.
+
+    Attributes:
+        source (str):               Where the numbers came from: ``cgroup`` for a cgroup of the test's own, ``rusage``
+                                    for ``wait4``, or ``sampled`` for periodic samples of the test's processes.
+        peak_rss (int):             The peak memory in bytes. With a cgroup this is the peak memory charged to the
+                                    cgroup, which includes the page cache. With ``wait4`` it's the peak resident set
+                                    of the largest process.
+        user_cpu (float):           User CPU seconds.
+        system_cpu (float):         System CPU seconds.
+        voluntary_switches (int):   Voluntary context switches, from waiting for I/O or other processes.
+        involuntary_switches (int): Involuntary context switches, from being preempted by the scheduler.
+        read_bytes (int):           Bytes read by read system calls, including those served from the page cache.
+        write_bytes (int):          Bytes written by write system calls.
+
+    Any of the numbers can be None if its source isn't available.
+    """
+
+    FIELDS = ('source', 'peak_rss', 'user_cpu', 'system_cpu', 'voluntary_switches', 'involuntary_switches',
+              'read_bytes', 'write_bytes')
+    """ tuple: The names of the attributes, as used in the JSON representation."""
+
+    def __init__(self, source, peak_rss=None, user_cpu=None, system_cpu=None, voluntary_switches=None,
+                 involuntary_switches=None, read_bytes=None, write_bytes=None):
+        self.source = source
+        self.peak_rss = peak_rss
+        self.user_cpu = user_cpu
+        self.system_cpu = system_cpu
+        self.voluntary_switches = voluntary_switches
+        self.involuntary_switches = involuntary_switches
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    def to_dict(self):
+        """Return the usage as a dict that can be written as JSON."""
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, values):
+        """Create the usage from the dict returned by :meth:`to_dict`, or return None if values is None."""
+        if values is None:
+            return None
+        return cls(**{field: values.get(field) for field in cls.FIELDS})
+
+    @classmethod
+    def from_rusage(cls, rusage, io=(None, None)):
+        """Create the usage from the ``resource.struct_rusage`` returned by ``wait4``.
+
+        Args:
+            rusage (:obj:`resource.struct_rusage`): The resource usage of a child process.
+            io (tuple): The bytes read and written by the child, or None if they aren't known.
+        """
+        # ru_maxrss is in kilobytes, except on macOS
+        peak_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+        return cls('rusage', peak_rss=peak_rss, user_cpu=rusage.ru_utime, system_cpu=rusage.ru_stime,
+                   voluntary_switches=rusage.ru_nvcsw, involuntary_switches=rusage.ru_nivcsw,
+                   read_bytes=io[0], write_bytes=io[1])
+
+    @classmethod
+    def read(cls, file):
+        """Read the usage written by the accounting script for a command.
+
+        Args:
+            file (str): The JSON file written by the script.
+
+        Returns:
+            :obj:`ResourceUsage`: The usage, or None if the file couldn't be read, e.g. because the script was killed.
+        """
+        try:
+            with open(file, "r") as f:
+                return cls.from_dict(json.load(f)['usage'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+
+def wrap_command(command_line, usage_file, cgroup=None):
+    """Wrap a command line so that the resources used by the command are written to a file.
+
+    The wrapped command has the same exit code as the command, and forwards the signals used to stop it to the
+    command.
+
+    Args:
+        command_line (list of str): The command and its arguments.
+        usage_file (str): The JSON file to write the :obj:`ResourceUsage` of the command to.
+        cgroup (str): The cgroup v2 directory to create the command's cgroup in. By default the cgroup of the
+            accounting script is used.
+
+    Returns:
+        list of str: The wrapped command line.
+    """
+    config = {'usage_file': usage_file, 'cgroup': cgroup}
+    return [sys.executable, SCRIPT, json.dumps(config), '--'] + list(command_line)
+
+
+def read_proc_io(pid):
+    """Read the bytes read and written by a process, including the children it has waited for.
+
+    Args:
+        pid (int): The process id. This can be a zombie process that hasn't been reaped.
+
+    Returns:
+        tuple: The bytes read and written, or (None, None) if they aren't available.
+    """
+    try:
+        with open(f'/proc/{pid}/io', "r") as f:
+            values = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def reap_child(pid=-1, block=True):
+    """Wait for a child process to exit, and reap it.
+
+    The child's I/O is read from /proc while it's a zombie, before it's reaped, so that it includes the I/O of the
+    descendants it waited for.
+
+    Args:
+        pid (int): The process id of the child, or -1 for any child.
+        block (bool): Whether to wait for a child to exit. If False, this returns None if no child has exited.
+
+    Returns:
+        tuple: The pid, exit code, and :obj:`ResourceUsage` of the child. As with :obj:`subprocess.Popen`, the exit
+        code is the negative signal number if the child was killed by a signal.
+    """
+    io = (None, None)
+    if hasattr(os, 'waitid') and hasattr(os, 'WNOWAIT'):
+        options = os.WEXITED | os.WNOWAIT | (0 if block else os.WNOHANG)
+        info = os.waitid(os.P_PID if pid > 0 else os.P_ALL, max(pid, 0), options)
+        if info is None:
+            return None
+        pid = info.si_pid
+        io = read_proc_io(pid)
+
+    pid, status, rusage = os.wait4(pid, 0 if block or pid > 0 else os.WNOHANG)
+    if pid == 0:
+        return None
+    return pid, os.waitstatus_to_exitcode(status), ResourceUsage.from_rusage(rusage, io)
+
+
+def cgroup_dir():
+    """Return the cgroup v2 directory of this process, or None if cgroup v2 isn't available."""
+    try:
+        mount = None
+        with open('/proc/self/mounts', "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] == 'cgroup2':
+                    mount = fields[1]
+                    break
+        with open('/proc/self/cgroup', "r") as f:
+            paths = [line.strip()[3:] for line in f if line.startswith('0::')]
+    except OSError:
+        return None
+    if mount is None or len(paths) == 0:
+        return None
+    return os.path.join(mount, paths[0].lstrip('/'))
+
+
+def create_cgroup(parent):
+    """Create a cgroup for a command.
+
+    Args:
+        parent (str): The cgroup v2 directory to create the cgroup in.
+
+    Returns:
+        str: The directory of the new cgroup, or None if it couldn't be created or doesn't have the memory
+        controller, which needs to be enabled in the parent's ``cgroup.subtree_control``.
+    """
+    path = os.path.join(parent, f'pypeit_test.{os.getpid()}')
+    try:
+        os.mkdir(path)
+    except OSError:
+        return None
+    if not os.path.exists(os.path.join(path, 'memory.peak')) \
+            or not os.access(os.path.join(path, 'cgroup.procs'), os.W_OK):
+        remove_cgroup(path)
+        return None
+    return path
+
+
+def read_cgroup_usage(path, usage):
+    """Update the usage of a command with the peak memory and CPU time of its cgroup.
+
+    Args:
+        path (str): The cgroup directory.
+        usage (:obj:`ResourceUsage`): The usage from ``wait4``, which is updated.
+    """
+    try:
+        with open(os.path.join(path, 'memory.peak'), "r") as f:
+            peak_rss = int(f.read())
+        with open(os.path.join(path, 'cpu.stat'), "r") as f:
+            cpu_stat = dict(line.split() for line in f if len(line.split()) == 2)
+    except (OSError, ValueError):
+        return
+    usage.source = 'cgroup'
+    usage.peak_rss = peak_rss
+    if 'user_usec' in cpu_stat and 'system_usec' in cpu_stat:
+        usage.user_cpu = int(cpu_stat['user_usec']) / 1e6
+        usage.system_cpu = int(cpu_stat['system_usec']) / 1e6
+
+
+def remove_cgroup(path):
+    """Kill any processes left in a cgroup, and remove it."""
+    try:
+        with open(os.path.join(path, 'cgroup.kill'), "w") as f:
+            f.write('1')
+    except OSError:
+        pass
+    # The killed processes take a moment to leave the cgroup
+    for attempt in range(50):
+        try:
+            os.rmdir(path)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.02)
+
+
+def _run(config, command_line):
+    """Run a command, writing its resource usage to a file. Returns its exit code."""
+    parent = config['cgroup'] if config['cgroup'] is not None else cgroup_dir()
+    cgroup = create_cgroup(parent) if parent is not None else None
+
+    # Signals sent to stop the command before it started are forwarded once it has
+    child = None
+    pending = []
+    def forward(signum, frame):
+        if child is None:
+            pending.append(signum)
+        else:
+            child.send_signal(signum)
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, forward)
+
+    def join_cgroup():
+        with open(os.path.join(cgroup, 'cgroup.procs'), "w") as f:
+            f.write('0')
+
+    try:
+        try:
+            child = subprocess.Popen(command_line, preexec_fn=join_cgroup if cgroup is not None else None)
+        except subprocess.SubprocessError:
+            # Couldn't move the command into the cgroup
+            remove_cgroup(cgroup)
+            cgroup = None
+            child = subprocess.Popen(command_line)
+    except OSError as e:
+        print(f'Could not run {command_line[0]}: {e}', file=sys.stderr, flush=True)
+        if cgroup is not None:
+            remove_cgroup(cgroup)
+        return 127
+
+    for signum in pending:
+        child.send_signal(signum)
+
+    pid, returncode, usage = reap_child(child.pid)
+    child.returncode = returncode
+    if cgroup is not None:
+        read_cgroup_usage(cgroup, usage)
+        remove_cgroup(cgroup)
+
+    # Write the usage atomically, so that a partial file is never read
+    tmp_file = config['usage_file'] + '.tmp'
+    with open(tmp_file, "w") as f:
+        json.dump({'returncode': returncode, 'usage': usage.to_dict()}, f)
+    os.replace(tmp_file, config['usage_file'])
+    return returncode
+
+
+if __name__ == '__main__':
+    returncode = _run(json.loads(sys.argv[1]), sys.argv[3:])
+    if returncode < 0:
+        # Exit from the same signal as the command, without dumping core if the command already could have
+        soft, hard = resource.getrlimit(resource.RLIMIT_CORE)
+        resource.setrlimit(resource.RLIMIT_CORE, (0, hard))
+        signal.signal(-returncode, signal.SIG_DFL)
+        os.kill(os.getpid(), -returncode)
+    sys.exit(returncode)
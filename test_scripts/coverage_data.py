@@ -0,0 +1,225 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Collects the coverage data of a ``pypeit_test --coverage`` run with as little overhead as possible.
+
+The tests are run with coverage's ``sys.monitoring`` core (:pep:`669`) when the interpreter has it (Python 3.12 and
+later). It stops monitoring a line once it has run, instead of calling the classic tracer for every line run, which
+is most of the overhead of coverage in PypeIt's loops.
+
+Each test writes its coverage data to files of its own next to its log (see :meth:`CoverageCollector.test_data_file`).
+These are combined into the run's data in a background thread as each test finishes, so that combining the data of
+the whole suite isn't left until the end of the run. Any data files left at the end, e.g. from the unit and vet tests
+run with pytest, are combined as a tree: groups of files are combined in parallel, and then the groups are combined
+into the run's data (see :meth:`CoverageCollector.finish`).
+"""
+
+import os
+import sys
+import glob
+import time
+import datetime
+import subprocess
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+COMBINED_FILE = '.coverage'
+""" str: The name of the combined coverage data file in the output directory."""
+
+MIN_GROUP_SIZE = 20
+""" int: The fewest data files combined by each worker when the data files left at the end of a run are combined."""
+
+
+def coverage_core(core=None):
+    """Return the coverage core to run the tests with.
+
+    Args:
+        core (str): The core given on the command line, if any.
+
+    Returns:
+        str: The value of the ``COVERAGE_CORE`` environment variable for the tests: the given core, or ``sysmon`` if
+        the interpreter supports it. None to leave the choice to coverage.
+    """
+    if core is not None:
+        return core
+    return 'sysmon' if sys.version_info >= (3, 12) else None
+
+
+def coverage_env(env, core):
+    """Return the environment to run a command under coverage with a coverage core.
+
+    Args:
+        env (:obj:`Mapping`): The environment of the command.
+        core (str): The coverage core, or None for coverage's default.
+
+    Returns:
+        :obj:`Mapping`: The environment.
+    """
+    return env if core is None else dict(env, COVERAGE_CORE=core)
+
+
+class CoverageCollector(object):
+    """Combines the coverage data of tests as they finish.
+
+    Attributes:
+        outputdir (str):        The output directory of the run.
+        data_file (str):        The combined coverage data of the run.
+        core (str):             The coverage core the tests are run with (see :func:`coverage_core`).
+        num_files (int):        The number of data files that have been combined.
+        combine_time (float):   The seconds spent combining data files while the tests were running.
+        finish_time (float):    The seconds spent combining data files after the tests finished.
+        errors (list of str):   The output of ``coverage combine`` when it failed.
+
+        _pending (list of str): Data files waiting to be combined.
+        _combining (bool):      Whether the background thread is combining data files.
+        _lock (:obj:`threading.Lock`): Protects _pending and _combining.
+        _executor (:obj:`ThreadPoolExecutor`): The background thread.
+    """
+
+    def __init__(self, outputdir, core=None):
+        self.outputdir = os.path.abspath(outputdir)
+        self.data_file = os.path.join(self.outputdir, COMBINED_FILE)
+        self.core = core
+        self.num_files = 0
+        self.combine_time = 0.0
+        self.finish_time = 0.0
+        self.errors = []
+        self._pending = []
+        self._combining = False
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def test_data_file(self, test):
+        """Return the coverage data file of a test, next to its log.
+
+        Tests are run in parallel mode, so each process of the test writes this file with a suffix of its own.
+        """
+        return os.path.splitext(test.logfile)[0] + '.coverage'
+
+    def test_completed(self, test):
+        """Combine the coverage data written by a test in the background.
+
+        Args:
+            test (:obj:`PypeItTest`): A test whose child has exited.
+        """
+        files = glob_data_files(self.test_data_file(test) + '.*')
+        if len(files) == 0:
+            return
+        with self._lock:
+            self._pending += files
+            if self._combining:
+                # The files are combined after those being combined now
+                return
+            self._combining = True
+        self._executor.submit(self._combine_pending)
+
+    def _combine_pending(self):
+        """Combine the pending data files until there are none, combining those that arrive together in one go."""
+        while True:
+            with self._lock:
+                files = self._pending
+                self._pending = []
+                if len(files) == 0:
+                    self._combining = False
+                    return
+            start = time.monotonic()
+            self.combine(files, self.data_file)
+            self.combine_time += time.monotonic() - start
+
+    def combine(self, files, data_file):
+        """Combine data files into a data file, removing them.
+
+        Args:
+            files (list of str): The data files.
+            data_file (str): The data file to combine them into. Its data is kept if it exists.
+
+        Returns:
+            bool: Whether the files were combined.
+        """
+        process = subprocess.run(["coverage", "combine", "--append", "--data-file", data_file] + files,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.outputdir)
+        if process.returncode != 0:
+            self.errors.append(process.stdout.decode(errors='replace'))
+            return False
+        with self._lock:
+            self.num_files += len(files)
+        return True
+
+    def finish(self, num_workers=1):
+        """Wait for the data of the tests to be combined, and combine any other data files in the output directory.
+
+        Args:
+            num_workers (int): The number of data file groups combined in parallel.
+
+        Returns:
+            bool: Whether there is combined coverage data.
+        """
+        start = time.monotonic()
+        self._executor.shutdown(wait=True)
+        # The data files of pytest runs, and of any test that didn't hand its files over
+        files = glob_data_files(os.path.join(self.outputdir, '**', COMBINED_FILE + '.*')) + \
+            glob_data_files(os.path.join(self.outputdir, '**', '*' + COMBINED_FILE + '.*'))
+        num_groups = max(min(num_workers, len(files) // MIN_GROUP_SIZE), 1)
+        if num_groups > 1:
+            # Combine the groups in parallel into data files that don't match the pattern of the files left to
+            # combine, and then combine those
+            groups = [files[i::num_groups] for i in range(num_groups)]
+            group_files = [os.path.join(self.outputdir, f'{COMBINED_FILE}_group{i}') for i in range(num_groups)]
+            with ThreadPoolExecutor(max_workers=num_groups) as executor:
+                combined = list(executor.map(self.combine, groups, group_files))
+            files = [file for file, ok in zip(group_files, combined) if ok]
+        if len(files) > 0:
+            self.combine(files, self.data_file)
+        self.finish_time = time.monotonic() - start
+        return os.path.exists(self.data_file)
+
+    def summary(self):
+        """Return a line describing the time spent combining coverage data."""
+        total = datetime.timedelta(seconds=round(self.combine_time + self.finish_time))
+        after = datetime.timedelta(seconds=round(self.finish_time))
+        return f"Combined {self.num_files} coverage data files in {total}, {after} of it after testing finished"
+
+
+def glob_data_files(pattern):
+    """Find coverage data files.
+
+    Args:
+        pattern (str): A glob pattern, which can use ``**``.
+
+    Returns:
+        list of str: The sorted data files, without the journals of data files that are being written.
+    """
+    return sorted([file for file in glob.glob(pattern, recursive=True)
+                   if not file.endswith('-journal') and os.path.isfile(file)])
+
+
+def coverage_overhead(setups, history):
+    """Compare the durations of the tests of a coverage run with their durations without coverage.
+
+    Args:
+        setups (list of :obj:`TestSetup`): The test setups of the coverage run.
+        history (:obj:`TestHistory`): The history of prior runs.
+
+    Returns:
+        str: A line describing the overhead, or None if none of the tests that passed have run without coverage.
+    """
+    coverage_time = 0.0
+    baseline_time = 0.0
+    num_tests = 0
+    for setup in setups:
+        for test in setup.tests:
+            if not test.passed or test.start_time is None or test.end_time is None or test.from_cache:
+                continue
+            baseline = history.predicted_duration(setup.key, test.description, coverage=False)
+            if baseline is None:
+                continue
+            coverage_time += (test.end_time - test.start_time).total_seconds()
+            baseline_time += baseline
+            num_tests += 1
+    if num_tests == 0 or baseline_time <= 0.0:
+        return None
+    return (f"Coverage overhead: {num_tests} tests took {datetime.timedelta(seconds=round(coverage_time))}, "
+            f"{coverage_time / baseline_time:.2f} times the {datetime.timedelta(seconds=round(baseline_time))} "
+            f"they took without coverage")
@@ -0,0 +1,319 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+An index of the PypeIt code run by each test of the dev suite, used to select the tests impacted by a change
+(``pypeit_test impacted``).
+
+With ``pypeit_test --coverage``, each test is run under coverage with its own context, the test's "instr/setup
+description" (see :meth:`PypeItTest.run_child`), and the unit and vet tests run with pytest get the context of their
+test suite (e.g. "Unit Tests"). After the coverage data is combined, the lines each context ran are added to the
+index, along with the line spans of the functions in the measured files (see :meth:`CoverageIndex.update_from_coverage`).
+
+A change to a line inside a function impacts the tests that ran any line of that function, since a change to one
+line (e.g. of a variable's value) can change what the rest of the function does. A change to a line outside of any
+function (e.g. a module constant or an import) impacts the tests that ran that line, which for module level code is
+every test that imported the module.
+"""
+
+import os
+import re
+import ast
+import json
+from collections import defaultdict
+
+from .profiling import pypeit_path
+
+INDEX_FILE = 'coverage_index.json'
+""" str: The default coverage index file."""
+
+
+class CoverageIndex(object):
+    """The lines of the PypeIt source files run by each test.
+
+    The line numbers are those of the PypeIt version the tests were run with, so a diff is matched against the index
+    using the line numbers of the original side of the diff. The index should be built from a run of the code the
+    change is based on (e.g. the develop branch).
+
+    Attributes:
+        file (str):        The JSON file the index is read from and written to.
+        tests (dict):      Maps the context of each test to a dict mapping the PypeIt source files it ran (e.g.
+                           "pypeit/core/arc.py") to a sorted list of the [first, last] line ranges it ran.
+        functions (dict):  Maps each PypeIt source file to a dict mapping the qualified name of each function in it to
+                           its [first, body, last] lines (see :func:`function_spans`).
+    """
+
+    version = 1
+    """ int: The version of the index file's format. An index with a different version is ignored."""
+
+    def __init__(self, file=INDEX_FILE):
+        self.file = file
+        self.tests = dict()
+        self.functions = dict()
+        if os.path.exists(file):
+            with open(file, "r") as f:
+                data = json.load(f)
+            if data.get('version') == self.version:
+                self.tests = data['tests']
+                self.functions = data['functions']
+
+    def __len__(self):
+        """Return the number of tests in the index."""
+        return len(self.tests)
+
+    def write(self):
+        """Write the index to its file."""
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, "w") as f:
+            json.dump({'version': self.version, 'tests': self.tests, 'functions': self.functions}, f)
+        os.replace(tmp_file, self.file)
+
+    def update(self, lines_by_context, source_files):
+        """Add the lines run by tests to the index.
+
+        The lines of a test that is already in the index replace its old lines.
+
+        Args:
+            lines_by_context (dict): Maps the context of each test to a dict mapping the PypeIt source files it ran
+                (as returned by :func:`pypeit_path`) to the line numbers it ran.
+            source_files (dict): Maps the PypeIt source files to their paths, which are parsed to find the spans of
+                their functions.
+        """
+        for context, files in lines_by_context.items():
+            self.tests[context] = {path: line_ranges(lines) for path, lines in files.items()}
+        for path, source_file in source_files.items():
+            try:
+                self.functions[path] = function_spans(source_file)
+            except (OSError, SyntaxError, ValueError):
+                # The file was removed or changed since it was run
+                self.functions.pop(path, None)
+
+    def update_from_coverage(self, data_file):
+        """Add the lines run by each context of combined coverage data to the index.
+
+        Args:
+            data_file (str): The coverage data file, e.g. the ``.coverage`` file written by ``coverage combine``.
+
+        Returns:
+            int: The number of tests added to or updated in the index.
+        """
+        # Coverage is only needed to build the index
+        from coverage import CoverageData
+
+        data = CoverageData(basename=data_file)
+        data.read()
+        lines_by_context = defaultdict(dict)
+        source_files = dict()
+        for filename in data.measured_files():
+            path = pypeit_path(filename)
+            if path is None:
+                continue
+            source_files[path] = filename
+            for lineno, contexts in data.contexts_by_lineno(filename).items():
+                for context in contexts:
+                    # Lines run outside of the tests (e.g. by an old run without contexts) have the empty context
+                    if context != '':
+                        lines_by_context[context].setdefault(path, set()).add(lineno)
+        self.update(lines_by_context, source_files)
+        return len(lines_by_context)
+
+    def find_function(self, path, lineno):
+        """Find the innermost function containing a line.
+
+        Args:
+            path (str): The PypeIt source file.
+            lineno (int): The line number.
+
+        Returns:
+            tuple: The first and last lines of the body of the function, or None if the line isn't in a function.
+        """
+        span = None
+        for first, body, last in self.functions.get(path, dict()).values():
+            if first <= lineno <= last and (span is None or last - body < span[1] - span[0]):
+                span = (body, last)
+        return span
+
+    def impacted_tests(self, changes):
+        """Find the tests impacted by changes to PypeIt source files.
+
+        Args:
+            changes (dict): Maps each changed file (e.g. "pypeit/core/arc.py") to the :obj:`FileChange` of its
+                changes, as returned by :func:`parse_diff`.
+
+        Returns:
+            dict: Maps the context of each impacted test to the sorted list of the changed files that impact it.
+        """
+        impacted = defaultdict(set)
+        all_tests = list(self.tests.keys())
+        for path, change in changes.items():
+            if change.added and path.endswith('.py'):
+                # New code can only be run by changing the code that already exists
+                continue
+            if not path.endswith('.py') or change.deleted:
+                # A change to a data file (or a removed source file) can't be matched to lines, so it impacts every
+                # test that could use it
+                tests = all_tests if not path.endswith('.py') else \
+                    [context for context in all_tests if path in self.tests[context]]
+                for context in tests:
+                    impacted[context].add(path)
+                continue
+
+            spans = set()
+            for lineno in change.lines:
+                function = self.find_function(path, lineno)
+                spans.add(function if function is not None else (lineno, lineno))
+            for context in all_tests:
+                ranges = self.tests[context].get(path)
+                if ranges is not None and any([ranges_overlap(ranges, span) for span in spans]):
+                    impacted[context].add(path)
+        return {context: sorted(paths) for context, paths in impacted.items()}
+
+
+class FileChange(object):
+    """The changes to a file in a diff.
+
+    Attributes:
+        path (str):     The path of the file before the change.
+        lines (set):    The line numbers, before the change, of the lines that were changed or removed, and of the
+                        lines on either side of lines that were added.
+        added (bool):   Whether the file was added.
+        deleted (bool): Whether the file was removed.
+    """
+
+    def __init__(self, path, added=False, deleted=False):
+        self.path = path
+        self.lines = set()
+        self.added = added
+        self.deleted = deleted
+
+
+_HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+_BINARY_FILES = re.compile(r'^Binary files (.+) and (.+) differ$')
+
+
+def parse_diff(text):
+    """Parse a unified diff, such as the output of ``git diff`` or a patch file.
+
+    Args:
+        text (str): The diff.
+
+    Returns:
+        dict: Maps the path within the PypeIt package (see :func:`pypeit_path`) of each changed PypeIt file to its
+        :obj:`FileChange`. Files that aren't part of the PypeIt package (e.g. its docs) aren't included.
+    """
+    changes = dict()
+    old_path = None
+    change = None
+    old_line = 0
+    replacing = False
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        match = _BINARY_FILES.match(line)
+        if match is not None:
+            # Changes to binary files (e.g. FITS data files) don't have lines
+            old_path, new_path = diff_path(match.group(1)), diff_path(match.group(2))
+            path = pypeit_path(old_path if old_path is not None else new_path)
+            if path is not None:
+                changes[path] = FileChange(path, added=old_path is None, deleted=new_path is None)
+            change = None
+            continue
+        if line.startswith('--- ') and i + 1 < len(lines) and lines[i + 1].startswith('+++ '):
+            old_path = diff_path(line[4:])
+            new_path = diff_path(lines[i + 1][4:])
+            path = pypeit_path(old_path if old_path is not None else new_path)
+            if path is None:
+                change = None
+                continue
+            change = FileChange(path, added=old_path is None, deleted=new_path is None)
+            changes[path] = change
+            continue
+        if change is None:
+            continue
+        match = _HUNK_HEADER.match(line)
+        if match is not None:
+            old_line = int(match.group(1))
+            # A hunk that only adds lines gives the line before the addition, rather than the line after it
+            if match.group(2) == '0':
+                old_line += 1
+            replacing = False
+        elif line.startswith('-') and not line.startswith('--- '):
+            change.lines.add(old_line)
+            old_line += 1
+            replacing = True
+        elif line.startswith('+') and not line.startswith('+++ '):
+            # Lines that replace removed lines are covered by those lines. Lines inserted between two lines change
+            # the code around both of them.
+            if not replacing:
+                change.lines.update([old_line - 1, old_line] if old_line > 1 else [old_line])
+        elif line.startswith(' '):
+            old_line += 1
+            replacing = False
+    return changes
+
+
+def diff_path(path):
+    """Get the path of a file from a "---" or "+++" line of a diff.
+
+    Args:
+        path (str): The rest of the line, e.g. "a/pypeit/core/arc.py" or "/dev/null".
+
+    Returns:
+        str: The path without git's "a/" or "b/" prefix, or None if the file doesn't exist on that side of the diff.
+    """
+    path = path.split('\t')[0].strip()
+    if path == '/dev/null':
+        return None
+    if path[:2] in ('a/', 'b/'):
+        path = path[2:]
+    return path
+
+
+def function_spans(source_file):
+    """Find the lines of the functions in a Python source file.
+
+    Args:
+        source_file (str): The source file.
+
+    Returns:
+        dict: Maps the qualified name of each function (e.g. "WaveCalib.build_waveimg") to its first line, including
+        its decorators, the first line of its body, and its last line. The ``def`` line is run when the function is
+        defined, e.g. when its module is imported, so only the lines of the body show that the function was called. A
+        docstring isn't part of the body, as it isn't run.
+    """
+    with open(source_file, "r") as f:
+        tree = ast.parse(f.read(), filename=source_file)
+    spans = dict()
+
+    def visit(node, prefix):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                name = prefix + child.name
+                first = min([child.lineno] + [decorator.lineno for decorator in child.decorator_list])
+                body = child.body
+                if len(body) > 1 and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+                        and isinstance(body[0].value.value, str):
+                    body = body[1:]
+                spans[name] = [first, body[0].lineno, child.end_lineno]
+                visit(child, name + '.')
+            elif isinstance(child, ast.ClassDef):
+                visit(child, prefix + child.name + '.')
+    visit(tree, '')
+    return spans
+
+
+def line_ranges(lines):
+    """Compress line numbers into a sorted list of [first, last] ranges of consecutive lines."""
+    ranges = []
+    for lineno in sorted(lines):
+        if len(ranges) > 0 and lineno == ranges[-1][1] + 1:
+            ranges[-1][1] = lineno
+        else:
+            ranges.append([lineno, lineno])
+    return ranges
+
+
+def ranges_overlap(ranges, span):
+    """Return whether any of a sorted list of [first, last] line ranges overlaps a (first, last) span of lines."""
+    return any([first <= span[1] and span[0] <= last for first, last in ranges])
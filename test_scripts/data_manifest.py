@@ -0,0 +1,246 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+A versioned manifest of the dev suite's data: the path, size and sha256 of every file in RAW_DATA and CALIBS. The
+manifest is checked in next to ``setups.py``, and is written with ``pypeit_syncraw --update_manifest`` from a
+complete copy of the data.
+
+The manifest lets ``pypeit_syncraw`` transfer only the files that differ from it, and check a local copy of the data
+without reading it all: the sha256 of each local file is recorded in a stamps file in the dev suite directory with
+the file's size and modification time, so a file is only hashed again once it changes (see :class:`DataStamps`). The
+stamps also give the result cache the hashes of the raw data without hashing it, and the manifest gives the preflight
+checks the expected size of each raw file.
+"""
+
+import os
+import json
+import hashlib
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from .raw_staging import PARTIAL_SUFFIX
+
+_TEST_SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DATA_MANIFEST_FILE = os.path.join(_TEST_SCRIPTS_DIR, 'data_manifest.json')
+""" str: The data manifest checked into the dev suite."""
+
+STAMPS_FILE = '.pypeit_data_stamps.json'
+""" str: The name of the stamps file in the dev suite directory."""
+
+TREES = ('RAW_DATA', 'CALIBS')
+""" tuple: The data directories of the dev suite in the manifest."""
+
+HASH_WORKERS = 8
+""" int: The number of files hashed at the same time."""
+
+
+class DataManifest(object):
+    """The path, size and sha256 of the files of the dev suite's data directories.
+
+    Attributes:
+        file (str):  The manifest file.
+        files (dict): Maps each data directory (see :data:`TREES`) to a dict mapping the path of each of its files,
+                     relative to the directory, to the file's [size, sha256].
+    """
+
+    version = 1
+    """ int: The version of the manifest file's format. A manifest with a different version is ignored."""
+
+    def __init__(self, file=DATA_MANIFEST_FILE):
+        self.file = file
+        self.files = {tree: dict() for tree in TREES}
+        try:
+            with open(file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = dict()
+        if data.get('version') == self.version:
+            self.files.update(data['files'])
+
+    def __len__(self):
+        """Return the number of files in the manifest."""
+        return sum([len(files) for files in self.files.values()])
+
+    def write(self):
+        """Write the manifest to its file, one file per line and sorted so that changes to it diff well."""
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, "w") as f:
+            json.dump({'version': self.version, 'files': self.files}, f, indent=1, sort_keys=True)
+            f.write('\n')
+        os.replace(tmp_file, self.file)
+
+    def tree_files(self, tree, prefixes=None):
+        """Return the files of a data directory.
+
+        Args:
+            tree (str): The data directory, e.g. "RAW_DATA".
+            prefixes (list of str): Only return the files in these subdirectories, e.g. the instr/setup keys of test
+                setups. None for every file.
+
+        Returns:
+            dict: Maps the path of each file, relative to the data directory, to its [size, sha256].
+        """
+        files = self.files.get(tree, dict())
+        if prefixes is None:
+            return dict(files)
+        return {path: entry for path, entry in files.items() if in_prefixes(path, prefixes)}
+
+    def update(self, tree, root, stamps, prefixes=None, num_workers=HASH_WORKERS):
+        """Replace the files of a data directory, or of some of its subdirectories, with those of a local copy.
+
+        Args:
+            tree (str): The data directory, e.g. "RAW_DATA".
+            root (str): The local copy of the data directory.
+            stamps (:obj:`DataStamps`): Hashes the local files.
+            prefixes (list of str): Only replace the files in these subdirectories. None to replace every file.
+            num_workers (int): The number of files hashed at the same time.
+
+        Returns:
+            int: The number of files of the data directory that were added, changed or removed.
+        """
+        paths = [path for path in walk_files(root) if prefixes is None or in_prefixes(path, prefixes)]
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            entries = list(executor.map(lambda path: stamps.file_entry(os.path.join(root, path)), paths))
+        new_files = {path: entry for path, entry in zip(paths, entries)}
+
+        old_files = self.tree_files(tree, prefixes)
+        num_changed = len(set(old_files) ^ set(new_files)) + \
+            len([path for path in new_files if path in old_files and old_files[path] != new_files[path]])
+        files = {path: entry for path, entry in self.files.get(tree, dict()).items() if path not in old_files}
+        files.update(new_files)
+        self.files[tree] = files
+        return num_changed
+
+    def expected_sizes(self, tree, root):
+        """Return the size of each file of a data directory, keyed by the absolute path of a local copy of it.
+
+        Args:
+            tree (str): The data directory, e.g. "RAW_DATA".
+            root (str): The local copy of the data directory.
+
+        Returns:
+            dict: Maps the absolute paths of the files to their sizes.
+        """
+        root = os.path.abspath(root)
+        return {os.path.join(root, path): entry[0] for path, entry in self.files.get(tree, dict()).items()}
+
+    def verify(self, tree, root, stamps, prefixes=None, num_workers=HASH_WORKERS):
+        """Compare a local copy of a data directory with the manifest.
+
+        The size of each file is compared first, and a file whose size and modification time match the stamps is
+        compared using the hash in the stamps, so only new or changed files are hashed.
+
+        Args:
+            tree (str): The data directory, e.g. "RAW_DATA".
+            root (str): The local copy of the data directory.
+            stamps (:obj:`DataStamps`): Hashes the local files.
+            prefixes (list of str): Only compare the files in these subdirectories. None to compare every file.
+            num_workers (int): The number of files hashed at the same time.
+
+        Returns:
+            tuple: The sorted paths, relative to the data directory, of the files in the manifest that are missing or
+            differ from it, and of the local files that aren't in the manifest.
+        """
+        files = self.tree_files(tree, prefixes)
+        to_hash = []
+        differ = []
+        for path, (size, sha256) in files.items():
+            try:
+                stat = os.stat(os.path.join(root, path))
+            except OSError:
+                differ.append(path)
+                continue
+            if stat.st_size != size:
+                differ.append(path)
+            else:
+                to_hash.append(path)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            entries = list(executor.map(lambda path: stamps.file_entry(os.path.join(root, path)), to_hash))
+        differ += [path for path, entry in zip(to_hash, entries) if entry != files[path]]
+
+        extra = [path for path in walk_files(root)
+                 if path not in files and (prefixes is None or in_prefixes(path, prefixes))]
+        return sorted(differ), sorted(extra)
+
+
+class DataStamps(object):
+    """The sha256 of local data files, with the size and modification time they had when they were hashed.
+
+    Attributes:
+        file (str):     The stamps file.
+        stamps (dict):  Maps the absolute path of each file to its [size, modification time in nanoseconds, sha256].
+
+        _lock (:obj:`threading.Lock`): Synchronizes access to stamps, as files are hashed in worker threads.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._lock = Lock()
+        try:
+            with open(file, "r") as f:
+                self.stamps = json.load(f)
+        except (OSError, ValueError):
+            self.stamps = dict()
+
+    def write(self):
+        """Write the stamps to their file. A dev suite directory that can't be written to is left without one."""
+        tmp_file = self.file + '.tmp'
+        try:
+            with self._lock:
+                with open(tmp_file, "w") as f:
+                    json.dump(self.stamps, f)
+            os.replace(tmp_file, self.file)
+        except OSError:
+            pass
+
+    def known_hash(self, path, stat):
+        """Return the sha256 of a file from the stamps, or None if it has changed since it was hashed.
+
+        Args:
+            path (str): The absolute path of the file.
+            stat (:obj:`os.stat_result`): The file's current status.
+        """
+        with self._lock:
+            stamp = self.stamps.get(path)
+        if stamp is not None and stamp[0] == stat.st_size and stamp[1] == stat.st_mtime_ns:
+            return stamp[2]
+        return None
+
+    def file_entry(self, path):
+        """Return the [size, sha256] of a file, hashing it only if it has changed since it was last hashed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        digest = self.known_hash(path, stat)
+        if digest is None:
+            digest = file_sha256(path)
+            with self._lock:
+                self.stamps[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return [stat.st_size, digest]
+
+
+def file_sha256(path):
+    """Return the sha256 of a file, as a hex string."""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def in_prefixes(path, prefixes):
+    """Return whether a relative path is one of a list of subdirectories, or in one of them."""
+    return any([path == prefix or path.startswith(prefix.rstrip('/') + '/') for prefix in prefixes])
+
+
+def walk_files(root):
+    """Return the sorted paths of the files under a directory, relative to it, or an empty list if it doesn't
+    exist. Directories that are being fetched by ``pypeit_test --raw_source`` are left out."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.endswith(PARTIAL_SUFFIX)]
+        paths += [os.path.relpath(os.path.join(dirpath, filename), root) for filename in filenames]
+    return sorted([path.replace(os.sep, '/') for path in paths])
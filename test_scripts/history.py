@@ -0,0 +1,320 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Persistent history of the dev-suite test results, used to predict how long each test will take and how much
+memory it needs.
+"""
+
+import os
+import json
+from statistics import median
+
+
+class TestHistory(object):
+    """A class for reading and updating the results of tests from prior runs.
+
+    The history is stored as a JSON file. For each test, identified by its instr/setup key and description, it
+    keeps the duration, peak memory and result of the most recent runs. The history is updated after every run,
+    including runs of only some setups and runs with failures, so that it improves every time the dev suite is run.
+
+    Predictions use the median of the recent runs, so that a single slow run (e.g. on a busy machine) doesn't
+    throw off the ordering of tests. Tests that have never run get an estimate from the same type of test for
+    other setups of the same instrument, or failing that, from all other setups. Tests run under coverage take
+    longer, so the estimates use the runs with the same coverage mode as the run they're for, and only fall back to
+    the runs without it for tests that have never run in that mode.
+
+    Attributes:
+        max_runs (int):  The number of most recent runs kept for each test.
+        coverage (bool): Whether the run that the estimates are for is run under coverage.
+        default_duration (float): The predicted duration, in seconds, for a test when there is nothing to base an
+                                  estimate on.
+
+        _file (str):     The file name to read and write the history from.
+        _tests (dict):   Maps instr/setup keys to a dict mapping test descriptions to a list of runs. Each run is a
+                         dict with the 'start' time (ISO format), 'duration' in seconds, peak memory 'max_mem' in
+                         bytes (or None), and whether the test 'passed'. Runs under coverage also have 'coverage'
+                         set to True. The runs are in the order they were run.
+        _setups (dict):  Maps instr/setup keys to a dict with the size in bytes of the setup's raw data ('raw_size')
+                         and of its output directory ('output_size') from the most recent run.
+    """
+
+    version = 1
+    """int: The version of the history file format."""
+
+    def __init__(self, file, max_runs=10, default_duration=300.0, coverage=False):
+        """Reads the history from a file."""
+        self._file = file
+        self.max_runs = max_runs
+        self.coverage = coverage
+        self.default_duration = default_duration
+        self._tests = dict()
+        self._setups = dict()
+
+        if os.path.exists(file):
+            with open(file, "r") as f:
+                data = json.load(f)
+            if data.get('version') == self.version:
+                self._tests = data['tests']
+                # Histories written before sizes were recorded don't have this
+                self._setups = data.get('setups', dict())
+
+    def __len__(self):
+        """Return how many tests have a history"""
+        return sum([len(tests) for tests in self._tests.values()])
+
+    def runs(self, setup_key, description):
+        """Return the recorded runs of a test.
+
+        Args:
+            setup_key (str):   The instr/setup key of the test's setup.
+            description (str): The description of the test.
+
+        Returns:
+            list of dict: The runs of the test, oldest first. See the _tests attribute.
+        """
+        return self._tests.get(setup_key, dict()).get(description, [])
+
+    def record(self, setups, coverage=False, raw_sizes=None):
+        """Add the results of the tests that ran in a list of test setups to the history.
+
+        The size of the raw data and output directory of every test setup that ran any tests is also recorded.
+
+        Args:
+            setups (list of :obj:`TestSetup`): The test setups. Tests that didn't run (e.g. they were skipped or
+                                               restored from the cache) are not recorded.
+            coverage (bool): Whether the tests were run under coverage.
+            raw_sizes (dict): Maps the instr/setup keys of test setups whose raw data was fetched during the run to
+                              its size, which is recorded instead of the size of their raw data directories, as
+                              the raw data may have been evicted (see :class:`RawDataStager`).
+        """
+        raw_sizes = dict() if raw_sizes is None else raw_sizes
+        for setup in setups:
+            if any([test.start_time is not None for test in setup.tests]):
+                self._setups[setup.key] = {'raw_size': raw_sizes[setup.key] if setup.key in raw_sizes
+                                                       else directory_size(setup.rawdir),
+                                           'output_size': directory_size(setup.rdxdir)}
+            for test in setup.tests:
+                # Tests restored from the result cache don't say anything about how long the test takes
+                if test.start_time is None or test.end_time is None or test.from_cache:
+                    continue
+                runs = self._tests.setdefault(setup.key, dict()).setdefault(test.description, [])
+                if any([run['start'] == test.start_time.isoformat() for run in runs]):
+                    # A test that passed in an earlier run that was resumed was recorded by that run
+                    continue
+                run = {'start': test.start_time.isoformat(),
+                       'duration': (test.end_time - test.start_time).total_seconds(),
+                       'max_mem': test.max_mem,
+                       'passed': bool(test.passed)}
+                if coverage:
+                    run['coverage'] = True
+                runs.append(run)
+                del runs[:-self.max_runs]
+
+    def write(self):
+        """Write the history to its file."""
+        tmp_file = self._file + '.tmp'
+        with open(tmp_file, "w") as f:
+            json.dump({'version': self.version, 'tests': self._tests, 'setups': self._setups}, f, indent=1,
+                      sort_keys=True)
+        os.replace(tmp_file, self._file)
+
+    def predicted_duration(self, setup_key, description, coverage=None):
+        """Return the median duration of the recent runs of a test in seconds, or None if it has never run.
+
+        Only runs that passed are used if there are any, because failed tests often stop early. If coverage is
+        True or False, only the runs with or without coverage are used.
+        """
+        runs = self.runs(setup_key, description)
+        if coverage is not None:
+            runs = [run for run in runs if run.get('coverage', False) == coverage]
+        passed_runs = [run for run in runs if run['passed']]
+        durations = [run['duration'] for run in (passed_runs if len(passed_runs) > 0 else runs)]
+        return median(durations) if len(durations) > 0 else None
+
+    def mode_duration(self, setup_key, description):
+        """Return the median duration of the recent runs of a test in the coverage mode of the run in seconds,
+        falling back to its runs in the other mode, or None if it has never run."""
+        duration = self.predicted_duration(setup_key, description, coverage=self.coverage)
+        return self.predicted_duration(setup_key, description) if duration is None else duration
+
+    def estimate_duration(self, test):
+        """Estimate how long a test will take in seconds.
+
+        Args:
+            test (:obj:`PypeItTest`): The test.
+
+        Returns:
+            float: The median of the test's recent runs (see :meth:`mode_duration`). For a test that has never run,
+            the median of the same type of test for the other setups of the instrument, or of all setups if the
+            instrument has never run it.
+        """
+        duration = self.mode_duration(test.setup.key, test.description)
+        if duration is not None:
+            return duration
+
+        instr_durations = []
+        all_durations = []
+        for setup_key in self._tests:
+            duration = self.mode_duration(setup_key, test.description)
+            if duration is None:
+                continue
+            all_durations.append(duration)
+            if setup_key.split('/')[0] == test.setup.instr:
+                instr_durations.append(duration)
+
+        if len(instr_durations) > 0:
+            return median(instr_durations)
+        elif len(all_durations) > 0:
+            return median(all_durations)
+        return self.default_duration
+
+    def peak_mem(self, test):
+        """Return the largest peak memory of a test's recent runs in bytes, or None if it isn't known.
+
+        The largest value is used rather than the median because under estimating memory can cause the machine
+        to run out of memory.
+        """
+        mems = [run['max_mem'] for run in self.runs(test.setup.key, test.description) if run['max_mem']]
+        return max(mems) if len(mems) > 0 else None
+
+    def estimate_setup_duration(self, setup_key):
+        """Estimate how long all of the tests of a test setup will take in seconds, without building its tests.
+
+        Args:
+            setup_key (str): The instr/setup key of the test setup.
+
+        Returns:
+            float: The sum of the predicted durations of the setup's tests in its most recent runs. For a setup
+            that has never run, the median of the other setups of the instrument, or of all setups if the
+            instrument has never run.
+        """
+        def setup_duration(key):
+            return sum([self.mode_duration(key, description) for description in self._tests.get(key, dict())])
+
+        if len(self._tests.get(setup_key, dict())) > 0:
+            return setup_duration(setup_key)
+
+        instr = setup_key.split('/')[0]
+        all_durations = [setup_duration(key) for key in self._tests if len(self._tests[key]) > 0]
+        instr_durations = [setup_duration(key) for key in self._tests
+                           if len(self._tests[key]) > 0 and key.split('/')[0] == instr]
+        if len(instr_durations) > 0:
+            return median(instr_durations)
+        elif len(all_durations) > 0:
+            return median(all_durations)
+        return self.default_duration
+
+    def setup_peak_mem(self, setup_key):
+        """Return the largest peak memory of the recent runs of any test in a test setup in bytes, or None if it
+        isn't known."""
+        mems = [run['max_mem'] for runs in self._tests.get(setup_key, dict()).values() for run in runs
+                if run['max_mem']]
+        return max(mems) if len(mems) > 0 else None
+
+    def setup_failure_rate(self, setup_key):
+        """Return the fraction of the recent runs of a test setup's tests that failed, or 0.0 if it has never run."""
+        runs = [run for runs in self._tests.get(setup_key, dict()).values() for run in runs]
+        return len([run for run in runs if not run['passed']]) / len(runs) if len(runs) > 0 else 0.0
+
+    def setup_sizes(self, setup_key):
+        """Return the size in bytes of a test setup's (raw data, output directory) from its most recent run, or
+        None if they haven't been recorded."""
+        sizes = self._setups.get(setup_key)
+        return None if sizes is None else (sizes['raw_size'], sizes['output_size'])
+
+    def set_setup_priorities(self, setups):
+        """Set the priority of test setups so that the test setups predicted to take the longest run first.
+
+        Args:
+            setups (list of :obj:`TestSetup`): The test setups.
+        """
+        durations = [(sum([self.estimate_duration(test) for test in setup.tests]), setup) for setup in setups]
+        for priority, (duration, setup) in enumerate(sorted(durations, key=lambda x: (-x[0], x[1].key))):
+            setup.priority = priority
+
+    def shard_setups(self, setups, shard_count):
+        """Split test setups into shards with about the same predicted run time.
+
+        The split only depends on the test setups and the history, so that independent runs with the same history
+        file compute the same shards without coordinating. Test setups are assigned longest first to the shard
+        with the least predicted run time so far.
+
+        Args:
+            setups (list of :obj:`TestSetup`): The test setups.
+            shard_count (int):                  The number of shards.
+
+        Returns:
+            list of list of :obj:`TestSetup`: The test setups in each shard, in the same order as setups.
+        """
+        durations = {setup.key: sum([self.estimate_duration(test) for test in setup.tests]) for setup in setups}
+        shard_keys = balance_shards(durations, shard_count)
+        return [[setup for setup in setups if setup.key in keys] for keys in shard_keys]
+
+    def shard_setup_keys(self, setup_keys, shard_count):
+        """Split test setups into shards with about the same predicted run time, using only their instr/setup keys.
+
+        This is used to plan a sharded run without building the tests, e.g. on a machine without PypeIt installed.
+        The durations come from :meth:`estimate_setup_duration`, so the shards can differ from those of
+        :meth:`shard_setups` for setups that have never run.
+
+        Args:
+            setup_keys (list of str): The instr/setup keys of the test setups.
+            shard_count (int):        The number of shards.
+
+        Returns:
+            list of list of str: The keys in each shard, in the same order as setup_keys.
+        """
+        durations = {key: self.estimate_setup_duration(key) for key in setup_keys}
+        shard_keys = balance_shards(durations, shard_count)
+        return [[key for key in setup_keys if key in keys] for keys in shard_keys]
+
+    def merge(self, other):
+        """Add the runs from another history, such as the history written by another shard of the same run.
+
+        Args:
+            other (:obj:`TestHistory`): The other history. Runs that are in both histories are only kept once.
+        """
+        for setup_key, tests in other._tests.items():
+            for description, other_runs in tests.items():
+                runs = self._tests.setdefault(setup_key, dict()).setdefault(description, [])
+                starts = set([run['start'] for run in runs])
+                runs += [run for run in other_runs if run['start'] not in starts]
+                runs.sort(key=lambda run: run['start'])
+                del runs[:-self.max_runs]
+        self._setups.update(other._setups)
+
+
+def balance_shards(durations, shard_count):
+    """Split items into shards with about the same total duration.
+
+    Items are assigned longest first to the shard with the least total duration so far, with ties broken by the
+    item's key and the shard's index, so the result only depends on the durations.
+
+    Args:
+        durations (dict):  Maps the (sortable) key of each item to its duration.
+        shard_count (int): The number of shards.
+
+    Returns:
+        list of set: The keys of the items in each shard.
+    """
+    shard_durations = [0.0] * shard_count
+    shards = [set() for shard in range(shard_count)]
+    for key in sorted(durations, key=lambda key: (-durations[key], key)):
+        shard = shard_durations.index(min(shard_durations))
+        shards[shard].add(key)
+        shard_durations[shard] += durations[key]
+    return shards
+
+
+def directory_size(directory):
+    """Return the total size in bytes of the files under a directory, or 0 if it doesn't exist."""
+    size = 0
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(root, filename)).st_size
+            except FileNotFoundError:
+                continue
+    return size
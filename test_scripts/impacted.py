@@ -0,0 +1,146 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Selects the dev suite tests that run the PypeIt code changed by a git range or a patch (``pypeit_test impacted``),
+using the coverage index built by ``pypeit_test --coverage`` (see :mod:`coverage_index`).
+"""
+
+import os
+import sys
+import subprocess
+import importlib.util
+
+from .setups import all_setups
+from .coverage_index import CoverageIndex, INDEX_FILE, parse_diff
+
+
+def parser(options=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='pypeit_test impacted', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='List the dev suite tests that run the PypeIt code changed by a git '
+                                                 'range or patch, and the test setups to run to test the change. The '
+                                                 'code run by each test is read from a coverage index built by a '
+                                                 'pypeit_test --coverage run of the code the change is based on.')
+    parser.add_argument('--diff', type=str, required=True,
+                        help='A patch file, "-" to read a patch from stdin, or a git range of the PypeIt repository '
+                             '(e.g. "develop...HEAD").')
+    parser.add_argument('--pypeit_dir', type=str, default=None,
+                        help='The PypeIt git repository to run "git diff" in. Defaults to the repository of the '
+                             'installed PypeIt.')
+    parser.add_argument('--coverage_index', type=str, default=INDEX_FILE,
+                        help='The coverage index written by pypeit_test --coverage.')
+    parser.add_argument('--indexed_only', default=False, action='store_true',
+                        help='Only select test setups in the coverage index. By default the test setups that '
+                             'are not in the index are selected too, as the change could impact them.')
+    parser.add_argument('-q', '--quiet', default=False, action='store_true',
+                        help='Only print the instr/setup keys of the selected test setups, e.g. for '
+                             '"pypeit_test all -s $(pypeit_test impacted -q --diff develop...HEAD)". Warnings are '
+                             'printed to stderr, and nothing is printed if no test setup is selected.')
+
+    return parser.parse_args() if options is None else parser.parse_args(options)
+
+
+def read_diff(diff, pypeit_dir=None):
+    """Read a diff of PypeIt.
+
+    Args:
+        diff (str): A patch file, "-" for stdin, or a git range of the PypeIt repository.
+        pypeit_dir (str): The PypeIt repository. Defaults to the repository of the installed PypeIt.
+
+    Returns:
+        str: The diff.
+
+    Raises:
+        ValueError: If git couldn't produce the diff.
+    """
+    if diff == '-':
+        return sys.stdin.read()
+    if os.path.isfile(diff):
+        with open(diff, "r") as f:
+            return f.read()
+
+    if pypeit_dir is None:
+        # Found without importing PypeIt, which is slow
+        spec = importlib.util.find_spec('pypeit')
+        if spec is None or spec.origin is None:
+            raise ValueError("Could not find the PypeIt repository, use --pypeit_dir")
+        pypeit_dir = os.path.dirname(os.path.dirname(spec.origin))
+    # Without context lines, as only the changed lines are needed
+    process = subprocess.run(['git', 'diff', '-U0', '--no-color', diff], cwd=pypeit_dir,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise ValueError(f"git diff {diff} failed in {pypeit_dir}: {process.stderr.decode().strip()}")
+    return process.stdout.decode(errors='replace')
+
+
+def context_setup_key(context):
+    """Return the instr/setup key of the test setup of a coverage context, or None if it isn't a test setup's test.
+
+    The context of a test setup's test is "instr/setup description" (e.g. "shane_kast_blue/600_4310_d55 pypeit"),
+    while the unit and vet tests run with pytest have the name of their test suite (e.g. "Unit Tests").
+    """
+    key = context.split(' ')[0]
+    if '/' not in key:
+        return None
+    instr, name = key.split('/', 1)
+    return key if name in all_setups.get(instr, []) else None
+
+
+def main(options=None):
+    """List the tests impacted by a change to PypeIt.
+
+    Args:
+        options (list of str): The command line arguments after "impacted".
+
+    Returns:
+        int: 0 if test setups were selected, 1 if the coverage index or the diff couldn't be read, or 2 if no test
+        setup was selected.
+    """
+    pargs = parser(options)
+
+    index = CoverageIndex(pargs.coverage_index)
+    if len(index) == 0:
+        print(f'The coverage index {pargs.coverage_index} is empty or missing. Build it with a '
+              'pypeit_test --coverage run.', file=sys.stderr)
+        return 1
+    try:
+        changes = parse_diff(read_diff(pargs.diff, pargs.pypeit_dir))
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    impacted = index.impacted_tests(changes)
+    setup_keys = set([context_setup_key(context) for context in impacted]) - set([None])
+    # The unit and vet tests run with pytest aren't selected with -s
+    suites = sorted([context for context in impacted if '/' not in context.split(' ')[0]])
+
+    indexed_setups = set([context_setup_key(context) for context in index.tests]) - set([None])
+    unindexed = [f'{instr}/{name}' for instr, names in all_setups.items() for name in names
+                 if f'{instr}/{name}' not in indexed_setups]
+    selected = sorted(setup_keys if pargs.indexed_only else setup_keys | set(unindexed))
+
+    # With -q, only the selection goes to stdout
+    output = sys.stderr if pargs.quiet else sys.stdout
+    if not pargs.quiet:
+        print(f'{len(changes)} PypeIt files changed')
+        print(f'{len(impacted)} of the {len(index)} tests in the coverage index run the changed code:')
+        for context in sorted(impacted):
+            print(f'    {context} ({", ".join(impacted[context])})')
+    elif len(suites) > 0:
+        print(f'The changed code is also run by: {", ".join(suites)}', file=output)
+    if len(unindexed) > 0:
+        print(f'{len(unindexed)} test setups are not in the coverage index, and were '
+              f'{"not selected" if pargs.indexed_only else "selected as the change could impact them"}.', file=output)
+    if len(selected) == 0:
+        print('No test setups are impacted.', file=output)
+        return 2
+
+    if pargs.quiet:
+        print(' '.join(selected))
+    else:
+        print(f'Run the {len(selected)} selected test setups with:')
+        print(f'    pypeit_test all -s {" ".join(selected)}')
+    return 0
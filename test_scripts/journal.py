@@ -0,0 +1,217 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+An append-only journal of the tests that completed in a dev suite run, used to resume a run that was stopped before
+it finished (``pypeit_test --resume``).
+"""
+
+import os
+import json
+import datetime
+
+from .accounting import ResourceUsage
+
+JOURNAL_FILE = 'pypeit_test_journal.jsonl'
+""" str: The name of the journal file in the output directory."""
+
+HASH_FILE = 'pypeit_test_file_hashes.json'
+""" str: The name of the file in the output directory that the hashes of the tests' input files are saved to, when
+they aren't saved in a result cache."""
+
+
+class RunJournal(object):
+    """A journal of the tests that completed in the runs of the dev suite in an output directory.
+
+    Each line of the journal is a JSON record. A ``run`` record is written when a run starts, and a ``test`` record
+    when a test completes, with its result, timings, resource usage, the key of its inputs and the PypeIt version (see
+    :obj:`TestKeys`), and the output files it created or changed. Each record is synced to disk as it's written, so
+    the journal survives the run being killed or its machine going away.
+
+    A new run truncates the journal. A resumed run appends to it, and restores the tests that passed in the earlier
+    runs instead of running them again (see :meth:`restore`).
+
+    Attributes:
+        file (str):         The journal file.
+        outputdir (str):    The output directory of the run. Paths in the journal are relative to it.
+        keys (:obj:`TestKeys`): Computes the keys of the tests' inputs, or None if the run isn't resumed and doesn't
+                            use a result cache, so the tests' inputs aren't hashed.
+        resume (bool):      Whether tests that passed in earlier runs are restored.
+        run_start (:obj:`datetime.datetime`): When the first of the runs in the journal started.
+
+        _records (dict):    Maps the (setup key, description) of each test to its latest record.
+        _file (file):       The journal file, open for appending.
+    """
+
+    def __init__(self, outputdir, keys, resume=False):
+        self.outputdir = os.path.abspath(outputdir)
+        self.file = os.path.join(self.outputdir, JOURNAL_FILE)
+        self.keys = keys
+        self.resume = resume
+        self.run_start = datetime.datetime.now()
+        self._records = dict()
+
+        if resume and os.path.exists(self.file):
+            runs, self._records = read_journal(self.file)
+            if len(runs) > 0:
+                self.run_start = datetime.datetime.fromisoformat(runs[0]['start'])
+        self._file = open(self.file, "a" if resume else "w")
+        if self._file.tell() > 0:
+            # End any record that was being written when an earlier run was killed, so it isn't joined to the next
+            with open(self.file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self._file.write('\n')
+        self._append({'type': 'run', 'start': datetime.datetime.now().isoformat(), 'resumed': resume,
+                      'pypeit_version': self.pypeit_version})
+
+    @property
+    def pypeit_version(self):
+        """str: Identifies the PypeIt code being tested, or None without keys."""
+        return None if self.keys is None else self.keys.pypeit_version
+
+    def __len__(self):
+        """Return the number of tests recorded in the journal when it was loaded."""
+        return len(self._records)
+
+    def close(self):
+        """Close the journal file."""
+        self._file.close()
+
+    def _append(self, record):
+        """Append a record to the journal, and wait for it to reach the disk."""
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def restore(self, test):
+        """Restore the results of a test if it passed in an earlier run.
+
+        The test is restored if the run is being resumed, and the latest record of the test is a pass with the same
+        key and PypeIt version, whose output files still exist. The key of the test is only computed when the run is
+        being resumed.
+
+        Args:
+            test (:obj:`PypeItTest`): The test, with its log file and command line already set.
+
+        Returns:
+            bool: True if the test's results were restored, False if it needs to be run.
+        """
+        if not self.resume:
+            return False
+        try:
+            await self.keys.set_key(test)
+        except Exception:
+            # The test is run if its inputs can't be read (e.g. a malformed pypeit file), and reports the problem
+            # itself. Without a key it can't be resumed.
+            test.cache_key = None
+            return False
+        record = self._records.get((test.setup.key, test.description))
+        if record is None or not record['passed'] or record['key'] is None or record['key'] != test.cache_key \
+                or record['pypeit_version'] != self.pypeit_version:
+            return False
+        if not all([os.path.isfile(os.path.join(self.outputdir, file)) for file in record['outputs']]):
+            return False
+
+        # The test is reported with the log and timings of the run it passed in
+        logfile = os.path.join(self.outputdir, record['logfile'])
+        if os.path.isfile(logfile) and logfile != test.logfile:
+            if os.path.getsize(test.logfile) == 0:
+                os.unlink(test.logfile)
+            test.logfile = logfile
+        test.start_time = datetime.datetime.fromisoformat(record['start'])
+        test.end_time = datetime.datetime.fromisoformat(record['end'])
+        test.pid = record['pid']
+        test.max_mem = record['max_mem']
+        test.usage = ResourceUsage.from_dict(record['usage'])
+        test.from_cache = record['from_cache']
+        test.resumed = True
+        test.passed = True
+        return True
+
+    def record(self, test):
+        """Record a test that has completed.
+
+        Args:
+            test (:obj:`PypeItTest`): The test. Tests that were restored from the journal are already in it.
+        """
+        if test.resumed or test.passed is None:
+            return
+        record = {'type': 'test',
+                  'setup': test.setup.key,
+                  'description': test.description,
+                  'passed': bool(test.passed),
+                  'timed_out': test.timed_out,
+                  'start': test.start_time.isoformat() if test.start_time is not None else None,
+                  'end': test.end_time.isoformat() if test.end_time is not None else None,
+                  'pid': test.pid,
+                  'max_mem': test.max_mem,
+                  'usage': test.usage.to_dict() if test.usage is not None else None,
+                  'from_cache': test.from_cache,
+                  'key': test.cache_key,
+                  'pypeit_version': self.pypeit_version,
+                  'logfile': os.path.relpath(test.logfile, self.outputdir) if test.logfile is not None else None,
+                  'outputs': self.test_outputs(test) if test.passed else []}
+        self._append(record)
+        # Save the hashes of the inputs, so that they aren't computed again when the run is resumed
+        if self.keys is not None:
+            self.keys.write()
+
+    def test_outputs(self, test):
+        """Find the output files a test created or changed.
+
+        These are the files in the test's setup's output directory whose status changed while the test ran. Files
+        written by other tests of the setup that ran at the same time are included too.
+
+        Args:
+            test (:obj:`PypeItTest`): The test.
+
+        Returns:
+            list of str: The paths of the files, relative to the output directory.
+        """
+        if test.start_time is None or test.end_time is None:
+            return []
+        # The change time is used rather than the modification time, as files restored from the result cache are
+        # hard links that keep the modification time of the run that cached them. A second is allowed for the
+        # granularity of file system timestamps.
+        start = test.start_time.timestamp() - 1.0
+        end = test.end_time.timestamp() + 1.0
+        outputs = []
+        for root, dirs, filenames in os.walk(test.setup.rdxdir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    ctime = os.stat(path).st_ctime
+                except FileNotFoundError:
+                    continue
+                if start <= ctime <= end and path != test.logfile:
+                    outputs.append(os.path.relpath(path, self.outputdir))
+        return sorted(outputs)
+
+
+def read_journal(file):
+    """Read a journal file.
+
+    A record that was being written when a run was killed is ignored.
+
+    Args:
+        file (str): The journal file.
+
+    Returns:
+        tuple: The list of ``run`` records, and a dict mapping the (setup key, description) of each test to its latest
+        ``test`` record.
+    """
+    runs = []
+    tests = dict()
+    with open(file, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('type') == 'run':
+                runs.append(record)
+            elif record.get('type') == 'test':
+                tests[(record['setup'], record['description'])] = record
+    return runs, tests
@@ -0,0 +1,166 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+A cached manifest of the dev suite: its test setups, the tests run for each setup, and the raw data files each setup
+has in RAW_DATA. Reading the manifest saves importing the test definitions and walking RAW_DATA every time
+pypeit_test starts.
+
+The manifest is rebuilt when test_setups.py, setups.py, RAW_DATA, or any of the instrument and setup directories in
+RAW_DATA have changed since it was built, which is checked with their modification times. Raw data files added to a
+subdirectory of a setup's directory don't change the setup directory's modification time, so they aren't seen until
+the manifest is rebuilt for another reason.
+"""
+
+import os
+import json
+
+MANIFEST_FILE = '.pypeit_test_manifest.json'
+""" str: The name of the manifest file in the dev suite directory."""
+
+_TEST_SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SuiteManifest(object):
+    """The test setups of the dev suite, their tests, and their raw data files.
+
+    Attributes:
+        file (str):        The manifest file.
+        raw_data (str):    The RAW_DATA directory.
+        rebuilt (bool):    Whether the manifest was rebuilt rather than read from its file.
+        setups (dict):     Maps each instrument to the names of its test setups, as in :obj:`setups.all_setups`.
+        tests (dict):      Maps the instr/setup key of each test setup to a list of its tests, in the order of
+                           :obj:`test_setups.all_tests`. Each test is a dict with the 'name' and 'type' (a
+                           :obj:`TestPhase` name) of its test type, the name of its 'factory', and its 'kwargs'.
+        raw_files (dict):  Maps the instr/setup key of each test setup with a raw data directory to the sorted paths
+                           of the files in it, relative to the directory.
+
+        _stamps (dict):    The modification times of the files and directories the manifest was built from, as
+                           returned by :func:`source_stamps`.
+    """
+
+    version = 1
+    """ int: The version of the manifest file's format. A manifest with a different version is rebuilt."""
+
+    def __init__(self, dev_path, raw_data, file=None):
+        """Read the manifest, or build it and write it if it's out of date.
+
+        Args:
+            dev_path (str): The dev suite directory.
+            raw_data (str): The RAW_DATA directory.
+            file (str): The manifest file. Defaults to :data:`MANIFEST_FILE` in the dev suite directory.
+        """
+        self.file = file if file is not None else os.path.join(dev_path, MANIFEST_FILE)
+        self.raw_data = raw_data
+        self.rebuilt = False
+        self.setups = dict()
+        self.tests = dict()
+        self.raw_files = dict()
+        self._stamps = source_stamps(raw_data)
+
+        try:
+            with open(self.file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = dict()
+        if data.get('version') == self.version and data.get('stamps') == self._stamps:
+            self.setups = data['setups']
+            self.tests = data['tests']
+            self.raw_files = data['raw_files']
+        else:
+            self.build()
+            self.write()
+
+    def build(self):
+        """Build the manifest from the test definitions and the RAW_DATA directory."""
+        # Importing these is what reading the manifest saves
+        from .setups import all_setups
+        from .test_setups import all_tests
+
+        self.rebuilt = True
+        self.setups = {instr: list(names) for instr, names in all_setups.items()}
+        self.tests = dict()
+        self.raw_files = dict()
+        for instr, names in all_setups.items():
+            for name in names:
+                key = f'{instr}/{name}'
+                self.tests[key] = [{'name': test_descr['name'],
+                                    'type': test_descr['type'].name,
+                                    'factory': getattr(test_descr['factory'], '__name__', str(test_descr['factory'])),
+                                    'kwargs': kwargs}
+                                   for test_descr in all_tests
+                                   for kwargs in test_descr['setups'].get(instr, dict()).get(name, [])]
+                rawdir = os.path.join(self.raw_data, instr, name)
+                if os.path.isdir(rawdir):
+                    self.raw_files[key] = sorted([os.path.relpath(os.path.join(root, filename), rawdir)
+                                                  for root, dirs, filenames in os.walk(rawdir)
+                                                  for filename in filenames])
+
+    def write(self):
+        """Write the manifest to its file. A dev suite directory that can't be written to is left without one."""
+        tmp_file = self.file + '.tmp'
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump({'version': self.version, 'stamps': self._stamps, 'setups': self.setups,
+                           'tests': self.tests, 'raw_files': self.raw_files}, f)
+            os.replace(tmp_file, self.file)
+        except OSError:
+            pass
+
+    def setup_tests(self, setup_key):
+        """Return the tests of a test setup, as described for the ``tests`` attribute."""
+        return self.tests.get(setup_key, [])
+
+    def missing_raw_data(self, setup_keys):
+        """Find the raw data missing for test setups.
+
+        Args:
+            setup_keys (list of str): The instr/setup keys of the test setups.
+
+        Returns:
+            list of str: The raw data directories that don't exist, and the raw files named by the setups' tests
+            (e.g. the files reduced by a quick look test) that aren't in their directories.
+        """
+        missing = []
+        for key in setup_keys:
+            rawdir = os.path.join(self.raw_data, key)
+            if key not in self.raw_files:
+                missing.append(rawdir)
+                continue
+            raw_files = set(self.raw_files[key])
+            for test in self.setup_tests(key):
+                for file in test['kwargs'].get('files', []):
+                    path = os.path.join(rawdir, file)
+                    if isinstance(file, str) and file not in raw_files and path not in missing:
+                        missing.append(path)
+        return missing
+
+
+def source_stamps(raw_data):
+    """Get the modification times of the files and directories the manifest is built from.
+
+    Args:
+        raw_data (str): The RAW_DATA directory.
+
+    Returns:
+        dict: Maps the path of test_setups.py, setups.py, RAW_DATA, and the instrument and setup directories in
+        RAW_DATA to their modification times in nanoseconds. Paths in RAW_DATA are relative to it.
+    """
+    stamps = {file: os.stat(os.path.join(_TEST_SCRIPTS_DIR, file)).st_mtime_ns
+              for file in ('test_setups.py', 'setups.py')}
+    try:
+        stamps['RAW_DATA'] = os.stat(raw_data).st_mtime_ns
+        with os.scandir(raw_data) as instr_entries:
+            for instr_entry in instr_entries:
+                if not instr_entry.is_dir():
+                    continue
+                stamps[instr_entry.name] = instr_entry.stat().st_mtime_ns
+                with os.scandir(instr_entry.path) as setup_entries:
+                    for setup_entry in setup_entries:
+                        if setup_entry.is_dir():
+                            stamps[f'{instr_entry.name}/{setup_entry.name}'] = setup_entry.stat().st_mtime_ns
+    except OSError:
+        # Without RAW_DATA, every setup is missing its raw data
+        pass
+    return stamps
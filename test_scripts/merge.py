@@ -0,0 +1,277 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Combines the results of dev suite runs that were split into shards with ``pypeit_test --shard``.
+
+Each shard's results are expected in a directory of their own, using the file names below. This is run with
+``pypeit_test merge``.
+"""
+
+import os
+import re
+import sys
+import subprocess
+import datetime
+
+from .history import TestHistory
+
+SHARD_REPORT = 'pypeit.report'
+""" str: The name of the report file (pypeit_test -r) of each shard."""
+
+SHARD_CSV = 'performance.csv'
+""" str: The name of the performance CSV file (pypeit_test --csv) of each shard."""
+
+SHARD_COVERAGE = '.coverage'
+""" str: The name of the combined coverage data file of each shard."""
+
+SHARD_HISTORY = 'test_history.json'
+""" str: The name of the test history file (pypeit_test --history) of each shard."""
+
+_ANSI_ESCAPE = re.compile(r'\x1B\[[0-9;]*m')
+""" :obj:`re.Pattern`: Matches the escape sequences used to color text in reports."""
+
+_TEST_RESULT = re.compile(r'^(?P<test>.+) Result: --- (?P<result>PASSED|FAILED|SKIPPED|TIMED OUT)'
+                          r'(?P<cached> \(from cache\))?(?: \(from an earlier run\))?\s*$')
+""" :obj:`re.Pattern`: Matches the result line of a test in a report, with the color escape sequences removed."""
+
+
+class ShardReport(object):
+    """The results of one shard, read from its report file.
+
+    Attributes:
+        file (str):           The report file.
+        setups (list of str): The test setups run by the shard.
+        body (str):           The detailed reports on the test setups and pytest runs of the shard.
+        results (list):       The (test, result, from_cache) of every test in the report, where result is PASSED,
+                              FAILED, or SKIPPED.
+        pytest_lines (list of str): The pytest result lines from the summary of the report.
+        start_time (:obj:`datetime.datetime`): When the shard started testing, or None if it isn't in the report.
+        end_time (:obj:`datetime.datetime`):   When the shard finished testing, or None if it isn't in the report.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.setups = []
+        self.results = []
+        self.pytest_lines = []
+        self.start_time = None
+        self.end_time = None
+
+        with open(file, "r") as f:
+            text = f.read()
+
+        # The summary is written last, after the detailed reports
+        summary_start = text.rfind('\nTest Summary\n')
+        if summary_start == -1:
+            # The shard didn't finish
+            summary_start = len(text)
+        lines = text[:summary_start].split('\n')
+
+        # Skip the header, which ends at the first setup or pytest report
+        body_start = len(lines)
+        in_setup_list = False
+        for i, line in enumerate(lines):
+            if line == 'Reduced data for the following setups:':
+                in_setup_list = True
+            elif in_setup_list and line.startswith('    '):
+                self.setups.append(line.strip())
+            elif line == '-------------------------' or line.endswith(' Results:'):
+                body_start = i
+                break
+            else:
+                in_setup_list = False
+        self.body = '\n'.join(lines[body_start:]).rstrip('\n')
+
+        for line in lines[body_start:]:
+            match = _TEST_RESULT.match(_ANSI_ESCAPE.sub('', line))
+            if match is not None:
+                self.results.append((match.group('test'), match.group('result'), match.group('cached') is not None))
+
+        for line in text[summary_start:].split('\n'):
+            if '--- PYTEST ' in line:
+                self.pytest_lines.append(line)
+            elif line.startswith('Testing Started at '):
+                self.start_time = datetime.datetime.fromisoformat(line[len('Testing Started at '):].strip())
+            elif line.startswith('Testing Completed at '):
+                self.end_time = datetime.datetime.fromisoformat(line[len('Testing Completed at '):].strip())
+
+
+def merge_reports(report_files, output, coverage_report=None):
+    """Combine the reports of shards into one report.
+
+    Args:
+        report_files (list of str): The report files of the shards.
+        output (file):              Where to write the combined report.
+        coverage_report (str):      The combined coverage report, or None if there's no coverage data.
+
+    Returns:
+        bool: True if every test in every shard passed.
+    """
+    shards = [ShardReport(file) for file in report_files]
+
+    print(f'Merged the reports of {len(shards)} shards:', file=output)
+    for shard in shards:
+        print(f'    {shard.file}', file=output)
+    print('', file=output)
+    print('Reduced data for the following setups:', file=output)
+    for shard in shards:
+        for setup in shard.setups:
+            print(f'    {setup}', file=output)
+    print('', file=output)
+
+    for shard in shards:
+        if len(shard.body) > 0:
+            print(shard.body, file=output)
+    print("-------------------------", file=output)
+
+    results = [result for shard in shards for result in shard.results]
+    passed = [test for test, result, from_cache in results if result == 'PASSED']
+    failed = [test for test, result, from_cache in results if result in ['FAILED', 'TIMED OUT']]
+    skipped = [test for test, result, from_cache in results if result == 'SKIPPED']
+    num_cached = len([test for test, result, from_cache in results if from_cache])
+    pytest_lines = [line for shard in shards for line in shard.pytest_lines]
+    unfinished = [shard.file for shard in shards if shard.end_time is None]
+
+    print("\nTest Summary\n--------------------------------------------------------", file=output)
+    for line in pytest_lines:
+        print(line, file=output)
+
+    num_tests = len(passed) + len(failed)
+    if len(failed) == 0:
+        print("\x1B[" + "1;32m" + f"--- PYPEIT DEVELOPMENT SUITE PASSED {len(passed)}/{num_tests} TESTS ---"
+              + "\x1B[" + "0m" + "\r", file=output)
+    else:
+        print("\x1B[" + "1;31m" + f"--- PYPEIT DEVELOPMENT SUITE FAILED {len(failed)}/{num_tests} TESTS ---"
+              + "\x1B[" + "0m" + "\r", file=output)
+        print('Failed tests:', file=output)
+        for test in failed:
+            print(f'    {test}', file=output)
+        print('Skipped tests:', file=output)
+        for test in skipped:
+            print(f'    {test}', file=output)
+    if num_cached > 0:
+        print(f'{num_cached} passed tests were restored from the cache', file=output)
+    if len(unfinished) > 0:
+        print('The following shards did not finish:', file=output)
+        for file in unfinished:
+            print(f'    {file}', file=output)
+
+    if coverage_report is not None:
+        print(f"Coverage results:", file=output)
+        with open(coverage_report, "r") as f:
+            coverage_lines = f.read().rstrip('\n').split('\n')
+        print(coverage_lines[-1], file=output)
+
+    start_times = [shard.start_time for shard in shards if shard.start_time is not None]
+    end_times = [shard.end_time for shard in shards if shard.end_time is not None]
+    if len(start_times) > 0 and len(end_times) > 0:
+        print(f"Testing Started at {min(start_times).isoformat()}", file=output)
+        print(f"Testing Completed at {max(end_times).isoformat()}", file=output)
+        print(f"Total Time: {max(end_times) - min(start_times)}", file=output)
+        shard_time = sum([shard.end_time - shard.start_time for shard in shards
+                          if shard.start_time is not None and shard.end_time is not None], datetime.timedelta())
+        print(f"Total Time of all Shards: {shard_time}", file=output)
+
+    return len(failed) == 0 and len(pytest_lines) == len([line for line in pytest_lines if ' PASSED ' in line]) \
+        and len(unfinished) == 0
+
+
+def merge_csvs(csv_files, output_file):
+    """Combine the performance CSV files of shards, keeping a single header line."""
+    with open(output_file, "w") as output:
+        header_written = False
+        for file in csv_files:
+            with open(file, "r") as f:
+                lines = f.readlines()
+            if len(lines) == 0:
+                continue
+            if not header_written:
+                output.write(lines[0])
+                header_written = True
+            output.writelines(lines[1:])
+
+
+def merge_coverage(coverage_files, outputdir):
+    """Combine the coverage data of shards and write a coverage report.
+
+    Args:
+        coverage_files (list of str): The coverage data files of the shards. They aren't changed.
+        outputdir (str):              The directory to write the combined coverage data and report to.
+
+    Returns:
+        str: The coverage report file, or None if the data couldn't be combined.
+    """
+    coverage_report = os.path.join(outputdir, 'coverage.report')
+    process = subprocess.run(["coverage", "combine", "--keep"] + [os.path.abspath(file) for file in coverage_files],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=outputdir)
+    if process.returncode != 0:
+        print("Failed to combine coverage data:", file=sys.stderr)
+        print(process.stdout.decode(), file=sys.stderr)
+        return None
+    with open(coverage_report, "w") as f:
+        subprocess.run(["coverage", "report", "-m"], stdout=f, stderr=subprocess.STDOUT, cwd=outputdir)
+    return coverage_report
+
+
+def merge_histories(history_files, output_file):
+    """Combine the test histories written by shards into one history file."""
+    history = TestHistory(output_file)
+    for file in history_files:
+        history.merge(TestHistory(file))
+    history.write()
+
+
+def parser(options=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='pypeit_test merge', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Combine the results of dev suite runs split with --shard. Each '
+                                                 f'shard directory can contain a report ({SHARD_REPORT}), performance '
+                                                 f'CSV ({SHARD_CSV}), coverage data ({SHARD_COVERAGE}), and test '
+                                                 f'history ({SHARD_HISTORY}). The combined files are written to the '
+                                                 'output directory with the same names.')
+    parser.add_argument('shard_dirs', type=str, nargs='+', help='The directories with the results of each shard.')
+    parser.add_argument('-o', '--outputdir', type=str, default='merged', help='Output folder.')
+
+    return parser.parse_args() if options is None else parser.parse_args(options)
+
+
+def main(options=None):
+    """Merge the results of shards.
+
+    Args:
+        options (list of str): The command line arguments after "merge".
+
+    Returns:
+        int: 0 if every test in every shard passed, 1 otherwise.
+    """
+    pargs = parser(options)
+    os.makedirs(pargs.outputdir, exist_ok=True)
+
+    def shard_files(name):
+        files = [os.path.join(shard_dir, name) for shard_dir in pargs.shard_dirs]
+        return [file for file in files if os.path.exists(file)]
+
+    coverage_report = None
+    coverage_files = shard_files(SHARD_COVERAGE)
+    if len(coverage_files) > 0:
+        coverage_report = merge_coverage(coverage_files, pargs.outputdir)
+
+    history_files = shard_files(SHARD_HISTORY)
+    if len(history_files) > 0:
+        merge_histories(history_files, os.path.join(pargs.outputdir, SHARD_HISTORY))
+
+    csv_files = shard_files(SHARD_CSV)
+    if len(csv_files) > 0:
+        merge_csvs(csv_files, os.path.join(pargs.outputdir, SHARD_CSV))
+
+    report_files = shard_files(SHARD_REPORT)
+    if len(report_files) != len(pargs.shard_dirs):
+        print(f'Found {len(report_files)} reports for {len(pargs.shard_dirs)} shards', file=sys.stderr)
+    with open(os.path.join(pargs.outputdir, SHARD_REPORT), "w") as output:
+        passed = merge_reports(report_files, output, coverage_report)
+    print(f'Wrote merged results to {pargs.outputdir}')
+
+    return 0 if passed and len(report_files) == len(pargs.shard_dirs) else 1
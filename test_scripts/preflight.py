@@ -0,0 +1,296 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Checks the raw data files read by the selected tests before any test is run, so that a missing or truncated raw
+frame is reported when pypeit_test starts rather than when run_pypeit reaches it hours into the run.
+
+The raw files of a test are those in the data block of its .pypeit file, and the files reduced by a quick look test
+(see :meth:`PypeItTest.raw_files`). The files are checked in parallel. A FITS file is checked by reading the headers
+of its HDUs and comparing the size they give with the size of the file. Only the primary header of a gzipped FITS
+file is read, and the uncompressed size in its gzip trailer is compared with the size a FITS file can have. A file
+that doesn't pass these checks is decompressed in full, which also checks the CRC in its trailer.
+
+The files that pass are recorded in a cache with their size and modification time, so they aren't checked again
+until they change.
+"""
+
+import os
+import gzip
+import zlib
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+PREFLIGHT_FILE = '.pypeit_test_preflight.json'
+""" str: The name of the cache of checked raw files in the dev suite directory."""
+
+PREFLIGHT_WORKERS = 16
+""" int: The number of raw files checked, or .pypeit files read, at the same time."""
+
+FITS_BLOCK = 2880
+""" int: The size of a FITS block. The headers and data of a FITS file are padded to a multiple of this."""
+
+_MAX_HEADER_BLOCKS = 1000
+""" int: The most blocks read looking for the END card of a header, so that a file that isn't FITS isn't read in full."""
+
+_FITS_SUFFIXES = ('.fits', '.fit', '.fts', '.fz')
+""" tuple: The suffixes of FITS files, after removing any ".gz". Other raw files are only checked to exist."""
+
+
+class RawFileChecker(object):
+    """Checks raw data files, remembering the files that passed.
+
+    Attributes:
+        file (str):      The cache file.
+        checked (dict):  Maps the absolute path of each file that passed to its [size, modification time in
+                         nanoseconds] when it was checked.
+        num_cached (int): The number of files of the last :meth:`check` that passed in an earlier run and haven't
+                         changed since.
+        expected_sizes (dict): Maps the absolute paths of raw files to their sizes in the data manifest (see
+                         :meth:`DataManifest.expected_sizes`). A file of a different size is damaged.
+    """
+
+    version = 1
+    """ int: The version of the cache file's format. A cache with a different version is ignored."""
+
+    def __init__(self, file, expected_sizes=None):
+        self.file = file
+        self.checked = dict()
+        self.num_cached = 0
+        self.expected_sizes = dict() if expected_sizes is None else expected_sizes
+        try:
+            with open(file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = dict()
+        if data.get('version') == self.version:
+            self.checked = data['files']
+
+    def write(self):
+        """Write the cache to its file. A dev suite directory that can't be written to is left without one."""
+        tmp_file = self.file + '.tmp'
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump({'version': self.version, 'files': self.checked}, f)
+            os.replace(tmp_file, self.file)
+        except OSError:
+            pass
+
+    def check(self, files, num_workers=PREFLIGHT_WORKERS):
+        """Check raw files, and write the files that passed to the cache.
+
+        Args:
+            files (list of str): The raw files.
+            num_workers (int): The number of files checked at the same time.
+
+        Returns:
+            tuple: The sorted list of the files that don't exist, and a dict mapping each file that exists but is
+            damaged to a description of the problem.
+        """
+        to_check = []
+        stats = dict()
+        missing = []
+        problems = dict()
+        self.num_cached = 0
+        for file in sorted(set([os.path.abspath(file) for file in files])):
+            try:
+                stat = os.stat(file)
+            except OSError:
+                missing.append(file)
+                continue
+            stats[file] = [stat.st_size, stat.st_mtime_ns]
+            expected_size = self.expected_sizes.get(file)
+            if expected_size is not None and expected_size != stat.st_size:
+                problems[file] = f"is {stat.st_size} bytes, but the data manifest says it's {expected_size} bytes"
+                self.checked.pop(file, None)
+            elif self.checked.get(file) == stats[file]:
+                self.num_cached += 1
+            else:
+                to_check.append(file)
+
+        if len(to_check) > 0:
+            with ThreadPoolExecutor(max_workers=max(min(len(to_check), num_workers), 1)) as executor:
+                results = list(executor.map(check_raw_file, to_check))
+            for file, problem in zip(to_check, results):
+                if problem is None:
+                    self.checked[file] = stats[file]
+                else:
+                    problems[file] = problem
+                    self.checked.pop(file, None)
+            self.write()
+        return missing, problems
+
+
+def check_raw_file(file):
+    """Check that a raw file is complete.
+
+    Args:
+        file (str): The raw file, which exists.
+
+    Returns:
+        str: A description of the problem with the file, or None if it passed.
+    """
+    try:
+        size = os.path.getsize(file)
+        if size == 0:
+            return "is empty"
+        name = file[:-3] if file.endswith('.gz') else file
+        if not name.lower().endswith(_FITS_SUFFIXES):
+            return None
+        if file.endswith('.gz'):
+            return check_gzipped_fits(file, size)
+        with open(file, "rb") as f:
+            return check_fits(f, size)
+    except OSError as e:
+        return f"could not be read: {e}"
+
+
+def check_fits(f, size):
+    """Check that a FITS file has all of the data its headers describe.
+
+    Args:
+        f (file-like): The file, opened in binary mode.
+        size (int): The size of the file.
+
+    Returns:
+        str: A description of the problem with the file, or None if it passed.
+    """
+    offset = 0
+    while offset < size:
+        f.seek(offset)
+        cards, header_size = read_fits_header(f, primary=offset == 0)
+        if cards is None:
+            if offset == 0:
+                return "has no readable FITS primary header"
+            # Anything after the last HDU isn't part of the FITS file
+            break
+        offset += header_size + fits_data_size(cards)
+    if offset > size:
+        return f"is truncated: it is {size} bytes, and its FITS headers describe {offset} bytes"
+    return None
+
+
+def check_gzipped_fits(file, size):
+    """Check that a gzipped FITS file has a readable primary header and a valid gzip trailer.
+
+    The last four bytes of a gzip file are the size of the uncompressed data (modulo 2**32). For a complete FITS file
+    this is a multiple of the FITS block size that covers at least the primary HDU. The trailer of a truncated file is
+    whatever bytes it was cut off at, so it rarely passes this check. A file whose trailer doesn't pass is decompressed
+    in full to be sure, as the size in the trailer of a file of more than 4 GiB doesn't pass either.
+
+    Args:
+        file (str): The file.
+        size (int): The size of the file.
+
+    Returns:
+        str: A description of the problem with the file, or None if it passed.
+    """
+    with open(file, "rb") as f:
+        if f.read(2) != b'\x1f\x8b':
+            return "is not a gzip file"
+        f.seek(max(size - 4, 0))
+        isize = struct.unpack('<I', f.read(4).rjust(4, b'\0'))[0]
+
+    try:
+        with gzip.open(file, "rb") as f:
+            cards, header_size = read_fits_header(f, primary=True)
+    except (EOFError, zlib.error, gzip.BadGzipFile):
+        cards = None
+    if cards is None:
+        return "has no readable FITS primary header"
+    if isize % FITS_BLOCK == 0 and isize >= header_size + fits_data_size(cards):
+        return None
+
+    # Read the whole file, which checks its CRC and size
+    try:
+        with gzip.open(file, "rb") as f:
+            while len(f.read(1 << 24)) > 0:
+                pass
+    except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+        return f"has an invalid gzip trailer: {e}"
+    return None
+
+
+def read_fits_header(f, primary=True):
+    """Read a FITS header.
+
+    Args:
+        f (file-like): The file, positioned at the start of the header.
+        primary (bool): Whether it's the primary header, which starts with SIMPLE, rather than an extension header,
+            which starts with XTENSION.
+
+    Returns:
+        tuple: A dict mapping the keywords of the header's cards to their values (as strings), and the size of the
+        header in bytes. The dict is None if the header couldn't be read.
+    """
+    cards = dict()
+    for i in range(_MAX_HEADER_BLOCKS):
+        block = f.read(FITS_BLOCK)
+        if len(block) < FITS_BLOCK:
+            return None, 0
+        if i == 0 and not block.startswith(b'SIMPLE  =' if primary else b'XTENSION='):
+            return None, 0
+        for start in range(0, FITS_BLOCK, 80):
+            card = block[start:start + 80].decode('ascii', errors='replace')
+            keyword = card[:8].strip()
+            if keyword == 'END':
+                return cards, (i + 1) * FITS_BLOCK
+            if card[8:10] == '= ':
+                cards[keyword] = card[10:].split('/')[0].strip()
+    return None, 0
+
+
+def fits_data_size(cards):
+    """Return the size in bytes of the data of an HDU, padded to the FITS block size.
+
+    Args:
+        cards (dict): The cards of the HDU's header, as returned by :func:`read_fits_header`.
+
+    Returns:
+        int: The size, or 0 if the header has no data or its size can't be worked out from the header.
+    """
+    try:
+        naxis = int(cards.get('NAXIS', '0'))
+        if naxis == 0:
+            return 0
+        axes = [int(cards[f'NAXIS{i + 1}']) for i in range(naxis)]
+        # Random groups have an NAXIS1 of 0
+        if axes[0] == 0 and cards.get('GROUPS') == 'T':
+            axes = axes[1:]
+        num_values = 1
+        for axis in axes:
+            num_values *= axis
+        bits = abs(int(cards['BITPIX'])) * int(cards.get('GCOUNT', '1')) * (int(cards.get('PCOUNT', '0')) + num_values)
+    except (KeyError, ValueError):
+        return 0
+    size = bits // 8
+    return -(-size // FITS_BLOCK) * FITS_BLOCK
+
+
+def find_raw_files(setups, num_workers=PREFLIGHT_WORKERS):
+    """Find the raw files read by the tests of test setups.
+
+    Test setups without a raw data directory are skipped, as pypeit_test already warns that their tests will fail.
+
+    Args:
+        setups (list of :obj:`TestSetup`): The test setups.
+        num_workers (int): The number of tests whose raw files (e.g. by reading their .pypeit files) are found at the
+            same time.
+
+    Returns:
+        list of str: The raw files.
+    """
+    def test_raw_files(test):
+        try:
+            return test.raw_files()
+        except Exception:
+            # A .pypeit file that can't be read is reported by run_pypeit as soon as it starts
+            return []
+
+    tests = [test for setup in setups if os.path.isdir(setup.rawdir) for test in setup.tests]
+    if len(tests) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=max(min(len(tests), num_workers), 1)) as executor:
+        return [file for files in executor.map(test_raw_files, tests) for file in files]
@@ -0,0 +1,136 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Combines the cProfile output of the tests of a dev suite run (``pypeit_test --profile``) into a report that ranks the
+PypeIt functions by the time spent in them, across the whole suite and for each instrument.
+"""
+
+import os
+import pstats
+from collections import defaultdict
+
+TOP_FUNCTIONS = 40
+""" int: The number of functions listed in each ranking of the profile report."""
+
+
+def pypeit_path(file):
+    """Get the path of a source file within the PypeIt package.
+
+    Args:
+        file (str): The source file of a function in a profile.
+
+    Returns:
+        str: The path starting from the last ``pypeit`` directory in the file's path (e.g. pypeit/core/arc.py), or
+        None if the file isn't part of PypeIt.
+    """
+    parts = file.replace(os.sep, '/').split('/')
+    for i in range(len(parts) - 2, -1, -1):
+        if parts[i] == 'pypeit':
+            return '/'.join(parts[i:])
+    return None
+
+
+def merge_profiles(profile_files):
+    """Merge cProfile output files.
+
+    Args:
+        profile_files (list of str): The cProfile output files.
+
+    Returns:
+        tuple: The merged :obj:`pstats.Stats`, or None if none of the files could be read, and the number of files
+        that were merged.
+    """
+    stats = None
+    num_merged = 0
+    for file in profile_files:
+        try:
+            if stats is None:
+                stats = pstats.Stats(file)
+            else:
+                stats.add(file)
+            num_merged += 1
+        except (OSError, EOFError, TypeError, ValueError):
+            # A test that crashed or was killed may not have written its profile
+            continue
+    return stats, num_merged
+
+
+def rank_functions(stats, sort_by, num_functions=TOP_FUNCTIONS):
+    """Rank the PypeIt functions in a profile.
+
+    Args:
+        stats (:obj:`pstats.Stats`): The profile.
+        sort_by (str): ``cumtime`` to rank by the time spent in the functions and the functions they call, or
+            ``tottime`` to rank by the time spent in the functions themselves.
+        num_functions (int): The number of functions to return.
+
+    Returns:
+        list: The (function, number of calls, tottime, cumtime) of the top functions, where the function is
+        "path:line(name)" with the path within PypeIt.
+    """
+    functions = []
+    for (file, line, name), (primitive_calls, calls, tottime, cumtime, callers) in stats.stats.items():
+        path = pypeit_path(file)
+        if path is not None:
+            functions.append((f'{path}:{line}({name})', calls, tottime, cumtime))
+    index = 3 if sort_by == 'cumtime' else 2
+    return sorted(functions, key=lambda function: function[index], reverse=True)[:num_functions]
+
+
+def write_rankings(stats, title, output, num_functions=TOP_FUNCTIONS):
+    """Write the rankings of the PypeIt functions in a profile by cumulative and self time.
+
+    Args:
+        stats (:obj:`pstats.Stats`): The profile.
+        title (str): What the profile is of, shown in the headings of the rankings.
+        output (file): Where to write the rankings.
+        num_functions (int): The number of functions in each ranking.
+    """
+    for sort_by, description in [('cumtime', 'cumulative time'), ('tottime', 'self time')]:
+        heading = f'PypeIt functions by {description}: {title}'
+        print(heading, file=output)
+        print('-' * len(heading), file=output)
+        print(f"{'cumtime (s)':>12} {'tottime (s)':>12} {'calls':>10}  function", file=output)
+        for function, calls, tottime, cumtime in rank_functions(stats, sort_by, num_functions):
+            print(f'{cumtime:12.2f} {tottime:12.2f} {calls:10d}  {function}', file=output)
+        print('', file=output)
+
+
+def write_profile_report(setups, report_file, num_functions=TOP_FUNCTIONS):
+    """Merge the profiles of the tests that were run and write a report ranking the PypeIt functions by time.
+
+    The merged profile of the whole suite is also written next to the report, with a ``.pstats`` extension, so it
+    can be explored with other tools (e.g. ``python -m pstats`` or snakeviz).
+
+    Args:
+        setups (list of :obj:`TestSetup`): The test setups that were run.
+        report_file (str): The report file to write.
+        num_functions (int): The number of functions in each ranking.
+
+    Returns:
+        int: The number of test profiles in the report.
+    """
+    profile_files = defaultdict(list)
+    for setup in setups:
+        for test in setup.tests:
+            if test.profile_file is not None:
+                profile_files[setup.instr].append(test.profile_file)
+
+    with open(report_file, "w") as f:
+        suite_stats, num_profiles = merge_profiles([file for files in profile_files.values() for file in files])
+        if suite_stats is None:
+            print("No test profiles were found.", file=f)
+            return 0
+
+        suite_stats.dump_stats(os.path.splitext(report_file)[0] + '.pstats')
+        print(f'Merged the profiles of {num_profiles} tests\n', file=f)
+        write_rankings(suite_stats, f'all instruments ({num_profiles} tests)', f, num_functions)
+
+        for instr in sorted(profile_files.keys()):
+            stats, num_instr_profiles = merge_profiles(profile_files[instr])
+            if stats is not None:
+                write_rankings(stats, f'{instr} ({num_instr_profiles} tests)', f, num_functions)
+
+    return num_profiles
@@ -8,27 +8,64 @@ Classes and utility functions for running individual pypeit tests.
 
 
 import os.path
+import re
+import sys
 import shutil
-import subprocess
+import signal
+import asyncio
 import datetime
 import traceback
 import glob
 from abc import ABC, abstractmethod
+from threading import Lock
 
 import psutil
 
-from astropy.table import Table
-import numpy as np
+from .accounting import ResourceUsage, wrap_command
+from .coverage_data import coverage_env
+from .preflight import read_fits_header
 
-from pypeit import inputfiles
+_COVERAGE_ARGS = ["--source", "pypeit", "--omit", "*PypeIt/pypeit/tests/*,*PypeIt/pypeit/deprecated/*", "--parallel-mode"] 
 
-from IPython import embed
+_unique_file_lock = Lock()
+""":obj:`threading.Lock`: Prevents tests running at the same time from picking the same unique file name."""
+
+_pypeit_imported = False
+"""bool: Whether :func:`import_pypeit` has imported PypeIt."""
+
+
+def import_pypeit():
+    """Import PypeIt, the first time it's needed.
+
+    PypeIt takes seconds to import, so it's only imported by the code that uses it rather than when pypeit_test
+    starts. Its logging is turned off when it's imported, to stop the logging from pypeit.par.utils when
+    reading and writing coadd1d files.
+
+    Returns:
+        module: The ``pypeit`` package.
+    """
+    global _pypeit_imported
+    import pypeit
+    if not _pypeit_imported:
+        pypeit.msgs.reset(verbosity=0)
+        _pypeit_imported = True
+    return pypeit
 
-_COVERAGE_ARGS = ["--source", "pypeit", "--omit", "*PypeIt/pypeit/tests/*,*PypeIt/pypeit/deprecated/*", "--parallel-mode"] 
 
 class PypeItTest(ABC):
     """Abstract base class for classes that run pypeit tests and hold the results from those tests."""
 
+    cacheable = True
+    """bool: Whether the results of the test can be restored from a :obj:`ResultCache`."""
+
+    stack_dump_wait = 10.0
+    """float: Seconds to wait for the processes of a test that timed out to write their stack traces before they're
+    killed."""
+
+    stop_wait = 10.0
+    """float: Seconds to wait for the processes of a test that was stopped (e.g. by a CTRL+C) to exit before they're
+    killed."""
+
 
     def __init__(self, setup, pargs, description, log_suffix):
         """
@@ -44,8 +81,16 @@ class PypeItTest(ABC):
         self.description = description
         self.log_suffix = log_suffix
         self.coverage = pargs.coverage is not None
+        self.profile = pargs.profile is not None and not self.coverage
+        """ bool: Whether to run the test's child under cProfile. Coverage runs aren't profiled."""
+        self.cgroup = pargs.cgroup
+        """ str: The cgroup v2 directory to create the cgroup of each test's child in, or None for the default (see
+        :func:`accounting.wrap_command`)."""
         self.env = os.environ
         """ :obj:`Mapping`: OS Environment to run the test under."""
+        self.coverage_collector = None
+        """ :obj:`CoverageCollector`: Combines the coverage data of the test's child when it exits, in coverage
+        runs."""
 
         self.passed = None
         """ bool: True if the test passed, False if the test failed, None if the test is in progress"""
@@ -59,6 +104,9 @@ class PypeItTest(ABC):
         self.logfile = None
         """ str: The log file for the test """
 
+        self.profile_file = None
+        """ str: The cProfile output of the test's child, next to its log file. Only set when profiling."""
+
         self.pid = None
         """ int: The process id of the child process than ran the test"""
 
@@ -69,7 +117,59 @@ class PypeItTest(ABC):
         """ :obj:`datetime.datetime`: The date and time the test finished."""
 
         self.max_mem = None
-        """ :obj:`int`: The maximum memory used by the test."""
+        """ :obj:`int`: The maximum memory used by the test. This is the larger of the peak memory in ``usage``
+        and the peak of the samples of the resident memory of the test's processes."""
+
+        self.usage = None
+        """ :obj:`ResourceUsage`: The resources used by the test's processes."""
+
+        self.timeout = None
+        """ float: Seconds the test can run for before it's stopped, or None to let it run for as long as it takes.
+        See :func:`test_main.get_timeout`."""
+
+        self.timed_out = False
+        """ bool: True if the test was stopped because it ran for longer than its timeout."""
+
+        self.cpu_samples = []
+        """ :obj:`list`: The (:obj:`datetime.datetime`, seconds) of each sample of the CPU time used by the test's
+        child process and its descendants."""
+
+        self.worker = None
+        """ int: The worker slot, from 0 to the number of parallel tests - 1, that ran the test."""
+
+        self.dependencies = []
+        """ :obj:`list` of :obj:`PypeItTest`: Tests that must pass before this test can run. These are in the same
+        setup, except for the tests of other setups that a :obj:`PypeItVetTest` uses the results of."""
+
+        self.zygote = None
+        """ :obj:`PypeItZygote`: If set, the zygote process used to run the test instead of a new Python process."""
+
+        self.cache = None
+        """ :obj:`ResultCache`: If set, the cache used to skip the test if its inputs haven't changed."""
+
+        self.cache_key = None
+        """ str: The key of the test's inputs (see :obj:`TestKeys`), which identifies its results in the cache and
+        the journal."""
+
+        self.from_cache = False
+        """ bool: True if the test's results were restored from the cache rather than running the test."""
+
+        self.journal = None
+        """ :obj:`RunJournal`: If set, the journal the test is recorded in, and restored from if it passed in an
+        earlier run that is being resumed."""
+
+        self.resumed = False
+        """ bool: True if the test passed in an earlier run that was resumed, and wasn't run again."""
+
+        self.references = None
+        """ :obj:`ReferenceCache`: If set, fetches the reference files the test reads (see :meth:`reference_files`)
+        into its cache and links them into PypeIt before the test's child runs."""
+
+        self._process = None
+        """ :obj:`psutil.Process`: The running child process, used to sample its memory."""
+
+        self._usage_file = None
+        """ str: The file the accounting script writes the resource usage of the child to, if it's run by it."""
 
 
     def __str__(self):
@@ -83,7 +183,7 @@ class PypeItTest(ABC):
         """Return a unique logifle name for the test"""
         # Get a unique log file to prevent a test from overwriting the log from a previous test
         name = '{0}_{1}.{2}.log'.format(self.setup.instr.lower(), self.setup.name.lower(), self.log_suffix)
-        return get_unique_file(os.path.join(self.setup.rdxdir, name))
+        return claim_unique_file(os.path.join(self.setup.rdxdir, name))
 
 
 
@@ -91,68 +191,21 @@ class PypeItTest(ABC):
     def build_command_line(self):
         pass
 
-    def run(self):
-        """Run a test in a child process."""
+    async def run(self):
+        """Run a test in a child process, or restore its results from the journal of a resumed run or the cache."""
 
         try:
             # Open a log for the test
-            child = None
             self.logfile = self.get_logfile()            
             self.command_line = self.build_command_line()
 
-            with open(self.logfile, "a") as f:
-                if self.coverage:
-                    # Coverage will need the full path to the script
-                    full_path_to_command = shutil.which(self.command_line[0])
-                    if full_path_to_command is not None:
-                        self.command_line[0] = full_path_to_command
-                    else:
-                        raise RuntimeError(f"Could not find full path for {self.command_line[0]}")
-
-                    self.command_line = ["coverage", "run"] + _COVERAGE_ARGS + self.command_line
-                if self.start_time is None:
-                    # If a subclass sets the start time or calls run multiple times,
-                    # (see deimos QL) use the first value as the start rather than overwriting it.
-                    self.start_time = datetime.datetime.now()
-                    
-                with subprocess.Popen(self.command_line, stdout=f, stderr=f, env=self.env, cwd=self.setup.rdxdir) as child:
-                    try:
-                        self.pid = child.pid
-                        returncode = None
-                        process = psutil.Process(self.pid)
-                        
-                        if self.max_mem is None:
-                            # Don't overwrite previous max_mem if run() is called multiple times.
-                            self.max_mem = 0
-
-                        while returncode is None:
-                            # Try to get memory usage information for the child,
-                            # ignore errors if we can't
-                            try:
-                                mem = process.memory_full_info().uss
-                                if self.max_mem < mem:
-                                    self.max_mem = mem
-                            except psutil.NoSuchProcess:
-                                pass
-                            except psutil.AccessDenied:
-                                pass
-                            # Wait 2 seconds for the child before checking the memory again
-                            try:
-                                returncode = child.wait(2)
-                            except subprocess.TimeoutExpired:
-                                # Normal, means the child didn't finish within the 2 second timeout
-                                pass
-
-                        self.end_time = datetime.datetime.now()
-                        self.passed = (child.returncode == 0)
-                    finally:
-                        # If an exception (possibly a CTRL+C) escapes the while loop around the child.wait(),
-                        # the child process may still be running. 
-                        # If it is running, we make sure to terminate the child here, as the Popen context
-                        # will wait for the child to finish
-                        if child.poll() is None:
-                            child.terminate()
-
+            if self.journal is not None and await self.journal.restore(self):
+                # The test passed in an earlier run that was stopped before it finished
+                pass
+            elif self.cache is not None and self.cacheable:
+                await self.cache.run_test(self)
+            else:
+                await self.run_child()
 
         except Exception:
             # An exception occurred while running the test
@@ -163,21 +216,258 @@ class PypeItTest(ABC):
 
         return self.passed
 
+    async def run_child(self):
+        """Run the test's command line in a child process, logging its output to the test's log file.
+
+        The memory and CPU time of the child are sampled when it starts, and then periodically by the test runner
+        (see :meth:`sample_memory` and :meth:`sample_cpu`) while waiting for the child to finish. The resources it
+        used are accounted for when it finishes (see :mod:`accounting`), falling back to the samples if that isn't
+        available. If the test runs for longer than its timeout, the child is stopped (see :meth:`stop_hung_child`).
+        """
+
+        if self.references is not None:
+            await self.references.provide(self)
+
+        with open(self.logfile, "a") as f:
+            if self.coverage:
+                # Coverage will need the full path to the script
+                full_path_to_command = shutil.which(self.command_line[0])
+                if full_path_to_command is not None:
+                    self.command_line[0] = full_path_to_command
+                else:
+                    raise RuntimeError(f"Could not find full path for {self.command_line[0]}")
+
+                # Each test has its own context, so the code it runs can be found in the combined data
+                coverage_args = _COVERAGE_ARGS + ["--context", str(self)]
+                if self.coverage_collector is not None:
+                    coverage_args += ["--data-file", self.coverage_collector.test_data_file(self)]
+                self.command_line = ["coverage", "run"] + coverage_args + self.command_line
+            elif self.profile:
+                # cProfile also needs the full path to the script
+                full_path_to_command = shutil.which(self.command_line[0])
+                if full_path_to_command is None:
+                    raise RuntimeError(f"Could not find full path for {self.command_line[0]}")
+                self.profile_file = os.path.splitext(self.logfile)[0] + '.pstats'
+                self.command_line = [sys.executable, "-m", "cProfile", "-o", self.profile_file,
+                                     full_path_to_command] + self.command_line[1:]
+            if self.start_time is None:
+                # If a subclass sets the start time or calls run multiple times,
+                # (see deimos QL) use the first value as the start rather than overwriting it.
+                self.start_time = datetime.datetime.now()
+                
+            child = await self.start_child(f)
+            try:
+                self.pid = child.pid
+                if self.max_mem is None:
+                    # Don't overwrite previous max_mem if run() is called multiple times.
+                    self.max_mem = 0
+                try:
+                    self._process = psutil.Process(self.pid)
+                except psutil.NoSuchProcess:
+                    pass
+                self.sample_memory()
+                self.sample_cpu()
+
+                if self.timeout is None:
+                    await child.wait()
+                else:
+                    # The timeout is from the start of the test, which may run more than one child
+                    remaining = self.timeout - (datetime.datetime.now() - self.start_time).total_seconds()
+                    try:
+                        await asyncio.wait_for(child.wait(), max(remaining, 0.0))
+                    except asyncio.TimeoutError:
+                        await self.stop_hung_child(child, f)
+                self.end_time = datetime.datetime.now()
+                self.passed = (child.returncode == 0) and not self.timed_out
+                self.account_for_usage(child)
+            finally:
+                # If the test is cancelled (possibly by a CTRL+C or SIGTERM) while waiting for the child, the child
+                # may still be running. If it is, its processes are terminated, and killed if they don't exit in time.
+                if child.returncode is None:
+                    processes = self.child_processes()
+                    if len(processes) == 0:
+                        try:
+                            child.terminate()
+                        except ProcessLookupError:
+                            pass
+                    await stop_processes(child, processes, signal.SIGTERM, self.stop_wait)
+                self._process = None
+                if self.coverage and self.coverage_collector is not None:
+                    self.coverage_collector.test_completed(self)
+
+    def child_processes(self):
+        """Return the running processes of the test's child and its descendants.
+
+        Returns:
+            list of :obj:`psutil.Process`: The processes. This doesn't include the accounting script the child is
+            run by, which reports how the child ended.
+        """
+        if self._process is None:
+            return []
+        try:
+            processes = self._process.children(recursive=True)
+        except psutil.Error:
+            return []
+        if self._usage_file is None:
+            processes.insert(0, self._process)
+        return processes
+
+    async def stop_hung_child(self, child, log):
+        """Stop the child of a test that ran for longer than its timeout.
+
+        The Python processes of the test write the stack traces of all of their threads to the test's log before
+        exiting, as they're run with faulthandler enabled (see :meth:`start_child`) and are sent SIGABRT. Any of the
+        test's processes that are still running after :attr:`stack_dump_wait` seconds are killed.
+
+        Args:
+            child (:obj:`asyncio.subprocess.Process` or :obj:`ZygoteChild`): The running child process.
+            log (file): The open log file of the test.
+        """
+        self.timed_out = True
+        self.error_msgs.append(f"Timed out after {self.timeout:.0f} seconds. The stack traces of the test's Python "
+                               f"processes are in its log.")
+
+        # The processes are found before any of them exit, as their children are then no longer their descendants
+        processes = self.child_processes()
+        print(f"\npypeit_test: Timed out after {self.timeout:.0f} seconds, dumping the stacks of processes "
+              f"{', '.join(str(process.pid) for process in processes)}\n", file=log, flush=True)
+        for process in processes:
+            try:
+                # Don't fill the disk with core dumps of the aborted processes
+                process.rlimit(psutil.RLIMIT_CORE, (0, process.rlimit(psutil.RLIMIT_CORE)[1]))
+            except (psutil.Error, AttributeError, ValueError):
+                pass
+        await stop_processes(child, processes, signal.SIGABRT, self.stack_dump_wait)
+
+    def account_for_usage(self, child):
+        """Set the resources used by the test's child after it finishes.
+
+        Args:
+            child (:obj:`asyncio.subprocess.Process` or :obj:`ZygoteChild`): The finished child process.
+        """
+        # Children forked from the zygote are accounted for by the zygote
+        usage = getattr(child, 'usage', None)
+        if usage is None and self._usage_file is not None:
+            usage = ResourceUsage.read(self._usage_file)
+            if os.path.exists(self._usage_file):
+                os.unlink(self._usage_file)
+        if usage is None:
+            usage = ResourceUsage('sampled', peak_rss=self.max_mem)
+        self.usage = usage
+        if usage.peak_rss is not None and usage.peak_rss > self.max_mem:
+            self.max_mem = usage.peak_rss
+
+    def sample_memory(self):
+        """Sample the resident memory of the test's running child process and its descendants, updating max_mem.
+
+        This reads the cheap memory summary of each process rather than its memory maps, and is a fallback for, and a
+        check on, the peak memory accounted for when the child finishes.
+        """
+        if self._process is None:
+            return
+        # Try to get memory usage information for the child, ignore errors if we can't
+        try:
+            processes = self._process.children(recursive=True)
+            if self._usage_file is None:
+                # The accounting script isn't part of the test
+                processes.append(self._process)
+        except psutil.Error:
+            return
+        mem = 0
+        for process in processes:
+            try:
+                mem += process.memory_info().rss
+            except psutil.Error:
+                pass
+        if self.max_mem < mem:
+            self.max_mem = mem
+
+    def sample_cpu(self):
+        """Sample the CPU time used by the test's running child process and its descendants, adding it to
+        cpu_samples."""
+        if self._process is None:
+            return
+        try:
+            processes = [self._process] + self._process.children(recursive=True)
+        except psutil.Error:
+            return
+        cpu = 0.0
+        for process in processes:
+            # The children times are those of descendants that have exited and been waited for
+            try:
+                times = process.cpu_times()
+                cpu += times.user + times.system + times.children_user + times.children_system
+            except psutil.Error:
+                pass
+        self.cpu_samples.append((datetime.datetime.now(), cpu))
+
+    async def start_child(self, log):
+        """Start the child process for the test.
+
+        The child is forked from the zygote if there is one and it can run the test's command. Otherwise, including
+        for coverage and profiling runs, the command is run in a new process by the accounting script (see
+        :func:`accounting.wrap_command`). The child is run with faulthandler enabled, so that its stack traces can be
+        written to the log if it crashes or times out.
+
+        Args:
+            log (file): The open log file for the child's output.
+
+        Returns:
+            :obj:`asyncio.subprocess.Process` or :obj:`ZygoteChild`: The child process.
+        """
+        env = dict(self.env, PYTHONFAULTHANDLER='1')
+        if self.coverage and self.coverage_collector is not None:
+            env = coverage_env(env, self.coverage_collector.core)
+        if self.zygote is not None and not self.coverage and not self.profile and \
+                self.zygote.can_run(self.command_line):
+            self._usage_file = None
+            return await self.zygote.start_child(self.command_line, self.logfile, env=env, cwd=self.setup.rdxdir)
+        # Run the command from the accounting script, which writes the resources it used next to the log
+        self._usage_file = os.path.splitext(self.logfile)[0] + '.usage.json'
+        command_line = wrap_command(self.command_line, self._usage_file, self.cgroup)
+        return await asyncio.create_subprocess_exec(*command_line, stdout=log, stderr=log, env=env,
+                                                    cwd=self.setup.rdxdir)
+
     def check_for_missing_files(self):
         """Return a list of any missing files the test requires. This is called before testing begins, so
         files generated during testing should be included"""
         return []
 
+    def cache_inputs(self):
+        """Return a list of the input files the test's results depend on, other than the files named on its command
+        line. These are used to build the test's key in the :obj:`ResultCache`."""
+        return []
+
+    def own_files(self):
+        """Return the files and directories the test writes that no other test uses, such as its log. Other tests of
+        the setup can write to its output directory at the same time as a test using the :obj:`ResultCache`, so
+        these are left out of the outputs the cache stores for it."""
+        return [file for file in [self.logfile, self.profile_file] if file is not None]
+
+    def raw_files(self):
+        """Return a list of the raw data files the test reads. These are checked before testing begins, see
+        :mod:`preflight`."""
+        return []
+
+    def reference_files(self):
+        """Return the names of the large reference files the test reads that PypeIt doesn't install, which are
+        fetched into the reference cache when the test runs (see :mod:`reference_data`)."""
+        return []
+
 
 class PypeItSetupTest(PypeItTest):
     """Test subclass that runs pypeit_setup"""
+
+    # The test sets up the later tests of the setup as well as running pypeit_setup
+    cacheable = False
+
     def __init__(self, setup, pargs):
         super().__init__(setup, pargs, "pypeit_setup", "setup")
         setup.generate_pyp_file = True
 
-    def run(self):
+    async def run(self):
 
-        if super().run():
+        if await super().run():
             # Check for the pypeit file after running the test
             rdxdir = os.path.join(self.setup.rdxdir, self.setup.instr.lower() + '_A')
             pyp_file = os.path.join(
@@ -242,6 +532,18 @@ class PypeItReduceTest(PypeItTest):
         else:
             return []
 
+    def cache_inputs(self):
+        import_pypeit()
+        from pypeit import inputfiles
+
+        # The raw data files in the data block of the pypeit file
+        files = inputfiles.PypeItFile.from_file(self.pyp_file).filenames
+        return [file for file in files if file is not None]
+
+    def raw_files(self):
+        # A pypeit file written by pypeit_setup doesn't exist until the test setup is run
+        return [] if self.setup.generate_pyp_file else self.cache_inputs()
+
 class PypeItSensFuncTest(PypeItTest):
     """Test subclass that runs pypeit_sensfunc"""
     def __init__(self, setup, pargs, std_file, sens_file=None):
@@ -252,7 +554,7 @@ class PypeItSensFuncTest(PypeItTest):
         if self.sens_file is not None:
             self.sens_file = os.path.join(setup.dev_path, 'sensfunc_files', self.sens_file)
 
-    def run(self):
+    async def run(self):
 
         search_pattern = os.path.join(self.setup.rdxdir, "Science", self.std_file)
         files = glob.glob(search_pattern)
@@ -265,7 +567,7 @@ class PypeItSensFuncTest(PypeItTest):
             self.passed = False
         else:
             self.std_file = files[0]
-            return super().run()
+            return await super().run()
 
     def build_command_line(self):
         command_line = ['pypeit_sensfunc', self.std_file]
@@ -281,6 +583,11 @@ class PypeItSensFuncTest(PypeItTest):
         else:
             return []
 
+    def reference_files(self):
+        # The std file has been found by the time the child runs
+        grid = telluric_grid(self.sens_file, self.std_file, sensfunc=True)
+        return [] if grid is None else [grid]
+
 
 class PypeItFluxSetupTest(PypeItTest):
     """Test subclass that runs pypeit_flux_setup"""
@@ -335,6 +642,11 @@ class PypeItCoadd1DTest(PypeItTest):
 
     def build_command_line(self):
 
+        import numpy as np
+        from astropy.table import Table
+        import_pypeit()
+        from pypeit import inputfiles
+
         # Double check the object ids in the coadd file to see if they are slightly off.
         # Correct them if they are
 
@@ -463,6 +775,10 @@ class PypeItTelluricTest(PypeItTest):
         command_line += ['-t', f'{self.tell_file}']
         return command_line
 
+    def reference_files(self):
+        grid = telluric_grid(self.tell_file, os.path.join(self.setup.rdxdir, self.coadd_file), sensfunc=False)
+        return [] if grid is None else [grid]
+
 class PypeItCollate1DTest(PypeItTest):
     """Test subclass that runs pypeit_collate_1d"""
     def __init__(self, setup, pargs, files, **options):
@@ -501,8 +817,13 @@ class PypeItQuickLookTest(PypeItTest):
        The specific test script run depends on the instrument type.
     """
 
+    # The QL calibrations and outputs are outside of the setup's output directory
+    cacheable = False
+
     def __init__(self, setup, pargs, files:list,  test_name:str=None, **options):
-        super().__init__(setup, pargs, "pypeit_ql", "test_ql")
+        # Include the test name in the description so each QL test of a setup can be told apart
+        description = "pypeit_ql" if test_name is None else f"pypeit_ql ({test_name})"
+        super().__init__(setup, pargs, description, "test_ql")
         self.files = files
         self.options = options
         self.redux_dir = os.path.abspath(pargs.outputdir)
@@ -511,15 +832,23 @@ class PypeItQuickLookTest(PypeItTest):
         # Place the calibrations into REDUX_DIR/QL_CALIB directory.
         self.output_dir = os.path.join(self.redux_dir, 'QL_CALIB')
 
-    def build_command_line(self):
+    def raw_files(self):
+        return [os.path.join(self.setup.rawdir, file) for file in self.files]
 
-        # Redux folder
-        redux_path = os.path.join(self.redux_dir,
-                self.setup.instr, self.setup.name)
+    def redux_path(self):
+        """Return the directory the QL outputs of the test are written to."""
         last_folder = 'QL'
         if self.test_name is not None:
             last_folder += '_' + self.test_name
-        redux_path = os.path.join(redux_path, last_folder)
+        return os.path.join(self.redux_dir, self.setup.instr, self.setup.name, last_folder)
+
+    def own_files(self):
+        return super().own_files() + [self.redux_path()]
+
+    def build_command_line(self):
+
+        # Redux folder
+        redux_path = self.redux_path()
                     
         command_line = [
             'pypeit_ql', self.setup.instr,
@@ -545,7 +874,7 @@ class PypeItQuickLookTest(PypeItTest):
                     # match to the correct setup.  For some instruments, this
                     # points to the QL_CALIB directory, for others this just
                     # points one directory up from the USE_CALIB_DIR result.
-                    idir = self.output_dir if self.instr_uses_build_calib() \
+                    idir = self.output_dir if uses_ql_calibs(self.setup.instr, self.setup.name) \
                                 else os.path.dirname(self.setup.rdxdir)
                 command_line += [option, idir]
             else:
@@ -553,57 +882,159 @@ class PypeItQuickLookTest(PypeItTest):
 
         return command_line
 
-    def instr_uses_build_calib(self):
+    async def run(self):
         """
-        Check if instrument uses pre-build calibrations.
-        """
-        # NOTE: This is required if any of the QL tests set the
-        # '--parent_calib_dir' to 'USE_ARCHIVE_CALIB_DIR'.  The *only*
-        # instrument that currently does this is Keck/NIRES.  The other QL test
-        # all use the calibrations directory from the main `reduce` run as the
-        # reference calibrations; i.e., the set '--setup_calib_dir' to
-        # 'USE_CALIB_DIR'.  See test_scripts/test_setups.py.
-        return self.setup.instr == 'keck_nires' \
-                or (self.setup.instr == 'keck_mosfire' and self.setup.name == 'Y_long') # \
-#                or (self.setup.instr == 'keck_lris_red_mark4' 
-#                        and self.setup.name == 'long_600_10000_d680')
-
-    def run(self):
-        """
-        Generate any required quick-look calibration before running the quick look test.
+        Run the quick look test, using the QL calibrations built by the setup's :class:`PypeItBuildQLCalibTest`.
         """
         # TODO: Do we need a way to point at an "archive" QL_CALIB directory for
         # calibs that don't (or rarely) change?
 
-        if self.instr_uses_build_calib():
-            logfile = get_unique_file(os.path.join(self.setup.rdxdir, "build_ql_calib_output.log"))
-            try:
-                # Build the calibrations with the output going to a log file
-                with open(logfile, "w") as log:
-                    result = subprocess.run([os.path.join(self.setup.dev_path, 'build_ql_calibs'),
-                                             self.setup.instr, '-s', self.setup.name,
-                                             '--output_dir', self.output_dir,
-                                             '--redux_dir', self.redux_dir, '--force_copy'],
-                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-                    print(result.stdout if isinstance(result.stdout, str)
-                            else result.stdout.decode(errors='replace'), file=log)
-
-                if result.returncode != 0:
-                    self.error_msgs.append("Failed to generate QL calibrations.")
-                    self.passed = False
-                    return False
-            except Exception:
-                # Prevent any exceptions from escaping the "run" method
-                self.error_msgs.append("Exception building QL calibrations:")
-                self.error_msgs.append(traceback.format_exc())
-                self.passed = False
-                return False
-
         # Run the quick look test via the parent's run method, setting the environment
-        # to use the newly generated calibrations
+        # to use the generated calibrations
         self.env = os.environ.copy()
         self.env['QL_CALIB'] = self.output_dir
-        return super().run()
+        return await super().run()
+
+
+class PypeItBuildQLCalibTest(PypeItTest):
+    """Test subclass that builds the QL calibrations of a setup with build_ql_calibs. The QL calibrations are shared
+    by all of the QL tests of the setup, which depend on this test, so they're built once before any of them run
+    rather than rebuilt while another QL test is reading them."""
+
+    # The QL calibrations are outside of the setup's output directory
+    cacheable = False
+
+    def __init__(self, setup, pargs):
+        super().__init__(setup, pargs, "build_ql_calibs", "test_ql_calib")
+        self.redux_dir = os.path.abspath(pargs.outputdir)
+        self.output_dir = os.path.join(self.redux_dir, 'QL_CALIB')
+
+    def build_command_line(self):
+        return [os.path.join(self.setup.dev_path, 'build_ql_calibs'), self.setup.instr, '-s', self.setup.name,
+                '--output_dir', self.output_dir, '--redux_dir', self.redux_dir, '--force_copy']
+
+
+def uses_ql_calibs(instr, setup_name):
+    """
+    Check if the QL tests of a setup use pre-built calibrations (see :class:`PypeItBuildQLCalibTest`).
+    """
+    # NOTE: This is required if any of the QL tests set the
+    # '--parent_calib_dir' to 'USE_ARCHIVE_CALIB_DIR'.  The *only*
+    # instrument that currently does this is Keck/NIRES.  The other QL test
+    # all use the calibrations directory from the main `reduce` run as the
+    # reference calibrations; i.e., the set '--setup_calib_dir' to
+    # 'USE_CALIB_DIR'.  See test_scripts/test_setups.py.
+    return instr == 'keck_nires' \
+            or (instr == 'keck_mosfire' and setup_name == 'Y_long') # \
+#            or (instr == 'keck_lris_red_mark4'
+#                    and setup_name == 'long_600_10000_d680')
+
+
+class PypeItVetTest(PypeItTest):
+    """Test subclass that runs vet tests with pytest, as soon as the tests of the setups whose results they use have
+    passed. See :func:`test_main.add_vet_tests`."""
+
+    # The vet tests check the results of the other tests, which they don't change
+    cacheable = False
+
+    def __init__(self, setup, pargs, test_ids, other_setups=[]):
+        """
+        Constructor
+
+        Args:
+            setup (:obj:`TestSetup`): The first test setup whose results the vet tests use.
+            test_ids (list of str): The pytest node ids of the vet tests.
+            other_setups (list of str): The instr/setup keys of the other test setups whose results the vet tests use.
+        """
+        description = "vet" if len(other_setups) == 0 else f"vet (with {', '.join(other_setups)})"
+        super().__init__(setup, pargs, description, "test_vet")
+        self.test_ids = test_ids
+        self.redux_out = pargs.outputdir
+        self.show_warnings = pargs.show_warnings
+        # The profile is of the PypeIt workload, which doesn't include vetting its results
+        self.profile = False
+
+    def build_command_line(self):
+        # The cache provider is disabled because several vet tests can run at once
+        command_line = ['pytest', '-v', '-p', 'no:cacheprovider', '--redux_out', self.redux_out]
+        if not self.show_warnings:
+            command_line.append('--disable-warnings')
+        return command_line + self.test_ids
+
+
+def is_alive(process):
+    """Return whether a :obj:`psutil.Process` is running, and not a zombie waiting to be reaped."""
+    try:
+        return process.is_running() and process.status() != psutil.STATUS_ZOMBIE
+    except psutil.Error:
+        return False
+
+
+def process_tree(pid):
+    """Return a running process and its descendants.
+
+    Args:
+        pid (int): The process id.
+
+    Returns:
+        list of :obj:`psutil.Process`: The process followed by its descendants, or an empty list if it has exited.
+    """
+    try:
+        process = psutil.Process(pid)
+        return [process] + process.children(recursive=True)
+    except psutil.Error:
+        return []
+
+
+async def stop_processes(child, processes, sig, wait):
+    """Stop the processes of a child process tree within a bounded time.
+
+    The processes are sent a signal, and any still running after ``wait`` seconds are killed, followed by the child
+    if it's still running ``wait`` seconds after that. This waits for the killed processes to exit, so that their
+    memory is free for the next test.
+
+    Args:
+        child (:obj:`asyncio.subprocess.Process` or :obj:`ZygoteChild`): The child process.
+        processes (list of :obj:`psutil.Process`): The processes to stop. These should be found before any of them
+            exit, as their children are then no longer the descendants of the child.
+        sig (int): The signal to stop the processes with.
+        wait (float): Seconds to wait for the processes to exit before they're killed.
+    """
+    for process in processes:
+        try:
+            process.send_signal(sig)
+        except psutil.Error:
+            pass
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    try:
+        await asyncio.wait_for(child.wait(), wait)
+    except asyncio.TimeoutError:
+        pass
+    # The child often exits first, and its descendants get the rest of the time to handle the signal, e.g. to dump
+    # their stacks
+    while loop.time() < deadline and any([is_alive(process) for process in processes]):
+        await asyncio.sleep(0.05)
+    for process in processes:
+        try:
+            process.kill()
+        except psutil.Error:
+            pass
+    try:
+        await asyncio.wait_for(child.wait(), wait)
+    except asyncio.TimeoutError:
+        # The child wasn't one of the processes, or ignored the signal
+        try:
+            child.kill()
+        except ProcessLookupError:
+            pass
+        await child.wait()
+
+    for attempt in range(100):
+        if not any([is_alive(process) for process in processes]):
+            break
+        await asyncio.sleep(0.05)
 
 
 def pypeit_file_name(instr, setup, std=False):
@@ -672,6 +1103,21 @@ def fix_pypeit_file_directory(pyp_file:str, dev_path:str, raw_data:str,
         ofile.writelines(lines)
     return outfile
 
+def claim_unique_file(file):
+    """Get a unique file name and create an empty file with it, so that another thread
+    calling this function can't pick the same name.
+
+    Args:
+        file (str): The full pathname of the file.
+
+    Return:
+        The unique file name (see :func:`get_unique_file`).
+    """
+    with _unique_file_lock:
+        file = get_unique_file(file)
+        open(file, "a").close()
+    return file
+
 def get_unique_file(file):
     """Ensures a file name is unique on the file system, modifying it if neccessary.
 
@@ -691,3 +1137,42 @@ def get_unique_file(file):
     return file
 
 
+
+
+def telluric_grid(par_file, spec1d_file, sensfunc):
+    """Return the name of the atmospheric model grid read by pypeit_sensfunc or pypeit_tellfit.
+
+    The grid is the ``telgridfile`` in the test's parameter file, if it sets one, and otherwise the default of the
+    spectrograph the spec1d file was reduced with. pypeit_sensfunc only reads a grid with the IR algorithm.
+
+    Args:
+        par_file (str): The .sens or .tell file given to the command, or None.
+        spec1d_file (str): The spec1d (or coadded spec1d) file given to the command.
+        sensfunc (bool): Whether the command is pypeit_sensfunc rather than pypeit_tellfit.
+
+    Returns:
+        str: The name of the grid file, or None if the command doesn't read one.
+    """
+    params = dict()
+    if par_file is not None:
+        with open(par_file, "r") as f:
+            for line in f:
+                match = re.match(r'^\s*(\w+)\s*=\s*(\S+)', line)
+                if match is not None:
+                    params[match.group(1)] = match.group(2)
+    if sensfunc and params.get('algorithm', 'IR') != 'IR':
+        return None
+    if 'telgridfile' in params:
+        return os.path.basename(params['telgridfile'])
+
+    with open(spec1d_file, "rb") as f:
+        cards, header_size = read_fits_header(f)
+    if cards is None or 'PYP_SPEC' not in cards:
+        raise ValueError(f"{spec1d_file} does not have the PYP_SPEC of its spectrograph")
+    import_pypeit()
+    from pypeit.spectrographs.util import load_spectrograph
+    par = load_spectrograph(cards['PYP_SPEC'].strip("'").strip()).default_pypeit_par()['sensfunc']
+    if sensfunc and params.get('algorithm', par['algorithm']) != 'IR':
+        return None
+    telgridfile = par['IR']['telgridfile']
+    return None if telgridfile is None else os.path.basename(telgridfile)
@@ -0,0 +1,361 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Fetches the raw data of each test setup into RAW_DATA when it's needed (``pypeit_test --raw_source``), rather than
+copying all of the raw data before testing starts.
+
+The raw data of the test setups is prefetched in the order their tests are scheduled to run (see
+:meth:`TestScheduler.setup_order`), with a bounded number of transfers at once and, optionally, a budget for the disk
+space of the prefetched data. A test of a setup whose raw data hasn't arrived waits for it, and the scheduler prefers
+tests whose raw data has arrived (see :meth:`TestScheduler.next_test`). With ``--evict_raw``, the raw data of a test
+setup is removed once all of its tests have finished, freeing disk space for the data of later setups.
+
+Each setup's raw data is copied into a directory next to its final one, which is renamed into place once the copy is
+complete, so that a copy that was interrupted is never mistaken for the setup's raw data. Raw data that is already in
+RAW_DATA isn't fetched, and is never evicted.
+"""
+
+import os
+import re
+import time
+import shutil
+import asyncio
+import datetime
+import subprocess
+from abc import ABC, abstractmethod
+from threading import Lock
+
+from .history import directory_size
+from .preflight import find_raw_files
+
+PARTIAL_SUFFIX = '.partial'
+""" str: The suffix of the directory a test setup's raw data is copied into before it's renamed into place."""
+
+
+class RawDataSource(ABC):
+    """Abstract base class of the places raw data, and reference files, can be fetched from.
+
+    Attributes:
+        location (str): The location of the RAW_DATA directory, which has the raw data of each test setup in
+                        <location>/<instr>/<setup>, or of the reference files (see :class:`ReferenceCache`).
+    """
+
+    def __init__(self, location):
+        self.location = location.rstrip('/')
+
+    def __str__(self):
+        return self.location
+
+    @abstractmethod
+    def fetch(self, setup_key, dest):
+        """Copy the raw data of a test setup.
+
+        Args:
+            setup_key (str): The instr/setup key of the test setup.
+            dest (str): The directory to copy the raw data into.
+
+        Raises:
+            RuntimeError: If the raw data couldn't be copied.
+        """
+        pass
+
+    @abstractmethod
+    def fetch_file(self, path, dest):
+        """Copy a single file, e.g. a reference file (see :class:`ReferenceCache`).
+
+        Args:
+            path (str): The path of the file, relative to the location.
+            dest (str): The file to copy it to.
+
+        Raises:
+            RuntimeError: If the file couldn't be copied.
+        """
+        pass
+
+
+class LocalRawSource(RawDataSource):
+    """Raw data in a local (or mounted) directory."""
+
+    def fetch(self, setup_key, dest):
+        source = os.path.join(self.location, setup_key)
+        if not os.path.isdir(source):
+            raise RuntimeError(f"{source} does not exist")
+        shutil.copytree(source, dest, dirs_exist_ok=True)
+
+    def fetch_file(self, path, dest):
+        source = os.path.join(self.location, path)
+        if not os.path.isfile(source):
+            raise RuntimeError(f"{source} does not exist")
+        shutil.copyfile(source, dest)
+
+
+class CommandRawSource(RawDataSource):
+    """Raw data copied by a command line tool."""
+
+    @abstractmethod
+    def command(self, setup_key, dest):
+        """Return the command line that copies the raw data of a test setup into a directory."""
+        pass
+
+    @abstractmethod
+    def file_command(self, path, dest):
+        """Return the command line that copies a single file to dest."""
+        pass
+
+    def fetch(self, setup_key, dest):
+        self.run_command(self.command(setup_key, dest))
+
+    def fetch_file(self, path, dest):
+        self.run_command(self.file_command(path, dest))
+
+    def run_command(self, command_line):
+        """Run a command line that copies data, raising a RuntimeError with its output if it fails."""
+        process = subprocess.run(command_line, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if process.returncode != 0:
+            raise RuntimeError(f"{' '.join(command_line)} failed: {process.stdout.decode(errors='replace').strip()}")
+
+
+class RcloneRawSource(CommandRawSource):
+    """Raw data on an rclone remote, e.g. "gdrive:RAW_DATA".
+
+    Attributes:
+        config (str): The rclone config file, or None to use rclone's default.
+    """
+
+    def __init__(self, location, config=None):
+        super().__init__(location)
+        self.config = config
+
+    def command(self, setup_key, dest):
+        config = [] if self.config is None else ['--config', self.config]
+        return ['rclone'] + config + ['copy', f'{self.location}/{setup_key}/', dest + '/']
+
+    def file_command(self, path, dest):
+        config = [] if self.config is None else ['--config', self.config]
+        return ['rclone'] + config + ['copyto', f'{self.location}/{path}', dest]
+
+
+class S3RawSource(CommandRawSource):
+    """Raw data in an S3 compatible bucket, e.g. "s3://pypeit/RAW_DATA", copied with the AWS CLI. The endpoint of
+    the storage is taken from the ENDPOINT_URL environment variable, as in the Nautilus jobs."""
+
+    def command(self, setup_key, dest):
+        endpoint = os.environ.get('ENDPOINT_URL')
+        endpoint = [] if endpoint is None else ['--endpoint-url', endpoint]
+        return ['aws'] + endpoint + ['s3', 'cp', f'{self.location}/{setup_key}/', dest + '/', '--recursive',
+                                     '--no-progress']
+
+    def file_command(self, path, dest):
+        endpoint = os.environ.get('ENDPOINT_URL')
+        endpoint = [] if endpoint is None else ['--endpoint-url', endpoint]
+        return ['aws'] + endpoint + ['s3', 'cp', f'{self.location}/{path}', dest, '--no-progress']
+
+
+def raw_data_source(location, dev_path):
+    """Return the source of the raw data at a location.
+
+    Args:
+        location (str): An s3:// URL, an rclone remote (e.g. "gdrive:RAW_DATA"), or a local directory.
+        dev_path (str): The dev suite directory, whose nautilus/rclone.conf is used for rclone remotes if it exists.
+
+    Returns:
+        :obj:`RawDataSource`: The source.
+    """
+    if location.startswith('s3://'):
+        return S3RawSource(location)
+    if re.match(r'^[A-Za-z0-9_\-]+:', location) is not None and not os.path.isdir(location):
+        config = os.path.join(dev_path, 'nautilus', 'rclone.conf')
+        return RcloneRawSource(location, config if os.path.isfile(config) else None)
+    return LocalRawSource(os.path.abspath(location))
+
+
+class RawDataStager(object):
+    """Fetches the raw data of test setups as the tests need it, prefetching the raw data of the setups that are
+    scheduled to run next.
+
+    Attributes:
+        source (:obj:`RawDataSource`): Where the raw data is fetched from.
+        max_transfers (int):    The most setups whose raw data is fetched at once.
+        disk_budget (int):      The most bytes of prefetched raw data on disk at once, or None for no limit. The raw
+                                data of a setup whose tests are waiting for it is fetched even if it's over budget.
+        evict (bool):           Whether to remove the raw data of a setup once its tests have finished.
+        history (:obj:`TestHistory`): The history of prior runs, with the size of the raw data of each setup.
+        checker (:obj:`RawFileChecker`): Checks the raw files read by a setup's tests once they've been fetched, or
+                                None to not check them.
+        sizes (dict):           Maps the instr/setup key of each setup whose raw data was fetched to its size in bytes.
+        errors (dict):          Maps the instr/setup key of each setup whose raw data couldn't be fetched to why.
+        staged_bytes (int):     The bytes of fetched raw data that are on disk.
+        fetch_time (float):     The seconds spent fetching raw data, summed over the transfers.
+        wait_time (float):      The seconds tests spent waiting for raw data, summed over the tests.
+        num_evicted (int):      The number of setups whose raw data was removed.
+
+        _queue (list):          The setups whose raw data is yet to be prefetched, in the order they'll run.
+        _tasks (dict):          Maps the instr/setup key of each setup whose raw data is being or has been fetched to
+                                the task fetching it.
+        _staged (set):          The instr/setup keys of the setups whose raw data has been fetched, or has failed to.
+        _reserved (int):        The predicted bytes of the raw data being fetched.
+        _num_transfers (int):   The number of fetches that have been started and haven't finished.
+        _semaphore (:obj:`asyncio.Semaphore`): Limits the fetches running at once.
+        _evictions (list):      The tasks removing raw data.
+        _check_lock (:obj:`threading.Lock`): Stops the raw files of two setups being checked at once, as they share
+                                the checker's cache.
+    """
+
+    def __init__(self, source, max_transfers=2, disk_budget=None, evict=False, history=None, checker=None):
+        self.source = source
+        self.max_transfers = max(max_transfers, 1)
+        self.disk_budget = disk_budget
+        self.evict = evict
+        self.history = history
+        self.checker = checker
+        self.sizes = dict()
+        self.errors = dict()
+        self.staged_bytes = 0
+        self.fetch_time = 0.0
+        self.wait_time = 0.0
+        self.num_evicted = 0
+        self._queue = []
+        self._tasks = dict()
+        self._staged = set()
+        self._reserved = 0
+        self._num_transfers = 0
+        self._semaphore = None
+        self._evictions = []
+        self._check_lock = Lock()
+
+    def start(self, setups):
+        """Start prefetching the raw data of test setups. This must be called in the event loop running the tests.
+
+        Args:
+            setups (list of :obj:`TestSetup`): The test setups, in the order their tests are expected to run.
+        """
+        self._semaphore = asyncio.Semaphore(self.max_transfers)
+        self._queue = [setup for setup in setups if not self.is_staged(setup)]
+        self._prefetch()
+
+    def is_staged(self, setup):
+        """Return whether the tests of a test setup can start without waiting for its raw data. This is also true
+        if fetching the raw data failed, so that the tests fail straight away."""
+        if setup.key in self._staged:
+            return True
+        return setup.key not in self._tasks and os.path.isdir(setup.rawdir)
+
+    async def stage(self, setup):
+        """Wait for the raw data of a test setup, fetching it if it isn't being fetched already.
+
+        Args:
+            setup (:obj:`TestSetup`): The test setup.
+
+        Returns:
+            str: Why the raw data couldn't be fetched, or None if it's in RAW_DATA.
+        """
+        if self.is_staged(setup):
+            return self.errors.get(setup.key)
+        if setup.key not in self._tasks:
+            if setup in self._queue:
+                self._queue.remove(setup)
+            self._start_fetch(setup)
+        start = time.monotonic()
+        await self._tasks[setup.key]
+        self.wait_time += time.monotonic() - start
+        return self.errors.get(setup.key)
+
+    def setup_finished(self, setup):
+        """Called once all of the tests of a test setup have finished. Its raw data is removed if evicting."""
+        if setup in self._queue:
+            self._queue.remove(setup)
+        if self.evict and setup.key in self.sizes and setup.key in self._staged:
+            self._evictions.append(asyncio.create_task(self._evict(setup)))
+
+    async def finish(self):
+        """Stop any fetches that are still running, e.g. if testing was stopped, and wait for evictions to finish."""
+        self._queue = []
+        fetches = [task for task in self._tasks.values() if not task.done()]
+        for task in fetches:
+            task.cancel()
+        await asyncio.gather(*fetches, *self._evictions, return_exceptions=True)
+
+    def summary(self):
+        """Return a line describing the raw data that was fetched."""
+        return (f"Fetched the raw data of {len(self.sizes)} test setups ({sum(self.sizes.values()) / 2**30:.1f} GiB) "
+                f"from {self.source} in {datetime.timedelta(seconds=round(self.fetch_time))}. Tests waited "
+                f"{datetime.timedelta(seconds=round(self.wait_time))} for raw data, and the raw data of "
+                f"{self.num_evicted} test setups was evicted.")
+
+    def _predicted_size(self, setup):
+        """Return the size in bytes of a test setup's raw data in its most recent run, or 0 if it isn't known."""
+        sizes = None if self.history is None else self.history.setup_sizes(setup.key)
+        return 0 if sizes is None else sizes[0]
+
+    def _prefetch(self):
+        """Start fetching the raw data of the next setups, within the limits on transfers and disk space."""
+        while len(self._queue) > 0 and self._num_transfers < self.max_transfers:
+            setup = self._queue[0]
+            if self.is_staged(setup) or setup.key in self._tasks:
+                self._queue.pop(0)
+                continue
+            in_use = self.staged_bytes + self._reserved
+            if self.disk_budget is not None and in_use > 0 and \
+                    in_use + self._predicted_size(setup) > self.disk_budget:
+                # Wait for the raw data of finished setups to be evicted
+                break
+            self._queue.pop(0)
+            self._start_fetch(setup)
+
+    def _start_fetch(self, setup):
+        """Start the task that fetches the raw data of a test setup, reserving disk space for it."""
+        predicted_size = self._predicted_size(setup)
+        self._reserved += predicted_size
+        self._num_transfers += 1
+        self._tasks[setup.key] = asyncio.create_task(self._fetch(setup, predicted_size))
+
+    async def _fetch(self, setup, predicted_size):
+        """Fetch the raw data of a test setup, then check its raw files and prefetch more."""
+        try:
+            async with self._semaphore:
+                start = time.monotonic()
+                try:
+                    await asyncio.to_thread(self._fetch_files, setup)
+                except (OSError, RuntimeError) as e:
+                    self.errors[setup.key] = f"Could not stage the raw data of {setup.key} from {self.source}: {e}"
+                finally:
+                    self.fetch_time += time.monotonic() - start
+        finally:
+            self._reserved -= predicted_size
+            self._num_transfers -= 1
+
+        if os.path.isdir(setup.rawdir):
+            self.sizes[setup.key] = directory_size(setup.rawdir)
+            self.staged_bytes += self.sizes[setup.key]
+        self._staged.add(setup.key)
+        self._prefetch()
+
+    def _fetch_files(self, setup):
+        """Copy the raw data of a test setup into place, and check the raw files its tests read. This is run in a
+        thread, as it waits on the file system and on the source."""
+        partial = setup.rawdir + PARTIAL_SUFFIX
+        if os.path.isdir(partial):
+            # Left by an earlier run that was stopped, so it may be incomplete
+            shutil.rmtree(partial)
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        self.source.fetch(setup.key, partial)
+        if not os.path.isdir(partial) or len(os.listdir(partial)) == 0:
+            raise RuntimeError("the source has no raw data for it")
+        os.replace(partial, setup.rawdir)
+
+        if self.checker is not None:
+            with self._check_lock:
+                missing, damaged = self.checker.check(find_raw_files([setup]))
+            problems = [f'{file} is missing' for file in missing] + \
+                       [f'{file} {problem}' for file, problem in damaged.items()]
+            if len(problems) > 0:
+                raise RuntimeError('its raw files are not usable:\n    ' + '\n    '.join(problems))
+
+    async def _evict(self, setup):
+        """Remove the fetched raw data of a test setup, and prefetch the raw data that now fits in the budget."""
+        await asyncio.to_thread(shutil.rmtree, setup.rawdir, True)
+        self.staged_bytes -= self.sizes[setup.key]
+        self.num_evicted += 1
+        self._prefetch()
@@ -0,0 +1,203 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+A shared cache of the large reference files that tests read but PypeIt doesn't install, such as the atmospheric model
+grids read by pypeit_sensfunc and pypeit_tellfit (``pypeit_test --reference_source``).
+
+The cached files are named by their sha256, so one cache directory (e.g. a persistent volume on a Nautilus node, or
+a local directory) can be shared by every run, PypeIt installation, and dev suite checkout that uses it. A file is
+fetched the first time a test needs it (see :meth:`PypeItTest.reference_files`): the published checksum of the file,
+a ``<file>.sha256`` next to it at the source, is read, and the file is only fetched if the cache doesn't already have
+a file with that checksum. A fetched file must match the checksum before it's added to the cache, and a lock file
+stops the tests of a run, or the runs sharing the cache, from fetching the same file at once. The cached file is then
+linked into PypeIt's data directory, where PypeIt looks for it.
+"""
+
+import os
+import re
+import time
+import fcntl
+import asyncio
+import datetime
+import threading
+import importlib.util
+
+from .raw_staging import PARTIAL_SUFFIX
+from .data_manifest import DataStamps, file_sha256
+
+REFERENCE_FILES = {'TelFit_MaunaKea_3100_26100_R20000.fits': 'telluric/atm_grids',
+                   'TelFit_LasCampanas_3100_26100_R20000.fits': 'telluric/atm_grids'}
+""" dict: Maps the name of each reference file managed by the cache to its directory, both at the source and in
+PypeIt's data directory. Other files that tests read are left for PypeIt to find."""
+
+REFERENCE_CACHE = 'REFERENCE_CACHE'
+""" str: The name of the default cache directory in the dev suite directory."""
+
+CHECKSUM_SUFFIX = '.sha256'
+""" str: The suffix of the file with the published sha256 of a reference file, next to it at the source."""
+
+
+class ReferenceCache(object):
+    """Fetches reference files into a shared cache when tests need them, and links them into PypeIt.
+
+    Attributes:
+        source (:obj:`RawDataSource`): Where the reference files and their checksums are fetched from.
+        cache_dir (str):  The cache directory. The files are in ``sha256/<first two digits>/<sha256>``.
+        data_path (str):  PypeIt's data directory, or None to use that of the installed PypeIt.
+        fetched (dict):   Maps the name of each reference file fetched in this run to its size in bytes.
+        fetch_time (float): The seconds spent fetching reference files.
+
+        _checksums (dict): Maps the name of each reference file to its published sha256, once it's been read.
+        _linked (set):    The names of the reference files that have been linked into PypeIt in this run.
+        _stamps (:obj:`DataStamps`): The hashes of files already in PypeIt's data directory, so that a file that
+                          matches the published checksum isn't replaced or hashed again.
+        _lock (:obj:`threading.Lock`): Synchronizes access to the attributes, as files are fetched in worker threads.
+    """
+
+    def __init__(self, source, cache_dir, data_path=None):
+        self.source = source
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.data_path = data_path
+        self.fetched = dict()
+        self.fetch_time = 0.0
+        self._checksums = dict()
+        self._linked = set()
+        self._stamps = DataStamps(os.path.join(self.cache_dir, 'stamps.json'))
+        self._lock = threading.Lock()
+
+    async def provide(self, test):
+        """Fetch the reference files a test reads, if they aren't in the cache, and link them into PypeIt.
+
+        Args:
+            test (:obj:`PypeItTest`): The test, which is about to start its child.
+
+        Raises:
+            RuntimeError: If a reference file couldn't be fetched, or doesn't match its published checksum.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self._provide, test)
+
+    def summary(self):
+        """Return a line describing the reference files that were fetched."""
+        return (f"Fetched {len(self.fetched)} reference files ({sum(self.fetched.values()) / 2**30:.1f} GiB) from "
+                f"{self.source} into {self.cache_dir} in {datetime.timedelta(seconds=round(self.fetch_time))}.")
+
+    def _provide(self, test):
+        try:
+            names = test.reference_files()
+        except Exception:
+            # If the files can't be worked out, PypeIt finds them itself
+            names = []
+        for name in names:
+            with self._lock:
+                if name not in REFERENCE_FILES or name in self._linked:
+                    continue
+            self.link(name, self.fetch(name))
+            with self._lock:
+                self._linked.add(name)
+        self._stamps.write()
+
+    def cached_file(self, digest):
+        """Return the path of the file with a sha256 in the cache."""
+        return os.path.join(self.cache_dir, 'sha256', digest[:2], digest)
+
+    def published_checksum(self, name):
+        """Return the published sha256 of a reference file.
+
+        Raises:
+            RuntimeError: If the checksum couldn't be fetched or read.
+        """
+        with self._lock:
+            digest = self._checksums.get(name)
+        if digest is not None:
+            return digest
+
+        path = f'{REFERENCE_FILES[name]}/{name}{CHECKSUM_SUFFIX}'
+        tmp_file = os.path.join(self.cache_dir, f'{name}{CHECKSUM_SUFFIX}.{os.getpid()}.{threading.get_ident()}')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            self.source.fetch_file(path, tmp_file)
+            with open(tmp_file, "r") as f:
+                # The format written by sha256sum: the checksum, then the file name
+                fields = f.read().split()
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        if len(fields) == 0 or re.fullmatch(r'[0-9a-f]{64}', fields[0].lower()) is None:
+            raise RuntimeError(f"{self.source}/{path} is not a sha256 checksum")
+        digest = fields[0].lower()
+        with self._lock:
+            self._checksums[name] = digest
+        return digest
+
+    def fetch(self, name):
+        """Return the cached copy of a reference file, fetching it if the cache doesn't have it.
+
+        The file is fetched while holding a lock on a lock file in the cache directory, so that a file needed by
+        several tests at once, or by several runs sharing the cache, is only fetched once.
+
+        Args:
+            name (str): The name of the reference file, which must be in :data:`REFERENCE_FILES`.
+
+        Returns:
+            str: The path of the file in the cache.
+
+        Raises:
+            RuntimeError: If the file couldn't be fetched, or doesn't match its published checksum.
+        """
+        digest = self.published_checksum(name)
+        cached_file = self.cached_file(digest)
+        if os.path.exists(cached_file):
+            return cached_file
+
+        lock_dir = os.path.join(self.cache_dir, 'locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+        with open(os.path.join(lock_dir, digest + '.lock'), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(cached_file):
+                # Fetched by another test or run while waiting for the lock
+                return cached_file
+
+            start = time.monotonic()
+            tmp_file = f'{cached_file}.{os.getpid()}.{threading.get_ident()}{PARTIAL_SUFFIX}'
+            try:
+                self.source.fetch_file(f'{REFERENCE_FILES[name]}/{name}', tmp_file)
+                if file_sha256(tmp_file) != digest:
+                    raise RuntimeError(f"{self.source}/{REFERENCE_FILES[name]}/{name} doesn't match its published "
+                                       f"sha256 {digest}")
+                os.replace(tmp_file, cached_file)
+            finally:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            with self._lock:
+                self.fetched[name] = os.path.getsize(cached_file)
+                self.fetch_time += time.monotonic() - start
+        return cached_file
+
+    def link(self, name, cached_file):
+        """Link a cached reference file into PypeIt's data directory.
+
+        A file that is already there is kept if it matches the published checksum, and otherwise replaced by the
+        link.
+
+        Args:
+            name (str): The name of the reference file.
+            cached_file (str): The path of the file in the cache.
+        """
+        data_path = self.data_path
+        if data_path is None:
+            # Found without importing PypeIt, which is slow
+            data_path = os.path.join(os.path.dirname(importlib.util.find_spec('pypeit').origin), 'data')
+        dest = os.path.join(data_path, REFERENCE_FILES[name], name)
+        if os.path.islink(dest):
+            if os.path.realpath(dest) == os.path.realpath(cached_file):
+                return
+        elif os.path.isfile(dest) and self._stamps.file_entry(dest)[1] == os.path.basename(cached_file):
+            return
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_link = f'{dest}.{os.getpid()}.{threading.get_ident()}.link'
+        os.symlink(cached_file, tmp_link)
+        os.replace(tmp_link, dest)
@@ -0,0 +1,368 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+A content addressed cache of the results of PypeIt tests, used to skip tests whose inputs haven't changed, and the
+keys of tests it's addressed by.
+"""
+
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import datetime
+import subprocess
+from collections import defaultdict
+from threading import Lock
+
+MAX_TEXT_FILE_SIZE = 2**20
+""" int: The largest file named on a test's command line that is read as text, so that the test's directories in it
+can be replaced by placeholders before it's hashed (see :meth:`TestKeys.command_file_hash`)."""
+
+
+def pypeit_code_version(pypeit):
+    """Return a string identifying the PypeIt code being tested.
+
+    ``pypeit.__version__`` is written when PypeIt is installed, so it doesn't change as an editable install is edited
+    or new commits are checked out. If PypeIt is in a git checkout, the version is instead its HEAD commit and a hash
+    of the uncommitted changes to the PypeIt package, including files that aren't tracked yet.
+
+    Args:
+        pypeit (module): The ``pypeit`` package.
+
+    Returns:
+        str: The version.
+    """
+    package_dir = os.path.dirname(os.path.abspath(pypeit.__file__))
+
+    def git(*args):
+        process = subprocess.run(['git', '-C', package_dir] + list(args), stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL)
+        if process.returncode != 0:
+            raise OSError(f"git {' '.join(args)} failed")
+        return process.stdout
+
+    try:
+        head = git('rev-parse', 'HEAD').decode().strip()
+        changes = hashlib.sha256(git('diff', 'HEAD', '--binary', '--', '.'))
+        for path in git('ls-files', '--others', '--exclude-standard', '-z', '--', '.').decode().split('\0'):
+            if len(path) > 0 and os.path.isfile(os.path.join(package_dir, path)):
+                changes.update(path.encode())
+                with open(os.path.join(package_dir, path), "rb") as f:
+                    changes.update(f.read())
+    except OSError:
+        # Not a git checkout, or git isn't installed
+        return pypeit.__version__
+    return f'{pypeit.__version__}+{head}.{changes.hexdigest()[:16]}'
+
+
+class TestKeys(object):
+    """Computes keys that identify everything that can affect the results of a test.
+
+    The key of a test combines:
+
+    * The PypeIt code being tested: the git commit and uncommitted changes of a PypeIt checkout, or the installed
+      version otherwise (see :func:`pypeit_code_version`).
+    * The type of test and its command line, with the test's directories replaced by placeholders.
+    * The contents of every file named on the command line, such as the rendered .pypeit, .flux or .coadd1d file,
+      with the test's directories in text files replaced by placeholders.
+    * The contents of the test's other inputs (see :meth:`PypeItTest.cache_inputs`), such as the raw data files of a
+      reduction.
+    * The keys of the tests it depends on.
+
+    Attributes:
+        pypeit_version (str):  Identifies the PypeIt code being tested, see :func:`pypeit_code_version`.
+
+        _hash_file (str):      The JSON file the file hashes are saved to, or None if they aren't saved.
+        _hashes (dict):        Maps file paths to the [size, modification time, sha256] of the file, so that large
+                               unchanged raw data files aren't hashed again on every run.
+        _hash_lock (:obj:`threading.Lock`): Synchronizes access to _hashes, as keys are computed in worker threads.
+        data_stamps (:obj:`DataStamps`): The hashes of the dev suite's data files recorded by pypeit_syncraw, used
+                               instead of hashing raw data files that haven't changed since, or None.
+    """
+
+    version = 1
+    """int: The version of the key format. Changing it changes the keys of all tests."""
+
+    def __init__(self, pypeit_version, hash_file=None):
+        self.pypeit_version = pypeit_version
+        self._hash_file = hash_file
+        self._hash_lock = Lock()
+        self._hashes = dict()
+        self.data_stamps = None
+        if hash_file is not None and os.path.exists(hash_file):
+            with open(hash_file, "r") as f:
+                self._hashes = json.load(f)
+
+    def write(self):
+        """Save the file hashes computed during this run, so they don't need to be computed again."""
+        if self._hash_file is None:
+            return
+        with self._hash_lock:
+            with open(self._hash_file + '.tmp', "w") as f:
+                json.dump(self._hashes, f)
+            os.replace(self._hash_file + '.tmp', self._hash_file)
+
+    def file_hash(self, path):
+        """Return the sha256 of a file's contents, reusing the hash from a prior run if the file hasn't changed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._hash_lock:
+            cached = self._hashes.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        digest = None if self.data_stamps is None else self.data_stamps.known_hash(path, stat)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    sha256.update(block)
+            digest = sha256.hexdigest()
+        with self._hash_lock:
+            self._hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    async def set_key(self, test):
+        """Compute the key of a test (see :meth:`test_key`), and set its cache_key.
+
+        Args:
+            test (:obj:`PypeItTest`): The test, with its command line already set.
+        """
+        # Hashing the inputs of a test that hasn't been seen before can mean reading gigabytes of raw data, so it's
+        # done in a worker thread to keep it from holding up the other tests
+        test.cache_key = await asyncio.to_thread(self.test_key, test)
+
+    def test_key(self, test):
+        """Return the key for a test. This must be called after the test's command line has been built.
+
+        Args:
+            test (:obj:`PypeItTest`): The test.
+
+        Returns:
+            str: The hex sha256 key.
+        """
+        command_line = []
+        for arg in test.command_line:
+            if os.path.isfile(arg):
+                # Files are identified by their contents rather than their name, which may be made unique per run
+                command_line.append(f'file:{self.command_file_hash(test, arg)}')
+            else:
+                command_line.append(replace_directories(test, arg))
+
+        key_data = {'version': self.version,
+                    'pypeit_version': self.pypeit_version,
+                    'test': type(test).__name__,
+                    'description': test.description,
+                    'command_line': command_line,
+                    'inputs': sorted([self.file_hash(file) for file in test.cache_inputs() if os.path.isfile(file)]),
+                    'dependencies': sorted([dependency.cache_key for dependency in test.dependencies
+                                            if dependency.cache_key is not None])}
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+    def command_file_hash(self, test, path):
+        """Return the sha256 of a file named on a test's command line.
+
+        Text files, such as the .pypeit file written for a reduction, name the test's directories (e.g. the raw data
+        files in the data block), so these are replaced by placeholders before the file is hashed, as they are on
+        the command line. Other files are hashed by :meth:`file_hash`.
+
+        Args:
+            test (:obj:`PypeItTest`): The test.
+            path (str): The file.
+
+        Returns:
+            str: The hex sha256.
+        """
+        if os.path.getsize(path) <= MAX_TEXT_FILE_SIZE:
+            with open(path, "rb") as f:
+                data = f.read()
+            try:
+                text = data.decode()
+            except UnicodeDecodeError:
+                text = None
+            if text is not None:
+                return hashlib.sha256(replace_directories(test, text).encode()).hexdigest()
+        return self.file_hash(path)
+
+
+def replace_directories(test, text):
+    """Replace the directories of a test in some text with placeholders, so that a cache can be shared between output
+    directories and dev suite checkouts.
+
+    Args:
+        test (:obj:`PypeItTest`): The test.
+        text (str): The text, e.g. an argument of the test's command line.
+
+    Returns:
+        str: The text with the placeholders.
+    """
+    # Longer paths are replaced first, as the output directory is often inside the dev suite
+    directories = sorted([(test.setup.rdxdir, '{rdxdir}'), (test.setup.rawdir, '{rawdir}'),
+                          (test.setup.dev_path, '{dev_path}')], key=lambda x: len(x[0]), reverse=True)
+    for directory, placeholder in directories:
+        text = text.replace(directory, placeholder)
+    return text
+
+
+class ResultCache(TestKeys):
+    """A cache of the output files of tests, keyed by a hash of everything that can affect the test's results (see
+    :obj:`TestKeys`).
+
+    When a test passes, the files it created or changed in its setup's output directory are hard linked into the
+    cache. If a later run finds the same key, the files are hard linked back (or copied if the cache is on another
+    file system) and the test is reported as passed from the cache instead of being run. Because cached files are
+    shared with the output directories, each entry records the size and modification time of its files, and an
+    entry is discarded if a file was changed in place after it was cached.
+
+    To tell which files a test wrote, the tests of a setup run one at a time when they use the cache, and the files
+    of the setup's other tests (see :meth:`PypeItTest.own_files`), such as their logs and QL outputs, are left out,
+    as tests that don't use the cache can write to the setup's output directory at the same time.
+
+    Attributes:
+        cache_dir (str):       The top level directory of the cache.
+
+        _setup_locks (dict):   Per setup :obj:`asyncio.Lock` objects so that only one test of a setup at a time
+                               writes to its outputs.
+    """
+
+    version = 1
+    """int: The version of the cache layout. Changing it invalidates all existing entries."""
+
+    def __init__(self, cache_dir, pypeit_version):
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(os.path.join(self.cache_dir, 'entries'), exist_ok=True)
+        super().__init__(pypeit_version, os.path.join(self.cache_dir, 'file_hashes.json'))
+        self._setup_locks = defaultdict(asyncio.Lock)
+
+    def _entry_dir(self, key):
+        """Return the directory of a cache entry."""
+        return os.path.join(self.cache_dir, 'entries', key[:2], key)
+
+    async def run_test(self, test):
+        """Run a test, or restore its results from the cache if its inputs haven't changed.
+
+        Args:
+            test (:obj:`PypeItTest`): The test, with its log file and command line already set.
+        """
+        async with self._setup_locks[test.setup.key]:
+            if test.cache_key is None:
+                await self.set_key(test)
+            if self.restore(test):
+                return
+
+            before = snapshot(test.setup.rdxdir)
+            await test.run_child()
+            if test.passed:
+                self.store(test, before)
+
+    def restore(self, test):
+        """Restore the results of a test from the cache.
+
+        Args:
+            test (:obj:`PypeItTest`): The test, with its cache_key set.
+
+        Returns:
+            bool: True if the results were restored, False if the test isn't in the cache.
+        """
+        entry_dir = self._entry_dir(test.cache_key)
+        entry_file = os.path.join(entry_dir, 'entry.json')
+        if not os.path.exists(entry_file):
+            return False
+
+        with open(entry_file, "r") as f:
+            entry = json.load(f)
+
+        # Make sure none of the cached files were changed in place through a hard link
+        for rel_path, (size, mtime_ns) in entry['files'].items():
+            try:
+                stat = os.stat(os.path.join(entry_dir, 'files', rel_path))
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return False
+
+        test.start_time = datetime.datetime.now()
+        for rel_path in entry['files']:
+            link_file(os.path.join(entry_dir, 'files', rel_path), os.path.join(test.setup.rdxdir, rel_path))
+
+        with open(test.logfile, "a") as log:
+            print(f"Restored {len(entry['files'])} files from cache entry {test.cache_key}, created "
+                  f"{entry['created']}. Log from the cached run:\n", file=log)
+            with open(os.path.join(entry_dir, 'log'), "r") as cached_log:
+                shutil.copyfileobj(cached_log, log)
+
+        test.end_time = datetime.datetime.now()
+        test.max_mem = entry['max_mem']
+        test.from_cache = True
+        test.passed = True
+        return True
+
+    def store(self, test, before):
+        """Add the results of a test that passed to the cache.
+
+        Args:
+            test (:obj:`PypeItTest`): The test, with its cache_key set.
+            before (dict):            The :func:`snapshot` of the setup's output directory from before the test ran.
+        """
+        after = snapshot(test.setup.rdxdir)
+        # The logs and other files of this and the setup's other tests
+        own_files = [os.path.relpath(os.path.abspath(file), test.setup.rdxdir)
+                     for setup_test in test.setup.tests + [test] for file in setup_test.own_files()]
+        outputs = sorted([rel_path for rel_path, info in after.items() if before.get(rel_path) != info and
+                          not any([rel_path == file or rel_path.startswith(file + os.sep) for file in own_files])])
+
+        # Build the entry in a temporary directory, so that other runs never see a partial entry
+        entry_dir = self._entry_dir(test.cache_key)
+        tmp_dir = f'{entry_dir}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        files = dict()
+        for rel_path in outputs:
+            cache_file = os.path.join(tmp_dir, 'files', rel_path)
+            link_file(os.path.join(test.setup.rdxdir, rel_path), cache_file)
+            stat = os.stat(cache_file)
+            files[rel_path] = [stat.st_size, stat.st_mtime_ns]
+        os.makedirs(tmp_dir, exist_ok=True)
+        shutil.copyfile(test.logfile, os.path.join(tmp_dir, 'log'))
+        with open(os.path.join(tmp_dir, 'entry.json'), "w") as f:
+            json.dump({'test': str(test), 'created': test.end_time.isoformat(), 'max_mem': test.max_mem,
+                       'files': files}, f, indent=1)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another run stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def snapshot(directory):
+    """Return a dict mapping the path (relative to directory) of every file under a directory to its
+    (size, modification time, inode)."""
+    files = dict()
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files[os.path.relpath(path, directory)] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    return files
+
+
+def link_file(source, dest):
+    """Hard link a file to a destination, replacing any existing file. The file is copied if it can't be linked,
+    for example if the destination is on another file system."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
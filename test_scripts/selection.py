@@ -0,0 +1,138 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Selects the test setups to run within a time budget (``pypeit_test --time_budget``), so that a short run tests as
+much of PypeIt as it can.
+
+The value of a subset of the test setups is the weighted number of distinct things it tests: the instruments, the
+types of test (e.g. quick look, coadd2d, telluric, flexure), and, given a coverage map, the PypeIt code run by the
+setups. Setups whose tests often failed in their recent runs are worth more, as they are more likely to catch a
+problem. Finding the most valuable subset within a budget is a budgeted maximum coverage problem, which is
+approximated by greedily adding the setup that adds the most value per second of its predicted duration.
+"""
+
+import json
+
+from .test_setups import all_tests
+from .history import balance_shards
+
+INSTRUMENT_WEIGHT = 1.0
+""" float: The value of testing an instrument."""
+
+TEST_TYPE_WEIGHT = 1.0
+""" float: The value of running a type of test (see :data:`test_setups.all_tests`)."""
+
+CODE_WEIGHT = 10.0
+""" float: The value of running all of the code in the coverage map, which is split evenly between its code units."""
+
+FAILURE_WEIGHT = 5.0
+""" float: The value of a test setup whose tests failed in all of their recent runs. Setups that failed less often
+are worth the same fraction of this."""
+
+
+def setup_test_types(setup_key, phases):
+    """Return the names of the types of test run for a test setup.
+
+    Args:
+        setup_key (str): The instr/setup key of the test setup.
+        phases (list of :obj:`TestPhase`): The test phases being run.
+
+    Returns:
+        list of str: The 'name' of each test type in :data:`test_setups.all_tests` run for the setup.
+    """
+    instr, setup_name = setup_key.split('/')
+    return [test_descr['name'] for test_descr in all_tests
+            if test_descr['type'] in phases and setup_name in test_descr['setups'].get(instr, dict())]
+
+
+def read_coverage_map(file):
+    """Read a coverage map.
+
+    Args:
+        file (str): A JSON file mapping the instr/setup key of each test setup to a list of the code units (e.g.
+                    "pypeit/core/arc.py:123" or "pypeit.core.arc.detect_lines") its tests run.
+
+    Returns:
+        dict: Maps instr/setup keys to a set of code units.
+    """
+    with open(file, "r") as f:
+        return {setup_key: set(units) for setup_key, units in json.load(f).items()}
+
+
+def predicted_wall_time(durations, num_workers):
+    """Predict the wall time of running test setups in parallel.
+
+    The tests of a setup mostly run one after another, so the setups are assigned to the workers longest first,
+    as with the shards of a run (see :func:`balance_shards`).
+
+    Args:
+        durations (dict):  Maps the key of each test setup to its predicted duration in seconds.
+        num_workers (int): The number of tests run at once.
+
+    Returns:
+        float: The predicted wall time in seconds.
+    """
+    shards = balance_shards(durations, num_workers)
+    return max([sum([durations[key] for key in shard]) for shard in shards], default=0.0)
+
+
+def select_setups(setup_keys, history, time_budget, num_workers, phases, coverage_map=None):
+    """Select the test setups that test the most within a time budget.
+
+    Args:
+        setup_keys (list of str): The instr/setup keys of the test setups to choose from.
+        history (:obj:`TestHistory`): The history of prior runs, used to predict the durations of the setups and
+            how often they fail.
+        time_budget (float): The wall time in seconds the selected setups are predicted to run in.
+        num_workers (int): The number of tests run at once.
+        phases (list of :obj:`TestPhase`): The test phases being run.
+        coverage_map (dict): Maps instr/setup keys to the set of code units run by the setup's tests, as returned by
+            :func:`read_coverage_map`. Setups that aren't in the map don't add to the code coverage.
+
+    Returns:
+        tuple: The selected keys, in the same order as setup_keys, and their predicted wall time in seconds.
+    """
+    if coverage_map is None:
+        coverage_map = dict()
+    all_units = set([unit for key in setup_keys for unit in coverage_map.get(key, [])])
+    weights = {('code', unit): CODE_WEIGHT / len(all_units) for unit in all_units}
+
+    features = dict()
+    for key in setup_keys:
+        features[key] = set([('instrument', key.split('/')[0])] +
+                            [('test', name) for name in setup_test_types(key, phases)] +
+                            [('code', unit) for unit in coverage_map.get(key, [])])
+        for feature in features[key]:
+            if feature[0] == 'instrument':
+                weights[feature] = INSTRUMENT_WEIGHT
+            elif feature[0] == 'test':
+                weights[feature] = TEST_TYPE_WEIGHT
+    failure_values = {key: FAILURE_WEIGHT * history.setup_failure_rate(key) for key in setup_keys}
+    durations = {key: history.estimate_setup_duration(key) for key in setup_keys}
+
+    selected = dict()
+    covered = set()
+    wall_time = 0.0
+    while True:
+        best = None
+        for key in setup_keys:
+            if key in selected:
+                continue
+            value = sum([weights[feature] for feature in features[key] - covered]) + failure_values[key]
+            if value <= 0.0:
+                continue
+            score = value / max(durations[key], 1.0)
+            if best is not None and score <= best[0]:
+                continue
+            key_wall_time = predicted_wall_time(dict(selected, **{key: durations[key]}), num_workers)
+            if key_wall_time <= time_budget:
+                best = (score, key, key_wall_time)
+        if best is None:
+            break
+        score, key, wall_time = best
+        selected[key] = durations[key]
+        covered |= features[key]
+
+    return [key for key in setup_keys if key in selected], wall_time
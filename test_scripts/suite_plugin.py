@@ -0,0 +1,120 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Fixtures and helpers shared by the conftest files of the dev suite's unit and vet tests, which import them. Like the
+vet tests, they import it with this directory on the path, as the test files named test_scripts.py hide the
+test_scripts package.
+
+The fixtures isolate the tests from each other, so that they can be run in parallel with pytest-xdist. The helpers
+find the instruments whose raw data a test uses, so that only the tests using the test setups selected with
+``--setups`` are run.
+"""
+
+import ast
+import fcntl
+import functools
+from contextlib import contextmanager
+
+import pytest
+
+from setups import all_setups
+
+
+def deselect(config, items, relevant):
+    """Deselect the collected tests that aren't relevant to the selected test setups.
+
+    Args:
+        config (:obj:`pytest.Config`): The pytest config.
+        items (list of :obj:`pytest.Item`): The collected tests, which is updated in place.
+        relevant (callable): Returns whether a test should be kept.
+    """
+    keep = []
+    deselected = []
+    for item in items:
+        if relevant(item):
+            keep.append(item)
+        else:
+            deselected.append(item)
+    if len(deselected) > 0:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = keep
+
+
+def uses_selected_raw_data(item, selected):
+    """Return whether a test uses the raw data of one of the selected instruments, or doesn't use any raw data.
+
+    Args:
+        item (:obj:`pytest.Item`): The test.
+        selected (list of str): The selected test setups, as instrument names or instr/setup keys.
+    """
+    used = raw_data_instruments(item)
+    return len(used) == 0 or not used.isdisjoint({key.split('/')[0] for key in selected})
+
+
+@functools.lru_cache(maxsize=None)
+def module_functions(path):
+    """The functions defined at the top level of a test file, by name"""
+    with open(path, "r") as f:
+        tree = ast.parse(f.read(), filename=path)
+    return {node.name: node for node in tree.body if isinstance(node, ast.FunctionDef)}
+
+
+def raw_data_instruments(item):
+    """The instruments whose raw data a test uses, found from the names of the instruments supported by the dev
+    suite in the test's parameters and in the code of the test and of the functions and fixtures in its file that it
+    uses"""
+    instruments = set(all_setups)
+    used = set()
+    callspec = getattr(item, 'callspec', None)
+    if callspec is not None:
+        used |= {value for value in callspec.params.values()
+                 if isinstance(value, str) and value in instruments}
+
+    functions = module_functions(str(item.path))
+    to_visit = [getattr(item, 'originalname', item.name)] + list(getattr(item, 'fixturenames', []))
+    visited = set()
+    while len(to_visit) > 0:
+        name = to_visit.pop()
+        if name in visited or name not in functions:
+            continue
+        visited.add(name)
+        for node in [node for stmt in functions[name].body for node in ast.walk(stmt)]:
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                # Also finds the instrument in paths like 'RAW_DATA/shane_kast_blue/600_4310_d55'
+                used |= set(node.value.split('/')) & instruments
+            elif isinstance(node, ast.Name):
+                to_visit.append(node.id)
+    return used
+
+
+@contextmanager
+def file_lock(lock_file):
+    """Hold an exclusive lock on a file, which is shared by every process on the machine"""
+    with open(lock_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@pytest.fixture(autouse=True)
+def isolated_cwd(tmp_path, monkeypatch):
+    """Run each test in a temporary directory of its own, so that files written to
+    the current directory don't collide with those of other tests"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(autouse=True)
+def data_output_lock(request):
+    """Run the tests using the output directory shared by all PypeIt tests
+    (pypeit.tests.tstutils.data_output_path) one at a time"""
+    data_output_path = getattr(request.module, 'data_output_path', None)
+    if data_output_path is None:
+        yield
+    else:
+        with file_lock(data_output_path('.dev_suite.lock')):
+            yield
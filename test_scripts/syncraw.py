@@ -0,0 +1,234 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Syncs the dev suite's RAW_DATA (and CALIBS) with a developer's copy (``pypeit_syncraw``), using the data manifest
+(see :mod:`data_manifest`) to only transfer the files of the selected test setups that differ from it.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import importlib.util
+
+from .test_main import parse_setup_arguments, select_setup_names
+from .data_manifest import DataManifest, DataStamps, DATA_MANIFEST_FILE, STAMPS_FILE, HASH_WORKERS
+
+DEVELOPER_SOURCES = {'jxp': ('GoogleDrive:Astronomy/UCO/PypeIt/PypeIt-development-suite/RAW_DATA',
+                             'GoogleDrive:Astronomy/UCO/PypeIt/Calibrations'),
+                     'rjc': ('PypeIt:RAW_DATA', None),
+                     'jfh': ('/mnt/quasar/joe/google_drive/PypeIt-development-suite/RAW_DATA', None)}
+""" dict: Maps each developer to their copy of RAW_DATA, and the copy of the calibrations with their telluric grids
+(or None)."""
+
+
+def parser(options=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='pypeit_syncraw', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Sync/copy the RAW_DATA. Files are compared with the data manifest, '
+                                                 'and only those that are missing or differ from it are transferred.')
+
+    parser.add_argument('developer', type=str, nargs='?', default=None, choices=sorted(DEVELOPER_SOURCES),
+                        help='Developer whose copy of RAW_DATA is synced from. Not needed with --source, --verify '
+                             'or --update_manifest.')
+    parser.add_argument('--source', type=str, default=None,
+                        help='Sync from this copy of RAW_DATA, an rclone remote or a local directory, instead of '
+                             'the developer\'s.')
+    parser.add_argument('--calibs_source', type=str, default=None,
+                        help='Also sync CALIBS from this copy of it, an rclone remote or a local directory.')
+    parser.add_argument('-i', '--instruments', type=str, nargs='+',
+                        help='Only sync the raw data of these instruments, as selected by pypeit_test.')
+    parser.add_argument('-s', '--setups', type=str, nargs='+',
+                        help='Only sync the raw data of these setups, as selected by pypeit_test.')
+    parser.add_argument('-j', '--jobs', type=int, default=HASH_WORKERS,
+                        help='The number of files transferred, and hashed, at the same time.')
+    parser.add_argument('--verify', default=False, action='store_true',
+                        help='Only check the local RAW_DATA (and CALIBS, if no instruments or setups are selected) '
+                             'against the data manifest. Only files whose size or modification time changed since '
+                             'they were last checked are read.')
+    parser.add_argument('--update_manifest', default=False, action='store_true',
+                        help='Update the data manifest from the local RAW_DATA (and CALIBS, if no instruments or '
+                             'setups are selected), instead of syncing. Run this from a complete copy of the data, '
+                             'and commit the manifest.')
+    parser.add_argument('--manifest', type=str, default=DATA_MANIFEST_FILE, help='The data manifest.')
+    parser.add_argument('-c', '--copy', default=False, action='store_true',
+                        help='Use copy instead of sync, which keeps local files that are not in the manifest')
+    parser.add_argument('-d', '--dryrun', default=False, action='store_true',
+                        help='Only list the steps')
+    parser.add_argument('-p', '--print', default=False, action='store_true',
+                        help='Print the commands instead of running them')
+    # Read by select_setup_names, which selects the setups as pypeit_test does
+    parser.set_defaults(debug=False)
+
+    return parser.parse_args() if options is None else parser.parse_args(options)
+
+
+def selected_prefixes(pargs):
+    """Return the instr/setup keys of the test setups selected by -i and -s, or None if none were selected.
+
+    Raises:
+        ValueError: If an instrument isn't supported.
+    """
+    if pargs.instruments is None and pargs.setups is None:
+        return None
+    instruments, unsupported, argument_setup_names, argument_setup_keys = \
+        parse_setup_arguments(pargs.instruments, pargs.setups)
+    if len(unsupported) > 0:
+        raise ValueError(f"The following instruments are not supported: {unsupported}")
+    return [f'{instr}/{name}' for instr in instruments
+                              for name in select_setup_names(pargs, instr, argument_setup_names, argument_setup_keys)]
+
+
+def run_command(pargs, command_line):
+    """Run a command, or only print it with --print.
+
+    Returns:
+        bool: Whether the command succeeded.
+    """
+    if pargs.print:
+        print(' '.join(command_line))
+        return True
+    return subprocess.run(command_line).returncode == 0
+
+
+def sync_tree(pargs, manifest, stamps, tree, root, source, prefixes):
+    """Sync a data directory from a source.
+
+    The files of the manifest that are missing or differ locally are copied with ``rclone copy --files-from``, and
+    then checked against the manifest. Local files that aren't in the manifest are removed, unless copying. If the
+    manifest has no files for the data directory (or selected setups), the directory (or the directories of the
+    selected setups) are synced with rclone without it.
+
+    Args:
+        pargs (:obj:`argparse.Namespace`): The command line arguments.
+        manifest (:obj:`DataManifest`): The data manifest.
+        stamps (:obj:`DataStamps`): Hashes the local files.
+        tree (str): The data directory, e.g. "RAW_DATA".
+        root (str): The local data directory.
+        source (str): The rclone remote or directory to sync from.
+        prefixes (list of str): The instr/setup keys of the selected test setups, or None to sync every file.
+
+    Returns:
+        bool: Whether the data directory was synced.
+    """
+    if len(manifest.tree_files(tree, prefixes)) == 0:
+        print(f'The data manifest has no files for {tree}, syncing it with rclone')
+        command = 'copy' if pargs.copy else 'sync'
+        dryrun = ['--dry-run'] if pargs.dryrun else []
+        return all([run_command(pargs, ['rclone', command, f'{source}/{prefix}', os.path.join(root, prefix), '-v',
+                                        '--transfers', str(pargs.jobs)] + dryrun)
+                    for prefix in ([''] if prefixes is None else prefixes)])
+
+    differ, extra = manifest.verify(tree, root, stamps, prefixes, pargs.jobs)
+    print(f'{len(differ)} files of {tree} are missing or differ from the data manifest')
+    if len(differ) > 0:
+        with tempfile.NamedTemporaryFile("w", suffix='.txt') as files_from:
+            files_from.write(''.join([path + '\n' for path in differ]))
+            files_from.flush()
+            command_line = ['rclone', 'copy', source, root, '--files-from', files_from.name, '-v',
+                            '--transfers', str(pargs.jobs)] + (['--dry-run'] if pargs.dryrun else [])
+            if not run_command(pargs, command_line):
+                return False
+
+    if not pargs.copy and len(extra) > 0:
+        print(f'{"Would remove" if pargs.dryrun or pargs.print else "Removing"} {len(extra)} files of {tree} that '
+              'are not in the data manifest')
+        for path in extra:
+            if pargs.dryrun or pargs.print:
+                print(f'    {path}')
+            else:
+                os.remove(os.path.join(root, path))
+
+    if len(differ) > 0 and not pargs.dryrun and not pargs.print:
+        # Check the files that were transferred
+        differ, extra = manifest.verify(tree, root, stamps, differ, pargs.jobs)
+        if len(differ) > 0:
+            print(f'{len(differ)} files of {tree} still differ from the data manifest:\n    ' + '\n    '.join(differ),
+                  file=sys.stderr)
+            return False
+    return True
+
+
+def sync_telluric(pargs, calib_path):
+    """Copy the telluric grids from a developer's calibrations into the installed PypeIt."""
+    command = 'copy' if pargs.copy else 'sync'
+    command_line = ['rclone', command, calib_path + '/Telluric', 'Telluric', '-v'] + \
+                   (['--dry-run'] if pargs.dryrun else [])
+    if not run_command(pargs, command_line):
+        return False
+    if pargs.dryrun or pargs.print:
+        return True
+    # Found without importing PypeIt, which is slow
+    spec = importlib.util.find_spec('pypeit')
+    tell_path = os.path.join(os.path.dirname(spec.origin), 'data', 'telluric')
+    for filename in os.listdir('Telluric'):
+        shutil.move(os.path.join('Telluric', filename), os.path.join(tell_path, filename))
+    shutil.rmtree('Telluric')
+    return True
+
+
+def main(options=None):
+    """Sync, verify, or update the manifest of the dev suite's data.
+
+    Args:
+        options (list of str): The command line arguments.
+
+    Returns:
+        int: 0 on success, 1 if the data differs from the manifest, or couldn't be synced.
+    """
+    pargs = parser(options)
+    dev_path = os.getenv('PYPEIT_DEV', os.getcwd())
+    try:
+        prefixes = selected_prefixes(pargs)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    manifest = DataManifest(pargs.manifest)
+    stamps = DataStamps(os.path.join(dev_path, STAMPS_FILE))
+    # CALIBS isn't split by test setup, so it's only included when every setup is
+    trees = [('RAW_DATA', prefixes)] + ([('CALIBS', None)] if prefixes is None else [])
+    try:
+        if pargs.update_manifest:
+            for tree, tree_prefixes in trees:
+                num_changed = manifest.update(tree, os.path.join(dev_path, tree), stamps, tree_prefixes, pargs.jobs)
+                print(f'{num_changed} files of {tree} changed in the data manifest')
+            manifest.write()
+            return 0
+
+        if pargs.verify:
+            result = 0
+            for tree, tree_prefixes in trees:
+                differ, extra = manifest.verify(tree, os.path.join(dev_path, tree), stamps, tree_prefixes, pargs.jobs)
+                print(f'{len(manifest.tree_files(tree, tree_prefixes)) - len(differ)} files of {tree} match the data '
+                      f'manifest')
+                if len(differ) > 0:
+                    print(f'{len(differ)} files are missing or differ from the data manifest:\n    ' +
+                          '\n    '.join(differ))
+                    result = 1
+                if len(extra) > 0:
+                    print(f'{len(extra)} files are not in the data manifest:\n    ' + '\n    '.join(extra))
+            return result
+
+        if pargs.source is None and pargs.developer is None:
+            print('Give a developer or --source to sync from', file=sys.stderr)
+            return 1
+        if not pargs.print and shutil.which('rclone') is None:
+            raise RuntimeError("You need to install rclone in your PATH")
+        raw_path, calib_path = (pargs.source, None) if pargs.source is not None else DEVELOPER_SOURCES[pargs.developer]
+
+        synced = sync_tree(pargs, manifest, stamps, 'RAW_DATA', os.path.join(dev_path, 'RAW_DATA'), raw_path,
+                           prefixes)
+        if pargs.calibs_source is not None:
+            synced = sync_tree(pargs, manifest, stamps, 'CALIBS', os.path.join(dev_path, 'CALIBS'),
+                               pargs.calibs_source, None) and synced
+        if calib_path is not None:
+            # Tellurics
+            synced = sync_telluric(pargs, calib_path) and synced
+        return 0 if synced else 1
+    finally:
+        stamps.write()
@@ -12,101 +12,40 @@ import sys
 import os
 import os.path
 import subprocess
-from queue import PriorityQueue, Empty
-from threading import Thread, Lock
+import heapq
+import re
+import io
+import asyncio
+import signal
+import importlib.util
 import traceback
 import datetime
 from pathlib import Path
 import textwrap
-
-import numpy as np
-import pypeit 
-# Stop logging from pypeit.par.utils when reading/writing coadd1d files
-pypeit.msgs.reset(verbosity=0) 
-
-
-from .test_setups import TestPhase, all_tests, all_setups
-from .pypeit_tests import get_unique_file, _COVERAGE_ARGS
-
-test_run_queue = PriorityQueue()
-""":obj:`queue.Queue`: FIFO queue for test setups to be run."""
-
-class TestPriorityList(object):
-    """A class for reading and updating the order test setups are are tested.
-    
-    The order that test setups should be tested in is stored as a list of instr/setup keys in a file named 
-    'test_priority_list' in $PYPEIT_DEV. This class is responsible for reading, writing and updating the file, and
-    for translating the order into a priority that can be used in a PriorityQueue.
-    
-    To determine the order to run tests, the slowest tests are run first in order to optimize CPU efficiency when
-    running with multiple threads.  Once the test suite is completed, the order is recalculated based on how long
-    the tests actually took.  If the order is changed, the new ordering is written to the test_priority_list file.
-    
-    Attributes:
-        _prority_map (:obj:`dict` of str to int): Maps instr/setup name identifiers to an integer priority.
-
-        _updated (boolean): Whether the _priority_map has been modified and should be written to disk.
-        _file (str):        The file name to write the priority list to.
-    """
-
-    def __init__(self, file):
-        """Reads the priority list from a file."""
-        self._priority_map = dict()
-        self._updated = False
-        self._file = file
-
-        count = 0
-        if os.path.exists(file):
-            with open(file, "r") as f:
-                while True:
-                    line = f.readline()
-                    if len(line) == 0:
-                        break
-                    setup_key = line.strip()
-                    if len(setup_key) > 0:
-                        self._priority_map[setup_key] = count
-                        count += 1
-
-    def __len__(self):
-        """Return how many test setups are in the priority list"""
-        return len(self._priority_map)
-
-    def set_test_setup_priority(self, setup):
-        """Set the test priority of a TestSetup object."""
-
-        if setup.key in self._priority_map:
-            setup.priority = self._priority_map[setup.key]
-        else:
-            # If the test setup is currently known, assume it is short and put it at the end of the priority list
-            # by assigning it a large number.
-            setup.priority = sys.maxsize
-
-    def update_priorities(self, setups):
-        """Update the test priorities based on the actual runtimes of the test setups"""
-        setup_durations = []
-        for setup in setups:
-            duration = sum([test.end_time - test.start_time for test in setup.tests], datetime.timedelta())
-            setup_durations.append((setup.key, duration))
-
-        count = 0
-        new_priority_map = dict()
-        for setup_key in [item[0] for item in sorted(setup_durations, key=lambda x: x[1])]:
-            new_priority_map[setup_key] = count
-            count += 1
-
-        if new_priority_map != self._priority_map:
-            self._priority_map = new_priority_map
-            self._updated = True
-
-    def write(self):
-        """Write the test priority list to a file if it has changed."""
-        if self._updated:
-            with open(self._file, "w") as f:
-                for item in sorted(self._priority_map.items(), key=lambda x: x[1], reverse=True):
-                    print(item[0], file=f)
-
-            self.updated = False
-
+from concurrent.futures import ThreadPoolExecutor
+
+from .test_setups import TestPhase, all_tests, all_setups, resolve_dependencies, phase_timeouts, test_timeouts
+from .pypeit_tests import import_pypeit, get_unique_file, PypeItTest, PypeItVetTest, process_tree, stop_processes, _COVERAGE_ARGS
+from .history import TestHistory
+from .zygote import PypeItZygote
+from .result_cache import ResultCache, TestKeys, pypeit_code_version
+from .journal import RunJournal, HASH_FILE
+from .vet import find_vet_tests, select_vet_tests
+from .profiling import write_profile_report
+from .timeline import write_trace, write_utilisation_summary
+from .selection import select_setups, read_coverage_map
+from .coverage_index import CoverageIndex, INDEX_FILE
+from .manifest import SuiteManifest
+from .preflight import RawFileChecker, PREFLIGHT_FILE, find_raw_files
+from .raw_staging import RawDataStager, raw_data_source
+from .reference_data import ReferenceCache, REFERENCE_CACHE
+from .data_manifest import DataManifest, DataStamps, STAMPS_FILE
+from .coverage_data import CoverageCollector, coverage_core, coverage_env, coverage_overhead
+from . import merge
+from . import impacted
+
+SETUP_BUILD_WORKERS = 16
+""" int: The most test setups built at once."""
 
 class TestSetup(object):
     """Representation of a test setup within the pypeit development suite.
@@ -121,13 +60,13 @@ class TestSetup(object):
         dev_path (str):     The path of the Pypeit-development-suite repository
         pyp_file (str):     The .pypeit file used for the test. This may be created by a PypeItSetupTest.
         std_pyp_file (str): The standards .pypeit file used for some tests.
-        priority (int):     The priority of the TestSetup. Used in a PriorityQueue to determine the order used to
+        priority (int):     The priority of the TestSetup. Used by the TestScheduler to determine the order used to
                             run test setups.
 
         generate_pyp_file (boolean): Set to true if this setup will generate it's own .pypeit file wint pypeit_setup.
 
-        tests (:obj:`list` of :obj:`PypeItTest`): The list of tests to run in this test setup. The tests will be run
-                                                  in sequential order
+        tests (:obj:`list` of :obj:`PypeItTest`): The list of tests to run in this test setup. A test is run once the
+                                                  tests it depends on have passed, see :class:`TestScheduler`
 
         missing_files (:obj:`list` of str): List of missing files preventing the test setup from running.
 
@@ -158,6 +97,219 @@ class TestSetup(object):
         return self.priority < other.priority
 
 
+class TestScheduler(object):
+    """Schedules the individual tests of the test setups being run across the worker threads.
+
+    Rather than running all of the tests of a test setup one after another, each test becomes ready to run as soon as
+    the tests it depends on (see :attr:`PypeItTest.dependencies`) have passed, so that tests that don't depend on each
+    other can run in parallel. Vet tests (see :func:`add_vet_tests`) can also depend on the tests of other setups. The test runner (see :func:`run_tests`) takes the ready test with the longest predicted
+    time until the end of its chain of dependent tests (its own predicted duration plus that of the longest chain of tests depending on it),
+    so that the slowest work starts first and the run doesn't end with a long straggler. If a test
+    fails, only the tests that depend on it (directly or indirectly) are skipped. When the raw data is staged as it's
+    needed (see :class:`RawDataStager`), the ready tests whose raw data has arrived are taken first.
+
+    Attributes:
+        test_report (:obj:`TestReport`): The test report to send test status to.
+        stager (:obj:`RawDataStager`):   Fetches the raw data of the test setups, or None if it's all in RAW_DATA.
+
+        _ready (list):         A heap of the tests that are ready to run, ordered by their _rank.
+        _rank (dict):          Maps each test to its predicted time until the end of its chain of dependent tests
+                               (negated so longer chains sort first), and then its setup's priority.
+        _num_waiting (dict):   Maps each test that hasn't been started to the number of its dependencies that haven't
+                               passed yet.
+        _dependents (dict):    Maps each test to the tests that depend on it.
+        _num_remaining (dict): Maps each test setup to the number of its tests that haven't completed or been skipped.
+        _num_unfinished (int): The number of tests that haven't completed or been skipped.
+        _count (int):          Incrementing counter used to keep the ordering of the _ready heap stable.
+        _expected_mem (dict):  Maps each test to its expected peak memory in bytes, or None if it must run alone.
+        _running_mem (int):    The sum of the expected peak memory of the running tests.
+        _num_running (int):    The number of running tests.
+        _running_alone (bool): Whether a test that must run alone is running.
+    """
+
+    def __init__(self, test_report, history, mem_budget=None, mem_margin=0.2, stager=None):
+        self.test_report = test_report
+        self.history = history
+        self.mem_budget = mem_budget
+        self.mem_margin = mem_margin
+        self.stager = stager
+        self._ready = []
+        self._num_waiting = dict()
+        self._dependents = dict()
+        self._rank = dict()
+        self._num_remaining = dict()
+        self._num_unfinished = 0
+        self._count = 0
+        self._expected_mem = dict()
+        self._running_mem = 0
+        self._num_running = 0
+        self._running_alone = False
+
+    def add_setups(self, setups):
+        """Add the tests from a list of test setups to the scheduler.
+
+        Args:
+            setups (list of :obj:`TestSetup`): The test setups to schedule.
+        """
+        setups = [setup for setup in setups if len(setup.tests) > 0]
+        for setup in setups:
+            self._num_remaining[setup] = len(setup.tests)
+            self._num_unfinished += len(setup.tests)
+            for test in setup.tests:
+                self._dependents[test] = []
+                self._expected_mem[test] = self._get_expected_mem(test)
+
+        # Vet tests can depend on the tests of other setups, so this is done once every test is known
+        for setup in setups:
+            for test in setup.tests:
+                self._num_waiting[test] = len(test.dependencies)
+                for dependency in test.dependencies:
+                    self._dependents[dependency].append(test)
+
+        chain_durations = dict()
+        def chain_duration(test):
+            if test not in chain_durations:
+                chain_durations[test] = self.history.estimate_duration(test) + \
+                                        max([chain_duration(dependent) for dependent in self._dependents[test]],
+                                            default=0.0)
+            return chain_durations[test]
+
+        for setup in setups:
+            for test in setup.tests:
+                self._rank[test] = (-chain_duration(test), setup.priority)
+
+        for setup in setups:
+            for test in setup.tests:
+                if len(test.dependencies) == 0:
+                    self._make_ready(test)
+
+    def setup_order(self):
+        """Return the test setups in the order their first tests are expected to start, which is the order their raw
+        data is prefetched in."""
+        first = dict()
+        for test, rank in self._rank.items():
+            if test.setup not in first or rank < first[test.setup]:
+                first[test.setup] = rank
+        return sorted(first, key=lambda setup: first[setup])
+
+    def _make_ready(self, test):
+        """Add a test to the heap of ready tests."""
+        del self._num_waiting[test]
+        heapq.heappush(self._ready, (self._rank[test], self._count, test))
+        self._count += 1
+
+    def _get_expected_mem(self, test):
+        """Return the expected peak memory of a test, or None if it must run alone."""
+        if self.mem_budget is None:
+            return 0
+        peak_mem = self.history.peak_mem(test)
+        if peak_mem is None:
+            return None
+        expected_mem = int(peak_mem * (1.0 + self.mem_margin))
+        return expected_mem if expected_mem <= self.mem_budget else None
+
+    def _can_start(self, test):
+        """Return whether a test fits within the memory budget."""
+        if self.mem_budget is None or self._num_running == 0:
+            return True
+        if self._running_alone or self._expected_mem[test] is None:
+            return False
+        return self._running_mem + self._expected_mem[test] <= self.mem_budget
+
+    def _take_ready_test(self):
+        """Remove and return the highest priority ready test that can start, or None if there isn't one."""
+        if self.mem_budget is None and self.stager is None:
+            test = heapq.heappop(self._ready)[2]
+        else:
+            entries = [entry for entry in sorted(self._ready) if self._can_start(entry[2])]
+            if len(entries) == 0:
+                return None
+            # A test whose raw data hasn't arrived would wait for it, so tests that can start now are taken first
+            entry = entries[0] if self.stager is None else \
+                next((entry for entry in entries if self.stager.is_staged(entry[2].setup)), entries[0])
+            self._ready.remove(entry)
+            heapq.heapify(self._ready)
+            test = entry[2]
+
+        self._num_running += 1
+        if self._expected_mem[test] is None:
+            self._running_alone = True
+        else:
+            self._running_mem += self._expected_mem[test]
+        return test
+
+    def next_test(self):
+        """Return the next test to run, if there is one that is ready and fits in the memory budget.
+
+        Returns:
+            :obj:`PypeItTest`: The test to run, or None if no test can start until a running test finishes, or if
+            all tests have finished.
+        """
+        if len(self._ready) == 0:
+            return None
+        return self._take_ready_test()
+
+    @property
+    def num_unfinished(self):
+        """int: The number of tests that haven't completed or been skipped."""
+        return self._num_unfinished
+
+    def test_finished(self, test):
+        """Called by the test runner once a test has finished running.
+
+        The tests that depend on it are made ready to run if it passed, or are skipped if it failed.
+
+        Args:
+            test (:obj:`PypeItTest`): The test that finished.
+        """
+        self._num_running -= 1
+        if self._expected_mem[test] is None:
+            self._running_alone = False
+        else:
+            self._running_mem -= self._expected_mem[test]
+
+        self._finished(test)
+        if test.passed:
+            for dependent in self._dependents[test]:
+                # Dependents aren't waiting if testing was stopped
+                if dependent in self._num_waiting:
+                    self._num_waiting[dependent] -= 1
+                    if self._num_waiting[dependent] == 0:
+                        self._make_ready(dependent)
+        else:
+            self._skip_dependents(test)
+
+    def stop(self):
+        """Skip every test that hasn't started, so that no more tests are run.
+
+        The tests that are running are still passed to :meth:`test_finished` when they finish.
+        """
+        skipped = [entry[2] for entry in sorted(self._ready)] + list(self._num_waiting)
+        self._ready = []
+        self._num_waiting.clear()
+        for test in skipped:
+            self.test_report.test_skipped(test)
+            self._finished(test)
+
+    def _skip_dependents(self, test):
+        """Skip every test that depends on a failed test."""
+        for dependent in self._dependents[test]:
+            if dependent in self._num_waiting:
+                del self._num_waiting[dependent]
+                self.test_report.test_skipped(dependent)
+                self._finished(dependent)
+                self._skip_dependents(dependent)
+
+    def _finished(self, test):
+        """Account for a completed or skipped test."""
+        self._num_unfinished -= 1
+        self._num_remaining[test.setup] -= 1
+        if self._num_remaining[test.setup] == 0:
+            self.test_report.test_setup_completed(test.setup)
+            if self.stager is not None:
+                self.stager.setup_finished(test.setup)
+
+
 def red_text(text):
     """Utiltiy method to wrap text in the escape sequences to make it appear red in a terminal"""
     return f'\x1B[1;31m{text}\x1B[0m'
@@ -167,6 +319,74 @@ def green_text(text):
     return f'\x1B[1;32m{text}\x1B[0m'
 
 
+class ReportWriter(object):
+    """Writes text to the report file.
+
+    While the writer task is running (see :meth:`__aenter__`), text is buffered and written by that task, so that
+    reporting never blocks the tests on the file system and bursts of text, like the output of pytest, are written
+    together. Otherwise text is written as soon as it is given.
+
+    Attributes:
+        file (str): The report file.
+
+        _buffer (list of str):            Text that hasn't been written yet.
+        _pending (:obj:`asyncio.Event`):  Set when there is text in the buffer, while the writer task is running.
+        _task (:obj:`asyncio.Task`):      The writer task.
+    """
+    def __init__(self, file):
+        self.file = file
+        self._buffer = []
+        self._pending = None
+        self._task = None
+
+    def write(self, text):
+        """Write text to the report file."""
+        self._buffer.append(text)
+        if self._pending is not None:
+            self._pending.set()
+        else:
+            self.flush()
+
+    def flush(self):
+        """Write any buffered text to the report file now."""
+        if len(self._buffer) > 0:
+            with open(self.file, "a") as f:
+                self._write_buffer(f)
+
+    def _write_buffer(self, f):
+        """Write the buffered text to an open file."""
+        text = ''.join(self._buffer)
+        self._buffer.clear()
+        f.write(text)
+        f.flush()
+
+    async def _run(self):
+        """The writer task, which keeps the report file open and writes buffered text whenever there is any."""
+        with open(self.file, "a") as f:
+            while True:
+                await self._pending.wait()
+                self._pending.clear()
+                self._write_buffer(f)
+
+    async def __aenter__(self):
+        """Start the writer task."""
+        self._pending = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, value, traceback):
+        """Stop the writer task, and write anything it didn't get to."""
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._pending = None
+        self.flush()
+        return False
+
+
 class TestReport(object):
     """Class for reporting on the status and results of testing.
 
@@ -187,14 +407,18 @@ class TestReport(object):
     num_passed (int):  The number of tests that have passed.
     num_failed (int):  The number of tests that have failed.
     num_skipped (int): The number of tests that were skipped because they depended on the results of a failed tests.
+    num_cached (int):  The number of passed tests whose results were restored from the cache rather than run.
+    num_resumed (int): The number of passed tests that passed in an earlier run that was resumed (``--resume``).
+    num_timed_out (int): The number of failed tests that were stopped because they ran for longer than their timeout.
     num_active (int):  The number of tests that are currently in progress.
 
     failed_tests (:obj:`list` of str):  List of names of tests that have failed
     skipped_tests (:obj:`list` of str): List of names of tests that have been skipped
 
     testing_complete (bool): Whether testing has completed.
-    lock (:obj:`threading.Lock`): Lock used to synchronize access when multiple threads are reporting status. This
-                                  prevents scrambled output being sent to stdout.
+    stop_reason (str): Why testing was stopped before all of the tests ran (by a signal or --fail_fast), or None if
+                       it wasn't.
+    report_writer (:obj:`ReportWriter`): Writes to the report file, or None if there is no report file.
     """
     def __init__(self, pargs):
         self.pargs = pargs
@@ -205,14 +429,19 @@ class TestReport(object):
         self.num_passed = 0
         self.num_failed = 0
         self.num_skipped = 0
+        self.num_cached = 0
+        self.num_resumed = 0
+        self.num_timed_out = 0
         self.num_active = 0
         self.failed_tests = []
         self.skipped_tests = []
-        self.lock = Lock()
         self.testing_complete = False
+        self.stop_reason = None
+        self.report_writer = ReportWriter(pargs.report) if pargs.report is not None else None
         self.start_time = datetime.datetime.now()
 
         self.pytest_results=dict()
+        self.coverage_summary = []
 
         if pargs.report is not None and os.path.exists(pargs.report):
             # Remove any old report files if we've been asked to overwrite it
@@ -235,83 +464,122 @@ class TestReport(object):
                 testing is complete.
 
         """
-        with self.lock:
-            self.test_setups = setups
-            # Create the report file (if needed) and write the header to it
-            if self.pargs.report:
-                try:
-                    with open(self.pargs.report, "a") as report_file:
-                        self.detailed_report_header(output=report_file)
+        self.test_setups = setups
+        # Create the report file (if needed) and write the header to it
+        if self.report_writer is not None:
+            try:
+                output = io.StringIO()
+                self.detailed_report_header(output=output)
+                self.report_writer.write(output.getvalue())
+                self.report_writer.flush()
 
-                except Exception as e:
-                    print(f"Could not open report file {self.pargs.report}", file=sys.stderr)
-                    traceback.print_exc()
-                    sys.exit(1)
+            except Exception as e:
+                print(f"Could not open report file {self.pargs.report}", file=sys.stderr)
+                traceback.print_exc()
+                sys.exit(1)
 
 
 
     def test_started(self, test):
         """Called when a test has started executing"""
-        with self.lock:
-            self.num_tests += 1
-            self.num_active += 1
+        self.num_tests += 1
+        self.num_active += 1
 
 
-            if not self.pargs.quiet:
-                verbose_info = ''
-                if self.pargs.verbose:
-                    verbose_info = f' at {datetime.datetime.now().ctime()}'
+        if not self.pargs.quiet:
+            verbose_info = ''
+            if self.pargs.verbose:
+                verbose_info = f' at {datetime.datetime.now().ctime()}'
 
-                print(f'{self._get_test_counts()} STARTED {test}{verbose_info}', flush=True)
+            print(f'{self._get_test_counts()} STARTED {test}{verbose_info}', flush=True)
 
     def test_skipped(self, test):
         """Called when a test has been skipped because a test before it has failed"""
-        with self.lock:
-            self.num_skipped += 1
-            self.skipped_tests.append(test)
+        self.num_skipped += 1
+        self.skipped_tests.append(test)
 
-            if not self.pargs.quiet:
-                print(f'{self._get_test_counts()} {red_text("SKIPPED")} {test}', flush=True)
+        if not self.pargs.quiet:
+            print(f'{self._get_test_counts()} {red_text("SKIPPED")} {test}', flush=True)
 
     def test_completed(self, test):
         """Called when a test has finished executing."""
-        with self.lock:
-            self.num_active -= 1
+        self.num_active -= 1
+        if test.passed:
+            self.num_passed += 1
+            if test.from_cache:
+                self.num_cached += 1
+            if test.resumed:
+                self.num_resumed += 1
+        else:
+            self.num_failed += 1
+            self.failed_tests.append(test)
+            if test.timed_out:
+                self.num_timed_out += 1
+
+        if not self.pargs.quiet:
+            verbose_info = ''
+            if self.pargs.verbose:
+                if test.end_time is not None and test.start_time is not None:
+                    duration = test.end_time-test.start_time
+                else:
+                    duration = 'n/a'
+
+                verbose_info = f' with pid {test.pid} at {datetime.datetime.now().ctime()} Duration {duration}'
+
             if test.passed:
-                self.num_passed += 1
+                cache_info = ' (from cache)' if test.from_cache else ''
+                if test.resumed:
+                    cache_info += ' (from an earlier run)'
+                print(f'{self._get_test_counts()} {green_text("PASSED")}  {test}{cache_info}{verbose_info}', flush=True)
             else:
-                self.num_failed += 1
-                self.failed_tests.append(test)
+                result = "TIMED OUT" if test.timed_out else "FAILED"
+                print(f'{self._get_test_counts()} {red_text(result)}  {test}{verbose_info}', flush=True)
+                self.report_on_test(test, flush=True)
+
+    def stop(self, reason):
+        """Called when testing is stopped before all of the tests have run.
 
+        Args:
+            reason (str): Why testing was stopped.
+        """
+        if self.stop_reason is None:
+            self.stop_reason = reason
             if not self.pargs.quiet:
-                verbose_info = ''
-                if self.pargs.verbose:
-                    if test.end_time is not None and test.start_time is not None:
-                        duration = test.end_time-test.start_time
-                    else:
-                        duration = 'n/a'
+                print(red_text(f'STOPPING: {reason}. No more tests will be started.'), flush=True)
 
-                    verbose_info = f' with pid {test.pid} at {datetime.datetime.now().ctime()} Duration {duration}'
+    def num_failures(self):
+        """Return the number of failed tests, including the failed pytest tests."""
+        num_pytest_failures = 0
+        for results in self.pytest_results.values():
+            num_pytest_failures += sum([int(count) for count in re.findall(r'(\d+) (?:failed|errors?)\b', results)])
+        return self.num_failed + num_pytest_failures
 
-                if test.passed:
-                    print(f'{self._get_test_counts()} {green_text("PASSED")}  {test}{verbose_info}', flush=True)
-                else:
-                    print(f'{self._get_test_counts()} {red_text("FAILED")}  {test}{verbose_info}', flush=True)
-                    self.report_on_test(test, flush=True)
+    def check_fail_fast(self):
+        """Stop testing if the number of failures has reached the --fail_fast limit.
+
+        Returns:
+            bool: Whether testing has been stopped, for this or any other reason.
+        """
+        if self.pargs.fail_fast is not None and self.stop_reason is None:
+            num_failures = self.num_failures()
+            if num_failures >= self.pargs.fail_fast:
+                self.stop(f'{num_failures} tests failed (--fail_fast {self.pargs.fail_fast})')
+        return self.stop_reason is not None
 
     def test_setup_completed(self, test_setup):
         """Called once all of the tests in a test setup have completed"""
-        if self.pargs.report is not None:
-            with self.lock:
-                with open(self.pargs.report, "a") as report_file:
-                    self.report_on_setup(test_setup, report_file)            
+        if self.report_writer is not None:
+            output = io.StringIO()
+            self.report_on_setup(test_setup, output)
+            self.report_writer.write(output.getvalue())
 
     def testing_completed(self):
         """Called once all test setups have complete"""
         self.end_time = datetime.datetime.now()
-        if self.pargs.report is not None:
-            with open(self.pargs.report, "a") as report_file:
-                self.summary_report(report_file)
+        if self.report_writer is not None:
+            output = io.StringIO()
+            self.summary_report(output)
+            self.report_writer.write(output.getvalue())
 
     def pytest_started(self, test_descr):
         """Called when a set of pytest tests have started.
@@ -326,10 +594,8 @@ class TestReport(object):
         if not self.pargs.quiet:
             print(f"Running {test_descr}", flush=True)
 
-        if self.pargs.report is not None:
-            with open(self.pargs.report, "a") as report_file:
-                print(f"{test_descr} Results:", file=report_file)
-                print ("-------------------------", file=report_file)                
+        if self.report_writer is not None:
+            self.report_writer.write(f"{test_descr} Results:\n-------------------------\n")
 
     def pytest_line(self, test_descr, line):
         """Called for each line ouptut from a pytest run. Each line is echoed to
@@ -347,9 +613,8 @@ class TestReport(object):
         if not self.pargs.quiet:
             print(line, flush=True)
 
-        if self.pargs.report is not None:
-            with open(self.pargs.report, "a") as report_file:
-                print(line, file=report_file)
+        if self.report_writer is not None:
+            self.report_writer.write(line + '\n')
         
         # Save any summary lines found for reporting later.
         if "warnings" in line or "passed" in line or "failed" in line:
@@ -378,6 +643,22 @@ class TestReport(object):
         if self.pargs.threads > 1:
             print(f'Ran tests in {self.pargs.threads} parallel processes\n', file=output)
 
+        if self.pargs.mem_budget is not None:
+            print(f'Ran tests within a memory budget of {self.pargs.mem_budget / 2**30:.1f} GiB\n', file=output)
+
+        if self.pargs.shard is not None:
+            print(f'Ran shard {self.pargs.shard[0]} of {self.pargs.shard[1]}\n', file=output)
+
+        if self.pargs.time_budget is not None:
+            print(f'Ran the test setups selected for a time budget of '
+                  f'{datetime.timedelta(seconds=round(self.pargs.time_budget))}\n', file=output)
+
+        if self.pargs.cache_dir is not None:
+            print(f'Restored the results of unchanged tests from the cache in {self.pargs.cache_dir}\n', file=output)
+
+        if self.pargs.resume:
+            print(f'Resumed an earlier run, without running the tests that passed in it again\n', file=output)
+
     def summarize_setup_tests(self, output=sys.stdout):
         """Display a summary of the PypeIt setup tests"""
 
@@ -394,10 +675,16 @@ class TestReport(object):
                   + "\x1B[" + "0m" + "\r", file=output)
             print('Failed tests:', file=output)
             for t in self.failed_tests:
-                print('    {0}'.format(t), file=output)
+                print('    {0}{1}'.format(t, ' (timed out)' if t.timed_out else ''), file=output)
             print('Skipped tests:', file=output)
             for t in self.skipped_tests:
                 print('    {0}'.format(t), file=output)
+        if self.num_timed_out > 0:
+            print(f'{self.num_timed_out} failed tests timed out', file=output)
+        if self.num_cached > 0:
+            print(f'{self.num_cached} passed tests were restored from the cache', file=output)
+        if self.num_resumed > 0:
+            print(f'{self.num_resumed} passed tests passed in an earlier run that was resumed', file=output)
 
     def summarize_pytest_results(self, test_descr, output=sys.stdout):
         """Display a summary of a pytest run."""
@@ -414,7 +701,9 @@ class TestReport(object):
 
     def performance_results(self, output):
         """Display performance statistics on PypeIt tests."""
-        print("Setup,Test Type,Start Time,End Time,Duration(s),Memory Usage (bytes),Duration (D:H:M:S), Memory Usage (MiB)", file=output)
+        print("Setup,Test Type,Start Time,End Time,Duration(s),Memory Usage (bytes),Duration (D:H:M:S), Memory Usage (MiB),"
+              "User CPU (s),System CPU (s),Voluntary Context Switches,Involuntary Context Switches,Bytes Read,"
+              "Bytes Written,Usage Source", file=output)
         for setup in self.test_setups:
             for test in setup.tests:
                 if test.start_time is not None and test.end_time is not None:
@@ -431,7 +720,12 @@ class TestReport(object):
                     mem_usage = test.max_mem
                     mem_usage_megs = test.max_mem / (2**20)
 
-                print(f'{test.setup},{test.description},{test.start_time},{test.end_time},{duration_secs},{mem_usage},{duration},{mem_usage_megs}', file=output)
+                usage = [] if test.usage is None else [test.usage.user_cpu, test.usage.system_cpu,
+                                                        test.usage.voluntary_switches, test.usage.involuntary_switches,
+                                                        test.usage.read_bytes, test.usage.write_bytes, test.usage.source]
+                usage = ",".join(["" if value is None else str(value) for value in usage] + [""] * (7 - len(usage)))
+
+                print(f'{test.setup},{test.description},{test.start_time},{test.end_time},{duration_secs},{mem_usage},{duration},{mem_usage_megs},{usage}', file=output)
 
 
     def print_tail(self, file, num_lines, output=sys.stdout, flush=False):
@@ -444,14 +738,21 @@ class TestReport(object):
         """Display a summary report on the results of testing to the given output stream"""
 
         print ("\nTest Summary\n--------------------------------------------------------", file=output)
+        if self.stop_reason is not None:
+            print(red_text(f"Testing was stopped early: {self.stop_reason}"), file=output)
         self.summarize_pytest_results("PypeIt Unit Tests", output)
         self.summarize_pytest_results("Unit Tests", output)
         self.summarize_pytest_results("Vet Tests", output)
         self.summarize_setup_tests(output)
+        write_utilisation_summary(self.test_setups, self.pargs.threads, output)
 
         if self.pargs.coverage is not None:
             print(f"Coverage results:", file=output)
             self.print_tail(self.pargs.coverage, 1, output)
+            for line in self.coverage_summary:
+                print(line, file=output)
+        elif self.pargs.profile is not None:
+            print(f"Profile report: {self.pargs.profile}", file=output)
 
         print(f"Testing Started at {self.start_time.isoformat()}", file=output)
         print(f"Testing Completed at {self.end_time.isoformat()}", file=output)
@@ -462,9 +763,12 @@ class TestReport(object):
         """Print a detailed report on the status of a test to the given output stream."""
 
         if test.passed:
-            result = green_text('--- PASSED')
+            result = green_text('--- PASSED' + (' (from cache)' if test.from_cache else '') +
+                                (' (from an earlier run)' if test.resumed else ''))
         elif test.passed is None:
             result = red_text('--- SKIPPED')
+        elif test.timed_out:
+            result = red_text('--- TIMED OUT')
         else:
             result = red_text('--- FAILED')
 
@@ -480,8 +784,20 @@ class TestReport(object):
         print(f'Start time: {test.start_time.ctime() if test.start_time is not None else "n/a"}', file=output, flush=flush)
         print(f'End time:   {test.end_time.ctime() if test.end_time is not None else "n/a"}', file=output, flush=flush)
         print(f'Duration:   {duration}', file=output, flush=flush)
+        if test.timeout is not None:
+            print(f'Timeout:    {datetime.timedelta(seconds=round(test.timeout))}', file=output, flush=flush)
         print(f'Mem Usage:  {test.max_mem}', file=output, flush=flush)
+        if test.usage is not None:
+            usage = test.usage
+            print(f'CPU Time:   user {usage.user_cpu}s, system {usage.system_cpu}s', file=output, flush=flush)
+            print(f'Ctx Switch: voluntary {usage.voluntary_switches}, involuntary {usage.involuntary_switches}',
+                  file=output, flush=flush)
+            print(f'I/O:        read {usage.read_bytes} bytes, written {usage.write_bytes} bytes', file=output,
+                  flush=flush)
+            print(f'Usage From: {usage.source}', file=output, flush=flush)
         print(f"Command:    {' '.join(test.command_line) if test.command_line is not None else ''}", file=output, flush=flush)
+        if test.cache_key is not None:
+            print(f'Cache key:  {test.cache_key}', file=output, flush=flush)
         print('', file=output, flush=flush)
         print('Error Messages:', file=output, flush=flush)
 
@@ -518,10 +834,38 @@ def clear_coverage_data(redux_out):
     path = Path(redux_out)
     for file in path.rglob(".coverage*"):
         file.unlink(missing_ok = True)
+    # The data files of the tests, next to their logs
+    for file in path.rglob("*.coverage.*"):
+        file.unlink(missing_ok = True)
+
+async def read_lines(stream, chunk_size=2**16):
+    """Read the lines from a stream, however long they are.
+
+    Iterating over a :obj:`asyncio.StreamReader` fails on lines longer than its limit (64 KiB by default), which
+    pytest can write, e.g. when reporting the parameters of a test. So the stream is read in chunks instead.
+
+    Args:
+        stream (:obj:`asyncio.StreamReader`): The stream.
+        chunk_size (int): The most bytes read at once.
 
-def run_pytest(pargs, test_descr, test_dir, test_report, 
-               redux_out=None):
-    """Run pytest on a directory of test files.
+    Yields:
+        bytes: Each line, including its newline, and then any output after the last newline.
+    """
+    pending = b''
+    while True:
+        chunk = await stream.read(chunk_size)
+        if len(chunk) == 0:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if len(pending) > 0:
+        yield pending
+
+async def run_pytest(pargs, test_descr, test_dir, test_report, 
+                     redux_out=None, parallel=False, test_ids=None, setups=None):
+    """Run pytest on a directory of test files, streaming its output to the test report.
     
     Args:
         pargs (:obj:`argparse.Namespace`): The arguments to pypeit_test, as returned by argparse.
@@ -541,62 +885,104 @@ def run_pytest(pargs, test_descr, test_dir, test_report,
         redux_out (str):
             The location of the output of this dev-suite run. Optional, only required
             if the pytest suite requires the output from the dev-suite (i.e vet_tests).
+
+        parallel (bool):
+            Whether the pytest suite can be run in parallel with pytest-xdist. If True, it runs
+            in pargs.threads processes when pytest-xdist is installed.
+
+        test_ids (list of str):
+            The pytest node ids of the tests to run. Optional, by default every test in
+            test_dir is run.
+
+        setups (list of str):
+            The test setups selected on the command line, as instrument names or instr/setup keys.
+            These are passed to the ``--setups`` option of the dev-suite unit and vet tests, so that only
+            the tests using them are collected. Optional, by default every test is run.
     """
     abs_test_dir = os.path.abspath(test_dir)
 
     test_report.pytest_started(test_descr)
 
-    # Tests not written to run in parallel yet
-    #args = ["pytest", "-v", "--color=yes", "-n", str(pargs.threads)]
-
     # Run pytest using coverage if requested
     if pargs.coverage is not None:
-        args = ["coverage", "run"] + _COVERAGE_ARGS + ["-m", "pytest", "-v", "--color=yes"]
+        args = ["coverage", "run"] + _COVERAGE_ARGS + ["--context", test_descr, "-m", "pytest", "-v", "--color=yes"]
     else:
         args = ["pytest", "-v", "--color=yes"]
 
+    # Coverage doesn't follow the pytest-xdist worker processes, so coverage runs stay in one process
+    if parallel and pargs.threads > 1 and pargs.coverage is None:
+        if importlib.util.find_spec("xdist") is not None:
+            args += ["-n", str(pargs.threads)]
+        elif not pargs.quiet:
+            print(f"pytest-xdist is not installed, running {test_descr} in a single process", flush=True)
+
     if not pargs.show_warnings:
         args.append("--disable-warnings")
     
     if redux_out is not None:
         args += ["--redux_out", redux_out]
 
-    args.append(abs_test_dir)
-
-    # Run pytest, sending the outpu to the test report.
-    # We change the current directory so that the coverage output goes to the outputdir
-    with subprocess.Popen(args,stderr=subprocess.STDOUT, stdout=subprocess.PIPE,cwd=pargs.outputdir) as p:
-        while(p.poll() is None):
-            test_report.pytest_line(test_descr, p.stdout.readline().decode().strip())
+    if setups is not None:
+        for setup in setups:
+            args += ["--setups", setup]
 
-def generate_coverage_report(pargs):
+    if pargs.fail_fast is not None:
+        # Only the failures still allowed by --fail_fast
+        args += ["--maxfail", str(max(pargs.fail_fast - test_report.num_failures(), 1))]
 
-    # Find the coverage files
-    coverage_files = [str(path) for path in Path(pargs.outputdir).rglob(".coverage.*")]
-    
-    if len(coverage_files) > 0:
-        if not pargs.quiet:
-            print("Combining coverage files...", flush=True)
+    if test_ids is None:
+        args.append(abs_test_dir)
     else:
+        args += test_ids
+
+    # Run pytest, sending the output to the test report.
+    # We change the current directory so that the coverage output goes to the outputdir
+    env = os.environ if pargs.coverage is None else coverage_env(os.environ, coverage_core(pargs.coverage_core))
+    process = await asyncio.create_subprocess_exec(*args, stderr=asyncio.subprocess.STDOUT,
+                                                   stdout=asyncio.subprocess.PIPE, cwd=pargs.outputdir, env=env)
+    try:
+        async for line in read_lines(process.stdout):
+            test_report.pytest_line(test_descr, line.decode(errors='replace').strip())
+        await process.wait()
+    finally:
+        # If testing was stopped, pytest and any pytest-xdist workers are stopped within a bounded time
+        if process.returncode is None:
+            await stop_processes(process, process_tree(process.pid), signal.SIGTERM, PypeItTest.stop_wait)
+
+def generate_coverage_report(pargs, collector):
+    """Combine the coverage data of a run, and write the coverage report.
+
+    Args:
+        pargs (:obj:`argparse.Namespace`): The arguments to pypeit_test, as returned by argparse.
+        collector (:obj:`CoverageCollector`): Has combined the data of the tests that have finished.
+    """
+    # Combine the data left over, changing to the output dir to keep the coverage data files there
+    if not pargs.quiet:
+        print("Combining coverage files...", flush=True)
+    if not collector.finish(pargs.threads):
         with open(pargs.coverage, "w") as f:
             print("Couldn't find coverage files to combine.", file=f)
+            for output in collector.errors:
+                print(output, file=f)
         return
-
-    # Combine them, changing to the output dir to keep the coverage 
-    # data files there
-    process = subprocess.run(["coverage", "combine"] + coverage_files, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=pargs.outputdir)
-    if process.returncode != 0:
+    if len(collector.errors) > 0:
         if not pargs.quiet:
-            print("Failed to combine coverage data.", flush=True)
-        with open(pargs.coverage, "w") as f:
-            print("Failed to combine coverage files. Output:", file=f)
-            print(process.stdout, file=f)
-        return
+            print("Failed to combine some coverage data.", flush=True)
+        print("Failed to combine coverage files. Output:", file=sys.stderr)
+        for output in collector.errors:
+            print(output, file=sys.stderr)
 
     # Generate the report.
     with open(pargs.coverage, "w") as f:
         process = subprocess.run(["coverage", "report", "-m"], stdout=f, stderr=subprocess.STDOUT, cwd=pargs.outputdir)
 
+    # Record the code run by each test, for selecting the tests impacted by a change
+    index = CoverageIndex(pargs.coverage_index)
+    num_tests = index.update_from_coverage(os.path.join(pargs.outputdir, ".coverage"))
+    index.write()
+    if not pargs.quiet:
+        print(f"Updated the code run by {num_tests} tests in the coverage index {pargs.coverage_index}", flush=True)
+
 def raw_data_dir():
     return os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA')
 
@@ -609,12 +995,56 @@ def available_setups(raw_data, instr):
     return [x.name for x in Path(raw_data).joinpath(instr).glob('*') if x.is_dir()]    
 
 
+def parse_mem_size(size):
+    """Parse a memory size given on the command line.
+
+    Args:
+        size (str): A number of bytes, optionally followed by a K, M, G, or T suffix (with an optional
+                    "i" and/or "B", e.g. "64G", "64Gi", or "64GiB"). Suffixes are powers of 1024.
+
+    Returns:
+        int: The size in bytes.
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*(?:([KMGT])i?B?)?\s*', size, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid memory size: {size}")
+    exponent = 0 if match.group(2) is None else 'KMGT'.index(match.group(2).upper()) + 1
+    return int(float(match.group(1)) * 1024**exponent)
+
+def parse_duration(duration):
+    """Parse a duration given on the command line.
+
+    Args:
+        duration (str): A number of seconds, or numbers followed by d, h, m, or s units (e.g. "30m" or "1h30m").
+
+    Returns:
+        float: The duration in seconds.
+    """
+    if re.fullmatch(r'\s*\d+(?:\.\d*)?\s*', duration):
+        return float(duration)
+    if re.fullmatch(r'(?:\s*\d+(?:\.\d*)?\s*[dhms])+\s*', duration, re.IGNORECASE) is None:
+        raise ValueError(f"Invalid duration: {duration}")
+    units = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+    return sum([float(number) * units[unit.lower()]
+                for number, unit in re.findall(r'(\d+(?:\.\d*)?)\s*([dhms])', duration, re.IGNORECASE)])
+
+def parse_shard(shard):
+    """Parse a shard given on the command line.
+
+    Args:
+        shard (str): The shard as INDEX/COUNT, with INDEX from 0 to COUNT-1 (e.g. "0/4").
+
+    Returns:
+        tuple: The (index, count) of the shard.
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', shard)
+    if match is None or int(match.group(2)) < 1 or int(match.group(1)) >= int(match.group(2)):
+        raise ValueError(f"Invalid shard: {shard}")
+    return int(match.group(1)), int(match.group(2))
+
 def parser(options=None):
     import argparse
 
-    dirs = available_data()
-    all_tests = np.unique([ [d.split('_')[0], d.split('_')[1]] for d in dirs ])
-
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                      description='Run pypeit tests on a set of instruments.  '
                                                  'Typical call for testing pypeit when developing '
@@ -633,7 +1063,9 @@ def parser(options=None):
 
     parser.add_argument('tests', type=str, nargs='+', default=None,
                         help='Which test types to run. Options are:  '
-                             'pypeit_tests, unit, reduce, afterburn, ql, vet, or all. Use list to show all supported instruments and setups.')
+                             'pypeit_tests, unit, reduce, afterburn, ql, vet, or all. Use list to show all supported instruments and setups. '
+                             'Use "pypeit_test merge" to combine the results of runs split with --shard '
+                             '(see "pypeit_test merge -h").')
     parser.add_argument('-o', '--outputdir', type=str, default='REDUX_OUT',
                         help='Output folder.')
     parser.add_argument('-i', '--instruments', type=str, nargs='+', 
@@ -656,62 +1088,340 @@ def parser(options=None):
                              'detailed report at the end of testing. This has no effect if -q is given')
     parser.add_argument('--coverage', default=None, type=str, 
                         help='Collect code coverage information. and write it to the given file.')
+    parser.add_argument('--coverage_core', default=None, type=str, choices=['sysmon', 'ctrace', 'pytrace'],
+                        help='The coverage core to measure coverage with. Defaults to sysmon, which has the lowest '
+                             'overhead, on Python 3.12 and later, and to the default of coverage otherwise.')
+    parser.add_argument('--coverage_index', default=INDEX_FILE, type=str,
+                        help='With --coverage, record the PypeIt code run by each test in this file. It is used by '
+                             '"pypeit_test impacted" to select the tests that run the code changed by a git range '
+                             'or patch.')
+    parser.add_argument('--profile', default=None, type=str,
+                        help='Run the PypeIt scripts of the tests under cProfile, and write a report ranking the PypeIt '
+                             'functions by cumulative and self time, for all tests and for each instrument, to the given '
+                             'file. The profile of each test is written next to its log, and the merged profile next '
+                             'to the report. Ignored with --coverage.')
     parser.add_argument('-r', '--report', default=None, type=str,
                         help='Write a detailed test report to REPORT.')
     parser.add_argument('-c', '--csv', default=None, type=str,
                         help='Write performance numbers to a CSV file.')
+    parser.add_argument('--cgroup', default=None, type=str,
+                        help='A cgroup v2 directory, with the memory controller enabled in its cgroup.subtree_control, '
+                             'to create a cgroup for each test in. The peak memory and CPU time of the cgroup include '
+                             'every process of the test. Defaults to the cgroup of pypeit_test. Without a usable cgroup, '
+                             'the resources used by tests are accounted for with wait4.')
+    parser.add_argument('--trace', default=None, type=str,
+                        help='Write a timeline of the tests run on each parallel worker, with the CPU usage of their '
+                             'processes, to the given file in the Chrome trace format. It can be viewed with '
+                             'https://ui.perfetto.dev or chrome://tracing.')
     parser.add_argument('-w', '--show_warnings', default=False, action='store_true',
                         help='Show warnings when running unit tests and vet tests.')
+    parser.add_argument('--mem_budget', default=None, type=parse_mem_size,
+                        help='Only run tests at the same time if the sum of their peak memory from prior runs fits '
+                             'within this many bytes. Accepts K, M, G, and T suffixes (e.g. 64G). Tests without a '
+                             'recorded peak memory run alone.')
+    parser.add_argument('--mem_margin', default=0.2, type=float,
+                        help='Safety margin added to the prior peak memory of a test when using --mem_budget, '
+                             'as a fraction of the peak memory.')
+    parser.add_argument('--fail_fast', default=None, type=int, metavar='N',
+                        help='Stop starting new tests once N tests have failed, including failed unit and vet tests. '
+                             'The tests that are running are allowed to finish, and the reports are written for the '
+                             'tests that ran.')
+    parser.add_argument('--timeout_factor', default=5.0, type=float,
+                        help='Stop tests that run for longer than this many times the median duration of their prior '
+                             'runs, after writing the stack traces of their processes to their logs. Tests that have '
+                             'never run use the timeout of their test phase, and timeouts can be set for specific tests, '
+                             'in test_setups.py. Tests that depend on a test that timed out are skipped. Use 0 to never '
+                             'stop tests.')
+    parser.add_argument('--min_timeout', default=600.0, type=float,
+                        help='The shortest timeout, in seconds, set from the prior runs of a test with --timeout_factor.')
+    parser.add_argument('--history', default='test_history.json', type=str,
+                        help='File with the duration, peak memory and result of each test from prior runs. It is '
+                             'used to run the slowest tests first and is updated after every run.')
+    parser.add_argument('--zygote', default=False, action='store_true',
+                        help='Run PypeIt scripts in processes forked from a process that has already imported PypeIt, '
+                             'rather than starting a new Python process for every test. Ignored with --coverage and '
+                             '--profile.')
+    parser.add_argument('--cache_dir', default=None, type=str,
+                        help='Cache the results of reduction and afterburn tests in this directory. Tests whose '
+                             'inputs, command line, and PypeIt version are unchanged from a cached run are restored '
+                             'from the cache instead of being run. Ignored with --coverage and --profile.')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='Resume an earlier run with the same output directory that was stopped before it '
+                             'finished. Tests that passed in it are not run again if their inputs, PypeIt version and '
+                             'output files are unchanged, and are reported with their results from that run. Only the '
+                             'tests of runs with --resume or --cache_dir can be resumed, as the other runs don\'t '
+                             'hash their inputs. Ignored with --coverage and --profile.')
+    parser.add_argument('--time_budget', default=None, type=parse_duration, metavar='DURATION',
+                        help='Only run the test setups that test the most within this predicted wall time for the '
+                             'number of parallel tests (-t), e.g. 30m or 1h30m. Setups are picked to cover as many '
+                             'instruments, test types and historically failing setups as they can, with their '
+                             'durations predicted from the test history. Unit and vet tests are only run for the '
+                             'selected setups, and aren\'t included in the budget.')
+    parser.add_argument('--coverage_map', default=None, type=str,
+                        help='JSON file mapping instr/setup keys to the PypeIt code units (e.g. lines or functions) '
+                             'their tests run. With --time_budget, setups are also picked to cover as much of this '
+                             'code as they can.')
+    parser.add_argument('--shard', default=None, type=parse_shard, metavar='INDEX/COUNT',
+                        help='Only run the test setups in shard INDEX (counting from 0) of COUNT shards. Test setups '
+                             'are split so that each shard has about the same predicted run time from the test history. '
+                             'Unit tests are only run in shard 0, and vet tests are not run. Use "pypeit_test merge" '
+                             'to combine the results of the shards.')
+    parser.add_argument('--raw_source', default=None, type=str,
+                        help='Fetch the raw data of each test setup from this copy of RAW_DATA as the tests need it, '
+                             'rather than it all being in RAW_DATA before testing starts. Either a local directory, '
+                             'an rclone remote (e.g. gdrive:RAW_DATA, using nautilus/rclone.conf if it exists), or an '
+                             's3:// URL (using the endpoint in $ENDPOINT_URL). The raw data of the setups expected to '
+                             'run next is prefetched while tests run. Setups already in RAW_DATA aren\'t fetched. The '
+                             'unit and vet tests run with pytest only see the raw data that has been fetched.')
+    parser.add_argument('--max_transfers', default=2, type=int,
+                        help='With --raw_source, the most test setups whose raw data is fetched at once.')
+    parser.add_argument('--raw_budget', default=None, type=parse_mem_size,
+                        help='With --raw_source, the most disk space used by the fetched raw data before prefetching '
+                             'waits for the raw data of finished setups to be evicted (see --evict_raw), e.g. 200G. '
+                             'The raw data of a setup whose tests are waiting for it is fetched regardless.')
+    parser.add_argument('--evict_raw', default=False, action='store_true',
+                        help='With --raw_source, remove the raw data fetched for a test setup once its tests have '
+                             'finished.')
+    parser.add_argument('--skip_preflight', default=False, action='store_true',
+                        help='Don\'t check that the raw files read by the tests exist and are complete before running '
+                             'the tests. Raw files that passed the check before are only checked again once they '
+                             'change.')
+    parser.add_argument('--reference_source', default=None, type=str,
+                        help='Fetch the large reference files that tests read but PypeIt doesn\'t install, such as '
+                             'the atmospheric model grids of pypeit_sensfunc and pypeit_tellfit, from this location '
+                             'the first time a test needs them, and link them into PypeIt. The location takes the '
+                             'same forms as --raw_source, e.g. s3://pypeit, and has a <file>.sha256 checksum next to '
+                             'each file.')
+    parser.add_argument('--reference_cache', default=None, type=str,
+                        help='With --reference_source, the directory the reference files are kept in, which can be '
+                             'shared by runs on the same machine. Defaults to REFERENCE_CACHE in the dev suite '
+                             'directory.')
     return parser.parse_args() if options is None else parser.parse_args(options)
 
-def show_setup_list():
-    """Show a list of all instruments and the setups they support."""
+def show_setup_list(manifest):
+    """Show a list of all instruments and the setups they support.
+
+    Args:
+        manifest (:obj:`SuiteManifest`): The manifest of the dev suite. Setups without raw data are marked with a "*".
+    """
     print("All instruments and test setups supported by the dev-suite:\n")
-    for instrument in all_setups.keys():
+    for instrument in manifest.setups.keys():
         print(instrument)
         # Print an indented line wrapped list of setups beneath the instrument.
         # "break_long_words=False" prevents it from breaking up setup names at an underscore,
         # which looks bad.
-        setups = " ".join(all_setups[instrument])
+        setups = " ".join([name + ('' if f'{instrument}/{name}' in manifest.raw_files else '*')
+                           for name in manifest.setups[instrument]])
         for line in textwrap.wrap(setups, width=80, initial_indent = "    ", 
                                   subsequent_indent="    ", break_long_words=False):
             print(line)
 
-def thread_target(test_report):
-    """Thread target method for running tests."""
-    while not test_report.testing_complete:
-        try:
-            test_setup = test_run_queue.get(timeout=2)
-        except Empty:
-            # queue is currently empty but another thread may put another test on it, so try again
-            continue
+def start_zygote(setups, pargs):
+    """Start a zygote process and use it to run the tests of the test setups.
 
-        passed = True
-        for test in test_setup.tests:
+    Args:
+        setups (list of :obj:`TestSetup`): The test setups being run.
+        pargs (:obj:`argparse.Namespace`):  The parsed command line arguments.
 
-            if not passed:
-                test_report.test_skipped(test)
-            else:
+    Returns:
+        :obj:`PypeItZygote`: The zygote, or None if it couldn't be started, in which case each test is run in
+        a new process.
+    """
+    zygote = PypeItZygote()
+    try:
+        zygote.start()
+    except Exception as e:
+        if not pargs.quiet:
+            print(f'Could not start the zygote process, running each test in a new process instead: {e}')
+        return None
+
+    for setup in setups:
+        for test in setup.tests:
+            test.zygote = zygote
+    if not pargs.quiet and pargs.verbose:
+        print(f'Started a zygote process that can run {len(zygote.commands)} PypeIt scripts')
+    return zygote
+
+async def sample_processes(running_tests, interval):
+    """Periodically sample the memory and CPU time used by the child processes of the running tests.
+
+    Args:
+        running_tests (:obj:`dict`): The tests that are running, as the values of the dict.
+        interval (float):            Seconds between samples.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for test in list(running_tests.values()):
+            test.sample_memory()
+            test.sample_cpu()
+
+async def run_tests(scheduler, test_report, num_workers, sample_interval=2.0):
+    """Run the tests from a scheduler, with up to num_workers tests running at once.
+
+    Each test runs as a task in the event loop, which starts its child process and waits for it to exit. Whenever a
+    test finishes, it's reported and the scheduler is told, which can make more tests ready to run. The memory and
+    CPU time of the running tests are sampled by a separate periodic task. Each test is given the lowest free worker
+    slot, which is used to show the timeline of the run (see :func:`write_trace`). A test that runs for longer than
+    its timeout stops its child and fails, which frees its worker and skips the tests that depend on it. Each test
+    that finishes is recorded in its journal, if it has one, so that the run can be resumed. Once
+    testing is stopped, by ``--fail_fast`` or a signal (see :func:`run_async`), the tests that haven't started are
+    skipped. If the scheduler has a raw data stager, the raw data of the test setups is prefetched in the order they
+    are expected to run, and each test waits for the raw data of its setup before it runs.
+
+    Args:
+        scheduler (:obj:`TestScheduler`): The scheduler with the tests to run.
+        test_report (:obj:`TestReport`):  The test report to send test status to.
+        num_workers (int):                The maximum number of tests to run at once.
+        sample_interval (float):          Seconds between samples of the memory and CPU time used by the running
+                                          tests.
+    """
+    running = dict()
+    free_workers = list(range(num_workers))
+    sampler = asyncio.create_task(sample_processes(running, sample_interval))
+    stager = scheduler.stager
+    if stager is not None:
+        stager.start(scheduler.setup_order())
+
+    async def run_test(test):
+        if stager is not None:
+            error = await stager.stage(test.setup)
+            if error is not None:
+                test.passed = False
+                test.error_msgs.append(error)
+                return False
+        return await test.run()
+
+    if test_report.check_fail_fast():
+        # Testing was stopped before these tests, e.g. by failed unit tests
+        scheduler.stop()
+    try:
+        while True:
+            while len(running) < num_workers:
+                test = scheduler.next_test()
+                if test is None:
+                    break
+                test.worker = free_workers.pop(0)
                 test_report.test_started(test)
-                passed = test.run()
+                running[asyncio.create_task(run_test(test))] = test
+
+            if len(running) == 0:
+                # Every test has finished or been skipped
+                break
+
+            done, pending = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                test = running.pop(task)
+                free_workers.append(test.worker)
+                free_workers.sort()
+                # Raise any exception that escaped from the test
+                task.result()
                 test_report.test_completed(test)
+                if test.journal is not None:
+                    test.journal.record(test)
+
+                # This may make tests that depend on this one ready to run, or skip them if it failed
+                scheduler.test_finished(test)
+                if not test.passed and test_report.check_fail_fast():
+                    scheduler.stop()
+    finally:
+        # If the run was interrupted (e.g. by a CTRL+C or SIGTERM), no more tests are started, and the running tests
+        # stop their children within a bounded time. They're reported as failed.
+        if len(running) > 0:
+            test_report.stop("Testing was interrupted")
+            scheduler.stop()
+        for task in list(running) + [sampler]:
+            task.cancel()
+        await asyncio.gather(*running, sampler, return_exceptions=True)
+        for test in running.values():
+            test.passed = False
+            test.error_msgs.append(f"Stopped before the test finished: {test_report.stop_reason}")
+            test_report.test_completed(test)
+            if test.journal is not None:
+                test.journal.record(test)
+            scheduler.test_finished(test)
+        if stager is not None:
+            await stager.finish()
+
+def run_async(test_report, coroutine):
+    """Run a coroutine to completion in a new event loop, with the report file written by the report writer task.
+
+    A SIGINT (CTRL+C) or SIGTERM (e.g. when a pod is shut down) stops testing: the coroutine is cancelled, which stops
+    the running tests' child processes, and this returns so that the results of the tests that finished can be
+    reported.
 
-        test_report.test_setup_completed(test_setup)
+    Args:
+        test_report (:obj:`TestReport`): The test report.
+        coroutine (coroutine):           The coroutine to run.
 
-        # Count the test setup as done. This needs to be done to allow the join() call in main to return when
-        # all of the tests have been completed
-        test_run_queue.task_done()
+    Returns:
+        The result of the coroutine, or None if it was stopped by a signal.
+    """
+    async def run():
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        signalled = []
+
+        def stop(signum):
+            # Further signals are ignored, so that they don't interrupt stopping the tests
+            if len(signalled) == 0:
+                signalled.append(signum)
+                test_report.stop(f"Stopped by {signal.Signals(signum).name}")
+                task.cancel()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop, signum)
+        try:
+            if test_report.report_writer is None:
+                return await coroutine
+            async with test_report.report_writer:
+                return await coroutine
+        except asyncio.CancelledError:
+            if len(signalled) == 0:
+                raise
+            return None
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+
+    use_pidfd_child_watcher()
+    return asyncio.run(run())
+
+def use_pidfd_child_watcher():
+    """Wait for child processes with pidfds where possible.
+
+    Before Python 3.12 the default child watcher waits for each child process in a thread of its own, so the
+    pidfd watcher, which waits for all children in the event loop, is used instead if the OS supports it.
+    """
+    if sys.version_info >= (3, 12) or not hasattr(os, 'pidfd_open'):
+        return
+    if isinstance(asyncio.get_child_watcher(), asyncio.PidfdChildWatcher):
+        return
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        # The kernel doesn't support pidfds
+        return
+    asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
 
 
 def main():
 
+    # Merging the results of shards has its own command line arguments
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        return merge.main(sys.argv[2:])
+
+    # As does selecting the tests impacted by a change
+    if len(sys.argv) > 1 and sys.argv[1] == 'impacted':
+        return impacted.main(sys.argv[2:])
+
     # ---------------------------------------------------------------------------
     # Parse command line arguments
 
     pargs = parser()
 
     if 'list' in pargs.tests:
-        show_setup_list()
+        show_setup_list(SuiteManifest(os.getenv('PYPEIT_DEV'), raw_data_dir()))
+        print("\nSetups marked with * have no raw data in RAW_DATA")
         return 0
 
     if pargs.threads <=0:
@@ -722,6 +1432,9 @@ def main():
         os.environ['OMP_NUM_THREADS'] = '1'
 
     raw_data = raw_data_dir()
+    if pargs.raw_source is not None:
+        # The raw data is fetched into RAW_DATA as it's needed
+        os.makedirs(raw_data, exist_ok=True)
     if not os.path.isdir(raw_data):
         raise NotADirectoryError('No directory: {0}'.format(raw_data))
 
@@ -745,8 +1458,6 @@ def main():
     flg_ql = False
     flg_vet = False
 
-    write_priorities = False
-
     for test in pargs.tests:
         if test == "all":
             flg_pypeit_tests = True
@@ -756,10 +1467,6 @@ def main():
             flg_ql = True
             flg_vet = True
 
-            # Write the test priority file if all tests are being run
-            if pargs.instruments is None and pargs.setups is None and pargs.debug == False:
-                write_priorities = True
-
         elif test == "pypeit_tests":
             flg_pypeit_tests = True
         elif test == "unit":
@@ -779,32 +1486,21 @@ def main():
             return 1
             
 
+    if pargs.shard is not None:
+        if pargs.shard[0] != 0:
+            # The unit tests don't depend on the test setups, so they only need to run in one shard
+            flg_pypeit_tests = False
+            flg_unit = False
+        if flg_vet and not pargs.quiet:
+            print('Not running vet tests in a shard, as they need the results of all of the shards')
+        flg_vet = False
+
     # ---------------------------------------------------------------------------
     # Determine which instruments will be tested
 
 
-    unsupported = []
-    instruments = []
-    all_instruments = all_setups.keys()
-    if pargs.instruments is not None and len(pargs.instruments) > 0:
-        for instr in pargs.instruments:
-            if instr in all_instruments:
-                instruments.append(instr) 
-            else:
-                unsupported.append(instr)
-
-    # Setups may be specified with a "instr/setup" syntax, parse those out
-    # and make sure the instruments are included
-    argument_setup_names = []
-    if pargs.setups is not None and len(pargs.setups) > 0:
-        for setup in pargs.setups:
-            if "/" in setup:
-                (instr, setup_name) = setup.split("/")
-                if instr not in instruments and instr in all_instruments:
-                    instruments.append(instr)
-                argument_setup_names.append(setup_name)
-            else:
-                argument_setup_names.append(setup)
+    instruments, unsupported, argument_setup_names, argument_setup_keys = \
+        parse_setup_arguments(pargs.instruments, pargs.setups)
 
     if len(unsupported) > 0:
         print("\x1B[" + "1;33m" + "\nWARNING - " + "\x1B[" + "0m" +
@@ -812,10 +1508,15 @@ def main():
                 unsupported))
         return 1
 
-    # If no instruments were supplied by either the instruments or
-    # setups arguments, test all instruments
-    if len(instruments) == 0:
-        instruments = all_instruments
+    # The test setups to run for each instrument
+    selected_setups = {instr: select_setup_names(pargs, instr, argument_setup_names, argument_setup_keys)
+                       for instr in instruments}
+
+    if pargs.time_budget is not None and (flg_reduce or flg_after or flg_ql):
+        selected_setups = select_within_time_budget(pargs, selected_setups, flg_reduce, flg_after, flg_ql)
+
+    # Only run the unit and vet tests that use the selected test setups
+    pytest_setups = pytest_setup_selection(selected_setups)
 
     # Report
     if not pargs.quiet:
@@ -837,30 +1538,36 @@ def main():
 
     # Clean up prior coverage results that could be left over from an
     # interrupted dev suite run
+    coverage_collector = None
     if pargs.coverage is not None:
         clear_coverage_data(pargs.outputdir)
+        coverage_collector = CoverageCollector(pargs.outputdir, coverage_core(pargs.coverage_core))
  
     # Start Unit Tests
     test_report = TestReport(pargs)
 
     # For coverage testing, run the PypeIt unit tests too
     if flg_pypeit_tests and not pargs.prep_only:
-        pypeit_tests_dir = Path(pypeit.__file__).parent.joinpath("tests")
-        run_pytest(pargs, "PypeIt Unit Tests", str(pypeit_tests_dir), test_report)
+        pypeit_tests_dir = Path(import_pypeit().__file__).parent.joinpath("tests")
+        run_async(test_report, run_pytest(pargs, "PypeIt Unit Tests", str(pypeit_tests_dir), test_report))
 
     dev_path = os.getenv('PYPEIT_DEV')
-    if flg_unit is True and not pargs.prep_only:
-        run_pytest(pargs, "Unit Tests", os.path.join(dev_path, "unit_tests"), test_report)
+    if flg_unit is True and not pargs.prep_only and not test_report.check_fail_fast():
+        run_async(test_report, run_pytest(pargs, "Unit Tests", os.path.join(dev_path, "unit_tests"), test_report,
+                                          parallel=True, setups=pytest_setups))
+
 
+    # The vet tests that are run after the other tests, or None for all of them
+    vet_test_ids = None
 
     if flg_reduce or flg_after or flg_ql:
         # ---------------------------------------------------------------------------
         # Build the TestSetup and PypeItTest objects for testing
 
-        # Load test setup priority from file
-        priority_list = TestPriorityList('test_priority_list')
+        # Load the results of prior runs, used to predict how long tests take and how much memory they use
+        history = TestHistory(pargs.history, coverage=pargs.coverage is not None)
         if not pargs.quiet and pargs.verbose:
-            print(f'Loaded {len(priority_list)} setup priorities')
+            print(f'Loaded the history of {len(history)} tests')
 
         # Report on instruments
         if not pargs.quiet:
@@ -870,97 +1577,185 @@ def main():
             print('')
 
 
-        setups = []
-        missing_files = []
-        for instr in instruments:
-            # Only do blue instruments
-            if pargs.debug and instr != 'shane_kast_blue':
-                continue
-
-            # Setups        
-            if len(argument_setup_names) > 0:
-                setup_names = [name for name in argument_setup_names if name in all_setups[instr]]
-
-                # No setups for this instrument specified, so run all setups
-                if len(setup_names)==0:
-                    setup_names = all_setups[instr]                    
-            elif pargs.debug:
-                setup_names = ['600_4310_d55']
-            else:
-                setup_names = all_setups[instr]
-
-            # Build test setups, check for missing files, and run any prep work
-            for setup_name in setup_names:
-
-                setup = build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after,
-                                        flg_ql)
-                missing_files += setup.missing_files
-
-                # set setup priority from file
-                priority_list.set_test_setup_priority(setup)
-
-                setups.append(setup)
+        # Warn about missing raw data before building the setups, using the raw files listed in the manifest. Raw
+        # data that isn't in RAW_DATA is fetched from the raw data source, if there is one.
+        manifest = SuiteManifest(dev_path, raw_data)
+        missing_raw_data = manifest.missing_raw_data([f'{instr}/{name}' for instr in instruments
+                                                                          for name in selected_setups[instr]])
+        if len(missing_raw_data) > 0 and not pargs.quiet and pargs.raw_source is None:
+            print("\x1B[" + "1;33m" + "WARNING - " + "\x1B[" + "0m" +
+                  "The tests that use the following raw data will fail:\n    {0}\n".format(
+                  '\n    '.join(missing_raw_data)))
+
+        # Build test setups, and run any prep work. This is file system work (creating the output directories and
+        # writing the .pypeit files), so the setups are built in parallel.
+        setup_names = [(instr, setup_name) for instr in instruments for setup_name in selected_setups[instr]]
+        with ThreadPoolExecutor(max_workers=max(min(len(setup_names), SETUP_BUILD_WORKERS), 1)) as executor:
+            setups = list(executor.map(lambda names: build_test_setup(pargs, names[0], names[1], flg_reduce,
+                                                                      flg_after, flg_ql, history),
+                                       setup_names))
+
+        # Only keep the test setups in this shard
+        if pargs.shard is not None:
+            shard_index, shard_count = pargs.shard
+            num_setups = len(setups)
+            setups = history.shard_setups(setups, shard_count)[shard_index]
+            if not pargs.quiet:
+                print(f'Running {len(setups)} of {num_setups} test setups in shard {shard_index} of {shard_count}')
 
-            print('Reducing data from {0} for the following setups:'.format(instr))
-            for name in setup_names:
-                print('    {0}'.format(name))
-            print('')
+        for instr in instruments:
+            setup_names = [setup.name for setup in setups if setup.instr == instr]
+            if len(setup_names) > 0:
+                print('Reducing data from {0} for the following setups:'.format(instr))
+                for name in setup_names:
+                    print('    {0}'.format(name))
+                print('')
+
+        # Run the vet tests that use the results of these test setups as soon as those results are ready
+        if flg_vet and not pargs.prep_only:
+            vet_tests = select_vet_tests(find_vet_tests(os.path.join(dev_path, "vet_tests")),
+                                         [f'{instr}/{name}' for instr in instruments
+                                                            for name in selected_setups[instr]])
+            vet_test_ids = add_vet_tests(pargs, setups, vet_tests, history)
 
         # ---------------------------------------------------------------------------
         # Check all the data and relevant files exist before starting!
-        if len(missing_files) > 0:
-            raise ValueError('Missing the following files:\n    {0}'.format(
-                            '\n    '.join(missing_files)))
+        missing_files = [file for setup in setups for file in setup.missing_files]
+        damaged_files = dict()
+        # The sizes of the raw files in the data manifest
+        expected_raw_sizes = DataManifest().expected_sizes('RAW_DATA', raw_data)
+        if not pargs.skip_preflight and not pargs.prep_only:
+            # Check the raw files read by the tests, so that a missing or truncated file is found now rather than
+            # when a test reaches it
+            checker = RawFileChecker(os.path.join(dev_path, PREFLIGHT_FILE), expected_raw_sizes)
+            raw_files = find_raw_files(setups)
+            missing_raw_files, damaged_files = checker.check(raw_files)
+            missing_files += [file for file in missing_raw_files if file not in missing_files]
+            if not pargs.quiet and pargs.verbose:
+                print(f'Checked {len(set(raw_files))} raw files, {checker.num_cached} of them unchanged since '
+                      'they were last checked')
+        if len(missing_files) > 0 or len(damaged_files) > 0:
+            message = []
+            if len(missing_files) > 0:
+                message.append('Missing the following files:\n    {0}'.format('\n    '.join(missing_files)))
+            if len(damaged_files) > 0:
+                message.append('The following raw files are damaged:\n    {0}'.format(
+                               '\n    '.join([f'{file} {problem}' for file, problem in damaged_files.items()])))
+            raise ValueError('\n'.join(message))
 
 
         # ---------------------------------------------------------------------------
         # Run the tests
+        # Run the test setups predicted to take the longest first
+        history.set_setup_priorities(setups)
+
         test_report.setup_testing_started(setups)
-        # Add tests to the test_run_queue
+        # Add the tests to the scheduler
+        stager = None
+        if pargs.raw_source is not None and not pargs.prep_only:
+            # The raw files are checked as they arrive, as they can't be checked before testing starts
+            checker = None if pargs.skip_preflight else RawFileChecker(os.path.join(dev_path, PREFLIGHT_FILE),
+                                                                       expected_raw_sizes)
+            stager = RawDataStager(raw_data_source(pargs.raw_source, dev_path), pargs.max_transfers,
+                                   pargs.raw_budget, pargs.evict_raw, history, checker)
+        scheduler = TestScheduler(test_report, history, pargs.mem_budget, pargs.mem_margin, stager)
+        scheduler.add_setups(setups)
+
+        # Restore the results of tests with unchanged inputs from the cache. Coverage and profiling runs need to
+        # run every test.
+        cache = None
+        if pargs.cache_dir is not None and pargs.coverage is None and pargs.profile is None and not pargs.prep_only:
+            cache = ResultCache(pargs.cache_dir, pypeit_code_version(import_pypeit()))
+            for setup in setups:
+                for test in setup.tests:
+                    test.cache = cache
+
+        # Record the tests that complete in a journal, so that the run can be resumed if it's stopped. The keys of
+        # the tests' inputs are shared with the cache, if there is one, and are only computed by runs that are
+        # resumed or use the cache. Coverage and profiling runs need to run every test, so they don't resume earlier
+        # runs.
+        resume = pargs.resume and pargs.coverage is None and pargs.profile is None
+        keys = cache
+        if keys is None and resume:
+            keys = TestKeys(pypeit_code_version(import_pypeit()), os.path.join(pargs.outputdir, HASH_FILE))
+        if keys is not None:
+            # Raw data files checked by pypeit_syncraw aren't hashed again
+            keys.data_stamps = DataStamps(os.path.join(dev_path, STAMPS_FILE))
+        journal = RunJournal(pargs.outputdir, keys, resume)
+        if resume:
+            # The report covers the earlier runs as well as this one
+            test_report.start_time = min(test_report.start_time, journal.run_start)
+            if not pargs.quiet:
+                print(f'Resuming a run with {len(journal)} tests in its journal {journal.file}')
+        references = None
+        if pargs.reference_source is not None and not pargs.prep_only:
+            references = ReferenceCache(raw_data_source(pargs.reference_source, dev_path),
+                                        pargs.reference_cache if pargs.reference_cache is not None
+                                        else os.path.join(dev_path, REFERENCE_CACHE))
         for setup in setups:
-            if len(setup.tests) == 0:
-                continue
-            test_run_queue.put(setup)
-
-        # Start threads to run the tests
-        if not pargs.quiet and pargs.threads > 1:
-            print(f'Running tests in {pargs.threads} parallel processes')
-
-        thread_pool = []
-        for i in range(pargs.threads):
-            new_thread = Thread(target=thread_target, args=[test_report])
-            thread_pool.append(new_thread)
-            new_thread.start()
+            for test in setup.tests:
+                test.journal = journal
+                test.coverage_collector = coverage_collector
+                test.references = references
 
-        # Wait for the tests to finish
-        test_run_queue.join()
+        # Start the zygote process that tests are forked from. Coverage and profiling runs always start a new
+        # process for each test, so that every test is run under coverage or cProfile.
+        zygote = None
+        if pargs.zygote and pargs.coverage is None and pargs.profile is None and not pargs.prep_only:
+            zygote = start_zygote(setups, pargs)
 
-        # Set the test status to complete and then wait for the threads to finish.
-        # We don't run the threads as daemon threads so that main() can be called multiple times
-        # in unit tests
-        test_report.testing_complete = True
-        for thread in thread_pool:
-            thread.join()
+        try:
+            # Run the tests, with up to "threads" tests running at once
+            if not pargs.quiet and pargs.threads > 1:
+                print(f'Running tests in {pargs.threads} parallel processes')
+
+            run_async(test_report, run_tests(scheduler, test_report, pargs.threads))
+            test_report.testing_complete = True
+            if stager is not None and not pargs.quiet:
+                print(stager.summary())
+            if references is not None and not pargs.quiet:
+                print(references.summary())
+        finally:
+            if zygote is not None:
+                zygote.stop()
+            journal.close()
+            if keys is not None:
+                keys.write()
+            # The timeline of an interrupted run shows the tests that finished
+            if pargs.trace is not None and not pargs.prep_only:
+                write_trace(setups, pargs.trace)
 
         if not pargs.quiet:
             test_report.summarize_setup_tests()
 
-    # Run the vet tests
-    if flg_vet is True:
-        run_pytest(pargs, "Vet Tests", os.path.join(dev_path, "vet_tests"), test_report, redux_out=pargs.outputdir)
-
+        # Record the results of the tests for the next run. This is done even if only some tests were run or
+        # tests failed, as the durations and memory usage of the tests that ran are still useful.
+        if not pargs.prep_only:
+            if pargs.coverage is not None:
+                # Compared with the durations of the tests in prior runs without coverage
+                overhead = coverage_overhead(setups, history)
+                if overhead is not None:
+                    test_report.coverage_summary.append(overhead)
+            history.record(setups, coverage=pargs.coverage is not None,
+                           raw_sizes=None if stager is None else stager.sizes)
+            history.write()
+            if not pargs.quiet and pargs.verbose:
+                print(f'Wrote the history of {len(history)} tests')
+
+    # Run the vet tests that weren't run with the test setups
+    if flg_vet is True and (vet_test_ids is None or len(vet_test_ids) > 0) and not test_report.check_fail_fast():
+        run_async(test_report, run_pytest(pargs, "Vet Tests", os.path.join(dev_path, "vet_tests"), test_report,
+                                          redux_out=pargs.outputdir, parallel=True, test_ids=vet_test_ids,
+                                          setups=pytest_setups))
 
-    # ---------------------------------------------------------------------------
-    # Build test priority list for next time, but only if all tests succeeded
-    # and all tests were being run
-    if write_priorities and test_report.num_passed == test_report.num_tests:
-        priority_list.update_priorities(setups)
-        priority_list.write()
-        if not pargs.quiet and pargs.verbose:
-            print(f'Wrote {len(priority_list)} setup priorities')
 
     if pargs.coverage is not None:
-        generate_coverage_report(pargs)
+        generate_coverage_report(pargs, coverage_collector)
+        test_report.coverage_summary.append(coverage_collector.summary())
+    elif pargs.profile is not None and not pargs.prep_only:
+        num_profiles = write_profile_report(test_report.test_setups, pargs.profile)
+        if not pargs.quiet:
+            print(f"Wrote the profile report of {num_profiles} tests to {pargs.profile}", flush=True)
 
     # ---------------------------------------------------------------------------
     # Finish up the report on the test results
@@ -976,10 +1771,252 @@ def main():
         else:
             test_report.summary_report()
 
+    if test_report.stop_reason is not None:
+        # Testing was stopped early, which is a failure even if none of the tests that ran failed
+        return max(test_report.num_failed, 1)
     return test_report.num_failed
 
 
-def build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after, flg_ql):
+def parse_setup_arguments(instrument_args, setup_args):
+    """
+    Parses the instruments and setups given on the command line with -i/--instruments and -s/--setups.
+
+    Args:
+        instrument_args (list of str):
+            The instruments, or None if none were given.
+
+        setup_args (list of str):
+            The setups, either setup names or instr/setup keys, or None if none were given.
+
+    Returns:
+        tuple: The instruments to test (every instrument if none were given by either argument), the unsupported
+        instruments, the setup names given without an instrument, and a dict mapping instruments to the setup names
+        given for them as instr/setup keys. The last two are passed to :func:`select_setup_names`.
+    """
+    unsupported = []
+    instruments = []
+    all_instruments = all_setups.keys()
+    if instrument_args is not None and len(instrument_args) > 0:
+        for instr in instrument_args:
+            if instr in all_instruments:
+                instruments.append(instr) 
+            else:
+                unsupported.append(instr)
+
+    # Setups may be specified with a "instr/setup" syntax, parse those out
+    # and make sure the instruments are included. Setup names aren't unique
+    # across instruments, so these only select the setup of that instrument.
+    argument_setup_names = []
+    argument_setup_keys = dict()
+    if setup_args is not None and len(setup_args) > 0:
+        for setup in setup_args:
+            if "/" in setup:
+                (instr, setup_name) = setup.split("/")
+                if instr not in instruments and instr in all_instruments:
+                    instruments.append(instr)
+                argument_setup_keys.setdefault(instr, []).append(setup_name)
+            else:
+                argument_setup_names.append(setup)
+
+    # If no instruments were supplied by either the instruments or
+    # setups arguments, test all instruments
+    if len(instruments) == 0:
+        instruments = all_instruments
+
+    return instruments, unsupported, argument_setup_names, argument_setup_keys
+
+
+def select_setup_names(pargs, instr, argument_setup_names, argument_setup_keys):
+    """
+    Selects the test setups of an instrument to run.
+
+    Args:
+        pargs (:obj:`argparse.Namespace`):
+            The arguments to pypeit_test, as returned by argparse.
+
+        instr (str):
+            The instrument.
+
+        argument_setup_names (list of str):
+            The setup names given on the command line without an instrument.
+
+        argument_setup_keys (dict):
+            The setup names given on the command line as instr/setup keys, by instrument.
+
+    Returns:
+        list of str: The names of the test setups of the instrument to run.
+    """
+    # Only do blue instruments
+    if pargs.debug and instr != 'shane_kast_blue':
+        return []
+
+    # Setups
+    if len(argument_setup_names) > 0 or len(argument_setup_keys) > 0:
+        setup_names = [name for name in argument_setup_names + argument_setup_keys.get(instr, [])
+                       if name in all_setups[instr]]
+
+        # No setups for this instrument specified, so run all setups
+        if len(setup_names)==0:
+            setup_names = all_setups[instr]
+    elif pargs.debug:
+        setup_names = ['600_4310_d55']
+    else:
+        setup_names = all_setups[instr]
+    return setup_names
+
+def select_within_time_budget(pargs, selected_setups, flg_reduce, flg_after, flg_ql):
+    """
+    Selects the test setups that test the most within the --time_budget (see :func:`selection.select_setups`).
+
+    Args:
+        pargs (:obj:`argparse.Namespace`):
+            The arguments to pypeit_test, as returned by argparse.
+
+        selected_setups (dict):
+            Maps each instrument to the names of its test setups to choose from.
+
+        flg_reduce (bool):
+            Whether or not reduce tests are being run.
+
+        flg_after (bool):
+            Whether or not afterburner tests are being run.
+
+        flg_ql (bool):
+            Whether or not quick look tests are being run.
+
+    Returns:
+        dict: Maps each instrument to the names of its selected test setups.
+    """
+    phases = [TestPhase.PREP] + ([TestPhase.REDUCE] if flg_reduce else []) + \
+             ([TestPhase.AFTERBURN] if flg_after else []) + ([TestPhase.QL] if flg_ql else [])
+    coverage_map = read_coverage_map(pargs.coverage_map) if pargs.coverage_map is not None else None
+    setup_keys = [f'{instr}/{name}' for instr, names in selected_setups.items() for name in names]
+    history = TestHistory(pargs.history, coverage=pargs.coverage is not None)
+    keys, wall_time = select_setups(setup_keys, history, pargs.time_budget, pargs.threads, phases, coverage_map)
+    if not pargs.quiet:
+        num_instruments = len(set([key.split('/')[0] for key in keys]))
+        print(f'Running {len(keys)} of {len(setup_keys)} test setups, from {num_instruments} instruments, predicted '
+              f'to take {datetime.timedelta(seconds=round(wall_time))} of the '
+              f'{datetime.timedelta(seconds=round(pargs.time_budget))} time budget')
+    return {instr: [name for name in names if f'{instr}/{name}' in keys] for instr, names in selected_setups.items()}
+
+def pytest_setup_selection(selected_setups):
+    """
+    Builds the values of the ``--setups`` option of the dev-suite unit and vet tests for the selected test setups.
+
+    Args:
+        selected_setups (dict):
+            The names of the test setups being run, by instrument.
+
+    Returns:
+        list of str:
+            The instruments whose test setups are all being run, and the instr/setup keys of the other test
+            setups being run. None if every test setup is being run, so that every test is run.
+    """
+    if all(set(selected_setups.get(instr, [])) == set(names) for instr, names in all_setups.items()):
+        return None
+
+    selection = []
+    for instr, names in selected_setups.items():
+        if set(names) == set(all_setups[instr]):
+            selection.append(instr)
+        else:
+            selection += [f'{instr}/{name}' for name in names]
+    return selection
+
+def add_vet_tests(pargs, setups, vet_tests, history=None):
+    """
+    Adds the vet tests that use the results of the test setups being run to those test setups.
+
+    This lets each vet test run as soon as the tests of the setups it uses (given by its ``setups``
+    marker) have passed, instead of after every test setup has finished. The vet tests that use the
+    same test setups are run together by one :obj:`PypeItVetTest`, which belongs to the first of those
+    setups and depends on all of their tests. If any of those tests fail, the vet tests are skipped.
+
+    Args:
+        pargs (:obj:`argparse.Namespace`):
+            The arguments to pypeit_test, as returned by argparse.
+
+        setups (list of :obj:`TestSetup`):
+            The test setups being run.
+
+        vet_tests (dict):
+            Maps the pytest node id of each vet test to the instr/setup keys of the test setups it
+            uses, or None if it isn't known, as returned by :func:`find_vet_tests`.
+
+        history (:obj:`TestHistory`):
+            The history of prior runs, used to set the timeouts of the vet tests (see
+            :func:`get_timeout`). If None, the vet tests have no timeout.
+
+    Returns:
+        list of str:
+            The node ids of the vet tests that weren't added, because they don't have a ``setups``
+            marker or none of their test setups are being run. These are run after all of the test
+            setups have finished, using the results in the output directory.
+    """
+    setups_by_key = {setup.key: setup for setup in setups if len(setup.tests) > 0}
+    setup_tests = {key: list(setup.tests) for key, setup in setups_by_key.items()}
+
+    # Vet tests that use setups that aren't being run depend on the setups that are
+    groups = dict()
+    remaining = []
+    for test_id, keys in vet_tests.items():
+        run_keys = [] if keys is None else sorted([key for key in keys if key in setups_by_key])
+        if len(run_keys) == 0:
+            remaining.append(test_id)
+        else:
+            groups.setdefault(tuple(run_keys), []).append(test_id)
+
+    for keys, test_ids in groups.items():
+        setup = setups_by_key[keys[0]]
+        test = PypeItVetTest(setup, pargs, test_ids, other_setups=list(keys[1:]))
+        test.dependencies = [dependency for key in keys for dependency in setup_tests[key]]
+        if history is not None:
+            test.timeout = get_timeout(pargs, history, test)
+        setup.tests.append(test)
+
+    return remaining
+
+def get_timeout(pargs, history, test, test_descr=None):
+    """
+    Get the timeout of a test.
+
+    This is the timeout of the test in :obj:`test_setups.test_timeouts` if it has one. Otherwise it's
+    ``--timeout_factor`` times the median duration of the test's prior runs, but at least ``--min_timeout``
+    seconds. A test that has never run gets the timeout of its test phase in :obj:`test_setups.phase_timeouts`.
+
+    Args:
+        pargs (:obj:`argparse.Namespace`):
+            The arguments to pypeit_test, as returned by argparse.
+
+        history (:obj:`TestHistory`):
+            The history of prior runs.
+
+        test (:obj:`PypeItTest`):
+            The test.
+
+        test_descr (dict):
+            The entry of the test's type in :obj:`test_setups.all_tests`, or None for tests that aren't
+            from all_tests, such as vet tests, which only have a timeout once they have run before.
+
+    Returns:
+        float:
+            The timeout in seconds, or None if the test shouldn't be timed out.
+    """
+    if pargs.timeout_factor <= 0:
+        return None
+    if test_descr is not None:
+        setup_timeouts = test_timeouts.get(test.setup.instr, dict()).get(test.setup.name, dict())
+        if test_descr['name'] in setup_timeouts:
+            return setup_timeouts[test_descr['name']]
+
+    # Tests run under coverage take longer, so they are only timed out from runs in the same mode
+    duration = history.predicted_duration(test.setup.key, test.description, coverage=history.coverage)
+    if duration is not None:
+        return max(pargs.timeout_factor * duration, pargs.min_timeout)
+    return None if test_descr is None else phase_timeouts.get(test_descr['type'])
+
+def build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after, flg_ql, history=None):
     """
     Builds a TestSetup object including the tests that it will run
 
@@ -1002,6 +2039,10 @@ def build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after, flg_ql):
         flg_ql (bool): 
             Whether or not quick look tests are being run.
 
+        history (:obj:`TestHistory`):
+            The history of prior runs, used to set the timeouts of the tests (see :func:`get_timeout`).
+            If None, the tests have no timeout.
+
     Returns:
         :obj:`TestSetup`:
             A TestSetup object representing the test setup.
@@ -1024,6 +2065,7 @@ def build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after, flg_ql):
 
     # Go through each test type and add it to this setup if it's applicable and
     # selected by the command line arguments
+    setup_tests = dict()
     for test_descr in all_tests:
 
         # Check instruments
@@ -1064,7 +2106,15 @@ def build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after, flg_ql):
             if not flg_ql and test_descr['type'] == TestPhase.QL:
                 continue
 
+            if history is not None:
+                test.timeout = get_timeout(pargs, history, test, test_descr)
             setup.tests.append(test)
+            setup_tests.setdefault(test_descr['name'], []).append(test)
+
+    # Now that all of the tests are known, find the tests each one depends on
+    for test_descr in all_tests:
+        for test in setup_tests.get(test_descr['name'], []):
+            test.dependencies = resolve_dependencies(test_descr['depends'], setup_tests)
 
     return setup
 
@@ -25,61 +25,86 @@ To get the coverage of the tests:
 """
 
 import pytest
+import asyncio
 import subprocess
 import sys
 import os
-from io import BytesIO
+import json
+import io
+import datetime
 import random
+import textwrap
+import math
+import types
+import importlib.util
+import psutil
+import signal
+import gzip
+import struct
+import shutil
 from test_scripts import test_main
-from test_scripts.pypeit_tests import PypeItReduceTest
+from test_scripts import merge
+from test_scripts.pypeit_tests import PypeItTest, PypeItReduceTest, PypeItVetTest, PypeItQuickLookTest, telluric_grid
+from test_scripts.zygote import PypeItZygote
+from test_scripts import result_cache
+from test_scripts.result_cache import ResultCache
+from test_scripts.journal import RunJournal, read_journal, JOURNAL_FILE, HASH_FILE
+from test_scripts.vet import find_vet_tests, expand_setup_keys, select_vet_tests
+from test_scripts.setups import all_setups
+from test_scripts.profiling import write_profile_report
+from test_scripts.timeline import write_trace
+from test_scripts.selection import select_setups, read_coverage_map
+from test_scripts import coverage_index
+from test_scripts import coverage_data
+from test_scripts.manifest import SuiteManifest
+from test_scripts.preflight import RawFileChecker, find_raw_files, check_raw_file
+from test_scripts.raw_staging import RawDataStager, raw_data_source, LocalRawSource, RcloneRawSource, S3RawSource
+from test_scripts.data_manifest import DataManifest, DataStamps, STAMPS_FILE, file_sha256
+from test_scripts import syncraw
+from test_scripts.reference_data import ReferenceCache
 import time
 
 
-class MockPopen(object):
+@pytest.fixture(autouse=True)
+def run_in_tmp_path(monkeypatch, tmp_path):
     """
-    Mock of the Popen objects returned by subprocess.Popen.
+    Run every test from its temporary directory, so that the files pypeit_test updates after each run
+    (like the test history) don't end up in the dev suite.
+    """
+    monkeypatch.chdir(tmp_path)
+
+
+class MockProcess(object):
+    """
+    Mock of the Process objects returned by asyncio.create_subprocess_exec.
 
     Attributes:
 
-        pid (int):           Randomly generate integer to simulate a process id
-        returncode (int):    Simulated return code from the child process. 0 unless failure_case is True
+        pid (int):           The process id of the test process, so that psutil can sample its memory
+        returncode (int):    Simulated return code from the child process, set once it has been waited for. 0 unless
+                             failure_case is True
         failure_case (bool): If set to True by __init__, causes the simulated test to appear to fail. Defaults to False.
+        stdout (:obj:`asyncio.StreamReader`): Simulated pytest output.
     """
 
     def __init__(self, failure_case=False):
-        self.pid = random.randint(1,99999)
-        self.returncode = 0
+        self.pid = os.getpid()
+        self.returncode = None
         self.failure_case = failure_case
-        self.poll_times = 0
-        self.stdout = BytesIO(b"Sample pytest output\npassed 1 warnings 1 failed 1\n")
-
-    def wait(self):
-        t = random.randint(1, 3)
-        time.sleep(t)
-        if self.failure_case:
-            self.returncode = 1
-        return 0
-
-    def poll(self, *args, **kwargs):
-        if self.poll_times == 0:
-            self.poll_times +=1
-            return None
-        else:
-            if self.failure_case:
-                return 1
-            else:
-                return 0
+        self.stdout = asyncio.StreamReader()
+        self.stdout.feed_data(b"Sample pytest output\npassed 1 warnings 1 failed 1\n")
+        self.stdout.feed_eof()
+
+    async def wait(self):
+        if self.returncode is None:
+            # Simulate the child taking a while, without holding up the other tests
+            await asyncio.sleep(random.uniform(0.1, 0.5))
+            self.returncode = 1 if self.failure_case else 0
+        return self.returncode
 
     def terminate(self):
         pass
 
-    # Mock contextmanager methods
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *args, **kwargs):
-        return False
-
 class MockCompletedProcess(object):
     """
     Mock of the CompletedProcess objects returned by subprocess.run.  Used to simulate the results of tailing the logs
@@ -90,29 +115,31 @@ class MockCompletedProcess(object):
         self.stdout = b"This is \nSample log output\nFor unit testing\n"
         self.returncode = returncode
 
-def mock_popen(*args, **kwargs):
+async def mock_create_subprocess_exec(*args, **kwargs):
     """
-    Mock function for subprocess.Popen()
+    Mock function for asyncio.create_subprocess_exec()
     """
-    return MockPopen()
+    return MockProcess()
 
-def mock_run(*args, **kwargs):
+async def mock_failed_build_calibs(*args, **kwargs):
     """
-    Mock function for subprocess.run()
+    Mock function for asyncio.create_subprocess_exec() where building the QL calibrations fails
     """
-    return MockCompletedProcess()
+    return MockProcess(any([os.path.basename(arg) == 'build_ql_calibs' for arg in args]))
 
-def mock_failed_run(*args, **kwargs):
+async def mock_raises_build_calibs(*args, **kwargs):
     """
-    Mock function for subprocess.run() that has a returncode not equal to zero
+    Mock function for asyncio.create_subprocess_exec() that raises an exception when building the QL calibrations
     """
-    return MockCompletedProcess(1)
+    if any([os.path.basename(arg) == 'build_ql_calibs' for arg in args]):
+        raise RuntimeError("Unit testing Exception")
+    return MockProcess()
 
-def mock_raises_run(*args, **kwargs):
+def mock_run(*args, **kwargs):
     """
-    Mock function for subprocess.run() that raises an exception
+    Mock function for subprocess.run()
     """
-    raise RuntimeError("Unit testing Exception")
+    return MockCompletedProcess()
 
 
 def create_dummy_files(base_path, files):
@@ -131,6 +158,20 @@ def create_dummy_files(base_path, files):
         with open(full_path, 'w') as f:
             print("dummy content", file=f)
 
+def write_history(file, durations):
+    """
+    Utility function to write a test history file with one passed run of the reduce test of test setups.
+
+    Args:
+        file (:obj:`pathlib.Path`): The history file to write.
+        durations (dict):           Maps the instr/setup key of each test setup to the duration of its reduce test.
+    """
+    with open(file, 'w') as f:
+        json.dump({'version': test_main.TestHistory.version,
+                   'tests': {setup_key: {'pypeit': [{'start': '2024-01-01T00:00:00', 'duration': duration,
+                                                     'max_mem': None, 'passed': True}]}
+                             for setup_key, duration in durations.items()}}, f)
+
 
 def change_dir(new_directory):
     """
@@ -160,7 +201,7 @@ def test_main_with_missing_file_failures(monkeypatch, tmp_path):
     Test test_main.main() when there are failures due to missing files
     """
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
 
         # Test failure to generate pypeit file
@@ -183,8 +224,8 @@ def test_main_with_missing_file_failures(monkeypatch, tmp_path):
         os.chdir(tmp_path)
         assert test_main.main() == 1
 
-        # Make sure the test_priority_list doesn't exist if there's a failure
-        assert not os.path.exists(tmp_path / "test_priority_list")
+        # The test history is still written when there's a failure
+        assert os.path.exists(tmp_path / "test_history.json")
 
 
 def test_main_with_build_command_failure(monkeypatch, tmp_path):
@@ -194,7 +235,7 @@ def test_main_with_build_command_failure(monkeypatch, tmp_path):
 
     with monkeypatch.context() as m2:
 
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
 
         # Test error building command
@@ -215,10 +256,10 @@ def test_main_with_test_failure(monkeypatch, tmp_path):
     with monkeypatch.context() as m3:
 
         # Test error running command, with verbose and multiple threads
-        def mock_failure_popen(*args, **kwargs):
-            return MockPopen(True)
+        async def mock_failure_exec(*args, **kwargs):
+            return MockProcess(True)
 
-        monkeypatch.setattr(subprocess, "Popen", mock_failure_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_failure_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
 
         monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-t', '4', '-v', 'reduce', '-i', 'shane_kast_blue'])
@@ -240,10 +281,10 @@ def test_main_develop_without_failures(monkeypatch, tmp_path):
                   'keck_lris_blue/long_400_3400_d560'
                   ]
 
-    priority_list = tmp_path / 'test_priority_list'
+    history_file = tmp_path / 'test_history.json'
 
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
         monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-t', '4', 'all'])
 
@@ -261,28 +302,24 @@ def test_main_develop_without_failures(monkeypatch, tmp_path):
 
         create_dummy_files(tmp_path, missing_files)
 
-        # Change to the temp path so that the test_priority_list is written there
+        # Change to the temp path so that the test history is written there
         with change_dir(tmp_path):
-            # Write out a short test priority list to exercise the code to detect changes from a full run
-            with open(priority_list, "w") as f:
-                for setup_key in test_order:
-                    print(setup_key, file=f)
-
-            # Get the size of it to make sure it changes
-            first_stat_info = priority_list.stat()
+            # Write out a short test history to make sure it's added to by a full run
+            write_history(history_file, {setup_key: 1000.0 - i for i, setup_key in enumerate(test_order)})
+            assert len(test_main.TestHistory(str(history_file))) == len(test_order)
 
             assert test_main.main() == 0
 
-        assert priority_list.exists()
-        second_stat_info = priority_list.stat()
-        assert first_stat_info.st_size < second_stat_info.st_size
+        history = test_main.TestHistory(str(history_file))
+        assert len(history) > len(test_order)
+        assert len(history.runs(test_order[0], 'pypeit')) == 2
 
 def test_main_debug_with_verbose_and_report(monkeypatch, tmp_path):
     """
     Test test_main.main() with the --debug option, verbose output, and an external report file
     """
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
 
         # This will include a failure and skipped tests as well as passed tests
@@ -295,42 +332,28 @@ def test_main_debug_with_verbose_and_report(monkeypatch, tmp_path):
         assert stat_result.st_size > 0
 
 
-def test_main_debug_priority_list(monkeypatch, tmp_path, capsys):
+def test_main_debug_history(monkeypatch, tmp_path, capsys):
     """
-    Test test_main.main() with the --debug option, and make sure tests run in the order given by the
-    test_priority list
+    Test test_main.main() with the --debug option, and make sure test setups run in the order of the durations
+    in the test history.
     """
 
-    test_order = ['p200_dbsp_blue/600_4000_d55',
-                  'shane_kast_blue/600_4310_d55',
-                  'keck_lris_blue/multi_300_5000_d680',
-                  'keck_lris_blue_orig/long_600_4000_d500',
-                  'keck_lris_blue/multi_600_4000_d560',
-                  'shane_kast_blue/452_3306_d57',
-                  'mmt_bluechannel/300l',
-                  'keck_lris_blue/long_600_4000_d560',
-                  'keck_lris_blue/long_400_3400_d560'
-                  ]
-
-    # The last test won't get written to the test priority list file so the code to assign the default
-    # priority executes
-    last_test = 'shane_kast_blue/830_3460_d46'
+    # The durations of the reduce tests in the history, slowest first
+    durations = {'shane_kast_blue/600_4310_d55': 30000.0,
+                 'shane_kast_blue/452_3306_d57': 10000.0}
 
+    # This setup isn't in the history, so its duration is estimated from the other shane_kast_blue setups, which
+    # puts it between them
+    test_order = ['shane_kast_blue/600_4310_d55', 'shane_kast_blue/830_3460_d46', 'shane_kast_blue/452_3306_d57']
 
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
 
-        # Run from the tmp_path so the test priority list is separated from other tests
+        # Run from the tmp_path so the test history is separated from other tests
         with change_dir(tmp_path):
 
-            # Write out a test priority list
-            with open('test_priority_list', "w") as f:
-                for setup_key in test_order:
-                    print(setup_key, file=f)
-
-            # Add the last test back to the test_order now that the priority list is written
-            test_order.append(last_test)
+            write_history(tmp_path / 'test_history.json', durations)
 
             # Prevent debug suite from failing
             missing_files = ['shane_kast_blue/600_4310_d55/shane_kast_blue_A/shane_kast_blue_A.pypeit',
@@ -338,7 +361,7 @@ def test_main_debug_priority_list(monkeypatch, tmp_path, capsys):
             create_dummy_files(tmp_path, missing_files)
 
             monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '--debug',
-                                              '-v', 'reduce', 'after', 'ql'])
+                                              '-v', 'reduce', '-s', '452_3306_d57', '600_4310_d55', '830_3460_d46'])
             assert test_main.main() == 0
 
             # Use captured stdout to make sure test setups were run in the order in test_order
@@ -375,7 +398,7 @@ def test_main_with_quiet(monkeypatch, tmp_path, capsys):
     """
 
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
 
 
@@ -400,7 +423,7 @@ def test_main_in_steps(monkeypatch, tmp_path):
     """
 
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
 
         missing_files = ['shane_kast_blue/600_4310_d55/shane_kast_blue_A/shane_kast_blue_A.pypeit',
@@ -431,16 +454,16 @@ def test_quick_look_build_calib_failure(monkeypatch, tmp_path):
 
     # Failure from the build script returning non-zero
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
-        monkeypatch.setattr(subprocess, "run", mock_failed_run)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_failed_build_calibs)
+        monkeypatch.setattr(subprocess, "run", mock_run)
         monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-i', 'keck_nires', 'reduce', 'ql'])
 
         assert test_main.main() == 1
 
     # Failure from an exception raised when running the build script
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
-        monkeypatch.setattr(subprocess, "run", mock_raises_run)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_raises_build_calibs)
+        monkeypatch.setattr(subprocess, "run", mock_run)
         monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-i', 'keck_nires', 'reduce', 'ql'])
 
         assert test_main.main() == 1
@@ -452,7 +475,7 @@ def test_quick_look_calib_env(monkeypatch, tmp_path):
 
     # Generate calibrations without the environment variable set
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
         monkeypatch.delenv('NIRES_CALIB', raising=False)
         monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-i', 'keck_nires', 'reduce', 'ql'])
@@ -461,9 +484,2052 @@ def test_quick_look_calib_env(monkeypatch, tmp_path):
 
     # Generate calibrations with the environment variable set
     with monkeypatch.context() as m:
-        monkeypatch.setattr(subprocess, "Popen", mock_popen)
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
         monkeypatch.setattr(subprocess, "run", mock_run)
         monkeypatch.setenv('NIRES_CALIB', str(tmp_path))
         monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-i', 'keck_nires', 'reduce', 'ql'])
 
         assert test_main.main() == 0
+
+class MockTest(object):
+    """
+    Mock of a PypeItTest used to test the TestScheduler without running anything.
+    """
+    def __init__(self, setup, description, dependencies=[]):
+        self.setup = setup
+        self.description = description
+        self.dependencies = dependencies
+        self.passed = None
+        self.max_mem = None
+        self.start_time = None
+        self.end_time = None
+        self.from_cache = False
+        self.resumed = False
+        self.journal = None
+        self.cpu_samples = []
+        self.usage = None
+        self.timeout = None
+        self.timed_out = False
+        self.worker = None
+        self.pid = None
+        self.logfile = None
+        self.error_msgs = []
+        setup.tests.append(self)
+
+    def __str__(self):
+        return f"{self.setup} {self.description}"
+
+    async def run(self):
+        """Simulate running the test, keeping track of how many tests run at once."""
+        self.start_time = datetime.datetime.now()
+        MockTest.running += 1
+        MockTest.max_running = max(MockTest.max_running, MockTest.running)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            MockTest.running -= 1
+        self.end_time = datetime.datetime.now()
+        self.passed = self.description != 'fail'
+        return self.passed
+
+    def sample_memory(self):
+        self.max_mem = 1000
+
+    def sample_cpu(self):
+        # Use half a core
+        if self.start_time is None:
+            return
+        now = datetime.datetime.now()
+        self.cpu_samples.append((now, (now - self.start_time).total_seconds() / 2))
+
+    running = 0
+    max_running = 0
+
+def test_scheduler_dependencies(tmp_path):
+    """
+    Test that the TestScheduler runs independent tests of a setup in parallel and only skips the tests
+    that depend on a failed test.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', 'reduce'])
+    test_report = test_main.TestReport(pargs)
+    setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path), str(tmp_path))
+    reduce = MockTest(setup, 'pypeit')
+    sensfunc = MockTest(setup, 'pypeit_sensfunc', [reduce])
+    flux = MockTest(setup, 'pypeit_flux', [sensfunc])
+    coadd1d = MockTest(setup, 'pypeit_coadd_1dspec', [flux])
+    coadd2d = MockTest(setup, 'pypeit_coadd_2dspec', [reduce])
+    ql = MockTest(setup, 'pypeit_ql', [reduce])
+
+    scheduler = test_main.TestScheduler(test_report, test_main.TestHistory(str(tmp_path / 'test_history.json')))
+    scheduler.add_setups([setup])
+
+    # Only the reduction is ready to start
+    assert scheduler.next_test() is reduce
+    reduce.passed = True
+    scheduler.test_finished(reduce)
+
+    # Everything that only depends on the reduction is ready at the same time. The sensfunc starts first because
+    # the longest chain of tests depends on it
+    assert [scheduler.next_test() for i in range(3)] == [sensfunc, coadd2d, ql]
+
+    # A failure only skips the tests that depend on it
+    sensfunc.passed = False
+    scheduler.test_finished(sensfunc)
+    assert test_report.skipped_tests == [flux, coadd1d]
+
+    coadd2d.passed = True
+    scheduler.test_finished(coadd2d)
+    ql.passed = True
+    scheduler.test_finished(ql)
+    assert scheduler.next_test() is None
+
+def test_build_test_setup_dependencies(tmp_path):
+    """
+    Test the dependencies between the tests of a test setup built from all_tests
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), 'reduce'])
+    setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '600_4310_d55', True, True, True)
+    tests = {test.description: test for test in setup.tests}
+
+    assert tests['pypeit_setup'].dependencies == []
+    assert tests['pypeit'].dependencies == [tests['pypeit_setup']]
+    assert tests['pypeit_sensfunc'].dependencies == [tests['pypeit']]
+    assert tests['pypeit_flux'].dependencies == [tests['pypeit_flux_setup']]
+    assert tests['pypeit_coadd_1dspec'].dependencies == [tests['pypeit_flux']]
+    assert all([test.dependencies == [tests['pypeit']] for test in setup.tests if test.description.startswith('pypeit_ql')])
+
+    # Without the reduce tests, the afterburner tests skip over the missing reduction
+    setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '600_4310_d55', False, True, False)
+    tests = {test.description: test for test in setup.tests}
+    assert 'pypeit' not in tests
+    assert tests['pypeit_sensfunc'].dependencies == [tests['pypeit_setup']]
+    assert tests['pypeit_flux_setup'].dependencies == [tests['pypeit_sensfunc']]
+
+    # The QL calibrations shared by the QL tests of a setup are built once, before any of them run
+    setup = test_main.build_test_setup(pargs, 'keck_nires', 'ABpat_wstandard', True, True, True)
+    tests = {test.description: test for test in setup.tests}
+    assert tests['build_ql_calibs'].dependencies == [tests['pypeit']]
+    ql_tests = [test for test in setup.tests if test.description.startswith('pypeit_ql')]
+    assert len(ql_tests) == 5
+    assert all([test.dependencies == [tests['build_ql_calibs']] for test in ql_tests])
+
+def test_parse_mem_size():
+    """
+    Test parsing the memory sizes accepted by --mem_budget
+    """
+    assert test_main.parse_mem_size("1000") == 1000
+    assert test_main.parse_mem_size("64G") == 64 * 2**30
+    assert test_main.parse_mem_size("1.5GiB") == int(1.5 * 2**30)
+    assert test_main.parse_mem_size("512mi") == 512 * 2**20
+    with pytest.raises(ValueError):
+        test_main.parse_mem_size("lots")
+
+def test_scheduler_mem_budget(tmp_path):
+    """
+    Test that the TestScheduler only starts tests that fit within the memory budget, and runs tests without
+    a prior peak memory alone.
+    """
+    setup = test_main.TestSetup('keck_deimos', '830G_M_8500', str(tmp_path), str(tmp_path), str(tmp_path))
+    big = MockTest(setup, 'big')
+    small1 = MockTest(setup, 'small1')
+    small2 = MockTest(setup, 'small2')
+    unknown = MockTest(setup, 'unknown')
+    last = MockTest(setup, 'last')
+
+    # Give the tests the same duration so only memory affects the order they run in
+    history_file = tmp_path / 'test_history.json'
+    with open(history_file, "w") as f:
+        json.dump({'version': test_main.TestHistory.version,
+                   'tests': {setup.key: {test.description: [{'start': '2024-01-01T00:00:00', 'duration': 10.0,
+                                                             'max_mem': mem, 'passed': True}]
+                                         for test, mem in [(big, 60), (small1, 20), (small2, 20), (last, 10),
+                                                           (unknown, None)]}}}, f)
+    history = test_main.TestHistory(str(history_file))
+    assert len(history) == 5
+
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', 'reduce'])
+    test_report = test_main.TestReport(pargs)
+    scheduler = test_main.TestScheduler(test_report, history, mem_budget=110, mem_margin=0.5)
+    scheduler.add_setups([setup])
+
+    # big (90 expected) is started, small1 (30) doesn't fit but last (15) does
+    assert scheduler.next_test() is big
+    assert scheduler.next_test() is last
+    big.passed = True
+    scheduler.test_finished(big)
+
+    # Both small tests fit, but the test without a peak memory has to wait for everything else to finish
+    assert scheduler.next_test() is small1
+    assert scheduler.next_test() is small2
+    for test in [small1, small2, last]:
+        test.passed = True
+        scheduler.test_finished(test)
+    assert scheduler.next_test() is unknown
+    unknown.passed = True
+    unknown.max_mem = 5
+    scheduler.test_finished(unknown)
+    assert scheduler.next_test() is None
+
+    # The new peak memory is recorded for the next run
+    unknown.start_time = datetime.datetime.now()
+    unknown.end_time = unknown.start_time + datetime.timedelta(seconds=10)
+    history.record([setup])
+    history.write()
+    assert test_main.TestHistory(str(history_file)).peak_mem(unknown) == 5
+
+def test_run_tests(tmp_path):
+    """
+    Test running many short tests on the event loop, and buffering the report in the report writer task.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', 'reduce'])
+    test_report = test_main.TestReport(pargs)
+    setups = []
+    for i in range(100):
+        setup = test_main.TestSetup('shane_kast_blue', f'setup_{i}', str(tmp_path), str(tmp_path), str(tmp_path))
+        reduce = MockTest(setup, 'pypeit')
+        MockTest(setup, 'fail' if i == 0 else 'pypeit_sensfunc', [reduce])
+        MockTest(setup, 'pypeit_flux', [setup.tests[1]])
+        setups.append(setup)
+    test_report.setups = setups
+
+    scheduler = test_main.TestScheduler(test_report, test_main.TestHistory(str(tmp_path / 'test_history.json')))
+    scheduler.add_setups(setups)
+    MockTest.running = 0
+    MockTest.max_running = 0
+    start = time.monotonic()
+    test_main.run_async(test_report, test_main.run_tests(scheduler, test_report, 8, sample_interval=0.001))
+
+    # The tests run 8 at a time, and finishing one test immediately starts the next
+    assert MockTest.max_running == 8
+    assert time.monotonic() - start < 10
+    assert scheduler.num_unfinished == 0
+    assert all([test.max_mem == 1000 for setup in setups[1:] for test in setup.tests])
+
+    # Only the test depending on the failed test is skipped
+    assert test_report.num_passed == 298
+    assert test_report.failed_tests == [setups[0].tests[1]]
+    assert test_report.skipped_tests == [setups[0].tests[2]]
+
+    # Without the writer task, text is written immediately
+    report_file = tmp_path / 'pypeit.report'
+    report_writer = test_main.ReportWriter(str(report_file))
+    report_writer.write('line 1\n')
+    report_writer.write('line 2\n')
+    with open(report_file) as f:
+        assert f.read() == 'line 1\nline 2\n'
+
+    # With it, text is written once the writer task gets to it
+    async def buffered_write():
+        async with report_writer:
+            report_writer.write('line 3\n')
+            with open(report_file) as f:
+                assert 'line 3' not in f.read()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            with open(report_file) as f:
+                assert f.read().endswith('line 3\n')
+    asyncio.run(buffered_write())
+
+def test_timeline(tmp_path):
+    """
+    Test the timeline of the tests on each worker, and the summary of how busy the workers were.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', '-t', '4', 'reduce'])
+    test_report = test_main.TestReport(pargs)
+    setups = []
+    for i in range(20):
+        setup = test_main.TestSetup('shane_kast_blue', f'setup_{i}', str(tmp_path), str(tmp_path), str(tmp_path))
+        reduce = MockTest(setup, 'pypeit')
+        MockTest(setup, 'pypeit_sensfunc', [reduce])
+        setups.append(setup)
+    scheduler = test_main.TestScheduler(test_report, test_main.TestHistory(str(tmp_path / 'test_history.json')))
+    scheduler.add_setups(setups)
+    test_main.run_async(test_report, test_main.run_tests(scheduler, test_report, 4, sample_interval=0.001))
+
+    # Each worker runs one test at a time
+    tests = [test for setup in setups for test in setup.tests]
+    assert set(test.worker for test in tests) == set(range(4))
+    for worker in range(4):
+        worker_tests = sorted([test for test in tests if test.worker == worker], key=lambda test: test.start_time)
+        assert all(a.end_time <= b.start_time for a, b in zip(worker_tests[:-1], worker_tests[1:]))
+
+    trace_file = tmp_path / 'trace.json'
+    write_trace(setups, str(trace_file))
+    with open(trace_file) as f:
+        events = json.load(f)['traceEvents']
+    slices = [event for event in events if event['ph'] == 'X']
+    assert len(slices) == 40
+    assert min(event['ts'] for event in slices) == 0
+    assert sorted(event['args']['name'] for event in events if event['name'] == 'thread_name') \
+        == [f'worker {worker}' for worker in range(4)]
+    counters = [event for event in events if event['ph'] == 'C']
+    assert set(event['name'] for event in counters) == set(f'worker {worker} CPU' for worker in range(4))
+    assert all(event['args']['cores'] in [0, 0.5] for event in counters)
+
+    # A run with a known timeline: setup B's tests run on worker 0 while setup A's run on worker 1, and then
+    # A's last test waits for a worker after its dependency finishes.
+    start = datetime.datetime(2024, 1, 1)
+    def timed_test(setup, description, worker, start_secs, end_secs, dependencies=[]):
+        test = MockTest(setup, description, dependencies)
+        test.worker = worker
+        test.start_time = start + datetime.timedelta(seconds=start_secs)
+        test.end_time = start + datetime.timedelta(seconds=end_secs)
+        test.cpu_samples = [(test.start_time, 0.0), (test.end_time, (end_secs - start_secs) / 2)]
+        return test
+    setup_a = test_main.TestSetup('shane_kast_blue', 'A', str(tmp_path), str(tmp_path), str(tmp_path))
+    setup_b = test_main.TestSetup('shane_kast_red', 'B', str(tmp_path), str(tmp_path), str(tmp_path))
+    reduce_b = timed_test(setup_b, 'pypeit', 0, 0, 30)
+    reduce_a = timed_test(setup_a, 'pypeit', 1, 0, 40)
+    timed_test(setup_b, 'pypeit_flux', 0, 30, 60, [reduce_b])
+    timed_test(setup_a, 'pypeit_sensfunc', 1, 50, 100, [reduce_a])
+
+    output = io.StringIO()
+    test_main.write_utilisation_summary([setup_a, setup_b], 2, output)
+    summary = output.getvalue()
+    assert 'Wall time of tests:     100.0s with 2 workers' in summary
+    assert 'Parallel efficiency:    75.0% (150.0s of tests)' in summary
+    assert 'CPU utilisation:        37.5% (75.0s of CPU time)' in summary
+    # Worker 0 is idle from 60s, and worker 1 from 40s to 50s
+    assert 'Idle worker time:       50.0s, 40.0s of it after the last test started' in summary
+    path = summary.split('Critical path:\n')[1].splitlines()
+    assert path[0].split() == ['0.0s', '40.0s', 'shane_kast_blue/A', 'pypeit']
+    assert path[1].split() == ['50.0s', '50.0s', 'shane_kast_blue/A', 'pypeit_sensfunc', '(waited', '10.0s', 'for',
+                               'a', 'worker)']
+
+def plugin_env():
+    """Return the environment for running pytest with copies of the dev suite's conftest files, which import the
+    fixtures and helpers they share from the dev suite."""
+    return dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(os.environ['PYPEIT_DEV'], 'test_scripts')] +
+                                                       [path for path in [os.environ.get('PYTHONPATH')] if path]))
+
+def test_run_pytest_parallel(monkeypatch, tmp_path):
+    """
+    Test that the dev suite's pytest suites are run with pytest-xdist, and that their tests are isolated from
+    each other.
+    """
+    commands = []
+    async def mock_exec(*args, **kwargs):
+        commands.append(args)
+        return MockProcess()
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_exec)
+    find_spec = importlib.util.find_spec
+    xdist_installed = True
+    monkeypatch.setattr(importlib.util, "find_spec",
+                        lambda name: (object() if xdist_installed else None) if name == 'xdist' else find_spec(name))
+
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', '-t', '4', 'unit'])
+    test_report = test_main.TestReport(pargs)
+    asyncio.run(test_main.run_pytest(pargs, "Unit Tests", str(tmp_path), test_report, parallel=True))
+    asyncio.run(test_main.run_pytest(pargs, "PypeIt Unit Tests", str(tmp_path), test_report))
+    xdist_installed = False
+    asyncio.run(test_main.run_pytest(pargs, "Unit Tests", str(tmp_path), test_report, parallel=True))
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', '-t', '4', '--coverage', str(tmp_path / 'coverage.report'),
+                              'unit'])
+    xdist_installed = True
+    asyncio.run(test_main.run_pytest(pargs, "Unit Tests", str(tmp_path), test_report, parallel=True))
+    assert ['-n' in command for command in commands] == [True, False, False, False]
+    assert commands[0][commands[0].index('-n') + 1] == '4'
+
+    # Run tests that would collide if they shared the current directory or PypeIt's test output directory
+    suite_dir = tmp_path / 'suite'
+    suite_dir.mkdir()
+    (suite_dir / 'conftest.py').write_text(open(os.path.join(os.environ['PYPEIT_DEV'], 'unit_tests',
+                                                             'conftest.py')).read())
+    (suite_dir / 'test_isolation.py').write_text(textwrap.dedent(f"""
+        import os
+        import fcntl
+        import pytest
+
+        def data_output_path(filename):
+            return os.path.join({str(tmp_path)!r}, filename)
+
+        @pytest.mark.parametrize('i', range(3))
+        def test_cwd(i):
+            assert not os.path.exists('output.txt')
+            with open('output.txt', 'w') as f:
+                f.write(str(i))
+
+        def test_data_output_locked():
+            with open(data_output_path('.dev_suite.lock')) as f:
+                with pytest.raises(BlockingIOError):
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        """))
+    process = subprocess.run([sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider', str(suite_dir)],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=tmp_path, env=plugin_env())
+    assert process.returncode == 0, process.stdout.decode()
+    assert not (tmp_path / 'output.txt').exists()
+
+def test_run_pytest_long_lines(monkeypatch, tmp_path):
+    """
+    Test that pytest output with lines longer than the limit of a StreamReader is read.
+    """
+    long_line = 'test_vet.py::test_wavelengths[' + 'x' * 200000 + '] PASSED'
+    async def mock_exec(*args, **kwargs):
+        process = MockProcess()
+        process.stdout = asyncio.StreamReader()
+        process.stdout.feed_data(f"{long_line}\n3 passed".encode())
+        process.stdout.feed_eof()
+        return process
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_exec)
+
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', 'unit'])
+    test_report = test_main.TestReport(pargs)
+    lines = []
+    monkeypatch.setattr(test_report, "pytest_line", lambda test_descr, line: lines.append(line))
+    asyncio.run(test_main.run_pytest(pargs, "Vet Tests", str(tmp_path), test_report))
+    assert lines == [long_line, '3 passed']
+
+def test_add_vet_tests(tmp_path):
+    """
+    Test that vet tests run as soon as the tests of the setups they use have passed, and are skipped if they fail.
+    """
+    # Every marker in the vet tests names a known test setup
+    vet_tests = find_vet_tests(os.path.join(os.environ['PYPEIT_DEV'], 'vet_tests'))
+    not_alfosc = os.path.join(os.environ['PYPEIT_DEV'], 'vet_tests', 'test_wavelengths.py::test_not_alfosc')
+    assert 'not_alfosc/grism4_nobin' in vet_tests[not_alfosc]
+    echelle = os.path.join(os.environ['PYPEIT_DEV'], 'vet_tests', 'test_echelles.py::test_keck_nires_orders')
+    assert vet_tests[echelle] == [f'keck_nires/{setup}' for setup in all_setups['keck_nires']]
+    with pytest.raises(ValueError):
+        expand_setup_keys(['shane_kast_blue/not_a_setup'])
+
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', 'reduce', 'vet'])
+    test_report = test_main.TestReport(pargs)
+    blue = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path), str(tmp_path))
+    red = test_main.TestSetup('shane_kast_red', '600_7500_d57', str(tmp_path), str(tmp_path), str(tmp_path))
+    blue_reduce = MockTest(blue, 'pypeit')
+    blue_flux = MockTest(blue, 'pypeit_flux', [blue_reduce])
+    red_reduce = MockTest(red, 'pypeit')
+
+    remaining = test_main.add_vet_tests(pargs, [red, blue], {'test_blue_1': ['shane_kast_blue/600_4310_d55'],
+                                                            'test_both': ['shane_kast_red/600_7500_d57',
+                                                                          'shane_kast_blue/600_4310_d55'],
+                                                            'test_not_run': ['keck_nires/NIRES'],
+                                                            'test_blue_2': ['shane_kast_blue/600_4310_d55',
+                                                                            'keck_nires/NIRES'],
+                                                            'test_unmarked': None})
+    assert remaining == ['test_not_run', 'test_unmarked']
+
+    # The vet tests using the same setups being run are run together, in the first of those setups
+    blue_vet, both_vet = blue.tests[2:]
+    assert len(red.tests) == 1
+    assert str(blue_vet) == 'shane_kast_blue/600_4310_d55 vet'
+    assert str(both_vet) == 'shane_kast_blue/600_4310_d55 vet (with shane_kast_red/600_7500_d57)'
+    assert blue_vet.build_command_line()[-2:] == ['test_blue_1', 'test_blue_2']
+    assert blue_vet.dependencies == [blue_reduce, blue_flux]
+    assert both_vet.dependencies == [blue_reduce, blue_flux, red_reduce]
+
+    scheduler = test_main.TestScheduler(test_report, test_main.TestHistory(str(tmp_path / 'test_history.json')))
+    scheduler.add_setups([red, blue])
+
+    # The blue vet tests start once the blue tests have passed, without waiting for the red test
+    ready = [scheduler.next_test(), scheduler.next_test()]
+    assert set(ready) == set([blue_reduce, red_reduce])
+    assert scheduler.next_test() is None
+    blue_reduce.passed = True
+    scheduler.test_finished(blue_reduce)
+    assert scheduler.next_test() is blue_flux
+    blue_flux.passed = True
+    scheduler.test_finished(blue_flux)
+    assert scheduler.next_test() is blue_vet
+
+    # The vet tests that also use the failed red setup are skipped
+    red_reduce.passed = False
+    scheduler.test_finished(red_reduce)
+    assert test_report.skipped_tests == [both_vet]
+    assert scheduler.next_test() is None
+    blue_vet.passed = True
+    scheduler.test_finished(blue_vet)
+    assert scheduler.num_unfinished == 0
+
+def test_setup_selection(monkeypatch, tmp_path):
+    """
+    Test that only the unit and vet tests using the test setups selected with -i and -s are run.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', 'unit', 'vet', '-s', 'keck_nires/ABBA_wstandard'])
+    setup_keys = {'keck_nires': ['ABBA_wstandard']}
+    assert test_main.select_setup_names(pargs, 'keck_nires', [], setup_keys) == ['ABBA_wstandard']
+    assert test_main.select_setup_names(pargs, 'shane_kast_blue', [], setup_keys) == all_setups['shane_kast_blue']
+
+    # Instruments with all of their setups selected are given by name
+    assert test_main.pytest_setup_selection(dict(all_setups)) is None
+    selection = test_main.pytest_setup_selection({'keck_nires': ['ABBA_wstandard'],
+                                                  'shane_kast_blue': all_setups['shane_kast_blue']})
+    assert selection == ['keck_nires/ABBA_wstandard', 'shane_kast_blue']
+
+    # Vet tests that use setups that aren't being run are dropped, and unmarked tests are left to pytest
+    vet_tests = {'test_nires': ['keck_nires/ABBA_wstandard'],
+                 'test_both': ['keck_nires/ABBA_wstandard', 'shane_kast_blue/600_4310_d55'],
+                 'test_unmarked': None}
+    assert list(select_vet_tests(vet_tests, ['keck_nires/ABBA_wstandard'])) == ['test_nires', 'test_unmarked']
+
+    commands = []
+    async def mock_exec(*args, **kwargs):
+        commands.append(args)
+        return MockProcess()
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_exec)
+    test_report = test_main.TestReport(pargs)
+    asyncio.run(test_main.run_pytest(pargs, "Vet Tests", str(tmp_path), test_report, setups=selection))
+    assert commands[0][-5:] == ('--setups', 'keck_nires/ABBA_wstandard', '--setups', 'shane_kast_blue', str(tmp_path))
+
+    # Run the selection with the dev suite's conftest files. The instruments are known without any RAW_DATA
+    dev_dir = tmp_path / 'dev'
+    dev_dir.mkdir()
+    for suite in ['unit_tests', 'vet_tests']:
+        suite_dir = tmp_path / suite
+        suite_dir.mkdir()
+        conftest = os.path.join(os.environ['PYPEIT_DEV'], suite, 'conftest.py')
+        (suite_dir / 'conftest.py').write_text(open(conftest).read())
+    (tmp_path / 'unit_tests' / 'test_selection.py').write_text(textwrap.dedent("""
+        import os
+        import pytest
+
+        @pytest.fixture
+        def kast_file():
+            return kast_path()
+
+        def kast_path():
+            return os.path.join(os.getenv('PYPEIT_DEV'), 'RAW_DATA/shane_kast_blue/600_4310_d55/b1.fits.gz')
+
+        def test_kast_fixture(kast_file):
+            pass
+
+        def test_kast_helper():
+            kast_path()
+
+        @pytest.mark.parametrize('spec', ['keck_nires', 'keck_deimos'])
+        def test_spec(spec):
+            pass
+
+        def test_no_raw_data():
+            pass
+        """))
+    (tmp_path / 'vet_tests' / 'test_selection.py').write_text(textwrap.dedent("""
+        import os
+        import pytest
+
+        @pytest.mark.setups('keck_nires/ABBA_wstandard')
+        def test_nires_setup():
+            pass
+
+        @pytest.mark.setups('keck_nires')
+        def test_nires():
+            pass
+
+        @pytest.mark.setups('keck_nires/ABBA_wstandard', 'shane_kast_blue/600_4310_d55')
+        def test_nires_and_kast():
+            pass
+
+        def test_deimos_raw_data():
+            os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA', 'keck_deimos', '830G_M_8500')
+        """))
+
+    def collect(suite, *setups):
+        args = [arg for setup in setups for arg in ['--setups', setup]]
+        process = subprocess.run([sys.executable, '-m', 'pytest', '-q', '--collect-only', '-p', 'no:cacheprovider',
+                                  str(tmp_path / suite)] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 cwd=tmp_path, env=dict(plugin_env(), PYPEIT_DEV=str(dev_dir)))
+        assert process.returncode == 0, process.stdout.decode()
+        return [line.split('::')[1] for line in process.stdout.decode().splitlines() if '::' in line]
+
+    assert collect('unit_tests', 'keck_nires/ABBA_wstandard') == ['test_spec[keck_nires]', 'test_no_raw_data']
+    assert collect('unit_tests', 'shane_kast_blue') == ['test_kast_fixture', 'test_kast_helper', 'test_no_raw_data']
+    assert len(collect('unit_tests')) == 5
+    assert collect('vet_tests', 'keck_nires/ABBA_wstandard') == ['test_nires_setup']
+    assert collect('vet_tests', 'keck_nires', 'shane_kast_blue') == ['test_nires_setup', 'test_nires',
+                                                                    'test_nires_and_kast']
+    assert collect('vet_tests', 'keck_deimos') == ['test_deimos_raw_data']
+
+def test_history(tmp_path):
+    """
+    Test predicting test durations from the TestHistory, and recording new runs in it.
+    """
+    history_file = tmp_path / 'test_history.json'
+    write_history(history_file, {'shane_kast_blue/600_4310_d55': 100.0,
+                                 'shane_kast_blue/452_3306_d57': 300.0,
+                                 'keck_deimos/830G_M_8500': 1000.0})
+    history = test_main.TestHistory(str(history_file), max_runs=3)
+
+    fast = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path), str(tmp_path))
+    new = test_main.TestSetup('shane_kast_blue', '830_3460_d46', str(tmp_path), str(tmp_path), str(tmp_path))
+    slow = test_main.TestSetup('keck_deimos', '830G_M_8500', str(tmp_path), str(tmp_path), str(tmp_path))
+    setups = [fast, new, slow]
+    reduce_tests = [MockTest(setup, 'pypeit') for setup in setups]
+
+    # The new setup is estimated from the other shane_kast_blue setups, and a test that's never been run for any
+    # setup gets the default
+    assert history.estimate_duration(reduce_tests[0]) == 100.0
+    assert history.estimate_duration(reduce_tests[1]) == 200.0
+    other = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path), str(tmp_path))
+    assert history.estimate_duration(MockTest(other, 'pypeit_sensfunc')) == history.default_duration
+
+    # The slowest setups run first
+    history.set_setup_priorities(setups)
+    assert sorted(setups) == [slow, new, fast]
+
+    # Record runs of the fast setup, including a failure that stopped early
+    fast_test = reduce_tests[0]
+    for duration, passed in [(150.0, True), (5.0, False), (200.0, True)]:
+        fast_test.start_time = datetime.datetime.now()
+        fast_test.end_time = fast_test.start_time + datetime.timedelta(seconds=duration)
+        fast_test.passed = passed
+        fast_test.max_mem = 1000
+        history.record([fast])
+    history.write()
+
+    # Only the last 3 runs are kept, and the failed run isn't used for the prediction
+    history = test_main.TestHistory(str(history_file), max_runs=3)
+    assert [run['duration'] for run in history.runs(fast.key, 'pypeit')] == [150.0, 5.0, 200.0]
+    assert history.predicted_duration(fast.key, 'pypeit') == 175.0
+    assert history.peak_mem(fast_test) == 1000
+    assert history.peak_mem(reduce_tests[2]) is None
+    assert history.setup_peak_mem(fast.key) == 1000
+
+    # The size of the raw data and outputs of the setups that ran are recorded
+    raw_size, output_size = history.setup_sizes(fast.key)
+    assert raw_size > 0 and output_size == raw_size
+    assert history.setup_sizes(slow.key) is None
+
+    # A coverage run of the fast setup is only used to estimate the durations of coverage runs, which fall back to
+    # the runs without coverage for the tests that have never run under it
+    fast_test.start_time = datetime.datetime.now()
+    fast_test.end_time = fast_test.start_time + datetime.timedelta(seconds=2000.0)
+    fast_test.passed = True
+    history.record([fast], coverage=True)
+    assert history.estimate_duration(fast_test) == 200.0
+    assert history.estimate_setup_duration(fast.key) == 200.0
+    history.coverage = True
+    assert history.estimate_duration(fast_test) == 2000.0
+    assert history.estimate_setup_duration(fast.key) == 2000.0
+    assert history.estimate_duration(reduce_tests[2]) == 1000.0
+
+class ZygoteTest(PypeItTest):
+    """
+    A PypeItTest that runs a fake script in the zygote.
+    """
+    def __init__(self, setup, pargs, options):
+        super().__init__(setup, pargs, "fake_script", "fake")
+        self.options = options
+
+    def build_command_line(self):
+        return ['fake_script'] + self.options
+
+def test_zygote(monkeypatch, tmp_path):
+    """
+    Test running tests in children forked from the zygote process.
+    """
+    # A script that can be run like a PypeIt script
+    with open(tmp_path / 'fake_scripts.py', 'w') as f:
+        print(textwrap.dedent('''
+            import os
+            import sys
+            import time
+            import argparse
+
+            class FakeScript:
+                @classmethod
+                def parse_args(cls, options=None):
+                    parser = argparse.ArgumentParser()
+                    parser.add_argument('message')
+                    parser.add_argument('--exit_code', type=int, default=0)
+                    parser.add_argument('--hang', default=False, action='store_true')
+                    return parser.parse_args(options)
+
+                @staticmethod
+                def main(args):
+                    # Give the test time to sample the memory of the child
+                    time.sleep(0.5)
+                    if args.hang:
+                        time.sleep(600)
+                    print(args.message, os.getcwd(), os.environ.get('ZYGOTE_TEST'))
+                    if args.exit_code != 0:
+                        sys.exit(args.exit_code)
+            '''), file=f)
+    monkeypatch.setenv('PYTHONPATH', str(tmp_path))
+
+    zygote = PypeItZygote(preload=['fake_scripts'], scripts={'fake_script': 'fake_scripts:FakeScript'})
+    zygote.start()
+    try:
+        assert zygote.can_run(['fake_script', 'hello'])
+        assert not zygote.can_run(['run_pypeit', 'test.pypeit'])
+
+        pargs = test_main.parser(['-o', str(tmp_path), 'reduce'])
+        rdxdir = tmp_path / 'rdx'
+        rdxdir.mkdir()
+        setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(rdxdir), str(tmp_path))
+
+        # The child runs in the test's directory and environment, and writes to the test's log
+        test = ZygoteTest(setup, pargs, ['hello'])
+        test.zygote = zygote
+        test.env = dict(os.environ, ZYGOTE_TEST='from_env')
+        assert asyncio.run(test.run()) is True
+        assert test.pid != os.getpid()
+        assert test.max_mem > 0
+        assert test.usage.source == 'rusage' and test.usage.user_cpu is not None
+        with open(test.logfile) as f:
+            assert f.read().split() == ['hello', str(rdxdir), 'from_env']
+
+        # A script exiting with an error fails the test
+        test = ZygoteTest(setup, pargs, ['goodbye', '--exit_code', '3'])
+        test.zygote = zygote
+        assert asyncio.run(test.run()) is False
+        assert test.error_msgs == []
+
+        # A child that hangs dumps its stack to the log when it times out
+        test = ZygoteTest(setup, pargs, ['hung', '--hang'])
+        test.zygote = zygote
+        test.timeout = 2.0
+        assert asyncio.run(test.run()) is False
+        assert test.timed_out
+        with open(test.logfile) as f:
+            assert 'in main' in f.read()
+    finally:
+        zygote.stop()
+
+class CachedTest(PypeItTest):
+    """
+    A PypeItTest that copies an input file into the Science directory of its setup.
+    """
+    def __init__(self, setup, pargs, input_file):
+        super().__init__(setup, pargs, "copy", "copy")
+        self.input_file = input_file
+
+    def build_command_line(self):
+        return [sys.executable, '-c',
+                'import os, shutil, sys; os.makedirs("Science", exist_ok=True); shutil.copy(sys.argv[1], "Science")',
+                self.input_file]
+
+def test_result_cache(tmp_path):
+    """
+    Test restoring the results of tests from the ResultCache.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), 'reduce'])
+    cache = ResultCache(str(tmp_path / 'cache'), '1.0.0')
+    input_file = tmp_path / 'input.txt'
+    input_file.write_text("version 1")
+    output_file = tmp_path / 'rdx' / 'Science' / 'input.txt'
+
+    def run_test():
+        setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path / 'rdx'),
+                                    str(tmp_path))
+        os.makedirs(setup.rdxdir, exist_ok=True)
+        test = CachedTest(setup, pargs, str(input_file))
+        test.cache = cache
+        assert asyncio.run(test.run()) is True
+        return test
+
+    # The first run isn't in the cache
+    first = run_test()
+    assert not first.from_cache
+    assert output_file.read_text() == "version 1"
+
+    # The second run is restored from the cache, without running the test
+    output_file.unlink()
+    second = run_test()
+    assert second.from_cache
+    assert second.pid is None
+    assert second.cache_key == first.cache_key
+    assert output_file.read_text() == "version 1"
+
+    # Changing the input runs the test again
+    input_file.write_text("version 2")
+    third = run_test()
+    assert not third.from_cache
+    assert third.cache_key != first.cache_key
+    assert output_file.read_text() == "version 2"
+
+    # A cached file that was changed in place invalidates its entry
+    with open(output_file, "a") as f:
+        print("changed", file=f)
+    fourth = run_test()
+    assert not fourth.from_cache
+    assert output_file.read_text() == "version 2"
+
+    # A different PypeIt version doesn't use the cached results
+    cache = ResultCache(str(tmp_path / 'cache'), '2.0.0')
+    assert not run_test().from_cache
+
+    # The version of PypeIt in a git checkout changes with its commits and uncommitted changes, as the installed
+    # version of an editable install doesn't
+    package_dir = tmp_path / 'PypeIt' / 'pypeit'
+    create_dummy_files(package_dir, ['__init__.py', 'core/wavecal.py'])
+    pypeit = types.SimpleNamespace(__file__=str(package_dir / '__init__.py'), __version__='1.0.0')
+    assert result_cache.pypeit_code_version(pypeit) == '1.0.0'
+    git = ['git', '-C', str(tmp_path / 'PypeIt'), '-c', 'user.name=dev', '-c', 'user.email=dev@example.com']
+    subprocess.run(git + ['init', '-q'], check=True)
+    subprocess.run(git + ['add', '.'], check=True)
+    subprocess.run(git + ['commit', '-q', '-m', 'first'], check=True)
+    committed = result_cache.pypeit_code_version(pypeit)
+    assert committed.startswith('1.0.0+')
+    with open(package_dir / 'core' / 'wavecal.py', 'a') as f:
+        print("edited", file=f)
+    edited = result_cache.pypeit_code_version(pypeit)
+    assert edited != committed
+    create_dummy_files(package_dir, ['core/new.py'])
+    assert result_cache.pypeit_code_version(pypeit) not in [committed, edited]
+    subprocess.run(git + ['commit', '-q', '-a', '-m', 'second'], check=True)
+    os.remove(package_dir / 'core' / 'new.py')
+    assert result_cache.pypeit_code_version(pypeit) not in [committed, edited]
+
+class PypeItFileTest(PypeItTest):
+    """
+    A PypeItTest run on a .pypeit file.
+    """
+    def __init__(self, setup, pargs, pypeit_file):
+        super().__init__(setup, pargs, "pypeit", "pypeit")
+        self.pypeit_file = pypeit_file
+
+    def build_command_line(self):
+        return ['run_pypeit', self.pypeit_file, '-r', self.setup.rdxdir]
+
+    def cache_inputs(self):
+        return [os.path.join(self.setup.rawdir, 'b1.fits.gz')]
+
+def test_result_cache_key_checkouts(tmp_path):
+    """
+    Test that a test has the same key in different dev suite checkouts, even though its .pypeit file names the raw
+    data in the checkout.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), 'reduce'])
+    keys = result_cache.TestKeys('1.0.0')
+
+    def checkout_key(name, raw_data="raw data"):
+        dev_path = tmp_path / name
+        setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55',
+                                    str(dev_path / 'RAW_DATA' / 'shane_kast_blue' / '600_4310_d55'),
+                                    str(dev_path / 'REDUX_OUT' / 'shane_kast_blue' / '600_4310_d55'), str(dev_path))
+        os.makedirs(setup.rawdir)
+        with open(os.path.join(setup.rawdir, 'b1.fits.gz'), 'w') as f:
+            f.write(raw_data)
+        pypeit_file = os.path.join(setup.rdxdir, 'shane_kast_blue_600_4310_d55.pypeit')
+        os.makedirs(setup.rdxdir)
+        with open(pypeit_file, 'w') as f:
+            f.write(f"[rdx]\n    spectrograph = shane_kast_blue\ndata read\n path {setup.rawdir}\n"
+                    f"filename | frametype\nb1.fits.gz | science\ndata end\n")
+        test = PypeItFileTest(setup, pargs, pypeit_file)
+        test.command_line = test.build_command_line()
+        return keys.test_key(test)
+
+    assert checkout_key('dev1') == checkout_key('other/dev2')
+    assert checkout_key('dev3') != checkout_key('dev4', raw_data="other raw data")
+
+def test_result_cache_own_files(tmp_path):
+    """
+    Test that the files of the other tests of a setup, which can be written while a test using the ResultCache runs,
+    aren't stored with its outputs.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path / 'out'), 'reduce'])
+    cache = ResultCache(str(tmp_path / 'cache'), '1.0.0')
+    setup = test_main.TestSetup('keck_nires', 'ABBA_wstandard', str(tmp_path),
+                                str(tmp_path / 'out' / 'keck_nires' / 'ABBA_wstandard'), str(tmp_path))
+    os.makedirs(setup.rdxdir)
+    input_file = tmp_path / 'input.txt'
+    input_file.write_text("version 1")
+    quick_look = PypeItQuickLookTest(setup, pargs, ['raw.fits'], test_name='A')
+    quick_look.logfile = quick_look.get_logfile()
+    ql_output = os.path.join(quick_look.redux_path(), 'Science', 'spec1d.fits')
+
+    class ConcurrentTest(CachedTest):
+        """Also writes the files a QL test of the setup writes at the same time."""
+        def build_command_line(self):
+            script = ('import os, shutil, sys; os.makedirs("Science", exist_ok=True); shutil.copy(sys.argv[1], '
+                      '"Science")\nfor file in sys.argv[2:]:\n    os.makedirs(os.path.dirname(file), exist_ok=True)\n'
+                      '    open(file, "a").close()')
+            return [sys.executable, '-c', script, self.input_file, quick_look.logfile, ql_output]
+
+    test = ConcurrentTest(setup, pargs, str(input_file))
+    setup.tests += [quick_look, test]
+    test.cache = cache
+    assert asyncio.run(test.run()) is True
+    assert os.path.exists(ql_output)
+    with open(os.path.join(cache._entry_dir(test.cache_key), 'entry.json')) as f:
+        assert list(json.load(f)['files']) == [os.path.join('Science', 'input.txt')]
+
+
+class ProfiledTest(PypeItTest):
+    """
+    A PypeItTest that runs a script calling a function in a package named pypeit.
+    """
+    def __init__(self, setup, pargs, loops):
+        super().__init__(setup, pargs, "profiled", "profiled")
+        self.loops = loops
+
+    def build_command_line(self):
+        return ['fake_pypeit_script', str(self.loops)]
+
+def test_profile(monkeypatch, tmp_path):
+    """
+    Test running tests under cProfile and merging their profiles into a report.
+    """
+    core_dir = tmp_path / 'lib' / 'pypeit' / 'core'
+    core_dir.mkdir(parents=True)
+    (tmp_path / 'lib' / 'pypeit' / '__init__.py').write_text('')
+    (core_dir / '__init__.py').write_text('')
+    (core_dir / 'fakecore.py').write_text(textwrap.dedent('''
+        def slow(loops):
+            return sum(fast(i) for i in range(loops))
+
+        def fast(i):
+            return i * 2
+        '''))
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'fake_pypeit_script'
+    script.write_text(textwrap.dedent(f'''
+        #!{sys.executable}
+        import sys
+        sys.path.insert(0, {str(tmp_path / 'lib')!r})
+        from pypeit.core import fakecore
+        fakecore.slow(int(sys.argv[1]))
+        ''').lstrip())
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+    report_file = tmp_path / 'profile.txt'
+    pargs = test_main.parser(['-o', str(tmp_path), '--profile', str(report_file), 'reduce'])
+    setups = []
+    for instr, setup_name, loops in [('shane_kast_blue', '600_4310_d55', 1000), ('keck_nires', 'ABBA_wstandard', 2000)]:
+        rdxdir = tmp_path / instr
+        rdxdir.mkdir()
+        setup = test_main.TestSetup(instr, setup_name, str(tmp_path), str(rdxdir), str(tmp_path))
+        test = ProfiledTest(setup, pargs, loops)
+        setup.tests = [test]
+        setups.append(setup)
+        assert asyncio.run(test.run()) is True, test.error_msgs
+
+        # The profile is next to the log
+        assert test.command_line[:3] == [sys.executable, '-m', 'cProfile']
+        assert test.profile_file == os.path.splitext(test.logfile)[0] + '.pstats'
+        assert os.path.exists(test.profile_file)
+
+    # A test that didn't write its profile isn't in the report
+    crashed = ProfiledTest(setups[0], pargs, 10)
+    crashed.profile_file = str(tmp_path / 'missing.pstats')
+    setups[0].tests.append(crashed)
+
+    assert write_profile_report(setups, str(report_file)) == 2
+    report = report_file.read_text()
+    assert 'PypeIt functions by cumulative time: all instruments (2 tests)' in report
+    assert 'PypeIt functions by self time: keck_nires (1 tests)' in report
+    assert 'PypeIt functions by self time: shane_kast_blue (1 tests)' in report
+    assert os.path.exists(tmp_path / 'profile.pstats')
+
+    # The calls in both tests are merged, and only PypeIt functions are ranked
+    ranking = report.split('\n\n')[1].splitlines()
+    assert ranking[3].split()[2:] == ['2', 'pypeit/core/fakecore.py:2(slow)']
+    assert [line.split()[2:] for line in ranking[3:] if 'fast' in line] == [['3000', 'pypeit/core/fakecore.py:5(fast)']]
+    assert all(' pypeit/' in line for line in ranking[3:])
+
+    # Coverage runs aren't profiled, and neither are vet tests
+    pargs = test_main.parser(['-o', str(tmp_path), '--profile', str(report_file), '--coverage',
+                              str(tmp_path / 'coverage.txt'), 'reduce'])
+    assert not ProfiledTest(setups[0], pargs, 10).profile
+    pargs = test_main.parser(['-o', str(tmp_path), '--profile', str(report_file), 'reduce', 'vet'])
+    assert not PypeItVetTest(setups[0], pargs, ['test_id']).profile
+
+class AccountedTest(PypeItTest):
+    """
+    A PypeItTest that runs a python script in a child process.
+    """
+    def __init__(self, setup, pargs, code):
+        super().__init__(setup, pargs, "accounted", "accounted")
+        self.code = code
+
+    def build_command_line(self):
+        return [sys.executable, '-c', self.code]
+
+def test_accounting(tmp_path):
+    """
+    Test accounting for the resources used by the process tree of a test.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), 'reduce'])
+    setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path), str(tmp_path))
+
+    # The memory of a grandchild and the bytes written by the child are accounted for
+    test = AccountedTest(setup, pargs, textwrap.dedent('''
+        import subprocess, sys
+        subprocess.run([sys.executable, '-c', 'x = bytearray(64 * 2**20); x[::4096] = b"1" * len(x[::4096])'],
+                       check=True)
+        with open('written.dat', 'wb') as f:
+            f.write(b'0' * 4 * 2**20)
+        '''))
+    assert asyncio.run(test.run()) is True, test.error_msgs
+    assert test.usage.source in ('cgroup', 'rusage')
+    assert test.usage.peak_rss >= 64 * 2**20
+    assert test.max_mem >= test.usage.peak_rss
+    assert test.usage.user_cpu > 0 and test.usage.system_cpu >= 0
+    assert test.usage.write_bytes >= 4 * 2**20
+    assert test.usage.voluntary_switches is not None and test.usage.involuntary_switches is not None
+    assert not os.path.exists(os.path.splitext(test.logfile)[0] + '.usage.json')
+
+    # The usage is in the performance results
+    test.start_time = datetime.datetime.now()
+    test.end_time = test.start_time + datetime.timedelta(seconds=10)
+    setup.tests = [test]
+    report = test_main.TestReport(pargs)
+    report.test_setups = [setup]
+    output = io.StringIO()
+    report.performance_results(output)
+    header, row = [line.split(',') for line in output.getvalue().splitlines()[:2]]
+    assert header[-1] == 'Usage Source' and len(row) == len(header)
+    assert row[-1] == test.usage.source and int(row[-2]) >= 4 * 2**20
+
+    # The exit code and signals of the command are passed through the accounting script
+    test = AccountedTest(setup, pargs, 'import sys; sys.exit(3)')
+    assert asyncio.run(test.run()) is False
+    assert test.usage is not None
+    test = AccountedTest(setup, pargs, 'import os, signal; os.kill(os.getpid(), signal.SIGKILL)')
+    assert asyncio.run(test.run()) is False
+    assert test.usage is not None
+
+class HungTest(PypeItTest):
+    """
+    A PypeItTest that runs a python script, which may never finish.
+    """
+    def __init__(self, setup, pargs, script):
+        super().__init__(setup, pargs, "hung", "hung")
+        self.script = script
+
+    def build_command_line(self):
+        return [sys.executable, self.script]
+
+def test_timeouts(tmp_path):
+    """
+    Test stopping tests that run for longer than their timeout, and setting the timeouts from the test history.
+    """
+    script = tmp_path / 'hung.py'
+    script.write_text(textwrap.dedent('''
+        import os, signal, subprocess, sys, time
+
+        def hang():
+            time.sleep(600)
+
+        if len(sys.argv) > 1:
+            # A grandchild, which records its pid so the test can check it was stopped
+            with open(f'grandchild_{sys.argv[1]}.pid', 'w') as f:
+                f.write(str(os.getpid()))
+            if sys.argv[1] == 'stubborn':
+                signal.signal(signal.SIGABRT, signal.SIG_IGN)
+            hang()
+        else:
+            grandchildren = [subprocess.Popen([sys.executable, __file__, kind]) for kind in ['dumps', 'stubborn']]
+            for grandchild in grandchildren:
+                grandchild.wait()
+        '''))
+    pargs = test_main.parser(['-o', str(tmp_path), 'reduce'])
+    setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path), str(tmp_path))
+
+    # The stacks of the test's processes are dumped to its log, and then they're killed
+    test = HungTest(setup, pargs, str(script))
+    test.timeout = 2.0
+    test.stack_dump_wait = 0.5
+    assert asyncio.run(test.run()) is False
+    assert test.timed_out
+    assert (test.end_time - test.start_time).total_seconds() < 30
+    assert test.error_msgs[0].startswith('Timed out after 2 seconds')
+    log = open(test.logfile).read()
+    assert 'pypeit_test: Timed out after 2 seconds' in log
+    assert log.count('Fatal Python error: Aborted') == 2
+    assert 'in hang' in log
+    for kind in ['dumps', 'stubborn']:
+        pid = int((tmp_path / f'grandchild_{kind}.pid').read_text())
+        try:
+            assert psutil.Process(pid).status() == psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            pass
+
+    # A test that finishes in time isn't affected
+    script.write_text('print("done")')
+    test = HungTest(setup, pargs, str(script))
+    test.timeout = 60.0
+    assert asyncio.run(test.run()) is True
+    assert not test.timed_out
+
+    # The report shows the test timed out
+    test_report = test_main.TestReport(test_main.parser(['-o', str(tmp_path), '-q', 'reduce']))
+    timed_out = HungTest(setup, pargs, str(script))
+    timed_out.passed = False
+    timed_out.timed_out = True
+    timed_out.timeout = 2.0
+    test_report.test_completed(timed_out)
+    output = io.StringIO()
+    test_report.report_on_test(timed_out, output)
+    assert '--- TIMED OUT' in output.getvalue() and 'Timeout:    0:00:02' in output.getvalue()
+    output = io.StringIO()
+    test_report.summarize_setup_tests(output)
+    assert '1 failed tests timed out' in output.getvalue()
+
+    # The timeouts are set from the history of the tests, with a minimum, or from the timeouts in test_setups
+    write_history(tmp_path / 'history.json', {'shane_kast_blue/600_4310_d55': 1000.0,
+                                              'shane_kast_red/600_7500_d57': 10.0})
+    history = test_main.TestHistory(str(tmp_path / 'history.json'))
+    pargs = test_main.parser(['-o', str(tmp_path), '--timeout_factor', '3', 'reduce'])
+    setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '600_4310_d55', True, True, False, history)
+    tests = {test.description: test for test in setup.tests}
+    assert tests['pypeit'].timeout == 3000.0
+    assert tests['pypeit_setup'].timeout == test_main.phase_timeouts[test_main.TestPhase.PREP]
+    assert tests['pypeit_sensfunc'].timeout == test_main.phase_timeouts[test_main.TestPhase.AFTERBURN]
+    setup = test_main.build_test_setup(pargs, 'shane_kast_red', '600_7500_d57', True, False, False, history)
+    assert setup.tests[0].timeout == 600.0
+
+    # Coverage runs are only timed out from the earlier runs under coverage
+    coverage_history = test_main.TestHistory(str(tmp_path / 'history.json'), coverage=True)
+    setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '600_4310_d55', True, True, False, coverage_history)
+    assert {test.description: test for test in setup.tests}['pypeit'].timeout == \
+                test_main.phase_timeouts[test_main.TestPhase.REDUCE]
+
+    test_main.test_timeouts['shane_kast_blue'] = {'600_4310_d55': {'reduce': None, 'sensfunc': 100}}
+    try:
+        setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '600_4310_d55', True, True, False, history)
+    finally:
+        del test_main.test_timeouts['shane_kast_blue']
+    tests = {test.description: test for test in setup.tests}
+    assert tests['pypeit'].timeout is None
+    assert tests['pypeit_sensfunc'].timeout == 100
+
+    # Vet tests only have a timeout once they have run, and --timeout_factor 0 turns off timeouts
+    test_main.add_vet_tests(pargs, [setup], {'vet_tests/test_kast.py::test_kast': ['shane_kast_blue/600_4310_d55']},
+                            history)
+    assert setup.tests[-1].timeout is None
+    pargs = test_main.parser(['-o', str(tmp_path), '--timeout_factor', '0', 'reduce'])
+    setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '600_4310_d55', True, True, False, history)
+    assert all(test.timeout is None for test in setup.tests)
+
+def test_stop_testing(tmp_path):
+    """
+    Test stopping testing after --fail_fast failures, or when pypeit_test receives a SIGTERM.
+    """
+    # No tests are started after the second failure, but the running tests finish
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', '--fail_fast', '2', 'reduce'])
+    test_report = test_main.TestReport(pargs)
+    setups = []
+    for i in range(20):
+        setup = test_main.TestSetup('shane_kast_blue', f'setup_{i}', str(tmp_path), str(tmp_path), str(tmp_path))
+        reduce = MockTest(setup, 'fail' if i % 5 == 0 else 'pypeit')
+        MockTest(setup, 'pypeit_sensfunc', [reduce])
+        setups.append(setup)
+    scheduler = test_main.TestScheduler(test_report, test_main.TestHistory(str(tmp_path / 'test_history.json')))
+    scheduler.add_setups(setups)
+    test_main.run_async(test_report, test_main.run_tests(scheduler, test_report, 2, sample_interval=0.001))
+    assert test_report.num_failed == 2
+    assert test_report.stop_reason == '2 tests failed (--fail_fast 2)'
+    assert scheduler.num_unfinished == 0
+    assert test_report.num_passed + test_report.num_failed + test_report.num_skipped == 40
+    assert test_report.num_passed < 20
+
+    # Failed unit tests count towards --fail_fast, and stop testing before the test setups
+    test_report = test_main.TestReport(pargs)
+    test_report.pytest_results['Unit Tests'] = ' 1 failed, 10 passed, 1 error in 3.00s '
+    assert test_report.num_failures() == 2
+    scheduler = test_main.TestScheduler(test_report, test_main.TestHistory(str(tmp_path / 'test_history.json')))
+    scheduler.add_setups(setups[:1])
+    test_main.run_async(test_report, test_main.run_tests(scheduler, test_report, 2))
+    assert test_report.num_skipped == 2 and test_report.num_tests == 0
+
+    # A SIGTERM stops the running tests within a bounded time, even if some of their processes ignore it
+    script = tmp_path / 'stubborn.py'
+    script.write_text(textwrap.dedent('''
+        import os, signal, subprocess, sys, time
+        if len(sys.argv) > 1:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            with open('stubborn.pid', 'w') as f:
+                f.write(str(os.getpid()))
+            time.sleep(600)
+        else:
+            subprocess.run([sys.executable, __file__, 'stubborn'])
+        '''))
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', 'reduce'])
+    test_report = test_main.TestReport(pargs)
+    setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path), str(tmp_path))
+    stubborn = HungTest(setup, pargs, str(script))
+    stubborn.stop_wait = 0.5
+    waiting = HungTest(setup, pargs, str(script))
+    waiting.dependencies = [stubborn]
+    setup.tests = [stubborn, waiting]
+    scheduler = test_main.TestScheduler(test_report, test_main.TestHistory(str(tmp_path / 'test_history.json')))
+    scheduler.add_setups([setup])
+
+    async def run_and_terminate():
+        task = asyncio.create_task(test_main.run_tests(scheduler, test_report, 2))
+        while not (tmp_path / 'stubborn.pid').exists():
+            await asyncio.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGTERM)
+        return await task
+
+    start = time.monotonic()
+    assert test_main.run_async(test_report, run_and_terminate()) is None
+    assert time.monotonic() - start < 30
+    assert test_report.stop_reason == 'Stopped by SIGTERM'
+    assert test_report.failed_tests == [stubborn] and test_report.skipped_tests == [waiting]
+    assert stubborn.error_msgs == ['Stopped before the test finished: Stopped by SIGTERM']
+    try:
+        assert psutil.Process(int((tmp_path / 'stubborn.pid').read_text())).status() == psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        pass
+
+    # The signal handlers are removed afterwards
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
+
+def test_resume(tmp_path):
+    """
+    Test resuming a run from its journal, without running the tests that passed in it again.
+    """
+    input_file = tmp_path / 'input.txt'
+    input_file.write_text("version 1")
+    other_file = tmp_path / 'other.txt'
+
+    def run(resume, pypeit_version='1.0.0'):
+        pargs = test_main.parser(['-o', str(tmp_path), '-q', 'reduce'] + (['--resume'] if resume else []))
+        test_report = test_main.TestReport(pargs)
+        setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path / 'rdx'),
+                                    str(tmp_path))
+        os.makedirs(setup.rdxdir, exist_ok=True)
+        first = CachedTest(setup, pargs, str(input_file))
+        second = CachedTest(setup, pargs, str(other_file))
+        second.description = "copy other"
+        second.dependencies = [first]
+        setup.tests = [first, second]
+        journal = RunJournal(str(tmp_path), result_cache.TestKeys(pypeit_version, str(tmp_path / HASH_FILE)), resume)
+        for test in setup.tests:
+            test.journal = journal
+        scheduler = test_main.TestScheduler(test_report, test_main.TestHistory(str(tmp_path / 'test_history.json')))
+        scheduler.add_setups([setup])
+        test_main.run_async(test_report, test_main.run_tests(scheduler, test_report, 2))
+        journal.close()
+        return test_report, first, second
+
+    # The second test fails, as its input is missing. A run that can be resumed starts a journal when there isn't one
+    test_report, first, second = run(True)
+    assert first.passed and not second.passed and first.cache_key is not None
+    runs, records = read_journal(str(tmp_path / JOURNAL_FILE))
+    assert len(runs) == 1 and len(records) == 2
+    assert records[(first.setup.key, 'copy')]['outputs'] == [os.path.join('rdx', 'Science', 'input.txt')]
+    assert records[(first.setup.key, 'copy other')]['passed'] is False
+
+    # Resuming only runs the test that failed, and reports the first test with its results from the first run
+    other_file.write_text("other")
+    with open(tmp_path / JOURNAL_FILE, "a") as f:
+        # A record that was being written when the run was killed
+        f.write('{"type": "test", "setup": ')
+    test_report, resumed, second = run(True)
+    assert resumed.passed and resumed.resumed and second.passed and not second.resumed
+    assert (resumed.start_time, resumed.end_time, resumed.pid) == (first.start_time, first.end_time, first.pid)
+    assert resumed.logfile == first.logfile and resumed.cache_key == first.cache_key
+    assert test_report.num_passed == 2 and test_report.num_resumed == 1
+    assert len(read_journal(str(tmp_path / JOURNAL_FILE))[0]) == 2
+    assert (tmp_path / 'rdx' / 'Science' / 'other.txt').read_text() == "other"
+
+    # Both tests are resumed until an input, an output, or the PypeIt version changes
+    test_report, first, second = run(True)
+    assert first.resumed and second.resumed
+    (tmp_path / 'rdx' / 'Science' / 'other.txt').unlink()
+    test_report, first, second = run(True)
+    assert first.resumed and not second.resumed and second.passed
+    input_file.write_text("version 2")
+    test_report, first, second = run(True)
+    assert not first.resumed and not second.resumed
+    test_report, first, second = run(True, '2.0.0')
+    assert not first.resumed and not second.resumed
+
+    # A run that isn't resumed starts a new journal, without the keys of its tests
+    test_report, first, second = run(False)
+    assert not first.resumed and first.cache_key is None
+    runs, records = read_journal(str(tmp_path / JOURNAL_FILE))
+    assert len(runs) == 1 and records[(first.setup.key, 'copy')]['key'] is None
+
+def test_plain_run_skips_keys(monkeypatch, tmp_path):
+    """
+    Test that a run that isn't resumed and doesn't use the result cache doesn't hash the inputs of its tests.
+    """
+    keyed = []
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
+    monkeypatch.setattr(subprocess, "run", mock_run)
+    monkeypatch.setattr(result_cache.TestKeys, "test_key", lambda self, test: keyed.append(test) or 'key')
+    monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-q', 'reduce',
+                                      '-s', 'shane_kast_blue/600_4310_d55'])
+    with change_dir(tmp_path):
+        test_main.main()
+    assert keyed == []
+    runs, records = read_journal(str(tmp_path / JOURNAL_FILE))
+    assert len(records) > 0 and all([record['key'] is None for record in records.values()])
+
+    # Resumed runs do compute them
+    monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-q', '--resume', 'reduce',
+                                      '-s', 'shane_kast_blue/600_4310_d55'])
+    with change_dir(tmp_path):
+        test_main.main()
+    assert len(keyed) > 0
+
+def test_time_budget(tmp_path):
+    """
+    Test selecting the test setups that test the most within a --time_budget.
+    """
+    assert test_main.parse_duration("90") == 90.0
+    assert test_main.parse_duration("30m") == 1800.0
+    assert test_main.parse_duration("1h 30M") == 5400.0
+    assert test_main.parse_duration("1.5h") == 5400.0
+    with pytest.raises(ValueError):
+        test_main.parse_duration("30 minutes")
+
+    durations = {'shane_kast_blue/452_3306_d57': 100.0,
+                 'shane_kast_blue/600_4310_d55': 300.0,
+                 'shane_kast_blue/830_3460_d46': 100.0,
+                 'keck_nires/ABBA_nostandard': 200.0,
+                 'keck_nires/ABC_nostandard': 200.0,
+                 'keck_nires/ABBA_nostandard_faint': 1000.0}
+    history_file = tmp_path / 'test_history.json'
+    write_history(history_file, durations)
+    with open(history_file) as f:
+        data = json.load(f)
+    # The reductions of one of the setups often fail
+    data['tests']['keck_nires/ABC_nostandard']['pypeit'][0]['passed'] = False
+    with open(history_file, 'w') as f:
+        json.dump(data, f)
+    history = test_main.TestHistory(str(history_file))
+    assert history.setup_failure_rate('keck_nires/ABC_nostandard') == 1.0
+    assert history.setup_failure_rate('keck_nires/ABBA_nostandard') == 0.0
+
+    setup_keys = list(durations.keys())
+    phases = list(test_main.TestPhase)
+
+    # The setup that often fails is worth the most for its duration. After it, the Kast setup with the most test
+    # types fits alongside it with two parallel tests, and the other setups only test instruments and test types
+    # that are already covered, or don't fit
+    keys, wall_time = select_setups(setup_keys, history, 400.0, 2, phases)
+    assert keys == ['shane_kast_blue/600_4310_d55', 'keck_nires/ABC_nostandard']
+    assert wall_time == 300.0
+
+    # Running one test at a time leaves no room for the Kast setup with the most test types
+    keys, wall_time = select_setups(setup_keys, history, 400.0, 1, phases)
+    assert keys == ['shane_kast_blue/452_3306_d57', 'keck_nires/ABC_nostandard']
+    assert wall_time == 300.0
+
+    # Code only run by a setup makes it worth running
+    coverage_map_file = tmp_path / 'coverage_map.json'
+    with open(coverage_map_file, 'w') as f:
+        json.dump({'shane_kast_blue/830_3460_d46': ['pypeit/core/arc.py:10', 'pypeit/core/arc.py:11'],
+                   'shane_kast_blue/600_4310_d55': ['pypeit/core/arc.py:10']}, f)
+    keys, wall_time = select_setups(setup_keys, history, 400.0, 2, phases, read_coverage_map(coverage_map_file))
+    assert keys == ['shane_kast_blue/600_4310_d55', 'shane_kast_blue/830_3460_d46', 'keck_nires/ABC_nostandard']
+    assert wall_time == 300.0
+
+    # Nothing fits in a budget shorter than any setup
+    assert select_setups(setup_keys, history, 10.0, 2, phases) == ([], 0.0)
+
+def test_impacted(tmp_path, capsys):
+    """
+    Test selecting the tests that run the code changed by a patch, from a coverage index.
+    """
+    source_dir = tmp_path / 'PypeIt' / 'pypeit' / 'core'
+    source_dir.mkdir(parents=True)
+    source_file = source_dir / 'arc.py'
+    source_file.write_text(textwrap.dedent('''\
+        import numpy as np
+        THRESHOLD = 3.0
+
+        def detect_lines(spec):
+            peaks = np.argmax(spec)
+            return peaks
+
+        class Fitter:
+            @staticmethod
+            def fit(x):
+                return x
+        '''))
+    assert coverage_index.function_spans(str(source_file)) == {'detect_lines': [4, 5, 6], 'Fitter.fit': [9, 11, 11]}
+
+    # Both tests import the module, but only the Kast test detects lines
+    index_file = str(tmp_path / 'coverage_index.json')
+    index = coverage_index.CoverageIndex(index_file)
+    index.update({'shane_kast_blue/600_4310_d55 pypeit': {'pypeit/core/arc.py': {1, 2, 4, 5, 6, 8, 9}},
+                  'keck_nires/ABBA_nostandard pypeit': {'pypeit/core/arc.py': {1, 2, 4, 8, 9}},
+                  'Unit Tests': {'pypeit/core/arc.py': {1, 2, 4, 8, 9, 11}}},
+                 {'pypeit/core/arc.py': str(source_file)})
+    index.write()
+    index = coverage_index.CoverageIndex(index_file)
+    assert len(index) == 3
+    assert index.tests['keck_nires/ABBA_nostandard pypeit']['pypeit/core/arc.py'] == [[1, 2], [4, 4], [8, 9]]
+
+    def patch(hunks, old='a/pypeit/core/arc.py', new='b/pypeit/core/arc.py'):
+        return f'diff --git a/x b/x\n--- {old}\n+++ {new}\n' + hunks
+
+    # Changing the last line of detect_lines impacts the test that ran it. Changing a module constant impacts every
+    # test that imported the module.
+    changes = coverage_index.parse_diff(patch('@@ -6 +6 @@ def detect_lines(spec):\n-    return peaks\n+    return peaks+1\n'))
+    assert list(changes.keys()) == ['pypeit/core/arc.py'] and changes['pypeit/core/arc.py'].lines == {6}
+    assert index.impacted_tests(changes) == {'shane_kast_blue/600_4310_d55 pypeit': ['pypeit/core/arc.py']}
+    changes = coverage_index.parse_diff(patch('@@ -2 +2 @@\n-THRESHOLD = 3.0\n+THRESHOLD = 4.0\n'))
+    assert len(index.impacted_tests(changes)) == 3
+
+    # Adding a line to the start of Fitter.fit impacts the tests that called it, not those that only defined it
+    changes = coverage_index.parse_diff(patch('@@ -10,0 +11 @@ class Fitter:\n+        x = x*2\n'))
+    assert changes['pypeit/core/arc.py'].lines == {10, 11}
+    assert index.impacted_tests(changes) == {'Unit Tests': ['pypeit/core/arc.py']}
+
+    # New source files aren't run by any test, while changed data files could be used by any of them
+    assert index.impacted_tests(coverage_index.parse_diff(patch('@@ -0,0 +1 @@\n+x = 1\n',
+                                                                old='/dev/null', new='b/pypeit/core/new.py'))) == {}
+    changes = coverage_index.parse_diff('Binary files a/pypeit/data/arc_lines/NeI.fits and '
+                                        'b/pypeit/data/arc_lines/NeI.fits differ\n')
+    assert len(index.impacted_tests(changes)) == 3
+    assert coverage_index.parse_diff(patch('@@ -1 +1 @@\n-a\n+b\n', old='a/doc/index.rst', new='b/doc/index.rst')) == {}
+
+    # The impacted command prints the test setups to run
+    patch_file = tmp_path / 'change.patch'
+    patch_file.write_text(patch('@@ -5 +5 @@ def detect_lines(spec):\n-    peaks = np.argmax(spec)\n+    peaks = 1\n'))
+    assert test_main.impacted.main(['--diff', str(patch_file), '--coverage_index', index_file,
+                                    '--indexed_only']) == 0
+    output = capsys.readouterr().out
+    assert '1 of the 3 tests in the coverage index run the changed code' in output
+    assert 'pypeit_test all -s shane_kast_blue/600_4310_d55\n' in output
+    assert test_main.impacted.main(['-q', '--diff', str(patch_file), '--coverage_index', index_file,
+                                    '--indexed_only']) == 0
+    captured = capsys.readouterr()
+    assert captured.out == 'shane_kast_blue/600_4310_d55\n'
+    num_setups = sum([len(names) for names in all_setups.values()])
+    assert f'{num_setups - 2} test setups are not in the coverage index, and were not selected' in captured.err
+
+    # By default the test setups that aren't in the index are selected too
+    assert test_main.impacted.main(['-q', '--diff', str(patch_file), '--coverage_index', index_file]) == 0
+    captured = capsys.readouterr()
+    assert captured.out.split() == sorted([f'{instr}/{name}' for instr, names in all_setups.items()
+                                           for name in names if f'{instr}/{name}' != 'keck_nires/ABBA_nostandard'])
+    assert 'selected as the change could impact them' in captured.err
+
+    # A change that only impacts the unit tests selects no test setups, which is reported on stderr
+    patch_file.write_text(patch('@@ -10,0 +11 @@ class Fitter:\n+        x = x*2\n'))
+    assert test_main.impacted.main(['-q', '--diff', str(patch_file), '--coverage_index', index_file,
+                                    '--indexed_only']) == 2
+    captured = capsys.readouterr()
+    assert captured.out == ''
+    assert 'The changed code is also run by: Unit Tests' in captured.err
+    assert 'No test setups are impacted' in captured.err
+    assert test_main.impacted.main(['--diff', str(patch_file),
+                                    '--coverage_index', str(tmp_path / 'missing.json')]) == 1
+
+
+def test_coverage_index_from_data(tmp_path):
+    """
+    Test building the coverage index from coverage data with a context for each test.
+    """
+    coverage = pytest.importorskip('coverage')
+    source_dir = tmp_path / 'PypeIt' / 'pypeit'
+    source_dir.mkdir(parents=True)
+    source_file = source_dir / 'utils.py'
+    source_file.write_text('import os\n\ndef add(a, b):\n    return a + b\n')
+
+    data = coverage.CoverageData(basename=str(tmp_path / '.coverage'))
+    data.set_context('keck_nires/ABC_nostandard pypeit')
+    data.add_lines({str(source_file): [1, 3, 4]})
+    # Lines run without a context aren't attributed to a test
+    data.set_context('')
+    data.add_lines({str(source_file): [1]})
+    data.write()
+
+    index = coverage_index.CoverageIndex(str(tmp_path / 'coverage_index.json'))
+    assert index.update_from_coverage(str(tmp_path / '.coverage')) == 1
+    assert index.tests == {'keck_nires/ABC_nostandard pypeit': {'pypeit/utils.py': [[1, 1], [3, 4]]}}
+    assert index.functions == {'pypeit/utils.py': {'add': [3, 4, 4]}}
+
+
+def test_coverage_collection(tmp_path):
+    """
+    Test the coverage core, the coverage overhead, and combining the coverage data of tests as they finish.
+    """
+    assert coverage_data.coverage_core('ctrace') == 'ctrace'
+    assert coverage_data.coverage_core() == ('sysmon' if sys.version_info >= (3, 12) else None)
+    assert coverage_data.coverage_env({'HOME': '/home'}, 'sysmon') == {'HOME': '/home', 'COVERAGE_CORE': 'sysmon'}
+    assert coverage_data.coverage_env({'HOME': '/home'}, None) == {'HOME': '/home'}
+
+    # The overhead is relative to the runs of the tests without coverage
+    setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(tmp_path), str(tmp_path), str(tmp_path))
+    test = MockTest(setup, 'pypeit')
+    test.passed = True
+    test.start_time = datetime.datetime(2024, 1, 2)
+    test.end_time = test.start_time + datetime.timedelta(seconds=300)
+    history_file = tmp_path / 'test_history.json'
+    write_history(history_file, {setup.key: 200.0})
+    history = test_main.TestHistory(str(history_file))
+    assert coverage_data.coverage_overhead([setup], history) == \
+        'Coverage overhead: 1 tests took 0:05:00, 1.50 times the 0:03:20 they took without coverage'
+    history.record([setup], coverage=True)
+    assert history.runs(setup.key, 'pypeit')[-1]['coverage']
+    assert history.predicted_duration(setup.key, 'pypeit') == 250.0
+    assert history.predicted_duration(setup.key, 'pypeit', coverage=False) == 200.0
+    assert history.predicted_duration(setup.key, 'pypeit', coverage=True) == 300.0
+    assert coverage_data.coverage_overhead([setup], test_main.TestHistory(str(tmp_path / 'missing.json'))) is None
+
+    # The data of each test is combined when it finishes, and the data of pytest runs at the end
+    coverage = pytest.importorskip('coverage')
+    source_dir = tmp_path / 'pypeit'
+    source_dir.mkdir()
+    (source_dir / 'utils.py').write_text('def f(x):\n    return x\n\ndef g(x):\n    return -x\n')
+    collector = coverage_data.CoverageCollector(str(tmp_path))
+    for i, (context, lines) in enumerate([('shane_kast_blue/600_4310_d55 pypeit', [1, 2]),
+                                         ('shane_kast_blue/600_4310_d55 pypeit_sensfunc', [1, 4, 5])]):
+        test = MockTest(setup, context.split(' ')[1])
+        test.logfile = str(tmp_path / f'test{i}.log')
+        data = coverage.CoverageData(basename=collector.test_data_file(test), suffix=f'host.{i}.1')
+        data.set_context(context)
+        data.add_lines({str(source_dir / 'utils.py'): lines})
+        data.write()
+        collector.test_completed(test)
+    data = coverage.CoverageData(basename=str(tmp_path / '.coverage'), suffix='host.3.1')
+    data.set_context('Unit Tests')
+    data.add_lines({str(source_dir / 'utils.py'): [1]})
+    data.write()
+    assert collector.finish(2)
+    assert collector.errors == [] and collector.num_files == 3
+    assert coverage_data.glob_data_files(str(tmp_path / '**' / '*.coverage.*')) == []
+    data = coverage.CoverageData(basename=collector.data_file)
+    data.read()
+    assert sorted(data.measured_contexts()) == ['Unit Tests', 'shane_kast_blue/600_4310_d55 pypeit',
+                                                'shane_kast_blue/600_4310_d55 pypeit_sensfunc']
+    assert collector.summary().startswith('Combined 3 coverage data files in')
+
+
+def test_manifest(tmp_path):
+    """
+    Test reading and rebuilding the cached manifest of the dev suite.
+    """
+    raw_data = tmp_path / 'RAW_DATA'
+    create_dummy_files(raw_data / 'shane_kast_blue' / '600_4310_d55', ['b1.fits.gz', 'b10.fits.gz', 'b27.fits.gz'])
+    manifest_file = str(tmp_path / 'manifest.json')
+
+    manifest = SuiteManifest(str(tmp_path), str(raw_data), manifest_file)
+    assert manifest.rebuilt
+    assert manifest.setups == all_setups
+    assert manifest.raw_files == {'shane_kast_blue/600_4310_d55': ['b1.fits.gz', 'b10.fits.gz', 'b27.fits.gz']}
+    tests = manifest.setup_tests('shane_kast_blue/600_4310_d55')
+    assert [test['name'] for test in tests][:3] == ['setup', 'reduce', 'sensfunc']
+    assert tests[1] == {'name': 'reduce', 'type': 'REDUCE', 'factory': 'PypeItReduceTest', 'kwargs': {}}
+
+    # One of the quick look tests uses a raw file that's missing, and the other setup has no raw data
+    raw_dir = str(raw_data / 'shane_kast_blue' / '600_4310_d55')
+    assert manifest.missing_raw_data(['shane_kast_blue/600_4310_d55', 'shane_kast_blue/452_3306_d57']) == \
+        [os.path.join(raw_dir, 'b28.fits.gz'), str(raw_data / 'shane_kast_blue' / '452_3306_d57')]
+
+    # The manifest is read from its file until the raw data changes
+    manifest = SuiteManifest(str(tmp_path), str(raw_data), manifest_file)
+    assert not manifest.rebuilt and 'shane_kast_blue/600_4310_d55' in manifest.raw_files
+    create_dummy_files(raw_data / 'shane_kast_blue' / '600_4310_d55', ['b28.fits.gz'])
+    stat = os.stat(raw_dir)
+    os.utime(raw_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    manifest = SuiteManifest(str(tmp_path), str(raw_data), manifest_file)
+    assert manifest.rebuilt
+    assert manifest.missing_raw_data(['shane_kast_blue/600_4310_d55']) == []
+
+
+def test_preflight(tmp_path):
+    """
+    Test checking the raw files of the tests before they're run
+    """
+    def fits_bytes(shape, extension_shape=None):
+        cards = ['SIMPLE  =                    T', 'BITPIX  =                   16', f'NAXIS   = {len(shape):20d}']
+        cards += [f'NAXIS{i + 1:<3d}= {axis:20d}' for i, axis in enumerate(shape)] + ['END']
+        header = ''.join([card.ljust(80) for card in cards]).ljust(2880).encode()
+        data = bytes(2 * math.prod(shape)).ljust(2880 * -(-2 * math.prod(shape) // 2880), b'\0')
+        if extension_shape is not None:
+            ext = ['XTENSION= \'IMAGE   \'', 'BITPIX  =                  -32', 'NAXIS   =                    1',
+                   f'NAXIS1  = {extension_shape:20d}', 'PCOUNT  =                    0', 'GCOUNT  =                    1',
+                   'END']
+            data += ''.join([card.ljust(80) for card in ext]).ljust(2880).encode() + bytes(4 * 2880)
+        return header + data
+
+    raw_dir = tmp_path / 'RAW_DATA'
+    raw_dir.mkdir()
+    good = fits_bytes((100, 50), extension_shape=2880)
+    (raw_dir / 'good.fits').write_bytes(good)
+    (raw_dir / 'truncated.fits').write_bytes(good[:-2880])
+    (raw_dir / 'good.fits.gz').write_bytes(gzip.compress(good))
+    (raw_dir / 'truncated.fits.gz').write_bytes(gzip.compress(good)[:-100])
+    (raw_dir / 'not_fits.fits').write_bytes(b'Not a FITS file'.ljust(2880))
+    (raw_dir / 'empty.fits').write_bytes(b'')
+    (raw_dir / 'notes.txt').write_text('Not a FITS file either')
+
+    files = [str(raw_dir / name) for name in ['good.fits', 'truncated.fits', 'good.fits.gz', 'truncated.fits.gz',
+                                              'not_fits.fits', 'empty.fits', 'notes.txt', 'missing.fits.gz']]
+    checker = RawFileChecker(str(tmp_path / 'preflight.json'))
+    missing, problems = checker.check(files + files[:1], num_workers=4)
+    assert missing == [str(raw_dir / 'missing.fits.gz')]
+    assert sorted(problems.keys()) == sorted([str(raw_dir / name) for name in ['truncated.fits', 'truncated.fits.gz',
+                                                                               'not_fits.fits', 'empty.fits']])
+    assert problems[str(raw_dir / 'truncated.fits')].startswith('is truncated')
+    assert problems[str(raw_dir / 'not_fits.fits')] == 'has no readable FITS primary header'
+    assert problems[str(raw_dir / 'empty.fits')] == 'is empty'
+    assert checker.num_cached == 0
+
+    # A gzip trailer that doesn't look like a FITS file's size is checked by decompressing the file
+    compressed = bytearray(gzip.compress(good))
+    compressed[-4:] = struct.pack('<I', len(good) + 1)
+    (raw_dir / 'odd_trailer.fits.gz').write_bytes(bytes(compressed))
+    assert check_raw_file(str(raw_dir / 'odd_trailer.fits.gz')).startswith('has an invalid gzip trailer')
+
+    # The files that passed are not checked again until they change
+    checker = RawFileChecker(str(tmp_path / 'preflight.json'))
+    assert sorted(checker.checked.keys()) == sorted([str(raw_dir / name) for name in ['good.fits', 'good.fits.gz',
+                                                                                      'notes.txt']])
+    (raw_dir / 'good.fits').write_bytes(good[:-2880])
+    missing, problems = checker.check(files)
+    assert checker.num_cached == 2
+    assert str(raw_dir / 'good.fits') in problems
+    assert str(raw_dir / 'good.fits') not in checker.checked
+
+    # The raw files of the tests are found through the tests, and a test that can't find them is skipped
+    class MockRawTest(MockTest):
+        def __init__(self, setup, files):
+            super().__init__(setup, 'pypeit')
+            self.files = files
+
+        def raw_files(self):
+            if self.files is None:
+                raise RuntimeError('Unreadable pypeit file')
+            return self.files
+
+    setup = test_main.TestSetup('shane_kast_blue', '600_4310_d55', str(raw_dir), str(tmp_path), str(tmp_path))
+    setup.tests = [MockRawTest(setup, files[:2]), MockRawTest(setup, None), MockRawTest(setup, files[2:3])]
+    assert find_raw_files([setup]) == files[:3]
+
+
+def test_raw_staging(tmp_path):
+    """
+    Test fetching the raw data of test setups as their tests need it
+    """
+    source_dir = tmp_path / 'source'
+    create_dummy_files(source_dir, ['shane_kast_blue/A/raw1.fits', 'shane_kast_blue/A/sub/raw2.fits',
+                                    'shane_kast_blue/B/raw.fits', 'shane_kast_blue/C/raw.fits',
+                                    'shane_kast_blue/E/bad.fits'])
+    raw_data = tmp_path / 'RAW_DATA'
+    create_dummy_files(raw_data, ['shane_kast_blue/F/raw.fits'])
+    # An interrupted fetch from an earlier run is replaced
+    create_dummy_files(raw_data, ['shane_kast_blue/B.partial/stale.fits'])
+
+    class StagedTest(MockTest):
+        def __init__(self, setup, description, dependencies=[], raw_files=[]):
+            super().__init__(setup, description, dependencies)
+            self.files = raw_files
+            self.had_raw_data = None
+
+        def raw_files(self):
+            return self.files
+
+        async def run(self):
+            self.had_raw_data = os.path.isdir(self.setup.rawdir)
+            return await super().run()
+
+    setups = {name: test_main.TestSetup('shane_kast_blue', name, str(raw_data / 'shane_kast_blue' / name),
+                                        str(tmp_path / 'out' / name), str(tmp_path))
+              for name in ['A', 'B', 'C', 'D', 'E', 'F']}
+    for name, setup in setups.items():
+        reduce = StagedTest(setup, 'pypeit', raw_files=[os.path.join(setup.rawdir, 'bad.fits')] if name == 'E' else [])
+        StagedTest(setup, 'pypeit_sensfunc', [reduce])
+
+    # Only one transfer at a time
+    fetching = []
+    max_fetching = []
+    source = raw_data_source(str(source_dir), str(tmp_path))
+    assert isinstance(source, LocalRawSource)
+    fetch = source.fetch
+    def counting_fetch(setup_key, dest):
+        fetching.append(setup_key)
+        max_fetching.append(len(fetching))
+        try:
+            fetch(setup_key, dest)
+            time.sleep(0.02)
+        finally:
+            fetching.remove(setup_key)
+    source.fetch = counting_fetch
+
+    pargs = test_main.parser(['-o', str(tmp_path), '-q', 'reduce'])
+    test_report = test_main.TestReport(pargs)
+    history = test_main.TestHistory(str(tmp_path / 'test_history.json'))
+    checker = RawFileChecker(str(tmp_path / 'preflight.json'))
+    stager = RawDataStager(source, max_transfers=1, evict=True, history=history, checker=checker)
+    scheduler = test_main.TestScheduler(test_report, history, stager=stager)
+    scheduler.add_setups(list(setups.values()))
+    assert sorted(setup.name for setup in scheduler.setup_order()) == sorted(setups)
+    test_main.run_async(test_report, test_main.run_tests(scheduler, test_report, 2, sample_interval=0.001))
+
+    assert max(max_fetching) == 1
+    for name in ['A', 'B', 'C', 'F']:
+        assert all([test.passed and test.had_raw_data for test in setups[name].tests])
+    # The tests of a setup whose raw data couldn't be fetched or checked fail without running
+    reduce_d, sensfunc_d = setups['D'].tests
+    assert not reduce_d.passed and reduce_d.had_raw_data is None and sensfunc_d.passed is None
+    assert reduce_d.error_msgs[0].startswith('Could not stage the raw data of shane_kast_blue/D')
+    reduce_e = setups['E'].tests[0]
+    assert not reduce_e.passed and reduce_e.error_msgs[0].endswith('bad.fits has no readable FITS primary header')
+
+    # The fetched raw data was evicted once its setup finished, but raw data that was already in RAW_DATA was kept
+    assert sorted(stager.sizes.keys()) == ['shane_kast_blue/A', 'shane_kast_blue/B', 'shane_kast_blue/C',
+                                           'shane_kast_blue/E']
+    assert stager.num_evicted == 4 and stager.staged_bytes == 0
+    assert sorted([path.name for path in (raw_data / 'shane_kast_blue').iterdir()]) == ['F']
+    assert 'Fetched the raw data of 4 test setups' in stager.summary()
+
+    # The size of the evicted raw data is recorded in the history
+    history.record(list(setups.values()), raw_sizes=stager.sizes)
+    assert history.setup_sizes('shane_kast_blue/A')[0] == stager.sizes['shane_kast_blue/A']
+
+    # Prefetching stops at the disk budget, until raw data is evicted
+    stager = RawDataStager(source, max_transfers=4, disk_budget=1, history=history)
+    async def prefetch():
+        stager.start([setups['A'], setups['B']])
+        await stager.stage(setups['A'])
+        assert 'shane_kast_blue/B' not in stager._tasks
+        stager.staged_bytes = 0
+        stager._prefetch()
+        assert await stager.stage(setups['B']) is None
+    asyncio.run(prefetch())
+
+    # The sources of remote raw data are copied with their command line tools
+    source = raw_data_source('gdrive:RAW_DATA', os.environ['PYPEIT_DEV'])
+    assert isinstance(source, RcloneRawSource)
+    assert source.command('keck_deimos/830G_M_8500', '/tmp/raw')[-2:] == ['gdrive:RAW_DATA/keck_deimos/830G_M_8500/',
+                                                                         '/tmp/raw/']
+    source = raw_data_source('s3://pypeit/RAW_DATA/', os.environ['PYPEIT_DEV'])
+    assert isinstance(source, S3RawSource)
+    assert 's3://pypeit/RAW_DATA/keck_deimos/830G_M_8500/' in source.command('keck_deimos/830G_M_8500', '/tmp/raw')
+
+
+def test_data_manifest_and_syncraw(monkeypatch, tmp_path, capsys):
+    """
+    Test the data manifest, and syncing and verifying the raw data with it
+    """
+    monkeypatch.setenv('PYPEIT_DEV', str(tmp_path))
+    raw_data = tmp_path / 'RAW_DATA'
+    create_dummy_files(raw_data, ['shane_kast_blue/600_4310_d55/b1.fits.gz', 'shane_kast_blue/600_4310_d55/b2.fits.gz',
+                                  'shane_kast_blue/830_3460_d46/b3.fits.gz'])
+    create_dummy_files(tmp_path / 'CALIBS', ['shane_kast_blue/arc.fits'])
+    # Being fetched by pypeit_test --raw_source
+    create_dummy_files(raw_data, ['shane_kast_blue/452_3306_d57.partial/b4.fits.gz'])
+    manifest_file = str(tmp_path / 'data_manifest.json')
+
+    assert syncraw.main(['--update_manifest', '--manifest', manifest_file]) == 0
+    manifest = DataManifest(manifest_file)
+    assert len(manifest) == 4
+    assert sorted(manifest.tree_files('RAW_DATA', ['shane_kast_blue/600_4310_d55'])) == \
+        ['shane_kast_blue/600_4310_d55/b1.fits.gz', 'shane_kast_blue/600_4310_d55/b2.fits.gz']
+    b1 = str(raw_data / 'shane_kast_blue/600_4310_d55/b1.fits.gz')
+    assert manifest.expected_sizes('RAW_DATA', str(raw_data))[b1] == os.path.getsize(b1)
+    assert syncraw.main(['--verify', '--manifest', manifest_file]) == 0
+
+    # Unchanged files aren't hashed again
+    stamps = DataStamps(str(tmp_path / STAMPS_FILE))
+    assert len(stamps.stamps) == 4
+    stamps.stamps[b1][2] = 'not the hash'
+    stamps.write()
+    differ, extra = manifest.verify('RAW_DATA', str(raw_data), DataStamps(str(tmp_path / STAMPS_FILE)))
+    assert differ == ['shane_kast_blue/600_4310_d55/b1.fits.gz'] and extra == []
+    assert syncraw.main(['--update_manifest', '--manifest', manifest_file]) == 0
+
+    # A changed file of the same size is hashed again
+    with open(b1, "w") as f:
+        print("dummy CONTENT", file=f)
+    create_dummy_files(raw_data, ['shane_kast_blue/600_4310_d55/extra.fits'])
+    os.remove(raw_data / 'shane_kast_blue/830_3460_d46/b3.fits.gz')
+    assert syncraw.main(['--verify', '--manifest', manifest_file, '-s', 'shane_kast_blue/600_4310_d55']) == 1
+    output = capsys.readouterr().out
+    assert '1 files of RAW_DATA match the data manifest' in output
+    assert 'shane_kast_blue/600_4310_d55/b1.fits.gz' in output
+    assert 'shane_kast_blue/600_4310_d55/extra.fits' in output
+    assert 'b3.fits.gz' not in output
+
+    # Only the files of the selected setups that differ are transferred
+    assert syncraw.main(['--source', 'remote:RAW_DATA', '--print', '--manifest', manifest_file, '-j', '3',
+                         '-i', 'shane_kast_blue']) == 0
+    output = capsys.readouterr().out
+    assert f'rclone copy remote:RAW_DATA {raw_data} --files-from' in output
+    assert '--transfers 3' in output
+    assert 'Would remove 1 files of RAW_DATA' in output
+    assert os.path.exists(raw_data / 'shane_kast_blue/600_4310_d55/extra.fits')
+
+    # Setups that aren't in the manifest are synced without it
+    assert syncraw.main(['--source', 'remote:RAW_DATA', '--print', '--manifest', manifest_file,
+                         '-s', 'shane_kast_blue/452_3306_d57']) == 0
+    output = capsys.readouterr().out
+    assert f'rclone sync remote:RAW_DATA/shane_kast_blue/452_3306_d57 {raw_data}/shane_kast_blue/452_3306_d57' in output
+
+    assert syncraw.main(['--verify', '-i', 'not_an_instrument']) == 1
+
+
+def test_reference_cache(tmp_path):
+    """
+    Test fetching reference files into the shared cache as tests need them, and linking them into PypeIt
+    """
+    grid = 'TelFit_MaunaKea_3100_26100_R20000.fits'
+    other_grid = 'TelFit_LasCampanas_3100_26100_R20000.fits'
+    source_dir = tmp_path / 'source'
+    create_dummy_files(source_dir, [f'telluric/atm_grids/{grid}', f'telluric/atm_grids/{other_grid}'])
+    with open(source_dir / 'telluric' / 'atm_grids' / f'{grid}.sha256', 'w') as f:
+        f.write(f'{file_sha256(source_dir / "telluric" / "atm_grids" / grid)}  {grid}\n')
+    # A published checksum that doesn't match the file
+    with open(source_dir / 'telluric' / 'atm_grids' / f'{other_grid}.sha256', 'w') as f:
+        f.write(f'{"0" * 64}  {other_grid}\n')
+    data_path = tmp_path / 'pypeit_data'
+    cache_dir = tmp_path / 'cache'
+
+    class ReferenceTest(MockTest):
+        def __init__(self, setup, description, names):
+            super().__init__(setup, description)
+            self.names = names
+
+        def reference_files(self):
+            return self.names
+
+    setup = test_main.TestSetup('gemini_gnirs_echelle', '32_SB_SXD', str(tmp_path / 'raw'), str(tmp_path / 'out'),
+                                str(tmp_path))
+    # The grid is only fetched once by the tests that need it at the same time. Files that aren't managed by the
+    # cache are left for PypeIt to find.
+    tests = [ReferenceTest(setup, 'pypeit_sensfunc', [grid]), ReferenceTest(setup, 'pypeit_tellfit', [grid]),
+             ReferenceTest(setup, 'pypeit_flux', ['TelFit_Lick_3100_11100_R10000.fits'])]
+    references = ReferenceCache(LocalRawSource(str(source_dir)), str(cache_dir), str(data_path))
+
+    async def provide_all(references, tests):
+        await asyncio.gather(*[references.provide(test) for test in tests])
+    asyncio.run(provide_all(references, tests))
+    assert list(references.fetched) == [grid]
+    cached_file = references.cached_file(file_sha256(source_dir / 'telluric' / 'atm_grids' / grid))
+    assert os.path.isfile(cached_file)
+    link = data_path / 'telluric' / 'atm_grids' / grid
+    assert os.path.islink(link) and os.path.realpath(link) == os.path.realpath(cached_file)
+    assert not os.path.exists(data_path / 'telluric' / 'atm_grids' / 'TelFit_Lick_3100_11100_R10000.fits')
+    assert 'Fetched 1 reference files' in references.summary()
+
+    # Another run sharing the cache, e.g. in another pod on the node, links the cached file without fetching it,
+    # replacing a copy that doesn't match
+    os.remove(link)
+    with open(link, 'w') as f:
+        f.write('an older grid\n')
+    references = ReferenceCache(LocalRawSource(str(source_dir)), str(cache_dir), str(data_path))
+    asyncio.run(provide_all(references, tests[:1]))
+    assert len(references.fetched) == 0
+    assert os.path.islink(link) and os.path.realpath(link) == os.path.realpath(cached_file)
+
+    # A file that doesn't match its published checksum isn't cached or linked
+    with pytest.raises(RuntimeError, match="doesn't match its published sha256"):
+        asyncio.run(provide_all(references, [ReferenceTest(setup, 'pypeit_tellfit', [other_grid])]))
+    assert not os.path.exists(data_path / 'telluric' / 'atm_grids' / other_grid)
+    assert os.listdir(cache_dir / 'sha256' / ('0' * 2)) == []
+
+    # The grid of a test set in its parameter file, without looking up the spectrograph's default
+    sens_file = tmp_path / 'test.sens'
+    with open(sens_file, 'w') as f:
+        f.write(f'[sensfunc]\n  algorithm = IR\n  [[IR]]\n    telgridfile = {grid}\n')
+    assert telluric_grid(str(sens_file), None, sensfunc=True) == grid
+    with open(sens_file, 'w') as f:
+        f.write('[sensfunc]\n  algorithm = UVIS\n')
+    assert telluric_grid(str(sens_file), None, sensfunc=True) is None
+
+
+def test_parse_shard():
+    """
+    Test parsing the shards accepted by --shard
+    """
+    assert test_main.parse_shard("0/4") == (0, 4)
+    assert test_main.parse_shard("3/4") == (3, 4)
+    for shard in ["4/4", "1/0", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            test_main.parse_shard(shard)
+
+def test_history_shards(tmp_path):
+    """
+    Test splitting test setups into shards with the same predicted run time, and merging the histories of shards.
+    """
+    durations = {'keck_deimos/830G_M_8500': 100.0, 'keck_deimos/600ZD_M_6500': 60.0,
+                 'shane_kast_blue/600_4310_d55': 50.0, 'shane_kast_blue/452_3306_d57': 40.0,
+                 'shane_kast_blue/830_3460_d46': 10.0}
+    write_history(tmp_path / 'test_history.json', durations)
+    history = test_main.TestHistory(str(tmp_path / 'test_history.json'))
+
+    setups = []
+    for key in durations:
+        instr, name = key.split('/')
+        setup = test_main.TestSetup(instr, name, str(tmp_path), str(tmp_path), str(tmp_path))
+        MockTest(setup, 'pypeit')
+        setups.append(setup)
+
+    # Every setup is in one shard, and the predicted run times are balanced
+    shards = history.shard_setups(setups, 2)
+    assert sorted([setup.key for shard in shards for setup in shard]) == sorted(durations)
+    assert [[setup.key for setup in shard] for shard in shards] == [
+        ['keck_deimos/830G_M_8500', 'shane_kast_blue/452_3306_d57'],
+        ['keck_deimos/600ZD_M_6500', 'shane_kast_blue/600_4310_d55', 'shane_kast_blue/830_3460_d46']]
+
+    # The shards are the same every time, regardless of the order of the setups
+    assert [[setup.key for setup in shard] for shard in history.shard_setups(list(reversed(setups)), 2)] == \
+           [[setup.key for setup in reversed(shard)] for shard in shards]
+
+    # The same shards can be planned from the setup keys alone, and setups that have never run are estimated from
+    # the other setups of the instrument
+    assert history.shard_setup_keys(list(durations), 2) == [[setup.key for setup in shard] for shard in shards]
+    assert history.estimate_setup_duration('shane_kast_blue/600_4310_d55') == 50.0
+    assert history.estimate_setup_duration('shane_kast_blue/600_4310_d57') == 40.0
+    assert history.estimate_setup_duration('keck_nires/NIRES') == 50.0
+
+    # Merging the history from another shard adds its runs, without duplicating the runs both started with
+    other = test_main.TestHistory(str(tmp_path / 'test_history.json'))
+    setup = setups[-1]
+    setup.tests[0].start_time = datetime.datetime.now()
+    setup.tests[0].end_time = setup.tests[0].start_time + datetime.timedelta(seconds=20)
+    setup.tests[0].passed = True
+    other.record([setup])
+    history.merge(other)
+    assert [run['duration'] for run in history.runs(setup.key, 'pypeit')] == [10.0, 20.0]
+
+def test_main_shards_and_merge(monkeypatch, tmp_path):
+    """
+    Test running the dev suite split into shards and merging the results.
+    """
+    with monkeypatch.context() as m:
+        monkeypatch.setattr(asyncio, "create_subprocess_exec", mock_create_subprocess_exec)
+        monkeypatch.setattr(subprocess, "run", mock_run)
+
+        setups = ['shane_kast_blue/452_3306_d57', 'shane_kast_blue/600_4310_d55', 'shane_kast_blue/830_3460_d46']
+        create_dummy_files(tmp_path / 'REDUX_OUT',
+                           ['shane_kast_blue/600_4310_d55/shane_kast_blue_A/shane_kast_blue_A.pypeit'])
+        for index in range(2):
+            shard_dir = tmp_path / f'shard{index}'
+            shard_dir.mkdir()
+            with change_dir(shard_dir):
+                monkeypatch.setattr(sys, "argv", ['pypeit_test', 'reduce', '-o', str(tmp_path / 'REDUX_OUT'), '-t', '2',
+                                                  '-q', '--shard', f'{index}/2', '-r', 'pypeit.report',
+                                                  '--csv', 'performance.csv', '-s'] + setups)
+                assert test_main.main() == 0
+
+        monkeypatch.setattr(sys, "argv", ['pypeit_test', 'merge', '-o', str(tmp_path / 'merged'),
+                                          str(tmp_path / 'shard0'), str(tmp_path / 'shard1')])
+        assert test_main.main() == 0
+
+    with open(tmp_path / 'merged' / 'pypeit.report') as f:
+        report = f.read()
+    for setup in setups:
+        assert f'    {setup}\n' in report
+        assert f'{setup} pypeit Result:' in report
+    # 600_4310_d55 also runs pypeit_setup
+    assert 'PASSED 4/4 TESTS' in report
+
+    with open(tmp_path / 'merged' / 'performance.csv') as f:
+        lines = f.readlines()
+    assert lines[0].startswith('Setup,')
+    assert len(lines) == 5
+
+    history = test_main.TestHistory(str(tmp_path / 'merged' / 'test_history.json'))
+    assert len(history) == 4
+
+    # Tests that timed out, or passed in an earlier run that was resumed, are read from shard reports too
+    (tmp_path / 'resumed.report').write_text("-------------------------\n"
+                                             "a/b pypeit Result: --- PASSED (from an earlier run)\n"
+                                             "a/b pypeit_sensfunc Result: --- TIMED OUT\n")
+    assert merge.ShardReport(str(tmp_path / 'resumed.report')).results == [('a/b pypeit', 'PASSED', False),
+                                                                           ('a/b pypeit_sensfunc', 'TIMED OUT', False)]
+
+FAKE_PYPEIT_TEST = """#!/bin/bash
+echo "$@" > args.txt
+setups=$(echo "$@" | sed 's/.* -s //')
+{
+    echo "Reduced data for the following setups:"
+    for setup in $setups; do echo "    $setup"; done
+    echo ""
+    echo "-------------------------"
+    for setup in $setups; do echo "$setup pypeit Result: --- PASSED"; done
+    echo ""
+    echo "Test Summary"
+    echo "Testing Started at 2024-01-01T00:00:00"
+    echo "Testing Completed at 2024-01-01T01:00:00"
+} > pypeit.report
+if [ -f test_history.json ]; then cp test_history.json seed_history.json; fi
+echo '{"version": 1, "tests": {}}' > test_history.json
+"""
+""" str: A pypeit_test script for the pods of a sharded job, that reports every test setup of its shard passed."""
+
+def test_gen_kube_devsuite_shards(tmp_path):
+    """
+    Test generating a sharded Nautilus job, running the shard commands of its pods, and merging their results,
+    with local directories standing in for Google Drive and S3.
+    """
+    import yaml
+    import importlib.util
+    from importlib.machinery import SourceFileLoader
+    # The script doesn't have a .py extension, so its loader has to be given explicitly
+    loader = SourceFileLoader('gen_kube_devsuite',
+                              os.path.join(os.environ['PYPEIT_DEV'], 'nautilus', 'gen_kube_devsuite'))
+    gen_kube = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(gen_kube)
+
+    setups = ['shane_kast_blue/600_4310_d55', 'shane_kast_blue/452_3306_d57', 'keck_deimos/830G_M_8500']
+    write_history(tmp_path / 'test_history.json', {setups[0]: 100.0, setups[1]: 60.0, setups[2]: 50.0})
+    with open(tmp_path / 'test_history.json') as f:
+        history_data = json.load(f)
+    for setup in setups:
+        history_data['tests'][setup]['pypeit'][0]['max_mem'] = 10 * 2**30
+    history_data['setups'] = {setup: {'raw_size': 20 * 2**30, 'output_size': 30 * 2**30} for setup in setups}
+    with open(tmp_path / 'test_history.json', 'w') as f:
+        json.dump(history_data, f)
+
+    gdrive = tmp_path / 'gdrive'
+    create_dummy_files(gdrive / 'RAW_DATA', [f'{setup}/raw.fits' for setup in setups] +
+                       ['shane_kast_blue/830_3460_d46/raw.fits'])
+    create_dummy_files(gdrive / 'CALIBS', ['calib.fits'])
+    # The latest history, which the pods start from
+    s3 = tmp_path / 's3'
+    s3.mkdir()
+    shutil.copy(tmp_path / 'test_history.json', s3 / gen_kube.LATEST_HISTORY)
+    job_args = ['devsuite-shards', str(tmp_path / 'job.yaml'), 'all -s ' + ' '.join(setups), '--shards', '2',
+                '--ncpu', '2', '--results_dest', str(s3), '--history_file', str(tmp_path / 'test_history.json'),
+                '--raw_source', str(gdrive / 'RAW_DATA'), '--calibs_source', str(gdrive / 'CALIBS')]
+
+    # Generate the job. The pods are sized for the largest shard, which runs two setups at once and holds the raw
+    # data and output of both
+    assert gen_kube.main(job_args) == 0
+    with open(tmp_path / 'job.yaml') as f:
+        job = yaml.safe_load(f)
+    assert job['spec']['completionMode'] == 'Indexed'
+    assert job['spec']['completions'] == 2
+    assert job['spec']['parallelism'] == 2
+    requests = job['spec']['template']['spec']['containers'][0]['resources']['requests']
+    assert requests['memory'] == f'{math.ceil(20 * 1.2) + gen_kube.BASE_RAM}Gi'
+    assert requests['ephemeral-storage'] == f'{math.ceil(100 * 1.2) + gen_kube.BASE_STORAGE}Gi'
+
+    # Run the shard commands of each pod
+    pargs = gen_kube.parser(job_args)
+    plan = gen_kube.plan_shards(pargs)
+    assert [shard['setups'] for shard in plan] == [[setups[0]], [setups[1], setups[2]]]
+    # Without a local history, the shards are planned from the latest one
+    assert gen_kube.plan_shards(gen_kube.parser(job_args + ['--history_file', str(tmp_path / 'missing.json')])) \
+                == plan
+    commands = gen_kube.shard_commands(pargs, plan)
+    assert commands in job['spec']['template']['spec']['containers'][0]['args'][0]
+    for index in range(2):
+        pod_dir = tmp_path / f'pod{index}'
+        pod_dir.mkdir()
+        with open(pod_dir / 'pypeit_test', 'w') as f:
+            f.write(FAKE_PYPEIT_TEST)
+        os.chmod(pod_dir / 'pypeit_test', 0o755)
+        process = subprocess.run(['bash', '-c', commands], cwd=pod_dir,
+                                 env=dict(os.environ, JOB_COMPLETION_INDEX=str(index)))
+        assert process.returncode == 0
+
+        # Only the raw data of the shard is copied
+        assert sorted([str(path.parent.relative_to(pod_dir / 'RAW_DATA'))
+                       for path in (pod_dir / 'RAW_DATA').rglob('*.fits')]) == sorted(plan[index]['setups'])
+
+        # Unit tests are only run by the first shard, and vet tests aren't run at all
+        with open(pod_dir / 'args.txt') as f:
+            args = f.read().split()
+        assert args[args.index('-s') + 1:] == plan[index]['setups']
+        assert ('unit' in args) == (index == 0)
+        assert 'vet' not in args
+        assert (s3 / 'devsuite-shards' / f'shard-{index}' / 'pypeit.report').exists()
+        assert (pod_dir / 'seed_history.json').read_text() == (s3 / gen_kube.LATEST_HISTORY).read_text()
+
+    # Merge the results of the shards, which are also copied next to the results of unsharded jobs
+    assert gen_kube.main(['devsuite-shards', str(tmp_path / 'merged'), '--shards', '2', '--merge',
+                          '--results_dest', str(s3)]) == 0
+    with open(s3 / 'devsuite-shards.report') as f:
+        report = f.read()
+    assert 'PASSED 3/3 TESTS' in report
+    for setup in setups:
+        assert f'    {setup}' in report
+    # The merged history becomes the latest
+    assert (s3 / gen_kube.LATEST_HISTORY).read_text() == (tmp_path / 'merged' / 'test_history.json').read_text()
@@ -29,7 +29,8 @@ To add a new type of test:
 1) Edit pypeit_tests.py to add a new subclass to run the new test type as a child process.
 2) Add a new test list with at least one instrument/setup that runs the new test.
 3) Add the test to the all_tests list. This list defines the order the test types are run for a test setup, the
-   PypeItTest subclass that runs the test, and the test phase (prep, reduce, afterburn, quicklook).
+   PypeItTest subclass that runs the test, the test phase (prep, reduce, afterburn, quicklook), and which other
+   test types must finish before it can start.
 
 Attributes:
     _reduce_setups:          The test setups that support reduction. A dict of instruments to the supported test
@@ -43,6 +44,8 @@ Attributes:
 
                              Each test type is represented by a dict with the following keys:
 
+                             'name': A unique name for the test type, used to refer to it in 'depends'.
+
                              'factory': A callable that builds a PypeItTest subclasss to run the test.
                              This callable will be passed a TestSetup object, the command line arguments to
                              pypeit_test (as returned by argparse.ArgumentParser), and any keyword arguments included
@@ -50,6 +53,10 @@ Attributes:
 
                              'type': A TestPhase enum that is either PREP, REDUCE, AFTERBURN, or QL.
 
+                             'depends': The names of the test types that must finish for the same setup before this
+                             test can start. Tests without a dependency between them may run at the same time, and
+                             a failed test only causes the tests that depend on it to be skipped.
+
                              'setups': Which setups should run the test along with any arguments needed to run the test.
 
                              The setup can also be specified as an instrument name to indicate every setup for the
@@ -74,6 +81,19 @@ Attributes:
                             _telluric:          Test setups that run pypeit_tellfit.
                             _quick_look:        Test setups that run quick look script. The actual script run is chosen
                                                 based on the instrument.
+                            _ql_calib:          Test setups whose QL calibrations are built with build_ql_calibs
+                                                before their quick look tests run.
+
+    all_tests_by_name:       Maps the 'name' of each test type in all_tests to its dict.
+
+    phase_timeouts:          Maps each TestPhase to the timeout in seconds of its tests that have no history of
+                             prior runs to set their timeout from (see pypeit_test --timeout_factor).
+
+    test_timeouts:           Timeouts in seconds that replace the default timeout of tests. A dict of instruments to
+                             a dict of setups to a dict mapping the 'name' of a test type in all_tests to its timeout.
+                             A timeout of None means the test is never timed out. For example:
+
+                             test_timeouts = {'keck_deimos': {'1200G_M_7750': {'reduce': 12 * 3600}}}
 
 """
 
@@ -390,46 +410,133 @@ _quick_look = {
     }
 
 
+# The QL calibrations are shared by the QL tests of a setup, so they're built
+# once before those tests run
+_ql_calib = {instr: {setup: [{}] for setup in _quick_look[instr]
+                     if pypeit_tests.uses_ql_calibs(instr, setup)}
+             for instr in _quick_look}
+_ql_calib = {instr: setups for instr, setups in _ql_calib.items() if len(setups) > 0}
+
+# Tests that have never run are stopped after these many seconds. Once a test
+# has run, its timeout is set from the duration of its prior runs instead.
+phase_timeouts = {
+    TestPhase.PREP:      3600,
+    TestPhase.REDUCE:    12 * 3600,
+    TestPhase.AFTERBURN: 4 * 3600,
+    TestPhase.QL:        4 * 3600,
+    }
+
+# Timeouts for tests whose duration varies too much for a timeout set from
+# their prior runs
+test_timeouts = {}
+
+
 # The order of these tests in all_tests determine the order they run
-# in for the setup. So that tests that depend on previous tests must
-# be in the right order. e.g. PypeItSetupTest must come before
-# PypeItReduceTest and PypeItSensFuncTest must come before
-# PypeItFluxTest.
+# in for the setup when more than one of them is ready to run. Which tests
+# must finish before another can start is given by the 'depends' key.
+# e.g. PypeItSetupTest must finish before PypeItReduceTest and
+# PypeItSensFuncTest must finish before PypeItFluxTest, but the coadd2d
+# and quick look tests only need the reduction.
 #
-all_tests = [{'factory': pypeit_tests.PypeItSetupTest,
+all_tests = [{'name':    'setup',
+              'factory': pypeit_tests.PypeItSetupTest,
               'type':    TestPhase.PREP,
+              'depends': [],
               'setups':  _pypeit_setup},
-             {'factory': pypeit_tests.PypeItReduceTest,
+             {'name':    'reduce',
+              'factory': pypeit_tests.PypeItReduceTest,
               'type':    TestPhase.REDUCE,
+              'depends': ['setup'],
               'setups':  _reduce_setups},
-             {'factory': pypeit_tests.PypeItReduceTest,
+             # The additional reductions write to the same output directory as
+             # the main reduction, so they can't run at the same time
+             {'name':    'additional_reduce',
+              'factory': pypeit_tests.PypeItReduceTest,
               'type':    TestPhase.REDUCE,
+              'depends': ['reduce'],
               'setups':  _additional_reduce},
-             {'factory': pypeit_tests.PypeItSensFuncTest,
+             {'name':    'sensfunc',
+              'factory': pypeit_tests.PypeItSensFuncTest,
               'type':    TestPhase.AFTERBURN,
+              'depends': ['additional_reduce'],
               'setups':  _sensfunc},
-             {'factory': pypeit_tests.PypeItFluxSetupTest,
+             {'name':    'flux_setup',
+              'factory': pypeit_tests.PypeItFluxSetupTest,
               'type':    TestPhase.AFTERBURN,
+              'depends': ['sensfunc'],
               'setups':  _flux_setup},
-             {'factory': pypeit_tests.PypeItFluxTest,
+             # pypeit_flux_calib updates the spec1d files in place, so anything
+             # else reading the spec1d files waits for it
+             {'name':    'flux',
+              'factory': pypeit_tests.PypeItFluxTest,
               'type':    TestPhase.AFTERBURN,
+              'depends': ['flux_setup'],
               'setups':  _flux},
-             {'factory': pypeit_tests.PypeItFlexureTest,
+             {'name':    'flexure',
+              'factory': pypeit_tests.PypeItFlexureTest,
               'type':    TestPhase.AFTERBURN,
+              'depends': ['flux'],
               'setups':  _flexure},
-             {'factory': pypeit_tests.PypeItCollate1DTest,
+             {'name':    'collate1d',
+              'factory': pypeit_tests.PypeItCollate1DTest,
               'type':    TestPhase.AFTERBURN,
+              'depends': ['flux'],
               'setups':  _collate1d},
-             {'factory': pypeit_tests.PypeItCoadd1DTest,
+             {'name':    'coadd1d',
+              'factory': pypeit_tests.PypeItCoadd1DTest,
               'type':    TestPhase.AFTERBURN,
+              'depends': ['flux'],
               'setups':  _coadd1d},
-             {'factory': pypeit_tests.PypeItCoadd2DTest,
+             {'name':    'coadd2d',
+              'factory': pypeit_tests.PypeItCoadd2DTest,
               'type':    TestPhase.AFTERBURN,
+              'depends': ['additional_reduce'],
               'setups':  _coadd2d},
-             {'factory': pypeit_tests.PypeItTelluricTest,
+             {'name':    'telluric',
+              'factory': pypeit_tests.PypeItTelluricTest,
               'type':    TestPhase.AFTERBURN,
+              'depends': ['coadd1d'],
               'setups':  _telluric},
-             {'factory': pypeit_tests.PypeItQuickLookTest,
+             {'name':    'ql_calib',
+              'factory': pypeit_tests.PypeItBuildQLCalibTest,
+              'type':    TestPhase.QL,
+              'depends': ['additional_reduce'],
+              'setups':  _ql_calib},
+             {'name':    'ql',
+              'factory': pypeit_tests.PypeItQuickLookTest,
               'type':    TestPhase.QL,
+              'depends': ['ql_calib'],
               'setups':  _quick_look},
              ]
+"""list: The test types run by the dev suite. See the module docstring."""
+
+all_tests_by_name = {test_descr['name']: test_descr for test_descr in all_tests}
+"""dict: Maps the 'name' of each entry in all_tests to the entry."""
+
+
+def resolve_dependencies(depends, setup_tests):
+    """Find the tests within a test setup that a test depends on.
+
+    A dependency on a test type that isn't run for the test setup (either because
+    the setup doesn't support it or it wasn't selected on the command line) is
+    replaced by the dependencies of that test type. For example a flux test for
+    a setup without a sensfunc test will depend on the reduce test instead.
+
+    Args:
+        depends (list of str):
+            The 'depends' value of the test type in all_tests.
+        setup_tests (dict):
+            Maps the 'name' of each test type in all_tests to the list of
+            PypeItTest objects of that type in the test setup.
+
+    Returns:
+        list of :obj:`PypeItTest`: The tests that must finish before the test can run.
+    """
+    dependencies = []
+    for name in depends:
+        if name in setup_tests:
+            tests = setup_tests[name]
+        else:
+            tests = resolve_dependencies(all_tests_by_name[name]['depends'], setup_tests)
+        dependencies += [test for test in tests if test not in dependencies]
+    return dependencies
@@ -0,0 +1,166 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Reports on how the tests of a dev suite run used the parallel workers. :func:`write_trace` writes a timeline of the
+tests on each worker in the Chrome trace event format, which can be viewed with https://ui.perfetto.dev or
+chrome://tracing. :func:`write_utilisation_summary` summarizes how busy the workers were, and the chain of tests
+that set the wall time of the run.
+"""
+
+import json
+
+
+def timed_tests(setups):
+    """Get the tests that ran in a worker, with their start and end times. Tests that passed in an earlier run that
+    was resumed aren't included, as they ran before the other tests.
+
+    Args:
+        setups (list of :obj:`TestSetup`): The test setups that were run.
+
+    Returns:
+        list of :obj:`PypeItTest`: The tests that ran, in the order they started.
+    """
+    tests = [test for setup in setups for test in setup.tests
+             if test.start_time is not None and test.end_time is not None and test.worker is not None
+             and not test.resumed]
+    return sorted(tests, key=lambda test: test.start_time)
+
+
+def cpu_usage(test):
+    """Get the CPU usage of a test's process tree between its CPU samples.
+
+    Args:
+        test (:obj:`PypeItTest`): The test.
+
+    Returns:
+        list: The (time, cores) at each CPU sample after the first, where cores is the CPU time used by the test's
+        processes since the previous sample divided by the time between the samples.
+    """
+    usage = []
+    for (prev_time, prev_cpu), (time, cpu) in zip(test.cpu_samples[:-1], test.cpu_samples[1:]):
+        seconds = (time - prev_time).total_seconds()
+        if seconds > 0:
+            # The CPU time of processes that exited but haven't been waited for is lost until they are
+            usage.append((time, max(cpu - prev_cpu, 0.0) / seconds))
+    return usage
+
+
+def test_cpu_time(test):
+    """Get the CPU seconds used by a test's processes, from its accounted resource usage if available, or else from
+    its last CPU sample."""
+    if test.usage is not None and test.usage.user_cpu is not None and test.usage.system_cpu is not None:
+        return test.usage.user_cpu + test.usage.system_cpu
+    return test.cpu_samples[-1][1] if len(test.cpu_samples) > 0 else 0.0
+
+
+def write_trace(setups, trace_file):
+    """Write a timeline of the tests run on each worker, with the CPU usage of their processes, as a Chrome trace.
+
+    Args:
+        setups (list of :obj:`TestSetup`): The test setups that were run.
+        trace_file (str): The JSON trace file to write.
+    """
+    tests = timed_tests(setups)
+    start = min([test.start_time for test in tests], default=None)
+
+    def timestamp(time):
+        # Trace timestamps are in microseconds
+        return round((time - start).total_seconds() * 1e6)
+
+    events = [{"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "pypeit_test"}}]
+    for worker in sorted(set(test.worker for test in tests)):
+        events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": worker,
+                       "args": {"name": f"worker {worker}"}})
+
+    for test in tests:
+        result = "passed" if test.passed else "skipped" if test.passed is None else "failed"
+        events.append({"name": f"{test.setup} {test.description}", "cat": result, "ph": "X", "pid": 0,
+                       "tid": test.worker, "ts": timestamp(test.start_time),
+                       "dur": timestamp(test.end_time) - timestamp(test.start_time),
+                       "args": {"setup": str(test.setup), "test": test.description, "result": result,
+                                "from_cache": test.from_cache, "max_mem": test.max_mem, "pid": test.pid,
+                                "logfile": test.logfile}})
+
+        # A counter of the CPU cores used on each worker, which drops to 0 when the test ends
+        counter = f"worker {test.worker} CPU"
+        for time, cores in cpu_usage(test):
+            events.append({"name": counter, "ph": "C", "pid": 0, "ts": timestamp(time),
+                           "args": {"cores": round(cores, 3)}})
+        events.append({"name": counter, "ph": "C", "pid": 0, "ts": timestamp(test.end_time), "args": {"cores": 0}})
+
+    with open(trace_file, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def critical_path(tests):
+    """Find the chain of tests that set the wall time of a run.
+
+    The chain ends at the last test to finish. Each test in it is preceded by the dependency that finished last,
+    which is the one the test was waiting for.
+
+    Args:
+        tests (list of :obj:`PypeItTest`): The tests that ran, as returned by :func:`timed_tests`.
+
+    Returns:
+        list of :obj:`PypeItTest`: The tests in the chain, in the order they ran.
+    """
+    if len(tests) == 0:
+        return []
+    timed = set(tests)
+    path = [max(tests, key=lambda test: test.end_time)]
+    while True:
+        dependencies = [test for test in path[-1].dependencies if test in timed]
+        if len(dependencies) == 0:
+            break
+        path.append(max(dependencies, key=lambda test: test.end_time))
+    return path[::-1]
+
+
+def write_utilisation_summary(setups, num_workers, output):
+    """Summarize how busy the workers were during a run.
+
+    Reports the parallel efficiency of the run (the time spent running tests divided by the time the workers were
+    available), the time the workers were idle after the last test started, and the critical path of the run.
+
+    Args:
+        setups (list of :obj:`TestSetup`): The test setups that were run.
+        num_workers (int): The number of workers (pypeit_test -t).
+        output (file): Where to write the summary.
+    """
+    tests = timed_tests(setups)
+    if len(tests) == 0:
+        return
+    start = min(test.start_time for test in tests)
+    end = max(test.end_time for test in tests)
+    wall_time = (end - start).total_seconds()
+    test_time = sum((test.end_time - test.start_time).total_seconds() for test in tests)
+    cpu_time = sum(test_cpu_time(test) for test in tests)
+
+    # After the last test starts, workers that finish their tests stay idle until the run ends
+    last_start = max(test.start_time for test in tests)
+    worker_free = {worker: start for worker in range(num_workers)}
+    for test in tests:
+        worker_free[test.worker] = max(worker_free.get(test.worker, start), test.end_time)
+    tail_idle = sum((end - max(free, last_start)).total_seconds() for free in worker_free.values())
+
+    available = num_workers * wall_time
+    print("Worker utilisation:", file=output)
+    print(f"    Wall time of tests:     {wall_time:.1f}s with {num_workers} workers", file=output)
+    if available > 0:
+        print(f"    Parallel efficiency:    {100 * test_time / available:.1f}% ({test_time:.1f}s of tests)",
+              file=output)
+        print(f"    CPU utilisation:        {100 * cpu_time / available:.1f}% ({cpu_time:.1f}s of CPU time)",
+              file=output)
+    print(f"    Idle worker time:       {max(available - test_time, 0.0):.1f}s, {tail_idle:.1f}s of it after "
+          f"the last test started", file=output)
+    print("Critical path:", file=output)
+    previous_end = start
+    for test in critical_path(tests):
+        wait = (test.start_time - previous_end).total_seconds()
+        duration = (test.end_time - test.start_time).total_seconds()
+        print(f"    {(test.start_time - start).total_seconds():9.1f}s {duration:9.1f}s  {test.setup} "
+              f"{test.description}" + (f" (waited {wait:.1f}s for a worker)" if wait >= 1.0 else ""), file=output)
+        previous_end = test.end_time
+    print('', file=output)
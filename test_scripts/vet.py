@@ -0,0 +1,88 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Finds the vet tests and the test setups whose results they use, from the ``setups`` marker of each test (see
+vet_tests/conftest.py). The test files are parsed rather than imported, so that this is quick and doesn't need to
+import PypeIt.
+"""
+
+import os
+import ast
+import glob
+
+from .setups import all_setups
+
+MARKER = 'pytest.mark.setups'
+""" str: The decorator that declares the test setups a vet test uses."""
+
+
+def find_vet_tests(vet_dir):
+    """Find the vet tests and the test setups whose results they use.
+
+    Args:
+        vet_dir (str): The directory with the vet tests.
+
+    Returns:
+        dict: Maps the pytest node id ("file::function") of every vet test to the instr/setup keys of the test setups
+        it uses, or to None if it doesn't have a ``setups`` marker. The tests are in the order pytest runs them.
+
+    Raises:
+        ValueError: If a marker names a test setup or instrument that isn't in :obj:`all_setups`.
+    """
+    vet_tests = dict()
+    for file in sorted(glob.glob(os.path.join(vet_dir, 'test_*.py'))):
+        with open(file, "r") as f:
+            tree = ast.parse(f.read(), filename=file)
+        for node in tree.body:
+            if not isinstance(node, ast.FunctionDef) or not node.name.startswith('test'):
+                continue
+            keys = None
+            for decorator in node.decorator_list:
+                if isinstance(decorator, ast.Call) and ast.unparse(decorator.func) == MARKER:
+                    keys = expand_setup_keys([ast.literal_eval(arg) for arg in decorator.args])
+            vet_tests[f'{file}::{node.name}'] = keys
+    return vet_tests
+
+
+def expand_setup_keys(keys):
+    """Expand the arguments of a ``setups`` marker into instr/setup keys.
+
+    Args:
+        keys (list of str): instr/setup keys, or instrument names meaning all of the instrument's test setups.
+
+    Returns:
+        list of str: The instr/setup keys, without duplicates.
+
+    Raises:
+        ValueError: If a test setup or instrument isn't in :obj:`all_setups`.
+    """
+    setup_keys = []
+    for key in keys:
+        if '/' in key:
+            instr, name = key.split('/', 1)
+            if name not in all_setups.get(instr, []):
+                raise ValueError(f"Unknown test setup {key}")
+            expanded = [key]
+        elif key in all_setups:
+            expanded = [f'{key}/{name}' for name in all_setups[key]]
+        else:
+            raise ValueError(f"Unknown instrument {key}")
+        setup_keys += [setup_key for setup_key in expanded if setup_key not in setup_keys]
+    return setup_keys
+
+
+def select_vet_tests(vet_tests, setup_keys):
+    """Select the vet tests that can run with the results of the given test setups.
+
+    Args:
+        vet_tests (dict): The vet tests and the test setups they use, as returned by :func:`find_vet_tests`.
+        setup_keys (list of str): The instr/setup keys of the test setups being run.
+
+    Returns:
+        dict: The vet tests from ``vet_tests`` that only use the given test setups, and those without a ``setups``
+        marker, which are selected by the vet tests' ``--setups`` option when they are run.
+    """
+    setup_keys = set(setup_keys)
+    return {test_id: keys for test_id, keys in vet_tests.items() if keys is None or setup_keys.issuperset(keys)}
@@ -0,0 +1,312 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+A pre-forked "zygote" process for running PypeIt scripts without paying the Python startup and PypeIt import time
+for every test.
+
+The zygote is a separate Python process that imports ``pypeit.scripts`` once and then waits for requests on a unix
+socket. For each request it forks a child that changes to the test's directory, sets its environment, redirects
+stdout and stderr to the test's log, and calls the script's ``main(parse_args(...))`` directly. The child's pid is
+sent back immediately so that the test runner can sample its memory like any other child process, and its exit
+status and resource usage (see :mod:`accounting`) are sent back when it finishes.
+
+The zygote is run as a script by :class:`PypeItZygote`, and so this module only uses the standard library.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import signal
+import socket
+import selectors
+import subprocess
+import tempfile
+import shutil
+import traceback
+import importlib
+import faulthandler
+
+try:
+    from .accounting import ResourceUsage, reap_child
+except ImportError:
+    # Run as a script, with this directory at the start of sys.path
+    from accounting import ResourceUsage, reap_child
+
+
+class PypeItZygote(object):
+    """Starts and stops the zygote process, and starts tests in children forked from it.
+
+    Attributes:
+        preload (sequence):    The modules the zygote imports before forking any children.
+        scripts (dict):        Maps the names of the commands the zygote can run to the "module:Class" of their
+                               PypeIt script class. If None, this is found from the console script entry points
+                               of the pypeit package.
+        commands (set):        The names of the commands the zygote can run, available after :meth:`start`.
+
+        _tmp_dir (str):        Temporary directory holding the zygote's socket.
+        _socket_path (str):    The path of the unix socket the zygote listens on.
+        _process (:obj:`subprocess.Popen`): The zygote process.
+    """
+
+    def __init__(self, preload=('pypeit.scripts',), scripts=None):
+        self.preload = preload
+        self.scripts = scripts
+        self.commands = set()
+        self._tmp_dir = None
+        self._socket_path = None
+        self._process = None
+
+    def start(self):
+        """Start the zygote process and wait for it to finish importing the preloaded modules.
+
+        Raises:
+            RuntimeError: If the zygote failed to start, for example because a preloaded module couldn't be imported.
+        """
+        self._tmp_dir = tempfile.mkdtemp(prefix='pypeit_zygote_')
+        self._socket_path = os.path.join(self._tmp_dir, 'zygote.sock')
+        config = {'socket': self._socket_path, 'preload': self.preload, 'scripts': self.scripts}
+
+        # The zygote exits when its stdin is closed, so that it doesn't outlive the test runner
+        self._process = subprocess.Popen([sys.executable, os.path.abspath(__file__), json.dumps(config)],
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        ready = self._process.stdout.readline()
+        if ready == '':
+            self.stop()
+            raise RuntimeError("The PypeIt zygote process failed to start.")
+        self.commands = set(json.loads(ready)['commands'])
+
+    def stop(self):
+        """Stop the zygote process. Any children still running are terminated."""
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def can_run(self, command_line):
+        """Return whether the zygote can run a command line.
+
+        Args:
+            command_line (list of str): The command and its arguments.
+        """
+        return len(command_line) > 0 and command_line[0] in self.commands
+
+    async def start_child(self, command_line, logfile, env, cwd):
+        """Start a command in a child forked from the zygote.
+
+        Args:
+            command_line (list of str): The command and its arguments.
+            logfile (str):              The file the child's stdout and stderr are appended to.
+            env (:obj:`Mapping`):       The environment of the child.
+            cwd (str):                  The working directory of the child.
+
+        Returns:
+            :obj:`ZygoteChild`: The child process.
+        """
+        return await ZygoteChild.start(self._socket_path, command_line, logfile, env, cwd)
+
+
+class ZygoteChild(object):
+    """A child process forked from the zygote.
+
+    This has the parts of the :obj:`asyncio.subprocess.Process` interface used by :meth:`PypeItTest.run_child`, so
+    that it can be used in its place.
+
+    Attributes:
+        args (list of str):  The command and its arguments.
+        pid (int):           The process id of the child.
+        returncode (int):    The exit code of the child, or None if it's still running. As with
+                             :obj:`asyncio.subprocess.Process` this is the negative signal number if the child was
+                             killed by a signal.
+        usage (:obj:`ResourceUsage`): The resources used by the child, once it has finished.
+        _reader (:obj:`asyncio.StreamReader`): Connection to the zygote, which sends the exit code when the child
+                                               finishes.
+        _writer (:obj:`asyncio.StreamWriter`): The sending side of the connection to the zygote.
+    """
+
+    def __init__(self, command_line, pid, reader, writer):
+        self.args = command_line
+        self.pid = pid
+        self.returncode = None
+        self.usage = None
+        self._reader = reader
+        self._writer = writer
+
+    @classmethod
+    async def start(cls, socket_path, command_line, logfile, env, cwd):
+        """Ask the zygote to fork a child to run a command. See :meth:`PypeItZygote.start_child`."""
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        request = {'command': list(command_line), 'logfile': os.path.abspath(logfile), 'env': dict(env), 'cwd': cwd}
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        child = cls(command_line, None, reader, writer)
+        child.pid = (await child._read_message())['pid']
+        return child
+
+    async def _read_message(self):
+        """Read the next message from the zygote."""
+        line = await self._reader.readline()
+        if line == b'':
+            self._writer.close()
+            raise RuntimeError("Lost the connection to the PypeIt zygote process.")
+        return json.loads(line)
+
+    async def wait(self):
+        """Wait for the child to finish and return its exit code."""
+        if self.returncode is None:
+            message = await self._read_message()
+            self.usage = ResourceUsage.from_dict(message.get('usage'))
+            self.returncode = message['returncode']
+            self._writer.close()
+        return self.returncode
+
+    def send_signal(self, sig):
+        """Send a signal to the child if it's still running."""
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        """Terminate the child."""
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        """Kill the child."""
+        self.send_signal(signal.SIGKILL)
+
+
+def _find_scripts():
+    """Return a dict mapping the console scripts of the pypeit package to the "module:Class" of their script class."""
+    from importlib.metadata import distribution
+    scripts = dict()
+    for entry_point in distribution('pypeit').entry_points:
+        if entry_point.group == 'console_scripts' and entry_point.value.endswith('.entry_point'):
+            scripts[entry_point.name] = entry_point.value[:-len('.entry_point')]
+    return scripts
+
+
+def _load_script(value):
+    """Return the script class for a "module:Class" string."""
+    module_name, class_name = value.split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _run_child(request, script_class):
+    """Run a script in a newly forked child of the zygote. This never returns."""
+    returncode = 1
+    try:
+        fd = os.open(request['logfile'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null_fd, 0)
+        os.close(null_fd)
+
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        sys.argv = request['command']
+        if os.environ.get('PYTHONFAULTHANDLER'):
+            # As the interpreter would for a new process, so that a hung child's stacks can be dumped to its log
+            faulthandler.enable(all_threads=True)
+
+        script_class.main(script_class.parse_args(request['command'][1:]))
+        returncode = 0
+    except SystemExit as e:
+        # Follow the exit code conventions of the python interpreter
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            returncode = 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(returncode)
+
+
+def _serve(config):
+    """Run the zygote: preload modules, then fork a child for each request until stdin is closed."""
+    for module in config['preload']:
+        importlib.import_module(module)
+    scripts = config['scripts'] if config['scripts'] is not None else _find_scripts()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(config['socket'])
+    server.listen(64)
+
+    print(json.dumps({'commands': sorted(scripts)}), flush=True)
+
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    selector.register(sys.stdin, selectors.EVENT_READ)
+    children = dict()
+    running = True
+
+    while running:
+        for key, events in selector.select(timeout=0.2):
+            if key.fileobj is sys.stdin:
+                # The test runner closed our stdin, or exited
+                running = False
+            else:
+                connection, address = server.accept()
+                try:
+                    with connection.makefile('rb') as f:
+                        request = json.loads(f.readline())
+                    script_class = _load_script(scripts[request['command'][0]])
+                except Exception:
+                    traceback.print_exc()
+                    connection.close()
+                    continue
+
+                pid = os.fork()
+                if pid == 0:
+                    server.close()
+                    connection.close()
+                    for other in children.values():
+                        other.close()
+                    _run_child(request, script_class)
+
+                connection.sendall(json.dumps({'pid': pid}).encode() + b'\n')
+                children[pid] = connection
+
+        # Report the exit code and resource usage of any children that have finished
+        while len(children) > 0:
+            reaped = reap_child(block=False)
+            if reaped is None:
+                break
+            pid, returncode, usage = reaped
+            connection = children.pop(pid)
+            try:
+                message = {'returncode': returncode, 'usage': usage.to_dict()}
+                connection.sendall(json.dumps(message).encode() + b'\n')
+            except OSError:
+                pass
+            connection.close()
+
+    for pid, connection in children.items():
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        connection.close()
+    server.close()
+
+
+if __name__ == '__main__':
+    # Don't let the dev suite modules next to this script shadow modules imported by PypeIt
+    del sys.path[0]
+    _serve(json.loads(sys.argv[1]))
@@ -0,0 +1,24 @@
+# Local pytest plugin that isolates the unit tests from each other, so that they can
+# be run in parallel with pytest-xdist (e.g. "pytest -n 8 unit_tests"), and that only
+# runs the tests using the raw data of the instruments selected with "--setups"
+# (e.g. "pytest unit_tests --setups keck_nires"). The fixtures and helpers are shared
+# with the vet tests, in test_scripts/suite_plugin.py
+
+import os
+import sys
+
+# The dev suite's own modules
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_scripts"))
+from suite_plugin import isolated_cwd, data_output_lock, deselect, uses_selected_raw_data
+
+def pytest_addoption(parser):
+    parser.addoption("--setups", action="append", default=None, metavar="INSTR[/SETUP]",
+                     help="Only run the tests that use the raw data of these instruments, given as "
+                          "instrument names or dev-suite instr/setup keys. Tests that don't use "
+                          "the raw data of any instrument are always run. Can be given more than once.")
+
+def pytest_collection_modifyitems(config, items):
+    selected = config.getoption("--setups")
+    if selected is None:
+        return
+    deselect(config, items, lambda item: uses_selected_raw_data(item, selected))
@@ -1,14 +1,71 @@
 # Local pytest plugin to get the REDUX_OUT location from the pytest command line
-# using a "redux_out" fixture
+# using a "redux_out" fixture, to declare the test setups each vet test uses with
+# the "setups" marker, to only run the tests using the test setups selected with
+# "--setups" (e.g. "pytest vet_tests --setups keck_nires"), and to isolate the vet
+# tests from each other so that they can be run in parallel with pytest-xdist
+# (e.g. "pytest -n 8 vet_tests"). The fixtures and helpers shared with the unit tests
+# are in test_scripts/suite_plugin.py
 
 import pytest
-import os 
+import os
+import sys
+import shutil
+from pathlib import Path
+
+# The dev suite's own modules
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_scripts"))
+from suite_plugin import isolated_cwd, data_output_lock, deselect, uses_selected_raw_data
+
+def pytest_configure(config):
+    config.addinivalue_line("markers",
+                            "setups(*keys): the dev-suite test setups whose results the test uses, as "
+                            "instr/setup keys or instrument names for all of an instrument's setups. "
+                            "pypeit_test runs the test as soon as the tests of those setups have passed.")
 
 def pytest_addoption(parser):
-    parser.addoption("--redux_out", action="store", 
+    parser.addoption("--redux_out", action="store",
                      default=os.path.join(os.getenv('PYPEIT_DEV'), "REDUX_OUT"),
                      help="Location of dev-suite REDUX_OUT directory")
+    parser.addoption("--setups", action="append", default=None, metavar="INSTR[/SETUP]",
+                     help="Only run the tests that use the results of these dev-suite test setups, given "
+                          "as instr/setup keys or instrument names for all of an instrument's setups. "
+                          "Tests without a setups marker are run if they use the raw data of one of the "
+                          "instruments, or don't use any raw data. Can be given more than once.")
+
+def pytest_collection_modifyitems(config, items):
+    selected = config.getoption("--setups")
+    if selected is None:
+        return
+
+    def covered(key):
+        # An instrument name in a marker means all of the instrument's setups
+        return key in selected or key.split('/')[0] in selected
+
+    def relevant(item):
+        marker = item.get_closest_marker("setups")
+        if marker is not None:
+            return all(covered(key) for key in marker.args)
+        return uses_selected_raw_data(item, selected)
+
+    deselect(config, items, relevant)
 
 @pytest.fixture
 def redux_out(request):
-    return request.config.getoption("--redux_out")
\ No newline at end of file
+    return request.config.getoption("--redux_out")
+
+@pytest.fixture
+def redux_out_copy(redux_out, tmp_path):
+    """For tests that modify the results in REDUX_OUT. Returns a function that copies
+    directories of REDUX_OUT, given relative to it, to a temporary directory and
+    returns the location of that copy of REDUX_OUT, which the test uses instead"""
+    copy_root = tmp_path / 'REDUX_OUT'
+
+    def copy(*path):
+        dest = copy_root.joinpath(*path)
+        if not dest.exists():
+            shutil.copytree(Path(redux_out, *path), dest, symlinks=True)
+        return str(copy_root)
+
+    yield copy
+    # The copies can be large
+    shutil.rmtree(copy_root, ignore_errors=True)
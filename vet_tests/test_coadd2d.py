@@ -11,6 +11,7 @@ from pypeit import coadd2d
 from pypeit.spectrographs.util import load_spectrograph
 
 
+@pytest.mark.setups('keck_nires/ABBA_nostandard', 'keck_mosfire/long2pos1_H')
 def test_offsets_and_weights(redux_out):
 
     # echelle data
@@ -9,6 +9,7 @@ from astropy.table import Table
 
 from pypeit.specobjs import SpecObjs
 
+@pytest.mark.setups('keck_deimos/830G_M_8500')
 def test_collate_1d(redux_out):
 
     # Test that coadd files exist
@@ -22,6 +22,7 @@ import warnings
 warnings.simplefilter("ignore", UserWarning)
 
 
+@pytest.mark.setups('keck_kcwi/small_bh2_4200')
 def test_coadd_datacube(redux_out):
     """ Test the coaddition of spec2D files into datacubes """
     # Setup the dev path
@@ -162,6 +163,7 @@ def test_coadd_datacube(redux_out):
     os.remove(output1d_fileflux)
 
 
+@pytest.mark.setups('keck_kcwi/small_bh2_4200')
 def test_residuals(redux_out):
     """ Test the residuals of a spec2D DOMEFLAT file
     """
@@ -27,11 +27,13 @@ def chk_orders(instr, redux_out, det='DET01', max_bad:int=0):
         spec2d = spec2dobj.Spec2DObj.from_file(spec2d_file, det)
         assert np.sum(spec2d.slits.mask != 0) <= max_bad, f'Bad order(s) for {setup}'
 
+@pytest.mark.setups('vlt_xshooter')
 def test_vlt_xshooter_orders(redux_out):
     """ Confirm that all of the orders processed fine for each setup"""
     instr = 'vlt_xshooter'
     chk_orders(instr, redux_out)
 
+@pytest.mark.setups('magellan_mage')
 def test_magellan_mage_orders(redux_out):
     """ Confirm that all of the orders processed fine for each setup"""
     instr = 'magellan_mage'
@@ -45,18 +47,21 @@ def test_magellan_mage_orders(redux_out):
 #    # Some orders are rightly rejected
 #    chk_orders(instr, redux_out, det='MSC01', max_bad=3)
 
+@pytest.mark.setups('keck_nires')
 def test_keck_nires_orders(redux_out):
     """ Confirm that all of the orders processed fine for each setup"""
     instr = 'keck_nires'
 
     chk_orders(instr, redux_out)
 
+@pytest.mark.setups('gemini_gnirs_echelle')
 def test_gemini_gnirs_orders(redux_out):
     """ Confirm that all of the orders processed fine for each setup"""
     instr = 'gemini_gnirs_echelle'
 
     chk_orders(instr, redux_out)
 
+@pytest.mark.setups('magellan_fire')
 def test_magellan_fire_orders(redux_out):
     """ Confirm that all of the orders processed fine for each setup"""
     instr = 'magellan_fire'
@@ -15,6 +15,7 @@ from pypeit.spectrographs import util
 from pypeit import edgetrace
 from pypeit.core import trace
 
+@pytest.mark.setups('keck_lris_red/multi_400_8500_d560')
 def test_addrm_slit(redux_out):
     """ This tests the add and remove methods for user-supplied slit fussing. """
 
@@ -46,6 +47,7 @@ def test_addrm_slit(redux_out):
     assert edges.ntrace//2 == nslits, 'Did not remove trace.'
 
 
+@pytest.mark.setups('keck_lris_blue/long_600_4000_d560')
 def test_sobel_enhance(redux_out):
     """ This tests if the sobel enhance improves the edge detection. """
 
@@ -10,6 +10,7 @@ from pypeit.pypmsgs import PypeItError
 from pypeit.inputfiles import PypeItFile
 from pypeit import specobjs
 
+@pytest.mark.setups('bok_bc/300')
 def test_bok_bc_manual(redux_out):
     """ Checks that the manual extraction with FWHM is working for Bok BC"""
     instr = 'bok_bc' 
@@ -25,6 +26,7 @@ def test_bok_bc_manual(redux_out):
     assert np.isclose(hand_sobj.BOX_RADIUS[0], 4.)  # Value in the pypeit file
 
 
+@pytest.mark.setups('vlt_xshooter/VIS_manual')
 def test_ech_manual(redux_out):
     """ Checks that the manual extraction of VLT X-Shooter worked"""
     instr = 'vlt_xshooter' 
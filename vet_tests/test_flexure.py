@@ -9,6 +9,7 @@ from pypeit.tests.tstutils import data_output_path
 
 import pytest
 
+@pytest.mark.setups('keck_lris_red/multi_600_5000_d560')
 def test_spat_flexure(redux_out):
     # Check that spatial flexure shift was set!
     file_path = os.path.join(redux_out,
@@ -22,6 +23,7 @@ def test_spat_flexure(redux_out):
     assert spec2dObj.sci_spat_flexure > 0.
 
 
+@pytest.mark.setups('keck_deimos/830G_M_8500')
 def test_flex_multi(redux_out):
 
     # Set output file
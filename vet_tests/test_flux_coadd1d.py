@@ -1,6 +1,7 @@
 import os
 from pathlib import Path
 from configobj import ConfigObj
+import pytest
 
 import numpy as np
 
@@ -69,6 +70,9 @@ def run_flux_setup(input_paths, output_name):
 
     return flux_file, coadd1d_file, telluric_file
 
+@pytest.mark.setups(
+    'vlt_xshooter/VIS_2x1', 'vlt_xshooter/NIR', 'vlt_xshooter/VIS_1x1_Feige110',
+    'vlt_xshooter/NIR_Feige110')
 def test_flux_setup_vlt_xshooter(redux_out, monkeypatch):
 
     redux_out_path = Path(redux_out)
@@ -137,6 +141,9 @@ def test_flux_setup_vlt_xshooter(redux_out, monkeypatch):
         # Now test the coadding
         coadd(updated_coadd1d_filename, coadd_output_file)
 
+@pytest.mark.setups(
+    'vlt_xshooter/VIS_1x1_Feige110', 'vlt_xshooter/NIR_Feige110', 'vlt_xshooter/VIS_1x1_LTT3218',
+    'vlt_xshooter/NIR_LTT3218')
 def test_feige110_ltt3218(redux_out, monkeypatch):
 
     redux_out_path = Path(redux_out)
@@ -33,6 +33,7 @@ def kast_blue_files(request):
     return [std_file, sci_file]
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_sensfunc(kast_blue_files, request):
 
     sens_file = data_output_path('sensfunc.fits')
@@ -67,6 +68,7 @@ def test_sensfunc(kast_blue_files, request):
     assert np.all(np.isfinite(sensFunc.zeropoint))
     assert not np.any(sensFunc.wave < 0)
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_flux(kast_blue_files):
 
     # Validate fluxing information
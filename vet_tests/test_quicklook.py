@@ -3,6 +3,7 @@ Module to run tests on scripts
 """
 import os
 import glob
+import pytest
 from IPython import embed
 import numpy as np
 
@@ -11,6 +12,7 @@ from pypeit.inputfiles import PypeItFile
 from pypeit import specobjs
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_shane_kast_ql(redux_out):
     instr = 'shane_kast_blue' 
     outroot = os.path.join(redux_out, instr, '600_4310_d55')
@@ -47,6 +49,7 @@ def test_shane_kast_ql(redux_out):
             assert not np.isclose(sobjs.BOX_RADIUS[0], 4.651162790697675)
 
 
+@pytest.mark.setups('keck_deimos/600ZD_M_6500')
 def test_keck_deimos_ql(redux_out):
 
     instr = 'keck_deimos' 
@@ -83,6 +86,7 @@ def test_keck_deimos_ql(redux_out):
             assert np.all(sobjs.SLITID == [368,452])
             assert np.all(sobjs.MASKDEF_ID == [958474,958454])
 
+@pytest.mark.setups('keck_lris_red/long_600_7500_d560')
 def test_keck_lris_red_ql(redux_out):
 
     instr = 'keck_lris_red' 
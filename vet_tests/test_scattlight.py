@@ -57,6 +57,7 @@ def scattlight_resid(droot, par, tol=0.1):
     assert(stdval < tol)  # Check that the correction is better than 10%
 
 
+@pytest.mark.setups('keck_esi/Ech_1x1')
 def test_scattlight_keckesi(redux_out):
     """ Calculate the residuals of the scattered light subtraction for Keck ESI"""
     droot = os.path.join(redux_out,
@@ -72,6 +73,7 @@ def test_scattlight_keckesi(redux_out):
     scattlight_resid(droot, par, tol=0.1)
 
 
+@pytest.mark.setups('keck_kcwi/small_bh2_4200')
 def test_scattlight_keckkcwi(redux_out):
     """ Calculate the residuals of the scattered light subtraction for Keck/KCWI """
     droot = os.path.join(redux_out,
@@ -22,6 +22,7 @@ import json
 from pypeit.pypmsgs import PypeItError
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_show_1dspec(redux_out):
     spec_file = os.path.join(redux_out,
                              'shane_kast_blue', '600_4310_d55',
@@ -32,6 +33,7 @@ def test_show_1dspec(redux_out):
     scripts.show_1dspec.Show1DSpec.main(pargs)
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_show_2dspec(redux_out):
     droot = os.path.join(redux_out,
                              'shane_kast_blue', '600_4310_d55',
@@ -53,6 +55,7 @@ def test_show_2dspec(redux_out):
     os.chdir(cdir)
 
 
+@pytest.mark.setups('keck_lris_red/multi_400_8500_d560')
 def test_chk_edges(redux_out):
     mstrace_root = os.path.join(redux_out,
                                 'keck_lris_red', 
@@ -66,6 +69,7 @@ def test_chk_edges(redux_out):
     scripts.chk_edges.ChkEdges.main(pargs)
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_view_fits_list(redux_out):
     """ Test the list option
     """
@@ -77,6 +81,7 @@ def test_view_fits_list(redux_out):
     scripts.view_fits.ViewFits.main(pargs)
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_view_fits_proc_fail(redux_out):
     """ Test that it fails when trying to proc an output pypeit image
     """
@@ -90,6 +95,7 @@ def test_view_fits_proc_fail(redux_out):
         scripts.view_fits.ViewFits.main(pargs)
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_chk_flat(redux_out):
     droot = os.path.join(redux_out,
                              'shane_kast_blue', '600_4310_d55',
@@ -104,6 +110,7 @@ def test_chk_flat(redux_out):
     scripts.chk_flats.ChkFlats.main(pargs)
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_chk_wavecalib(redux_out):
     droot = os.path.join(redux_out,
                              'shane_kast_blue', '600_4310_d55',
@@ -116,6 +123,7 @@ def test_chk_wavecalib(redux_out):
     scripts.chk_wavecalib.ChkWaveCalib.main(pargs)
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_identify(redux_out):
     droot = os.path.join(redux_out, 'shane_kast_blue', '600_4310_d55', 'shane_kast_blue_A') 
     arc_file = os.path.join(droot, 'Calibrations',
@@ -166,6 +174,7 @@ def test_identify(redux_out):
     os.remove('wvcalib.fits')
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_compare_sky(redux_out):
     spec_file = os.path.join(redux_out,
                              'shane_kast_blue', '600_4310_d55',
@@ -183,6 +192,7 @@ def test_compare_sky(redux_out):
     scripts.compare_sky.CompareSky.main(pargs)
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55', 'keck_deimos/830G_M_8500')
 def test_collate_1d(tmp_path, monkeypatch, redux_out):
     kastb_dir = os.path.join(redux_out,
                              'shane_kast_blue', '600_4310_d55',
@@ -377,6 +387,7 @@ def test_collate_1d(tmp_path, monkeypatch, redux_out):
         assert scripts.collate_1d.Collate1D.main(parsed_args) == 0
         
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_parse_slits(redux_out):
     kastb_dir = os.path.join(redux_out,
                              'shane_kast_blue', '600_4310_d55',
@@ -395,6 +406,7 @@ def test_parse_slits(redux_out):
     scripts.parse_slits.ParseSlits.main(pargs)
 
 
+@pytest.mark.setups('gemini_gnirs_echelle/32_SB_SXD', 'keck_mosfire/mask1_K_with_continuum')
 def test_setup_coadd2d(redux_out):
 
     # Set the pypeit file
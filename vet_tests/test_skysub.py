@@ -4,6 +4,7 @@ Module to run test user-defined sky-subtraction regions
 from pathlib import Path
 import os
 import shutil
+import pytest
 
 from IPython import embed
 
@@ -18,8 +19,12 @@ from pypeit import pypeit
 from pypeit.core import skysub
 
 
-def test_skysub(redux_out):
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
+def test_skysub(redux_out_copy):
 
+    # The SkyRegions file is written and the standard reduced again in a copy of
+    # the results, so that other tests can still use the originals
+    redux_out = redux_out_copy('shane_kast_blue', '600_4310_d55', 'shane_kast_blue_A')
     redux_path = Path(redux_out).resolve() / 'shane_kast_blue' / '600_4310_d55' \
                     / 'shane_kast_blue_A'
 
@@ -31,7 +36,9 @@ def test_skysub(redux_out):
 
     # Set the name for the SkyRegions file
     calib_key, _ = CalibFrame.parse_key_dir(spec2DObj.calibs['EDGES'], from_filename=True)
-    regfile = SkyRegions.construct_file_name(calib_key, calib_dir=spec2DObj.head0['CALIBDIR'],
+    # The spec2d file points to the calibrations of the original results
+    calib_dir = redux_path / Path(spec2DObj.head0['CALIBDIR']).name
+    regfile = SkyRegions.construct_file_name(calib_key, calib_dir=calib_dir,
                                              basename=io.remove_suffix(spec2DObj.head0['FILENAME']))
     regfile = Path(regfile).resolve()
 
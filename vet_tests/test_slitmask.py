@@ -28,6 +28,7 @@ def flat_files(instr='keck_deimos'):
                     for ifile in ['m191015_0002.fits', 'm191015_0003.fits', 'm191015_0004.fits']]
 
 
+@pytest.mark.setups('keck_deimos/830G_M_8500', 'keck_mosfire/J_multi')
 def test_assign_maskinfo_add_missing(redux_out):
     instr_names = ['keck_deimos', 'keck_mosfire']
     for name in instr_names:
@@ -227,6 +228,7 @@ def test_deimosslitmask():
     assert spec.slitmask.nslits == 106, 'Incorrect number of slits read!'
 
 
+@pytest.mark.setups('keck_lris_blue/multi_600_4000_slitmask')
 def test_lris_blue_slitmask(redux_out):
     # Check that the LRIS slitmask was read in and used!
     file_path = os.path.join(redux_out,
@@ -242,6 +244,7 @@ def test_lris_blue_slitmask(redux_out):
     assert 'gal21' in specObjs.MASKDEF_OBJNAME
     assert 'gal49' in specObjs.MASKDEF_OBJNAME # This was "manually" extracted
 
+@pytest.mark.setups('keck_lris_red_mark4/multi_600_10000_slitmask')
 def test_lris_red_mark4_slitmask(redux_out):
     # Check that the LRIS slitmask was read in and used!
     file_path = os.path.join(redux_out,
@@ -258,6 +261,7 @@ def test_lris_red_mark4_slitmask(redux_out):
     assert 'gal124' in specObjs.MASKDEF_OBJNAME # Right-most slit
     assert 'FRBCoord' in specObjs.MASKDEF_OBJNAME # Forced extraction for faint source.
 
+@pytest.mark.setups('gemini_gmos/GS_HAM_B600_MOS')
 def test_gmos_slitmask(redux_out):
     # Check we have sensible RA, Dec
     file_path = os.path.join(redux_out,
@@ -276,6 +280,7 @@ def test_gmos_slitmask(redux_out):
     assert np.isclose(specObjs.RA[idx][0], 329.2278)
 
 
+@pytest.mark.setups('keck_deimos/600ZD_M_6500')
 def test_deimos_flipped_slitpa(redux_out):
 
     # This dataset has mask PA = -90 degrees and the slit PAs are some -90 and some 90 degrees.
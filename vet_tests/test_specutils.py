@@ -21,6 +21,7 @@ specutils_required = pytest.mark.skipif(Spectrum1D is None or SpectrumList is No
 
 
 @specutils_required
+@pytest.mark.setups('gemini_gnirs_echelle/32_SB_SXD')
 def test_identify_as_pypeit_file(redux_out):
     rdx = Path(redux_out).resolve()
 
@@ -79,6 +80,7 @@ def test_identify_as_pypeit_file(redux_out):
 
 
 @specutils_required
+@pytest.mark.setups('shane_kast_blue/600_4310_d55', 'gemini_gnirs_echelle/32_SB_SXD')
 def test_identify_as_spec1d_file(redux_out):
     rdx = Path(redux_out).resolve()
 
@@ -105,6 +107,7 @@ def test_identify_as_spec1d_file(redux_out):
 
 
 @specutils_required
+@pytest.mark.setups('shane_kast_blue/600_4310_d55', 'gemini_gnirs_echelle/32_SB_SXD')
 def test_identify_as_onespec_file(redux_out):
     rdx = Path(redux_out).resolve()
 
@@ -130,6 +133,7 @@ def test_identify_as_onespec_file(redux_out):
 
 # TODO: Break some of these out into separate tests?
 @specutils_required
+@pytest.mark.setups('shane_kast_blue/600_4310_d55', 'gemini_gnirs_echelle/32_SB_SXD')
 def test_load_spec1d(redux_out):
     rdx = Path(redux_out).resolve()
 
@@ -168,6 +172,7 @@ def test_load_spec1d(redux_out):
 
 
 @specutils_required
+@pytest.mark.setups('shane_kast_blue/600_4310_d55', 'gemini_gnirs_echelle/32_SB_SXD')
 def test_load_onespec(redux_out):
     rdx = Path(redux_out).resolve()
 
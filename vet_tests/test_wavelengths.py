@@ -1,5 +1,4 @@
 import os, sys
-import shutil
 import numpy as np
 from pathlib import Path
 
@@ -17,6 +16,8 @@ sys.path.append(os.path.join(
 import pypeit_tests
 
 
+@pytest.mark.setups(
+    'shane_kast_red/300_7500_Ne', 'shane_kast_red/600_7500_d57', 'shane_kast_red/1200_5000_d57')
 def test_shane_kast_red(redux_out):
 
     for setup, setupID, index, rms in zip(
@@ -35,6 +36,10 @@ def test_shane_kast_red(redux_out):
         waveCalib = WaveCalib.from_file(file_path)
         assert waveCalib.wv_fits[index].rms < rms, f'RMS of shane_kast_red {setup} is too high!'
 
+@pytest.mark.setups(
+    'not_alfosc/grism3', 'not_alfosc/grism4_nobin', 'not_alfosc/grism5', 'not_alfosc/grism7',
+    'not_alfosc/grism10', 'not_alfosc/grism11', 'not_alfosc/grism17', 'not_alfosc/grism18',
+    'not_alfosc/grism19', 'not_alfosc/grism20')
 def test_not_alfosc(redux_out):
 
     for setup, rms in zip(
@@ -53,6 +58,8 @@ def test_not_alfosc(redux_out):
         waveCalib = WaveCalib.from_file(file_path)
         assert waveCalib.wv_fits[index].rms < rms, f'RMS of not_alfosc {setup} is too high!'
 
+@pytest.mark.setups(
+    'keck_deimos/1200B_LVM_5200', 'keck_deimos/600ZD_M_6500', 'keck_deimos/900ZD_LVM_5500')
 def test_deimos(redux_out):
 
     for setup, index, rms, mosaic in zip(
@@ -72,6 +79,7 @@ def test_deimos(redux_out):
         waveCalib = WaveCalib.from_file(file_path)
         assert waveCalib.wv_fits[index].rms < rms, f'RMS of keck_deimos {setup} is too high!'
 
+@pytest.mark.setups('mdm_modspec/Echelle')
 def test_mdm_modspec(redux_out):
 
     for setup, rms in zip(
@@ -90,15 +98,21 @@ def test_mdm_modspec(redux_out):
         waveCalib = WaveCalib.from_file(file_path)
         assert waveCalib.wv_fits[index].rms < rms, f'RMS of mdm_modspec {setup} is too high!'
 
-def test_redoslits_kastr(redux_out):
+@pytest.mark.setups('shane_kast_red/600_5000_d46')
+def test_redoslits_kastr(redux_out_copy):
     """ Test the redo_slits option using shane_kast_red
 
     Args:
-        redux_out (str): path to REDUX_OUT
+        redux_out_copy (function): copies directories of REDUX_OUT, which this
+            test modifies
     """
 
     setup = '600_5000_d46'
 
+    # The slits are modified and the setup is reduced again, in a copy of its
+    # results so that other tests can still use the originals
+    redux_out = redux_out_copy('shane_kast_red', setup)
+
     rdx_dir = os.path.join(redux_out,
                              'shane_kast_red',
                              setup)
@@ -106,10 +120,6 @@ def test_redoslits_kastr(redux_out):
     slit_file = os.path.join(rdx_dir,
                              'Calibrations',
                              'Slits_A_0_DET01.fits.gz')
-    # Copy the original
-    orig_slit_file = slit_file.replace('.fits.gz', '_orig.fits.gz')
-    shutil.copyfile(slit_file, orig_slit_file)
-
     # Modify
     slits = SlitTraceSet.from_file(slit_file)
     slits.mask[0] = slits.bitmask.turn_on(slits.mask[0], 'BADWVCALIB')
@@ -142,12 +152,12 @@ def test_redoslits_kastr(redux_out):
     slits2 = SlitTraceSet.from_file(slit_file)
     assert slits2.mask[0] == 0, 'Slit was not fixed!'
 
-    # Copy back
-    shutil.copyfile(orig_slit_file, slit_file)
-
     os.chdir(sv_cd)
 
 
+@pytest.mark.setups(
+    'keck_lris_blue/multi_300_5000_d680', 'keck_lris_blue/long_400_3400_d560',
+    'keck_lris_blue/long_600_4000_d560')
 def test_keck_lris_blue(redux_out):
 
     _redux_out = Path(redux_out).resolve()
@@ -168,6 +178,7 @@ def test_keck_lris_blue(redux_out):
         assert np.all(rms_vals <= rms), f'wave RMS for setup {setup} is too high!'
 
 
+@pytest.mark.setups('keck_lris_blue_orig')
 def test_keck_lris_blue_orig(redux_out):
 
     _redux_out = Path(redux_out).resolve()
@@ -188,6 +199,12 @@ def test_keck_lris_blue_orig(redux_out):
         assert np.all(rms_vals <= rms), f'wave RMS for setup {setup} is too high!'
 
 
+@pytest.mark.setups(
+    'keck_lris_red/long_150_7500_d560', 'keck_lris_red/long_300_5000_d560',
+    'keck_lris_red/long_400_8500_longread', 'keck_lris_red/multi_600_5000_d560',
+    'keck_lris_red/long_600_7500_d560', 'keck_lris_red/long_600_10000_d680',
+    'keck_lris_red/mulit_831_8200_d560', 'keck_lris_red/multi_900_5500_d560',
+    'keck_lris_red/long_1200_7500_d560', 'keck_lris_red/multi_1200_9000_d680')
 def test_keck_lris_red(redux_out):
 
     _redux_out = Path(redux_out).resolve()
@@ -211,6 +228,7 @@ def test_keck_lris_red(redux_out):
         assert np.all(rms_vals <= rms), f'wave RMS for setup {setup} is too high!'
 
 
+@pytest.mark.setups('keck_lris_red_orig')
 def test_keck_lris_red_orig(redux_out):
 
     _redux_out = Path(redux_out).resolve()
@@ -232,6 +250,8 @@ def test_keck_lris_red_orig(redux_out):
         assert np.all(rms_vals <= rms), f'wave RMS for setup {setup} is too high!'
 
 
+@pytest.mark.setups(
+    'keck_lris_red_mark4/long_400_8500_d560', 'keck_lris_red_mark4/long_600_10000_d680')
 def test_keck_lris_red_mark4(redux_out):
 
     _redux_out = Path(redux_out).resolve()
@@ -251,6 +271,16 @@ def test_keck_lris_red_mark4(redux_out):
         assert np.all(rms_vals <= rms), f'wave RMS for setup {setup} is too high!'
 
 
+@pytest.mark.setups(
+    'keck_hires/J0100+2802_H204Hr_RED_C1_ECH_-0.82_XD_1.62_1x2',
+    'keck_hires/J0100+2802_H204Hr_RED_C1_ECH_0.75_XD_1.69_1x2',
+    'keck_hires/J0100+2802_H237Hr_RED_C1_ECH_-0.91_XD_1.46_1x2',
+    'keck_hires/J0100+2802_H237Hr_RED_C1_ECH_0.88_XD_1.46_1x2',
+    'keck_hires/J0100+2802_N255Hr_RED_C2_ECH_0.74_XD_1.39_1x3',
+    'keck_hires/J0306+1853_U074_RED_C2_ECH_-0.86_XD_1.31_1x3',
+    'keck_hires/J0306+1853_U074_RED_C2_ECH_0.72_XD_1.42_1x3',
+    'keck_hires/J1723+2243_W241_RED_C5_ECH_-0.15_XD_0.90_2x2',
+    'keck_hires/Q1009+2956_G10H_BLUE_C5_ECH_-0.00_XD_1.02_1x3')
 def test_keck_hires(redux_out):
 
     _redux_out = Path(redux_out).resolve()
@@ -285,6 +315,7 @@ def test_keck_hires(redux_out):
         assert np.all(rms_vals <= rms), f'wave RMS for setup {setup} is too high!'
 
 
+@pytest.mark.setups('gemini_gmos/GS_HAM_B480_550')
 def test_gmos(redux_out):
 
     for setup, index, rms, mosaic in zip(
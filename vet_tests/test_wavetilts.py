@@ -28,6 +28,7 @@ instant_dict = dict(coeffs=np.ones((6,4,1)),
                     func2d='legendre2d')
 
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_instantiate_from_master(redux_out):
     master_file = os.path.join(redux_out, kastb_dir, 'Calibrations',
                                'Tilts_A_0_DET01.fits')
@@ -40,6 +41,7 @@ def test_instantiate_from_master(redux_out):
 
 
 # Test rebuild tilts with a flexure offset
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_flexure(redux_out):
     flexure = 1.
     master_file = os.path.join(redux_out, kastb_dir, 'Calibrations',
@@ -54,6 +56,7 @@ def test_flexure(redux_out):
     new_tilts = waveTilts.fit2tiltimg(slitmask, flexure=flexure)
     # Test?
 
+@pytest.mark.setups('shane_kast_blue/600_4310_d55')
 def test_run(redux_out):
     # Masters
     spectrograph = load_spectrograph('shane_kast_blue')